@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Lettura delle opzioni dell'addon.
+Home Assistant scrive la configurazione dell'addon in /data/options.json.
+"""
+
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Percorso standard delle opzioni addon (sovrascrivibile per test/benchmark)
+OPTIONS_PATH = os.environ.get("ADDON_OPTIONS_PATH", "/data/options.json")
+
+_options: Optional[Dict[str, Any]] = None
+
+
+def load_options(path: str = OPTIONS_PATH) -> Dict[str, Any]:
+    """
+    Carica le opzioni dell'addon.
+    
+    Args:
+        path: Percorso del file options.json
+    
+    Returns:
+        Dizionario delle opzioni (vuoto se il file non esiste)
+    """
+    global _options
+    if _options is None:
+        try:
+            with open(path, encoding="utf-8") as f:
+                _options = json.load(f)
+        except FileNotFoundError:
+            logger.warning(f"File opzioni {path} non trovato, uso valori di default")
+            _options = {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Impossibile leggere le opzioni da {path}: {e}")
+            _options = {}
+    return _options
+
+
+def get_option(name: str, default: Any = None) -> Any:
+    """
+    Restituisce una singola opzione dell'addon.
+    
+    Args:
+        name: Nome dell'opzione (come in config.yaml)
+        default: Valore restituito se l'opzione non è impostata
+    
+    Returns:
+        Valore dell'opzione o default
+    """
+    value = load_options().get(name)
+    return default if value is None else value
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Server ASGI di produzione per l'API Flask.
+
+L'app Flask viene servita da uvicorn tramite a2wsgi con due pool di
+thread separati: uno per le generazioni LLM (lunghe, fino a minuti) e
+uno per tutti gli altri endpoint. Così health, entità e storia delle
+conversazioni restano reattivi anche con diverse generazioni in corso.
+
+Le richieste LLM passano un controllo di ammissione prima di occupare un
+thread: con coda LLM piena o thread esauriti ricevono subito 429, invece
+di attendere senza limite nella coda interna del pool.
+"""
+
+import json
+import logging
+import re
+from typing import Callable, Iterable, Optional, Pattern
+
+import uvicorn
+from a2wsgi import WSGIMiddleware
+
+from llm_scheduler import AdmissionError
+
+logger = logging.getLogger(__name__)
+
+# Endpoint che attendono una generazione di llama-server
+LLM_PATHS = (
+    r"^/api/chat$",
+    r"^/api/chat/batch$",
+    r"^/api/conversation/[^/]+/message$",
+)
+
+
+class SplitPoolApp:
+    """
+    App ASGI che smista le richieste su due pool di thread WSGI.
+
+    Entrambi i pool servono la stessa app Flask; cambia solo il gruppo
+    di thread che esegue la richiesta.
+    """
+
+    def __init__(
+        self,
+        wsgi_app,
+        api_workers: int = 8,
+        llm_workers: int = 4,
+        llm_paths: Iterable[str] = LLM_PATHS,
+        admission: Optional[Callable[[bool], None]] = None
+    ):
+        """
+        Inizializza l'app.
+
+        Args:
+            wsgi_app: Applicazione WSGI (Flask)
+            api_workers: Thread per gli endpoint rapidi
+            llm_workers: Thread per gli endpoint che attendono il LLM
+            llm_paths: Regex dei path da eseguire nel pool LLM
+            admission: Controllo prima di accodare una richiesta LLM; riceve
+                True se tutti i thread LLM sono occupati e solleva
+                `AdmissionError` per rifiutarla
+        """
+        self.api = WSGIMiddleware(wsgi_app, workers=api_workers)
+        self.llm = WSGIMiddleware(wsgi_app, workers=llm_workers)
+        self.llm_paths: Pattern = re.compile("|".join(llm_paths))
+        self.llm_workers = llm_workers
+        self.admission = admission
+        # Richieste LLM in esecuzione o in attesa di un thread (solo event loop)
+        self.llm_active = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            # Nessuna risorsa async da inizializzare: conferma e basta
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if not self.llm_paths.match(scope.get("path", "")):
+            await self.api(scope, receive, send)
+            return
+
+        if self.admission is not None and scope["type"] == "http" and scope.get("method") == "POST":
+            try:
+                self.admission(self.llm_active >= self.llm_workers)
+            except AdmissionError as e:
+                await _reject(send, e)
+                return
+        self.llm_active += 1
+        try:
+            await self.llm(scope, receive, send)
+        finally:
+            self.llm_active -= 1
+
+
+async def _reject(send, error: AdmissionError):
+    """Risposta di rifiuto inviata senza passare dall'app Flask."""
+    body = json.dumps({"error": str(error)}, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": error.status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(error.retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def serve(
+    wsgi_app,
+    host: str = "0.0.0.0",
+    port: int = 5000,
+    api_workers: int = 8,
+    llm_workers: int = 4,
+    log_level: str = "warning",
+    admission: Optional[Callable[[bool], None]] = None
+):
+    """
+    Avvia uvicorn (bloccante).
+
+    Lo stato del servizio (conversazioni, cache, mirror) vive nel
+    processo, quindi si usa un solo processo e la concorrenza è data
+    dai due pool di thread.
+
+    Args:
+        wsgi_app: Applicazione WSGI (Flask)
+        host: Indirizzo di ascolto
+        port: Porta di ascolto
+        api_workers: Thread per gli endpoint rapidi
+        llm_workers: Thread per gli endpoint che attendono il LLM
+        log_level: Livello di log di uvicorn
+        admission: Controllo di ammissione delle richieste LLM (vedi `SplitPoolApp`)
+    """
+    logger.info(
+        f"🚀 Avvio server ASGI (uvicorn) su {host}:{port} "
+        f"- thread API: {api_workers}, thread LLM: {llm_workers}"
+    )
+    uvicorn.run(
+        SplitPoolApp(wsgi_app, api_workers, llm_workers, admission=admission),
+        host=host,
+        port=port,
+        log_level=log_level,
+        # I log di uvicorn passano dal logging del servizio (coda e formato)
+        log_config=None,
+        access_log=False,
+        timeout_keep_alive=30,
+    )
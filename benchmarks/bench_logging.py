@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Costo dei log di `call_llama_api` per richiesta.
+
+Confronta il logging originale (banner e anteprime di ogni messaggio a
+livello INFO, f-string, handler sincrono su stdout bufferizzato per riga)
+con quello attuale (`log_setup`: livello da `log_level`, formattazione
+pigra, anteprime campionate, scrittura in coda a blocchi), con un
+contesto Home Assistant di alcuni KB.
+
+Misura il tempo CPU del thread della richiesta, il tempo CPU totale del
+processo (compreso il thread di scrittura) e le scritture su stdout.
+
+Uso (dalla cartella dell'add-on):
+    python benchmarks/bench_logging.py [richieste]
+"""
+
+import io
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from log_setup import PayloadSampler, log_llama_request, log_llama_response, setup_logging  # noqa: E402
+
+
+class CountingSink(io.RawIOBase):
+    """Destinazione che conta le scritture (una per syscall write)."""
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+        return len(data)
+
+
+def build_payload():
+    states = "\n".join(
+        f"- light.stanza_{i} (Luce stanza {i}): on brightness=180,color_temp_kelvin=3000"
+        for i in range(120)
+    )
+    messages = [
+        {"role": "system", "content": "Sei un assistente per Home Assistant.\n\nENTITÀ DISPONIBILI:\n" + states},
+        {"role": "user", "content": "STATO ATTUALE:\n" + states + "\n\nDOMANDA: Quali luci sono accese?"},
+    ]
+    payload = {"messages": messages, "temperature": 0.7, "max_tokens": 512, "stream": False}
+    result = {
+        "choices": [{"message": {"role": "assistant", "content": "Sono accese le luci " * 20}}],
+        "usage": {"prompt_tokens": 2900, "completion_tokens": 80},
+    }
+    return payload, result
+
+
+def legacy_request(logger, url, payload, result):
+    # Copia dei log di call_llama_api/_post_chat_completion prima della modifica
+    messages = payload["messages"]
+    logger.info("=" * 80)
+    logger.info("📤 CHIAMATA LLAMA API")
+    logger.info(f"URL: {url}")
+    logger.info(f"Temperature: {payload['temperature']}, Max tokens: {payload['max_tokens']}, Stream: False")
+    logger.info(f"Numero messaggi: {len(messages)}")
+    for idx, msg in enumerate(messages):
+        content_preview = str(msg.get('content', ''))[:200]
+        content_len = len(str(msg.get('content', '')))
+        logger.info(f"  [{idx}] role={msg.get('role')}, content_len={content_len}")
+        logger.info(f"       preview: {content_preview}{'...' if content_len > 200 else ''}")
+    logger.info("=" * 80)
+    logger.info(f"📥 RISPOSTA LLAMA: status={200}")
+    response_preview = result['choices'][0].get('message', {}).get('content', '')[:100]
+    logger.info(f"✅ Risposta OK: {response_preview}...")
+
+
+def current_request(logger, url, payload, result, sampler):
+    log_llama_request(logger, payload, stream=False, sampler=sampler)
+    log_llama_response(logger, 200, result, sampler=sampler)
+
+
+def run(label, setup, request, n):
+    sink = CountingSink()
+    logger = setup(sink)
+    payload, result = build_payload()
+    for _ in range(50):
+        request(logger, payload, result)
+
+    sink.writes = sink.bytes = 0
+    thread_started, process_started = time.thread_time(), time.process_time()
+    for _ in range(n):
+        request(logger, payload, result)
+    thread_cpu = time.thread_time() - thread_started
+    teardown = getattr(logger, "teardown", None)
+    if teardown:
+        teardown()
+    process_cpu = time.process_time() - process_started
+
+    print(
+        f"{label:<28} CPU richiesta {thread_cpu / n * 1e6:8.1f} µs   "
+        f"CPU totale {process_cpu / n * 1e6:8.1f} µs   "
+        f"write {sink.writes / n:6.2f}/richiesta   {sink.bytes / n:8.0f} byte/richiesta"
+    )
+
+
+def legacy_setup(sink):
+    stream = io.TextIOWrapper(io.BufferedWriter(sink), encoding="utf-8", line_buffering=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        stream=stream,
+        force=True
+    )
+    return logging.getLogger("bench")
+
+
+def current_setup(level, rate):
+    def setup(sink):
+        stream = io.TextIOWrapper(io.BufferedWriter(sink), encoding="utf-8")
+        writer = setup_logging(level, stream=stream)
+        logger = logging.getLogger("bench")
+        logger.teardown = writer.stop
+        logger.sampler = PayloadSampler(rate)
+        return logger
+    return setup
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    url = "http://localhost:8080/v1/chat/completions"
+    payload, _ = build_payload()
+    size = sum(len(m["content"]) for m in payload["messages"])
+    print(f"Richieste: {n}, contesto: {size / 1024:.1f} KB\n")
+
+    run("prima (INFO)", legacy_setup, lambda lg, p, r: legacy_request(lg, url, p, r), n)
+    for level, rate in (("info", 0.1), ("debug", 0.1), ("debug", 1.0)):
+        run(
+            f"dopo ({level}, campioni {rate:g})",
+            current_setup(level, rate),
+            lambda lg, p, r: current_request(lg, url, p, r, lg.sampler),
+            n
+        )
+
+
+if __name__ == "__main__":
+    main()
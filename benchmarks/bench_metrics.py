@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Costo dell'istrumentazione Prometheus per richiesta.
+
+Riproduce le osservazioni che una richiesta `/api/chat` registra
+(costruzione del contesto, /tokenize e chat verso llama-server, attesa
+in coda, usage/timings, durata della richiesta) e le confronta con lo
+stesso ciclo senza metriche.
+
+Uso (dalla cartella dell'add-on):
+    python benchmarks/bench_metrics.py [iterazioni]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import metrics  # noqa: E402
+
+RESULT = {
+    "usage": {"prompt_tokens": 912, "completion_tokens": 64},
+    "timings": {"prompt_n": 40, "prompt_ms": 310.5, "predicted_per_second": 18.2},
+}
+
+
+def instrumented_request():
+    with metrics.Timer(metrics.CONTEXT_BUILD.labels("cache").observe):
+        pass
+    metrics.observe_upstream("llama_tokenize", 0.004)
+    metrics.observe_queue_wait(0, 0.0)
+    metrics.observe_upstream("llama_chat", 2.1)
+    metrics.observe_completion(RESULT)
+    metrics.observe_request("/api/chat", "POST", 200, 2.2)
+
+
+def bare_request():
+    started = time.perf_counter()
+    time.perf_counter() - started
+
+
+def measure(func, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    measure(instrumented_request, 1000)  # riscaldamento (creazione delle label)
+
+    bare = measure(bare_request, iterations)
+    instrumented = measure(instrumented_request, iterations)
+    overhead = instrumented - bare
+
+    started = time.perf_counter()
+    payload = metrics.generate_latest_text()
+    scrape = time.perf_counter() - started
+
+    print(f"Iterazioni:               {iterations}")
+    print(f"Senza metriche:           {bare * 1e6:8.2f} µs/richiesta")
+    print(f"Con metriche:             {instrumented * 1e6:8.2f} µs/richiesta")
+    print(f"Costo istrumentazione:    {overhead * 1e6:8.2f} µs/richiesta")
+    print(f"Rispetto a 1 s di LLM:    {overhead * 100:8.4f} %")
+    print(f"Scrape /metrics:          {scrape * 1e3:8.2f} ms ({len(payload)} byte)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+llama-server finto per i benchmark: API OpenAI-compatible con latenze
+configurabili e nessun modello.
+
+Simula quanto basta per misurare il servizio e non il modello:
+- `n` slot paralleli (le richieste oltre gli slot aspettano);
+- valutazione del prompt a `prompt_tps` token/s, con cache del prefisso
+  per slot (solo i token non in cache vengono "valutati", come con
+  `cache_prompt`);
+- generazione a un token ogni `token_ms` millisecondi, in streaming SSE
+  o in un'unica risposta;
+- `usage` e `timings` nello stesso formato di llama-server;
+- caricamento del modello di `load_s` secondi (503 "Loading model").
+
+I token sono stimati come caratteri / 4.
+
+Uso standalone:
+    python benchmarks/fake_llama.py --port 8080 --slots 2 --token-ms 20
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+WORDS = (
+    "Ho controllato la casa: le luci del soggiorno sono accese, la temperatura "
+    "è di 21 gradi e tutte le porte risultano chiuse. Posso fare altro?"
+).split()
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class _Slot:
+    def __init__(self, slot_id: int):
+        self.id = slot_id
+        self.prompt = ""
+        self.busy = False
+
+
+class FakeLlamaServer:
+    """Server OpenAI-compatible con slot, cache del prefisso e latenze finte."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, slots: int = 1,
+                 token_ms: float = 20.0, prompt_tps: float = 2000.0, tokens: int = 32,
+                 model: str = "fake-model", load_s: float = 0.0):
+        """
+        Args:
+            host: Indirizzo di ascolto
+            port: Porta (0 = libera)
+            slots: Richieste generate in parallelo (`--parallel`)
+            token_ms: Millisecondi per token generato
+            prompt_tps: Token di prompt valutati al secondo
+            tokens: Token generati per risposta (limitati da max_tokens)
+            model: Nome restituito da /v1/models
+            load_s: Secondi di "caricamento del modello" dopo l'avvio
+        """
+        self.token_delay = token_ms / 1000.0
+        self.prompt_tps = prompt_tps
+        self.tokens = tokens
+        self.model = model
+        self.slots = [_Slot(i) for i in range(max(1, slots))]
+        self.cond = threading.Condition()
+        self.requests = 0
+        self.load_s = load_s
+        self.loaded_at: Optional[float] = None
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = f"http://{host}:{self.port}"
+
+    def start(self) -> "FakeLlamaServer":
+        self.loaded_at = time.monotonic() + self.load_s
+        threading.Thread(target=self.server.serve_forever, name="fake-llama", daemon=True).start()
+        return self
+
+    @property
+    def loading(self) -> bool:
+        return self.loaded_at is None or time.monotonic() < self.loaded_at
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _acquire(self, prompt: str, id_slot: Optional[int]) -> _Slot:
+        """Slot libero: quello richiesto o quello con il prefisso comune più lungo."""
+        with self.cond:
+            while True:
+                free = [s for s in self.slots if not s.busy]
+                if id_slot is not None and 0 <= id_slot < len(self.slots):
+                    free = [s for s in free if s.id == id_slot]
+                if free:
+                    slot = max(free, key=lambda s: _common_prefix(s.prompt, prompt))
+                    slot.busy = True
+                    self.requests += 1
+                    return slot
+                self.cond.wait()
+
+    def _release(self, slot: _Slot, prompt: str):
+        with self.cond:
+            slot.prompt = prompt
+            slot.busy = False
+            self.cond.notify_all()
+
+    def generate(self, payload: Dict[str, Any], emit) -> Dict[str, Any]:
+        """
+        Esegue una generazione finta.
+
+        Args:
+            payload: Corpo di /v1/chat/completions
+            emit: Callback chiamata con il testo di ogni token (None = non streaming)
+
+        Returns:
+            Testo, finish_reason, usage e timings
+        """
+        prompt = json.dumps(payload.get("messages", []), ensure_ascii=False)
+        slot = self._acquire(prompt, payload.get("id_slot"))
+        try:
+            prompt_tokens = _tokens(prompt)
+            cached = _tokens(prompt[:_common_prefix(slot.prompt, prompt)]) if payload.get("cache_prompt", True) else 0
+            evaluated = max(1, prompt_tokens - cached)
+            prompt_ms = evaluated / self.prompt_tps * 1000
+            time.sleep(prompt_ms / 1000)
+
+            # n_predict=0 valuta solo il prompt (riscaldamento dello slot)
+            limit = payload.get("n_predict", payload.get("max_tokens"))
+            count = self.tokens if limit is None or int(limit) < 0 else min(self.tokens, int(limit))
+            pieces = [WORDS[i % len(WORDS)] + " " for i in range(count)]
+            started = time.perf_counter()
+            for piece in pieces:
+                time.sleep(self.token_delay)
+                if emit is not None:
+                    emit(piece)
+            predicted_ms = (time.perf_counter() - started) * 1000
+        finally:
+            self._release(slot, prompt)
+
+        return {
+            "text": "".join(pieces).strip(),
+            "finish_reason": "length" if count < self.tokens else "stop",
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": count,
+                "total_tokens": prompt_tokens + count,
+            },
+            "timings": {
+                "cache_n": prompt_tokens - evaluated,
+                "prompt_n": evaluated,
+                "prompt_ms": prompt_ms,
+                "predicted_n": count,
+                "predicted_ms": predicted_ms,
+                "predicted_per_second": count / (predicted_ms / 1000) if predicted_ms else 0.0,
+            },
+        }
+
+    def _handler(self):
+        llama = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, payload: Any, status: int = 200):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self) -> Dict[str, Any]:
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+            def _loading(self):
+                self._json({"error": {"code": 503, "message": "Loading model", "type": "unavailable_error"}}, 503)
+
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if llama.loading:
+                    return self._loading()
+                if path == "/health":
+                    return self._json({"status": "ok"})
+                if path == "/v1/models":
+                    return self._json({"object": "list", "data": [{"id": llama.model, "object": "model"}]})
+                if path == "/slots":
+                    return self._json([{"id": s.id, "is_processing": s.busy} for s in llama.slots])
+                self._json({"error": {"message": "Not found"}}, 404)
+
+            def do_POST(self):
+                path = self.path.split("?", 1)[0]
+                payload = self._body()
+                if llama.loading:
+                    return self._loading()
+                if path == "/v1/chat/completions":
+                    if payload.get("stream"):
+                        return self._stream(payload)
+                    return self._complete(payload)
+                if path == "/tokenize":
+                    return self._json({"tokens": list(range(_tokens(payload.get("content", ""))))})
+                if path in ("/embedding", "/v1/embeddings"):
+                    return self._embeddings(payload)
+                self._json({"error": {"message": "Not found"}}, 404)
+
+            def _complete(self, payload: Dict[str, Any]):
+                result = llama.generate(payload, None)
+                self._json({
+                    "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": llama.model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": result["text"]},
+                        "finish_reason": result["finish_reason"],
+                    }],
+                    "usage": result["usage"],
+                    "timings": result["timings"],
+                })
+
+            def _stream(self, payload: Dict[str, Any]):
+                completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, **extra):
+                    event = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": llama.model,
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                    }
+                    event.update(extra)
+                    self._write(f"data: {json.dumps(event)}\n\n")
+
+                chunk({"role": "assistant", "content": ""})
+                result = llama.generate(payload, lambda piece: chunk({"content": piece}))
+                chunk({}, result["finish_reason"], timings=result["timings"])
+                if (payload.get("stream_options") or {}).get("include_usage"):
+                    self._write(
+                        "data: " + json.dumps({
+                            "id": completion_id, "object": "chat.completion.chunk",
+                            "choices": [], "usage": result["usage"],
+                        }) + "\n\n"
+                    )
+                self._write("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write(self, text: str):
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def _embeddings(self, payload: Dict[str, Any]):
+                inputs = payload.get("input", payload.get("content", ""))
+                if isinstance(inputs, str):
+                    inputs = [inputs]
+                data = [
+                    {"index": i, "object": "embedding", "embedding": _fake_embedding(text)}
+                    for i, text in enumerate(inputs)
+                ]
+                self._json({"object": "list", "data": data, "model": llama.model})
+
+        return Handler
+
+
+def _common_prefix(a: str, b: str) -> int:
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _fake_embedding(text: str, dim: int = 256) -> List[float]:
+    """Vettore deterministico dalle parole del testo (stesse parole → vicini)."""
+    vector = [0.0] * dim
+    for word in re.findall(r"\w+", text.lower()):
+        vector[zlib.crc32(word.encode("utf-8")) % dim] += 1.0
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="llama-server finto per i benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--slots", type=int, default=1, help="richieste in parallelo")
+    parser.add_argument("--token-ms", type=float, default=20.0, help="millisecondi per token generato")
+    parser.add_argument("--prompt-tps", type=float, default=2000.0, help="token di prompt al secondo")
+    parser.add_argument("--tokens", type=int, default=32, help="token generati per risposta")
+    parser.add_argument("--load-s", type=float, default=0.0, help="secondi di caricamento del modello")
+    args = parser.parse_args()
+
+    llama = FakeLlamaServer(
+        args.host, args.port, args.slots, args.token_ms, args.prompt_tps, args.tokens, load_s=args.load_s
+    ).start()
+    print(f"llama-server finto su {llama.url} ({args.slots} slot, {args.token_ms} ms/token)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        llama.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,668 @@
+#!/usr/bin/env python3
+"""
+Supervisor finto per i benchmark: REST e WebSocket API di Home Assistant
+con un'installazione sintetica di N entità.
+
+Espone gli endpoint usati dal servizio:
+- GET  /core/api/states, /core/api/states/<entity_id>
+- GET  /core/api/services, /core/api/config
+- GET  /core/api/history/period/<inizio> (storia sintetica e deterministica)
+- POST /core/api/services/<dominio>/<servizio> (cambia stato ed emette l'evento)
+- WS   /core/websocket (auth, subscribe_events, ping, registri di entità,
+  dispositivi e aree, recorder/statistics_during_period; eventi
+  state_changed casuali a `event_rate` al secondo)
+
+La storia è una funzione del tempo: temperatura e umidità sinusoidali
+giornaliere, potenza con picchi serali, contatori di energia crescenti,
+entità on/off che cambiano a intervalli di 15 minuti. Un campione ogni
+`history_step` secondi: una settimana di un sensore sono ~10000 righe.
+
+Solo libreria standard (WebSocket RFC 6455 minimale, senza estensioni).
+
+Uso standalone:
+    python benchmarks/fake_supervisor.py --entities 1000 --port 8124
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import socket
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, unquote
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+ROOMS = [
+    "Soggiorno", "Cucina", "Camera", "Cameretta", "Bagno", "Studio", "Ingresso",
+    "Corridoio", "Taverna", "Garage", "Giardino", "Terrazzo", "Lavanderia", "Ufficio",
+]
+
+# Dominio → (quota delle entità, generatore di stato e attributi)
+DOMAIN_MIX = [
+    ("light", 0.22), ("switch", 0.12), ("sensor", 0.30), ("binary_sensor", 0.14),
+    ("cover", 0.06), ("climate", 0.03), ("media_player", 0.03), ("scene", 0.04),
+    ("automation", 0.04), ("person", 0.02),
+]
+
+DOMAIN_NAMES = {
+    "light": "Luce", "switch": "Presa", "sensor": "Sensore", "binary_sensor": "Rilevatore",
+    "cover": "Tapparella", "climate": "Termostato", "media_player": "TV", "scene": "Scena",
+    "automation": "Automazione", "person": "Persona",
+}
+
+SERVICES = {
+    "light": {"turn_on": ["brightness_pct", "color_temp_kelvin"], "turn_off": [], "toggle": []},
+    "switch": {"turn_on": [], "turn_off": [], "toggle": []},
+    "cover": {"open_cover": [], "close_cover": [], "set_cover_position": ["position"]},
+    "climate": {"set_temperature": ["temperature"], "turn_on": [], "turn_off": []},
+    "media_player": {"turn_on": [], "turn_off": [], "volume_set": ["volume_level"]},
+    "scene": {"turn_on": []},
+    "automation": {"trigger": [], "turn_on": [], "turn_off": []},
+    "homeassistant": {"reload_all": []},
+}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def _parse_time(value: str) -> float:
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def _hash(*parts: Any) -> int:
+    return int(hashlib.md5("|".join(map(str, parts)).encode()).hexdigest()[:8], 16)
+
+
+def history_value(state: Dict[str, Any], timestamp: float) -> str:
+    """
+    Stato sintetico di un'entità in un istante (stessa entità, stesso valore).
+
+    Args:
+        state: Stato corrente (entity_id e device_class)
+        timestamp: Istante (secondi epoch)
+
+    Returns:
+        Stato come stringa, nel formato di HA
+    """
+    entity_id = state["entity_id"]
+    phase = _hash(entity_id) % 1000 / 1000.0
+    day = 2 * math.pi * (timestamp / 86400.0 + phase / 10)
+    kind = state["attributes"].get("device_class")
+    if entity_id.startswith("sensor."):
+        if kind == "energy":
+            # Integrale di una potenza tra 0.1 e 0.7 kW: sempre crescente
+            hours = (timestamp - 1.7e9) / 3600.0
+            kwh = 0.4 * hours - 0.3 * 24 / (2 * math.pi) * math.cos(day) + phase * 100
+            return f"{kwh:.3f}"
+        if kind == "power":
+            return f"{400 + 350 * math.sin(day) + _hash(entity_id, int(timestamp // 60)) % 100:.1f}"
+        if kind == "humidity":
+            return f"{50 + 12 * math.sin(day + 1):.1f}"
+        return f"{21 + 3 * math.sin(day - math.pi / 2) + phase:.2f}"
+    slot = int(timestamp // 900)
+    if entity_id.startswith("person."):
+        return "home" if _hash(entity_id, slot // 8) % 3 else "not_home"
+    if entity_id.startswith("cover."):
+        return "open" if _hash(entity_id, slot // 4) % 2 else "closed"
+    return "on" if _hash(entity_id, slot) % 3 == 0 else "off"
+
+
+def history_rows(state: Dict[str, Any], start: float, end: float, step: float) -> List[Dict[str, Any]]:
+    """
+    Risposta di `/api/history/period` per un'entità (formato `minimal_response`).
+
+    Il primo elemento è lo stato in vigore a `start`; i sensori hanno un
+    campione ogni `step` secondi, le altre entità solo i cambi di stato.
+    """
+    rows = [{"entity_id": state["entity_id"], "state": history_value(state, start), "last_changed": _iso(start)}]
+    sensor = state["entity_id"].startswith("sensor.")
+    interval = step if sensor else 900
+    t = (math.floor(start / interval) + 1) * interval
+    while t <= end:
+        value = history_value(state, t)
+        if sensor or value != rows[-1]["state"]:
+            rows.append({"state": value, "last_changed": _iso(t)})
+        t += interval
+    return rows
+
+
+def recorded_rows(rows: List[Dict[str, Any]], start: float, end: float) -> List[Dict[str, Any]]:
+    """Righe registrate nell'intervallo, con lo stato in vigore a `start` in testa."""
+    times = [_parse_time(row["last_changed"]) for row in rows]
+    before = [row for row, t in zip(rows, times) if t <= start]
+    result = [dict(before[-1], last_changed=_iso(start))] if before else []
+    return result + [row for row, t in zip(rows, times) if start < t <= end]
+
+
+def statistics_rows(
+    state: Dict[str, Any],
+    start: float,
+    end: float,
+    period: str,
+    types: List[str]
+) -> List[Dict[str, Any]]:
+    """Righe di `recorder/statistics_during_period` (start/end in millisecondi)."""
+    length = {"5minute": 300, "hour": 3600, "day": 86400, "week": 604800, "month": 2592000}[period]
+    rows = []
+    t = math.floor(start / length) * length
+    while t < end:
+        samples = [float(history_value(state, t + length * i / 12)) for i in range(13)]
+        row = {"start": int(t * 1000), "end": int((t + length) * 1000)}
+        values = {
+            "mean": sum(samples[:12]) / 12, "min": min(samples), "max": max(samples),
+            "state": samples[-1], "sum": samples[-1], "change": samples[-1] - samples[0],
+        }
+        row.update({name: round(values[name], 4) for name in types if name in values})
+        rows.append(row)
+        t += length
+    return rows
+
+
+def _random_state(domain: str, rng: random.Random) -> (str, Dict[str, Any]):
+    if domain == "light":
+        on = rng.random() < 0.4
+        return ("on" if on else "off"), ({"brightness": rng.randint(1, 255), "color_temp_kelvin": 3000} if on else {})
+    if domain in ("switch", "automation"):
+        return rng.choice(["on", "off"]), {}
+    if domain == "sensor":
+        kind = rng.choice(["temperature", "humidity", "power"])
+        unit = {"temperature": "°C", "humidity": "%", "power": "W"}[kind]
+        value = {"temperature": rng.uniform(15, 28), "humidity": rng.uniform(30, 70), "power": rng.uniform(0, 2500)}[kind]
+        return f"{value:.1f}", {"device_class": kind, "unit_of_measurement": unit, "state_class": "measurement"}
+    if domain == "binary_sensor":
+        return rng.choice(["on", "off"]), {"device_class": rng.choice(["motion", "door", "window"])}
+    if domain == "cover":
+        position = rng.choice([0, 50, 100])
+        return ("open" if position else "closed"), {"current_position": position, "device_class": "shutter"}
+    if domain == "climate":
+        return "heat", {"current_temperature": round(rng.uniform(17, 23), 1), "temperature": 21, "hvac_action": "idle"}
+    if domain == "media_player":
+        return rng.choice(["off", "playing", "paused"]), {"volume_level": 0.3}
+    if domain == "person":
+        return rng.choice(["home", "not_home"]), {}
+    return "scening", {}
+
+
+def synthetic_states(count: int, seed: int = 42) -> List[Dict[str, Any]]:
+    """
+    Stati sintetici ma realistici per `count` entità.
+
+    Args:
+        count: Numero di entità
+        seed: Seme per avere la stessa installazione a ogni esecuzione
+
+    Returns:
+        Lista di stati nel formato di `GET /api/states`
+    """
+    rng = random.Random(seed)
+    states = []
+    counters: Dict[str, int] = {}
+    for domain, share in DOMAIN_MIX:
+        for _ in range(max(1, round(count * share))):
+            if len(states) >= count:
+                break
+            index = counters[domain] = counters.get(domain, 0) + 1
+            room = ROOMS[index % len(ROOMS)]
+            suffix = "" if index <= len(ROOMS) else f" {index // len(ROOMS) + 1}"
+            name = f"{DOMAIN_NAMES[domain]} {room}{suffix}"
+            entity_id = f"{domain}.{name.lower().replace(' ', '_')}"
+            state, attributes = _random_state(domain, rng)
+            if attributes.get("device_class") == "power" and index % 4 == 0:
+                # Un sensore di potenza su quattro diventa un contatore di energia
+                name = name.replace("Sensore", "Energia")
+                entity_id = f"{domain}.{name.lower().replace(' ', '_')}"
+                attributes = {"device_class": "energy", "unit_of_measurement": "kWh", "state_class": "total_increasing"}
+                state = history_value({"entity_id": entity_id, "attributes": attributes}, time.time())
+            attributes["friendly_name"] = name
+            if domain == "automation":
+                attributes["id"] = f"benchmark_{index}"
+            timestamp = _now()
+            states.append({
+                "entity_id": entity_id,
+                "state": state,
+                "attributes": attributes,
+                "last_changed": timestamp,
+                "last_updated": timestamp,
+                "context": {"id": f"{len(states):026d}", "parent_id": None, "user_id": None},
+            })
+    return states
+
+
+def registries(states: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Registri di aree, dispositivi ed entità coerenti con gli stati sintetici.
+
+    Ogni entità fisica ha un dispositivo nell'area indicata dal nome
+    ("Luce Cucina 2" → cucina); scene, automazioni e persone non hanno area.
+    """
+    areas = [{"area_id": room.lower(), "name": room} for room in ROOMS]
+    devices, entities = [], []
+    for i, state in enumerate(states):
+        entity_id = state["entity_id"]
+        entry = {"entity_id": entity_id, "area_id": None, "device_id": None, "platform": "benchmark"}
+        if entity_id.split(".", 1)[0] not in ("scene", "automation", "person"):
+            room = state["attributes"]["friendly_name"].split()[1]
+            device_id = f"device_{i:05d}"
+            devices.append({"id": device_id, "area_id": room.lower(), "name": state["attributes"]["friendly_name"]})
+            entry["device_id"] = device_id
+        entities.append(entry)
+    return {
+        "config/area_registry/list": areas,
+        "config/device_registry/list": devices,
+        "config/entity_registry/list": entities,
+    }
+
+
+def service_catalog() -> List[Dict[str, Any]]:
+    catalog = []
+    for domain, services in SERVICES.items():
+        catalog.append({
+            "domain": domain,
+            "services": {
+                name: {
+                    "name": name.replace("_", " ").capitalize(),
+                    "description": f"{name} per {domain}",
+                    "fields": {
+                        field: {"description": field, "selector": {"number": {"min": 0, "max": 100}}}
+                        for field in fields
+                    },
+                    "target": {"entity": [{"domain": [domain]}]},
+                }
+                for name, fields in services.items()
+            },
+        })
+    return catalog
+
+
+class _WebSocket:
+    """Connessione WebSocket lato server (frame di testo, senza frammentazione)."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def recv(self) -> Optional[str]:
+        while True:
+            header = self._read(2)
+            if header is None:
+                return None
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack(">H", self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack(">Q", self._read(8))[0]
+            mask = self._read(4) if header[1] & 0x80 else b"\x00\x00\x00\x00"
+            payload = bytearray(self._read(length) or b"")
+            for i in range(len(payload)):
+                payload[i] ^= mask[i % 4]
+            if opcode == 0x8:
+                return None
+            if opcode == 0x9:
+                self._frame(0xA, bytes(payload))
+                continue
+            if opcode in (0x1, 0x2):
+                return payload.decode("utf-8")
+
+    def send(self, message: Dict[str, Any]):
+        self._frame(0x1, json.dumps(message).encode("utf-8"))
+
+    def _frame(self, opcode: int, payload: bytes):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(header + payload)
+            except OSError:
+                self.closed = True
+
+    def _read(self, size: int) -> Optional[bytes]:
+        data = b""
+        while len(data) < size:
+            try:
+                chunk = self.sock.recv(size - len(data))
+            except OSError:
+                chunk = b""
+            if not chunk:
+                self.closed = True
+                return None
+            data += chunk
+        return data
+
+
+class FakeSupervisor:
+    """Installazione HA sintetica servita via HTTP e WebSocket."""
+
+    def __init__(self, entities: int = 1000, host: str = "127.0.0.1", port: int = 0,
+                 event_rate: float = 2.0, latency_ms: float = 0.0, seed: int = 42,
+                 history_step: float = 60.0):
+        """
+        Args:
+            entities: Numero di entità sintetiche
+            host: Indirizzo di ascolto
+            port: Porta (0 = libera)
+            event_rate: Eventi state_changed al secondo verso i sottoscrittori
+            latency_ms: Latenza aggiunta a ogni risposta REST
+            seed: Seme dell'installazione
+            history_step: Secondi tra due campioni della storia dei sensori
+        """
+        self.states = {s["entity_id"]: s for s in synthetic_states(entities, seed)}
+        self.services = service_catalog()
+        self.registries = registries(list(self.states.values()))
+        self.event_rate = event_rate
+        self.latency = latency_ms / 1000.0
+        self.history_step = history_step
+        self.recorded: Dict[str, List[Dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+        self.subscribers: List[(_WebSocket, int, str)] = []
+        self.requests = 0
+        self.service_calls = 0
+        self.history_requests = 0
+        self.history_rows = 0
+        self.statistics_requests = 0
+        self._rng = random.Random(seed + 1)
+        self._stop = threading.Event()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = f"http://{host}:{self.port}"
+
+    def start(self) -> "FakeSupervisor":
+        threading.Thread(target=self.server.serve_forever, name="fake-supervisor", daemon=True).start()
+        if self.event_rate > 0:
+            threading.Thread(target=self._events, name="fake-supervisor-events", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.url}/core/api"
+
+    @property
+    def ws_url(self) -> str:
+        return f"ws://{self.url.split('://', 1)[1]}/core/websocket"
+
+    def set_state(self, entity_id: str, state: str, attributes: Optional[Dict[str, Any]] = None):
+        with self.lock:
+            old = self.states.get(entity_id)
+            if old is None:
+                return None
+            new = dict(old, state=state, attributes=dict(old["attributes"], **(attributes or {})))
+            new["last_changed"] = new["last_updated"] = _now()
+            self.states[entity_id] = new
+        self.emit("state_changed", {"entity_id": entity_id, "old_state": old, "new_state": new})
+        return new
+
+    def set_history(self, entity_id: str, points: Optional[List[tuple]]):
+        """
+        Storia registrata al posto di quella sintetica (es. un contatore azzerato).
+
+        Args:
+            entity_id: Entità
+            points: Lista di (timestamp, stato) in ordine di tempo; None
+                torna alla storia sintetica
+        """
+        with self.lock:
+            if points is None:
+                self.recorded.pop(entity_id, None)
+            else:
+                self.recorded[entity_id] = [
+                    {"state": str(state), "last_changed": _iso(t)} for t, state in points
+                ]
+
+    def register_service(self, domain: str, service: str, fields: Optional[List[str]] = None):
+        """Aggiunge (o ridefinisce) un servizio ed emette `service_registered`."""
+        with self.lock:
+            entry = next((e for e in self.services if e["domain"] == domain), None)
+            if entry is None:
+                entry = {"domain": domain, "services": {}}
+                self.services.append(entry)
+            entry["services"][service] = {
+                "name": service, "description": f"{service} per {domain}",
+                "fields": {field: {"description": field, "selector": {"text": {}}} for field in fields or []},
+            }
+        self.emit("service_registered", {"domain": domain, "service": service})
+
+    def remove_service(self, domain: str, service: str):
+        """Rimuove un servizio ed emette `service_removed`."""
+        with self.lock:
+            for entry in self.services:
+                if entry["domain"] == domain:
+                    entry["services"].pop(service, None)
+            self.services = [e for e in self.services if e["services"]]
+        self.emit("service_removed", {"domain": domain, "service": service})
+
+    def emit(self, event_type: str, data: Dict[str, Any]):
+        """Invia un evento ai sottoscrittori del suo tipo."""
+        event = {"event_type": event_type, "data": data, "origin": "LOCAL", "time_fired": _now()}
+        with self.lock:
+            subscribers = [(ws, sub) for ws, sub, kind in self.subscribers if kind in (event_type, "*")]
+        for ws, subscription in subscribers:
+            ws.send({"id": subscription, "type": "event", "event": event})
+
+    def _events(self):
+        entity_ids = [e for e in self.states if e.split(".", 1)[0] in ("sensor", "binary_sensor", "light")]
+        while not self._stop.wait(1.0 / self.event_rate):
+            entity_id = self._rng.choice(entity_ids)
+            domain = entity_id.split(".", 1)[0]
+            state, attributes = _random_state(domain, self._rng)
+            self.set_state(entity_id, state, attributes)
+
+    def call_service(self, domain: str, service: str, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        entity_ids = data.get("entity_id") or []
+        if isinstance(entity_ids, str):
+            entity_ids = [e.strip() for e in entity_ids.split(",") if e.strip()]
+        new_state = {"turn_on": "on", "turn_off": "off", "open_cover": "open", "close_cover": "closed"}.get(service)
+        changed = []
+        for entity_id in entity_ids:
+            if new_state is None:
+                continue
+            state = self.set_state(entity_id, new_state)
+            if state is not None:
+                changed.append(state)
+        with self.lock:
+            self.service_calls += 1
+        return changed
+
+    def history(self, entity_id: str, start: float, end: float) -> List[List[Dict[str, Any]]]:
+        with self.lock:
+            state = self.states.get(entity_id)
+            recorded = self.recorded.get(entity_id)
+            self.history_requests += 1
+        if state is None:
+            return []
+        if recorded is not None:
+            rows = recorded_rows(recorded, start, min(end, time.time()))
+        else:
+            rows = history_rows(state, start, min(end, time.time()), self.history_step)
+        with self.lock:
+            self.history_rows += len(rows)
+        return [rows]
+
+    def statistics(self, message: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+        start, end = _parse_time(message["start_time"]), _parse_time(message["end_time"])
+        result = {}
+        with self.lock:
+            self.statistics_requests += 1
+            states = [self.states.get(entity_id) for entity_id in message.get("statistic_ids", [])]
+        for state in states:
+            if state is not None and state["attributes"].get("state_class"):
+                result[state["entity_id"]] = statistics_rows(
+                    state, start, end, message.get("period", "hour"), message.get("types", ["mean"])
+                )
+        return result
+
+    def automation_config(self, automation_id: str) -> Optional[Dict[str, Any]]:
+        """Configurazione (come `/api/config/automation/config/<id>`) ricavata dal nome."""
+        with self.lock:
+            state = next((s for s in self.states.values() if s["attributes"].get("id") == automation_id), None)
+        if state is None:
+            return None
+        name = state["attributes"]["friendly_name"]
+        room = name.split()[1]
+        return {
+            "id": automation_id,
+            "alias": name,
+            "description": f"Accende le luci di {room} al tramonto se c'è qualcuno in casa",
+            "triggers": [{"trigger": "sun", "event": "sunset"}],
+            "conditions": [{"condition": "state", "entity_id": "person.persona_cucina", "state": "home"}],
+            "actions": [{"action": "light.turn_on", "target": {"area_id": room.lower()}}],
+        }
+
+    def _handler(self):
+        supervisor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, payload: Any, status: int = 200):
+                if supervisor.latency:
+                    time.sleep(supervisor.latency)
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with supervisor.lock:
+                    supervisor.requests += 1
+
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                if path == "/core/websocket":
+                    return self._websocket()
+                if path == "/core/api/states":
+                    with supervisor.lock:
+                        states = list(supervisor.states.values())
+                    return self._json(states)
+                if path.startswith("/core/api/states/"):
+                    with supervisor.lock:
+                        state = supervisor.states.get(path.rsplit("/", 1)[1])
+                    return self._json(state or {"message": "Entity not found."}, 200 if state else 404)
+                if path == "/core/api/services":
+                    with supervisor.lock:
+                        services = json.loads(json.dumps(supervisor.services))
+                    return self._json(services)
+                if path == "/core/api/config":
+                    return self._json({
+                        "location_name": "Casa Benchmark", "version": "2025.1.0",
+                        "time_zone": "Europe/Rome", "unit_system": {"temperature": "°C"},
+                    })
+                if path.startswith("/core/api/history/period/"):
+                    params = parse_qs(query)
+                    start = _parse_time(unquote(path.rsplit("/", 1)[1]))
+                    end = _parse_time(params["end_time"][0]) if "end_time" in params else start + 86400
+                    return self._json(supervisor.history(params.get("filter_entity_id", [""])[0], start, end))
+                if path.startswith("/core/api/config/automation/config/"):
+                    config = supervisor.automation_config(path.rsplit("/", 1)[1])
+                    return self._json(config or {"message": "Resource not found"}, 200 if config else 404)
+                if path == "/core/api/":
+                    return self._json({"message": "API running."})
+                self._json({"message": "Not found"}, 404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+                parts = self.path.split("?", 1)[0].strip("/").split("/")
+                if parts[:3] == ["core", "api", "services"] and len(parts) == 5:
+                    return self._json(supervisor.call_service(parts[3], parts[4], body))
+                self._json({"message": "Not found"}, 404)
+
+            def _websocket(self):
+                key = self.headers.get("Sec-WebSocket-Key", "")
+                accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+
+                ws = _WebSocket(self.connection)
+                ws.send({"type": "auth_required", "ha_version": "2025.1.0"})
+                try:
+                    while True:
+                        raw = ws.recv()
+                        if raw is None:
+                            break
+                        message = json.loads(raw)
+                        kind = message.get("type")
+                        if kind == "auth":
+                            ws.send({"type": "auth_ok", "ha_version": "2025.1.0"})
+                        elif kind == "subscribe_events":
+                            with supervisor.lock:
+                                supervisor.subscribers.append(
+                                    (ws, message["id"], message.get("event_type", "*"))
+                                )
+                            ws.send({"id": message["id"], "type": "result", "success": True, "result": None})
+                        elif kind == "ping":
+                            ws.send({"id": message.get("id"), "type": "pong"})
+                        elif kind == "recorder/statistics_during_period":
+                            ws.send({
+                                "id": message["id"], "type": "result", "success": True,
+                                "result": supervisor.statistics(message),
+                            })
+                        elif kind in supervisor.registries:
+                            ws.send({
+                                "id": message["id"], "type": "result", "success": True,
+                                "result": supervisor.registries[kind],
+                            })
+                        else:
+                            ws.send({"id": message.get("id"), "type": "result", "success": True, "result": None})
+                finally:
+                    ws.closed = True
+                    with supervisor.lock:
+                        supervisor.subscribers = [s for s in supervisor.subscribers if s[0] is not ws]
+                    self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Supervisor finto per i benchmark")
+    parser.add_argument("--entities", type=int, default=1000)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8124)
+    parser.add_argument("--event-rate", type=float, default=2.0, help="eventi state_changed al secondo")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latenza aggiunta alle risposte REST")
+    args = parser.parse_args()
+
+    supervisor = FakeSupervisor(args.entities, args.host, args.port, args.event_rate, args.latency_ms).start()
+    print(f"Supervisor finto su {supervisor.api_url} ({len(supervisor.states)} entità), WebSocket {supervisor.ws_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Test di carico del servizio contro llama-server e Supervisor finti.
+
+Per ogni dimensione dell'installazione (`--entities 100,1000,10000`):
+1. avvia `fake_supervisor` e `fake_llama` in questo processo;
+2. avvia `ha_service.py` come sottoprocesso, puntato ai finti tramite
+   variabili d'ambiente e con un options.json temporaneo;
+3. misura il tempo di avvio (fino a health ok e mirror degli stati pronto)
+   e la durata delle fasi riportate in `startup`;
+4. esegue gli scenari con `--concurrency` client in parallelo;
+5. raccoglie latenze (p50/p95/p99), throughput, errori, TTFT per lo
+   streaming, tempo di costruzione del contesto (da /metrics) e memoria
+   (VmRSS/VmHWM del sottoprocesso).
+
+Il risultato è un JSON (`--output`); con `--baseline` viene confrontato
+con un'esecuzione precedente e l'uscita è 1 se p95 o throughput
+peggiorano oltre `--tolerance`, per usarlo in CI.
+
+Scenari:
+    chat         POST /api/chat con contesto entità
+    chat_stream  POST /api/chat in streaming (misura anche il TTFT)
+    context      GET /api/ha/context?refresh=true (costruzione senza cache)
+    entities     GET /api/ha/entities
+    entity_query GET /api/ha/entities filtrato per dominio, con proiezione e pagina
+    history      GET /api/ha/history di una settimana (serie in cache dopo la prima lettura)
+    command      POST /api/chat con "tools" e un comando semplice (percorso rapido)
+
+Uso (dalla cartella dell'add-on):
+    python benchmarks/load_test.py --entities 100,1000,10000 --concurrency 8 \\
+        --requests 200 --output bench.json
+    python benchmarks/load_test.py --baseline bench.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_llama import FakeLlamaServer  # noqa: E402
+from fake_supervisor import FakeSupervisor  # noqa: E402
+
+SCENARIOS = ("chat", "chat_stream", "context", "entities", "entity_query", "history", "rag_search", "command")
+# rag_search attiva l'indice RAG (cambia il prompt di /api/chat): solo su richiesta
+DEFAULT_SCENARIOS = tuple(name for name in SCENARIOS if name != "rag_search")
+
+# Metriche confrontate con la baseline: (nome, True se più alto è meglio)
+COMPARED = (("p95_ms", False), ("throughput_rps", True))
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Percentile con interpolazione lineare (q tra 0 e 100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float, extra: Optional[Dict[str, List[float]]] = None) -> Dict[str, Any]:
+    """Statistiche di uno scenario (latenze in secondi → millisecondi)."""
+    ms = [value * 1000 for value in latencies]
+    result = {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else None,
+    }
+    for q in (50, 95, 99):
+        value = percentile(ms, q)
+        result[f"p{q}_ms"] = round(value, 2) if value is not None else None
+    for name, values in (extra or {}).items():
+        values = [value * 1000 for value in values]
+        for q in (50, 95):
+            value = percentile(values, q)
+            result[f"{name}_p{q}_ms"] = round(value, 2) if value is not None else None
+    return result
+
+
+def process_memory(pid: int) -> Dict[str, Optional[float]]:
+    """VmRSS e VmHWM (picco) in MB da /proc (solo Linux)."""
+    memory = {"rss_mb": None, "peak_rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    memory["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return memory
+
+
+def histogram_totals(text: str, name: str) -> Dict[str, Any]:
+    """Somma, conteggio e bucket cumulativi di un istogramma Prometheus (tutte le etichette)."""
+    from prometheus_client.parser import text_string_to_metric_families
+
+    totals = {"sum": 0.0, "count": 0.0, "buckets": {}}
+    for family in text_string_to_metric_families(text):
+        if family.name != name:
+            continue
+        for sample in family.samples:
+            if sample.name == f"{name}_sum":
+                totals["sum"] += sample.value
+            elif sample.name == f"{name}_count":
+                totals["count"] += sample.value
+            elif sample.name == f"{name}_bucket":
+                bound = float(sample.labels["le"])
+                totals["buckets"][bound] = totals["buckets"].get(bound, 0.0) + sample.value
+    return totals
+
+
+def histogram_stats(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+    """Media e p95 (stimato dai bucket) delle osservazioni tra due letture."""
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return {"observations": 0, "mean_ms": None, "p95_ms": None}
+    buckets = sorted(
+        (bound, value - before["buckets"].get(bound, 0.0)) for bound, value in after["buckets"].items()
+    )
+    target = count * 0.95
+    p95 = None
+    previous_bound, previous_count = 0.0, 0.0
+    for bound, cumulative in buckets:
+        if cumulative >= target:
+            if bound == float("inf"):
+                p95 = previous_bound
+            else:
+                share = (target - previous_count) / ((cumulative - previous_count) or 1)
+                p95 = previous_bound + (bound - previous_bound) * share
+            break
+        previous_bound, previous_count = bound, cumulative
+    return {
+        "observations": int(count),
+        "mean_ms": round((after["sum"] - before["sum"]) / count * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3) if p95 is not None else None,
+    }
+
+
+class ServiceProcess:
+    """`ha_service.py` in un sottoprocesso puntato ai servizi finti."""
+
+    def __init__(self, port: int, supervisor: FakeSupervisor, llama: FakeLlamaServer,
+                 options: Dict[str, Any], log_path: str):
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.workdir = tempfile.mkdtemp(prefix="ha-bench-")
+        options_path = os.path.join(self.workdir, "options.json")
+        with open(options_path, "w") as f:
+            json.dump(options, f)
+        self.env = dict(
+            os.environ,
+            ADDON_OPTIONS_PATH=options_path,
+            SUPERVISOR_API_URL=supervisor.api_url,
+            SUPERVISOR_WS_URL=supervisor.ws_url,
+            SUPERVISOR_TOKEN="benchmark",
+            LLAMA_SERVER_URL=llama.url,
+            HA_SERVICE_PORT=str(port),
+            ADDON_STATUS_FILE=os.path.join(self.workdir, "status.json"),
+            RAG_INDEX_PATH=os.path.join(self.workdir, "rag"),
+        )
+        self.log_path = log_path
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float = 60.0) -> Tuple[float, Dict[str, Any]]:
+        """
+        Avvia il servizio e attende health ok e mirror pronto.
+
+        Returns:
+            (secondi dall'avvio del processo alla prontezza, `startup` di /api/health)
+        """
+        started = time.perf_counter()
+        log = open(self.log_path, "ab")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ADDON_DIR, "ha_service.py")],
+            cwd=self.workdir, env=self.env, stdout=log, stderr=subprocess.STDOUT
+        )
+        log.close()
+        deadline = started + timeout
+        while time.perf_counter() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"ha_service terminato (codice {self.process.returncode}), vedi {self.log_path}")
+            try:
+                health = requests.get(f"{self.url}/api/health", timeout=2).json()
+                if health.get("status") == "ok" and (health.get("state_mirror") or {}).get("ready"):
+                    return time.perf_counter() - started, health.get("startup") or {}
+            except (requests.exceptions.RequestException, ValueError):
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f"ha_service non pronto dopo {timeout}s, vedi {self.log_path}")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class LoadDriver:
+    """Esegue uno scenario con N client concorrenti (una sessione HTTP per thread)."""
+
+    def __init__(self, base_url: str, concurrency: int, requests_per_scenario: int, timeout: float = 120.0):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.total = requests_per_scenario
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def run(self, request: Callable[[int], Optional[Dict[str, float]]]) -> Dict[str, Any]:
+        """
+        Args:
+            request: Funzione (indice) → tempi extra in secondi; solleva in caso di errore
+
+        Returns:
+            Statistiche dello scenario
+        """
+        latencies: List[float] = []
+        extra: Dict[str, List[float]] = {}
+        errors = 0
+        lock = threading.Lock()
+
+        def one(index: int):
+            nonlocal errors
+            started = time.perf_counter()
+            try:
+                timings = request(index) or {}
+            except Exception:
+                with lock:
+                    errors += 1
+                return
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                for name, value in timings.items():
+                    extra.setdefault(name, []).append(value)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(one, range(self.total)))
+        return summarize(latencies, errors, time.perf_counter() - started, extra)
+
+    def get(self, path: str) -> requests.Response:
+        response = self.session.get(f"{self.base_url}{path}", timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def post(self, path: str, body: Dict[str, Any], stream: bool = False) -> requests.Response:
+        response = self.session.post(f"{self.base_url}{path}", json=body, timeout=self.timeout, stream=stream)
+        response.raise_for_status()
+        return response
+
+
+def scenario_requests(driver: LoadDriver, supervisor: FakeSupervisor) -> Dict[str, Callable[[int], Optional[Dict[str, float]]]]:
+    """Richieste di ogni scenario; i messaggi variano per non colpire la cache delle risposte."""
+    lights = [
+        s["attributes"]["friendly_name"] for s in supervisor.states.values() if s["entity_id"].startswith("light.")
+    ] or ["Luce Soggiorno"]
+    sensors = sorted(
+        s["entity_id"] for s in supervisor.states.values() if s["attributes"].get("state_class")
+    ) or ["sensor.sensore_soggiorno"]
+
+    def chat(index: int):
+        driver.post("/api/chat", {
+            "message": f"Quali luci sono accese? (richiesta {index})",
+            "include_entities": True,
+            "entity_domains": ["light", "switch", "sensor"],
+            "max_tokens": 64,
+        }).json()
+
+    def chat_stream(index: int):
+        started = time.perf_counter()
+        first = None
+        response = driver.post("/api/chat", {
+            "message": f"Che temperatura c'è in casa? (richiesta {index})",
+            "include_entities": True,
+            "stream": True,
+            "max_tokens": 64,
+        }, stream=True)
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if first is None and line and line.startswith("data:") and '"delta"' in line:
+                    first = time.perf_counter() - started
+        finally:
+            response.close()
+        return {"ttft": first} if first is not None else None
+
+    def context(index: int):
+        driver.get("/api/ha/context?refresh=true").json()
+
+    def entities(index: int):
+        driver.get("/api/ha/entities").json()
+
+    def entity_query(index: int):
+        driver.get("/api/ha/entities?domain=light&fields=state,attributes.friendly_name&limit=200").json()
+
+    def history(index: int):
+        sensor = sensors[index % min(len(sensors), 16)]
+        driver.get(f"/api/ha/history/{sensor}?period=ultimi 7 giorni&buckets=24").json()
+
+    def rag_search(index: int):
+        # Richiede --option rag_index=true
+        driver.get(f"/api/rag/search?q=luci accese in {lights[index % len(lights)].lower()}&k=8").json()
+
+    def command(index: int):
+        verb = "accendi" if index % 2 == 0 else "spegni"
+        driver.post("/api/chat", {
+            "message": f"{verb} {lights[index % len(lights)].lower()}",
+            "tools": True,
+        }).json()
+
+    return {
+        "chat": chat,
+        "chat_stream": chat_stream,
+        "context": context,
+        "entities": entities,
+        "entity_query": entity_query,
+        "history": history,
+        "rag_search": rag_search,
+        "command": command,
+    }
+
+
+def wait_rag_index(driver: LoadDriver, timeout: float = 300.0) -> Optional[float]:
+    """Attende la prima indicizzazione completa; restituisce la durata in secondi."""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        stats = driver.get("/api/health").json().get("rag_index") or {}
+        if stats.get("chunks") and not stats.get("pending"):
+            return round(time.perf_counter() - started, 3)
+        time.sleep(0.2)
+    return None
+
+
+def run_size(entities: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Avvia i finti e il servizio per una dimensione ed esegue gli scenari."""
+    supervisor = FakeSupervisor(entities, event_rate=args.event_rate).start()
+    llama = FakeLlamaServer(
+        slots=args.slots, token_ms=args.token_ms, prompt_tps=args.prompt_tps, tokens=args.tokens
+    ).start()
+    options = {
+        "log_level": "warning",
+        "parallel_requests": args.slots,
+        "context_size": args.context_size,
+        "llm_queue_size": max(16, args.concurrency * 2),
+    }
+    if "rag_search" in args.scenarios:
+        options["rag_index"] = True
+    options.update(args.option)
+    service = ServiceProcess(args.port, supervisor, llama, options, args.log)
+    result: Dict[str, Any] = {"entities": len(supervisor.states)}
+    try:
+        startup_s, startup = service.start()
+        result["startup_s"] = round(startup_s, 3)
+        result["startup_phases_s"] = startup.get("phases_s")
+        result["memory_idle"] = process_memory(service.process.pid)
+        driver = LoadDriver(service.url, args.concurrency, args.requests)
+        if options.get("rag_index"):
+            result["rag_index_s"] = wait_rag_index(driver)
+        requests_by_scenario = scenario_requests(driver, supervisor)
+
+        result["scenarios"] = {}
+        for name in args.scenarios:
+            before = histogram_totals(driver.get("/metrics").text, "ha_llm_context_build_seconds")
+            stats = driver.run(requests_by_scenario[name])
+            after = histogram_totals(driver.get("/metrics").text, "ha_llm_context_build_seconds")
+            stats["context_build"] = histogram_stats(before, after)
+            result["scenarios"][name] = stats
+            print(
+                f"  {entities:>6} entità  {name:<12} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms "
+                f"p99={stats['p99_ms']}ms {stats['throughput_rps']} req/s errori={stats['errors']}",
+                file=sys.stderr
+            )
+        result["memory"] = process_memory(service.process.pid)
+        result["fakes"] = {"llama_requests": llama.requests, "supervisor_requests": supervisor.requests}
+    finally:
+        service.stop()
+        llama.stop()
+        supervisor.stop()
+    return result
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Regressioni di p95 e throughput rispetto alla baseline, per dimensione e scenario."""
+    regressions = []
+    previous = {run["entities"]: run for run in baseline.get("runs", [])}
+    for run in current["runs"]:
+        old_run = previous.get(run["entities"])
+        if not old_run:
+            continue
+        for name, stats in run.get("scenarios", {}).items():
+            old = old_run.get("scenarios", {}).get(name)
+            if not old:
+                continue
+            for metric, higher_is_better in COMPARED:
+                new_value, old_value = stats.get(metric), old.get(metric)
+                if not new_value or not old_value:
+                    continue
+                change = (new_value - old_value) / old_value
+                if (change < -tolerance) if higher_is_better else (change > tolerance):
+                    regressions.append(
+                        f"{run['entities']} entità / {name}: {metric} {old_value} → {new_value} ({change:+.0%})"
+                    )
+    return regressions
+
+
+def parse_option(text: str):
+    """`nome=valore` → coppia; il valore è letto come JSON se possibile."""
+    name, _, value = text.partition("=")
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico di ha_service con servizi finti")
+    parser.add_argument("--entities", default="100,1000,10000", help="dimensioni dell'installazione, separate da virgola")
+    parser.add_argument("--scenarios", default=",".join(DEFAULT_SCENARIOS), help=f"scenari tra {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=4, help="client in parallelo")
+    parser.add_argument("--requests", type=int, default=100, help="richieste per scenario")
+    parser.add_argument("--slots", type=int, default=2, help="slot del llama-server finto")
+    parser.add_argument("--token-ms", type=float, default=10.0, help="millisecondi per token generato")
+    parser.add_argument("--prompt-tps", type=float, default=4000.0, help="token di prompt al secondo")
+    parser.add_argument("--tokens", type=int, default=32, help="token generati per risposta")
+    parser.add_argument("--context-size", type=int, default=8192, help="opzione context_size del servizio")
+    parser.add_argument("--event-rate", type=float, default=5.0, help="eventi state_changed al secondo")
+    parser.add_argument("--port", type=int, default=5055, help="porta del servizio sotto test")
+    parser.add_argument("--option", action="append", type=parse_option, default=[],
+                        help="opzione dell'add-on nome=valore (ripetibile)")
+    parser.add_argument("--log", default=os.path.join(tempfile.gettempdir(), "ha-bench-service.log"),
+                        help="log del servizio sotto test")
+    parser.add_argument("--output", help="file JSON dei risultati (default: stdout)")
+    parser.add_argument("--baseline", help="JSON di un'esecuzione precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="peggioramento ammesso (0.2 = 20%%)")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"scenari sconosciuti: {', '.join(sorted(unknown))}")
+    args.option = dict(args.option)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "concurrency": args.concurrency, "requests": args.requests, "slots": args.slots,
+            "token_ms": args.token_ms, "prompt_tps": args.prompt_tps, "tokens": args.tokens,
+            "event_rate": args.event_rate, "options": args.option,
+        },
+        "runs": [],
+    }
+    for size in (int(value) for value in args.entities.split(",") if value.strip()):
+        report["runs"].append(run_size(size, args))
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+        for regression in regressions:
+            print(f"REGRESSIONE {regression}", file=sys.stderr)
+        exit_code = 1 if regressions else 0
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Conteggio token e selezione delle entità entro un budget di contesto.
+
+I token vengono misurati con l'endpoint `/tokenize` di llama-server
+(con cache) oppure stimati localmente con un rapporto caratteri/token
+calibrato sulle misure reali.
+"""
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+# Domini controllabili, più utili al LLM di sensori diagnostici
+DOMAIN_PRIORITY = {
+    "light": 10, "switch": 9, "climate": 9, "cover": 8, "lock": 8, "fan": 7,
+    "media_player": 7, "alarm_control_panel": 7, "vacuum": 6, "scene": 6,
+    "script": 5, "sensor": 4, "binary_sensor": 4, "person": 4, "weather": 3,
+    "input_boolean": 3, "automation": 2,
+}
+
+# Parole chiave (it/en) che richiamano un dominio nel messaggio utente
+DOMAIN_KEYWORDS = {
+    "light": ("luce", "luci", "lampada", "lampadina", "light", "lights", "lamp"),
+    "switch": ("presa", "interruttore", "switch", "plug"),
+    "climate": ("termostato", "riscaldamento", "clima", "condizionatore", "thermostat", "heating"),
+    "cover": ("tapparella", "tapparelle", "tenda", "tende", "serranda", "cover", "blind", "blinds"),
+    "lock": ("serratura", "porta", "lock", "door"),
+    "media_player": ("tv", "televisione", "musica", "speaker", "media"),
+    "sensor": ("temperatura", "umidità", "consumo", "energia", "sensore", "temperature", "humidity", "energy"),
+    "binary_sensor": ("movimento", "finestra", "aperta", "aperto", "motion", "window", "open"),
+    "vacuum": ("aspirapolvere", "robot", "vacuum"),
+    "person": ("chi", "casa", "who", "home"),
+}
+
+# Attributi mostrati in forma compatta accanto allo stato
+COMPACT_ATTRIBUTES = (
+    "brightness", "color_temp_kelvin", "current_temperature", "temperature",
+    "hvac_action", "current_position", "percentage", "volume_level", "media_title",
+)
+
+RECENT_CHANGE_SECONDS = 3600
+_WORD_RE = re.compile(r"[\w]+", re.UNICODE)
+
+
+def words(text: str) -> set:
+    """Parole minuscole di almeno 3 caratteri (underscore separano)."""
+    return {w for w in _WORD_RE.findall(text.lower().replace("_", " ")) if len(w) >= 3}
+
+
+class TokenCounter:
+    """
+    Conta i token di un testo.
+
+    Usa `/tokenize` di llama-server con cache LRU sui testi già misurati;
+    se il server non risponde ricade su una stima chars/token calibrata.
+    """
+
+    def __init__(self, pool, llama_url: str, cache_size: int = 2048, chars_per_token: float = 3.5):
+        """
+        Inizializza il contatore.
+
+        Args:
+            pool: HTTPPool condiviso
+            llama_url: URL base di llama-server
+            cache_size: Numero massimo di testi memorizzati
+            chars_per_token: Rapporto iniziale per la stima locale
+        """
+        self.pool = pool
+        self.llama_url = llama_url
+        self.cache_size = cache_size
+        self.chars_per_token = chars_per_token
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.remote_calls = 0
+        self.cache_hits = 0
+        self.estimates = 0
+
+    def estimate(self, text: str) -> int:
+        """Stima locale, senza chiamate di rete."""
+        return int(len(text) / self.chars_per_token) + 1
+
+    def count(self, text: str) -> Tuple[int, bool]:
+        """
+        Conta i token di un testo.
+
+        Returns:
+            (numero di token, True se il valore è esatto)
+        """
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return self._cache[key], True
+
+        try:
+            response = self.pool.post(
+                f"{self.llama_url}/tokenize", endpoint="llama_tokenize", json={"content": text}
+            )
+            response.raise_for_status()
+            n_tokens = len(response.json().get("tokens", []))
+        except (requests.exceptions.RequestException, ValueError):
+            with self._lock:
+                self.estimates += 1
+            return self.estimate(text), False
+
+        with self._lock:
+            self.remote_calls += 1
+            self._cache[key] = n_tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            # Calibra la stima locale (media mobile) su testi significativi
+            if n_tokens >= 32:
+                self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * (len(text) / n_tokens)
+        return n_tokens, True
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "remote_calls": self.remote_calls,
+                "cache_hits": self.cache_hits,
+                "estimates": self.estimates,
+                "cached_texts": len(self._cache),
+                "chars_per_token": round(self.chars_per_token, 2),
+            }
+
+
+def compact_attributes(state: Dict[str, Any]) -> str:
+    """Attributi principali di un'entità in forma `k=v` compatta."""
+    attributes = state.get("attributes", {})
+    parts = []
+    for name in COMPACT_ATTRIBUTES:
+        value = attributes.get(name)
+        if value is None or value == "":
+            continue
+        if isinstance(value, float):
+            value = round(value, 1)
+        parts.append(f"{name}={value}")
+    return ",".join(parts)
+
+
+def static_rank(states: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Ordinamento indipendente dal messaggio (per il catalogo stabile).
+
+    Priorità del dominio, poi entity_id: stesso input, stesso output.
+    """
+    return sorted(
+        states,
+        key=lambda s: (-DOMAIN_PRIORITY.get(s.get("entity_id", "").split(".", 1)[0], 1),
+                       s.get("entity_id", ""))
+    )
+
+
+def relevance_rank(
+    states: Iterable[Dict[str, Any]],
+    user_message: str,
+    areas: Optional[Dict[str, Optional[str]]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Ordina le entità per rilevanza rispetto al messaggio utente.
+
+    Il punteggio combina: parole del messaggio presenti in entity_id,
+    friendly_name o nome dell'area; dominio richiamato da parole chiave;
+    cambio di stato recente; priorità del dominio.
+
+    Args:
+        states: Stati HA
+        user_message: Messaggio dell'utente
+        areas: entity_id → nome dell'area (dai registri del mirror; gli
+            stati HA non riportano l'area)
+    """
+    message_words = words(user_message)
+    # Parole chiave confrontate con tutte le parole, anche brevi ("tv")
+    all_words = set(_WORD_RE.findall(user_message.lower()))
+    wanted_domains = {
+        domain for domain, keywords in DOMAIN_KEYWORDS.items()
+        if all_words.intersection(keywords)
+    }
+    now = time.time()
+    areas = areas or {}
+
+    def score(state: Dict[str, Any]) -> float:
+        entity_id = state.get("entity_id", "")
+        domain = entity_id.split(".", 1)[0]
+        attributes = state.get("attributes", {})
+        names = words(f"{entity_id} {attributes.get('friendly_name', '')} {areas.get(entity_id) or ''}")
+        value = 5.0 * len(message_words & names)
+        if domain in wanted_domains:
+            value += 4.0
+        changed = _timestamp(state.get("last_changed"))
+        if changed and now - changed < RECENT_CHANGE_SECONDS:
+            value += 1.0
+        return value + DOMAIN_PRIORITY.get(domain, 1) / 10.0
+
+    return sorted(states, key=lambda s: (-score(s), s.get("entity_id", "")))
+
+
+def fit_lines(lines: Iterable[str], budget: int, counter: TokenCounter) -> List[str]:
+    """
+    Seleziona le righe (in ordine) finché la stima resta nel budget.
+    """
+    selected = []
+    used = 0
+    for line in lines:
+        cost = counter.estimate(line)
+        if used + cost > budget:
+            break
+        selected.append(line)
+        used += cost
+    return selected
+
+
+def _timestamp(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Cache con TTL e invalidazione esplicita per il contesto HA del LLM.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+CacheKey = Tuple[bool, bool, bool, Optional[Tuple[str, ...]]]
+
+
+class ContextCache:
+    """
+    Memorizza il testo prodotto da `HAContextBuilder.build_full_context`.
+
+    La chiave è (include_entities, include_services, include_system,
+    entity_domains); i domini vengono normalizzati (ordinati, senza
+    duplicati) così che ["switch", "light"] e ["light", "switch"]
+    condividano la stessa voce. I domini arrivano dai client: le voci
+    sono limitate a `max_entries` (LRU) e il lock di una chiave esiste
+    solo finché qualcuno la sta ricostruendo.
+    """
+
+    def __init__(self, builder, ttl: float = 30.0, max_entries: int = 64):
+        """
+        Inizializza la cache.
+
+        Args:
+            builder: Istanza di HAContextBuilder
+            ttl: Durata di validità in secondi (0 disabilita la cache)
+            max_entries: Voci massime in cache
+        """
+        self.builder = builder
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[CacheKey, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # chiave -> [lock, richieste che lo usano]
+        self._key_locks: Dict[CacheKey, List[Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(
+        include_entities: bool,
+        include_services: bool,
+        include_system: bool,
+        entity_domains: Optional[Iterable[str]]
+    ) -> CacheKey:
+        domains = tuple(sorted(set(entity_domains))) if entity_domains else None
+        return (bool(include_entities), bool(include_services), bool(include_system), domains)
+
+    def get(
+        self,
+        include_entities: bool = True,
+        include_services: bool = False,
+        include_system: bool = True,
+        entity_domains: Optional[Iterable[str]] = None
+    ) -> str:
+        """
+        Restituisce il contesto dalla cache o lo ricostruisce se scaduto.
+
+        Richieste concorrenti sulla stessa chiave attendono una sola
+        ricostruzione invece di interrogare il Supervisor in parallelo.
+        """
+        key = self.make_key(include_entities, include_services, include_system, entity_domains)
+
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+
+        try:
+            with key_lock[0]:
+                # Un'altra richiesta potrebbe averlo appena ricostruito
+                cached = self._lookup(key, count_miss=False)
+                if cached is not None:
+                    return cached
+
+                context = self.builder.build_full_context(
+                    include_entities=include_entities,
+                    include_services=include_services,
+                    include_system=include_system,
+                    entity_domains=list(key[3]) if key[3] else None
+                )
+                if self.ttl > 0:
+                    with self._lock:
+                        self._entries[key] = (time.monotonic() + self.ttl, context)
+                        self._entries.move_to_end(key)
+                        while len(self._entries) > self.max_entries:
+                            self._entries.popitem(last=False)
+                return context
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[key]
+
+    def _lookup(self, key: CacheKey, count_miss: bool = True) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            if count_miss:
+                self.misses += 1
+            return None
+
+    def invalidate(self) -> int:
+        """
+        Svuota la cache.
+
+        Returns:
+            Numero di voci rimosse
+        """
+        with self._lock:
+            removed = len(self._entries)
+            self._entries.clear()
+            self.invalidations += 1
+            return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiche hit/miss della cache."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "ttl": self.ttl,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Contesto Home Assistant per le conversazioni multi-turno.
+
+Una conversazione può essere legata a un profilo di contesto (entità,
+servizi, domini). Il profilo viene renderizzato all'avvio della
+conversazione, in background, e riutilizzato a ogni turno:
+- la parte stabile (info di sistema e catalogo) va in coda al system
+  prompt, così il prefisso resta identico tra un turno e l'altro;
+- gli stati correnti vanno solo nel messaggio utente del turno in corso
+  (nella conversazione salvata resta la domanda originale).
+
+I rendering sono condivisi tra le conversazioni con lo stesso profilo e
+vengono aggiornati in background quando scadono: il turno usa subito
+quello disponibile e non attende mai il Supervisor, salvo il primo.
+Un profilo senza più conversazioni (eliminate o scadute) perde il suo
+rendering; in ogni caso ne restano al più `max_profiles` (LRU).
+
+Dopo il rendering iniziale lo slot llama-server della conversazione
+viene "scaldato" valutando system prompt e stati con `n_predict=0`:
+al primo turno resta da valutare solo la domanda.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Separatore tra il system prompt della conversazione e il contesto HA
+CONTEXT_HEADER = "INFORMAZIONI SULLA CASA:"
+
+
+class ContextProfile:
+    """Cosa includere nel contesto HA di una conversazione."""
+
+    __slots__ = ("include_entities", "include_services", "entity_domains")
+
+    def __init__(
+        self,
+        include_entities: bool = True,
+        include_services: bool = False,
+        entity_domains: Optional[List[str]] = None
+    ):
+        self.include_entities = bool(include_entities)
+        self.include_services = bool(include_services)
+        self.entity_domains = tuple(sorted(set(entity_domains))) if entity_domains else None
+
+    @classmethod
+    def from_dict(cls, data: Any) -> "ContextProfile":
+        """
+        Profilo dal body della richiesta (`true` = entità di tutti i domini).
+
+        Raises:
+            ValueError: Se il profilo non è valido
+        """
+        if data is True:
+            return cls()
+        if not isinstance(data, dict):
+            raise ValueError("'ha_context' deve essere true o un oggetto")
+        domains = data.get("entity_domains")
+        if domains is not None and (
+            not isinstance(domains, list) or not all(isinstance(d, str) and d for d in domains)
+        ):
+            raise ValueError("'entity_domains' deve essere una lista di domini")
+        profile = cls(
+            data.get("include_entities", True),
+            data.get("include_services", False),
+            domains
+        )
+        if not profile.include_entities and not profile.include_services:
+            raise ValueError("Il profilo deve includere entità o servizi")
+        return profile
+
+    @property
+    def key(self) -> Tuple[bool, bool, Optional[Tuple[str, ...]]]:
+        return (self.include_entities, self.include_services, self.entity_domains)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "include_entities": self.include_entities,
+            "include_services": self.include_services,
+            "entity_domains": list(self.entity_domains) if self.entity_domains else None,
+        }
+
+
+class RenderedContext:
+    """Contesto renderizzato per un profilo."""
+
+    __slots__ = ("system", "states", "rendered_at", "render_time")
+
+    def __init__(self, system: str, states: str, render_time: float):
+        self.system = system
+        self.states = states
+        self.rendered_at = time.monotonic()
+        self.render_time = render_time
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.rendered_at
+
+
+class ConversationContexts:
+    """
+    Profili di contesto delle conversazioni, con prefetch e aggiornamento
+    in background.
+    """
+
+    def __init__(
+        self,
+        store,
+        render: Callable[[ContextProfile], Tuple[str, str]],
+        warm: Optional[Callable[[str, List[Dict[str, str]]], Optional[Dict[str, Any]]]] = None,
+        ttl: float = 30.0,
+        max_workers: int = 2,
+        max_profiles: int = 32
+    ):
+        """
+        Args:
+            store: ConversationStore (il profilo viene salvato con la conversazione)
+            render: Funzione profilo -> (parte stabile, blocco stati)
+            warm: Funzione (ID conversazione, messaggi) che valuta il prefisso
+                nello slot della conversazione; restituisce la risposta di
+                llama-server (None = riscaldamento disattivato)
+            ttl: Secondi dopo cui un rendering viene aggiornato in background
+            max_workers: Thread per rendering e riscaldamento
+            max_profiles: Rendering conservati (LRU)
+        """
+        self.store = store
+        self.render = render
+        self.warm = warm
+        self.ttl = ttl
+        self.max_profiles = max_profiles
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="conversation-context")
+        self._lock = threading.Lock()
+        self._rendered: "OrderedDict[Tuple, RenderedContext]" = OrderedDict()
+        self._pending: Dict[Tuple, Future] = {}
+        # Conversazioni per profilo: un profilo senza conversazioni si scarta
+        self._users: Dict[Tuple, Set[str]] = {}
+        self._profile_of: Dict[str, Tuple] = {}
+
+        self.bound = 0
+        self.renders = 0
+        self.render_failures = 0
+        self.render_time = 0.0
+        self.background_refreshes = 0
+        self.hits = 0
+        self.waits = 0
+        self.warmups = 0
+        self.warmup_failures = 0
+        self.warmup_tokens = 0
+
+    def bind(self, conversation_id: str, profile: ContextProfile, system_prompt: str, warm: bool = True) -> bool:
+        """
+        Lega il profilo alla conversazione e avvia il prefetch.
+
+        Args:
+            conversation_id: ID della conversazione (già creata)
+            profile: Profilo di contesto
+            system_prompt: System prompt della conversazione (per il riscaldamento)
+            warm: Se True scalda lo slot dopo il rendering
+
+        Returns:
+            False se la conversazione non esiste
+        """
+        if not self.store.set_context_profile(conversation_id, profile.to_dict()):
+            return False
+        with self._lock:
+            self.bound += 1
+            self._use_locked(conversation_id, profile.key)
+        future = self._render_async(profile)
+        if warm and self.warm is not None:
+            future.add_done_callback(
+                lambda done: self._executor.submit(self._warm, conversation_id, system_prompt, done)
+            )
+        return True
+
+    def get(self, conversation_id: str, timeout: Optional[float] = None) -> Optional[RenderedContext]:
+        """
+        Contesto della conversazione per il turno in corso.
+
+        Restituisce subito il rendering disponibile (aggiornandolo in
+        background se scaduto); attende solo se non ce n'è ancora uno.
+
+        Args:
+            conversation_id: ID della conversazione
+            timeout: Attesa massima del primo rendering in secondi
+
+        Returns:
+            Contesto renderizzato, o None se la conversazione non ha profilo
+            o il rendering non è disponibile
+        """
+        data = self.store.get_context_profile(conversation_id)
+        if not data:
+            return None
+        profile = ContextProfile.from_dict(data)
+
+        with self._lock:
+            # Anche le conversazioni legate prima di un riavvio (SQLite)
+            self._use_locked(conversation_id, profile.key)
+            rendered = self._rendered.get(profile.key)
+            if rendered is not None:
+                self._rendered.move_to_end(profile.key)
+        if rendered is not None:
+            with self._lock:
+                self.hits += 1
+            if rendered.age > self.ttl:
+                self._render_async(profile, background=True)
+            return rendered
+
+        with self._lock:
+            self.waits += 1
+        try:
+            return self._render_async(profile).result(timeout)
+        except Exception as e:
+            logger.warning(f"⚠️ Contesto HA della conversazione {conversation_id} non disponibile: {e}")
+            return None
+
+    @staticmethod
+    def compose(
+        history: List[Dict[str, Any]],
+        user_turn: Dict[str, Any],
+        rendered: Optional[RenderedContext]
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Storia e turno utente con il contesto, da inviare al modello.
+
+        Args:
+            history: Messaggi salvati (system prompt in testa)
+            user_turn: Nuovo messaggio dell'utente
+            rendered: Contesto della conversazione (None = invariati)
+
+        Returns:
+            (storia con il contesto nel system prompt, turno con gli stati)
+        """
+        if rendered is None:
+            return history, user_turn
+        history = list(history)
+        if rendered.system:
+            if history and history[0].get("role") == "system":
+                history[0] = dict(history[0], content=system_with_context(history[0]["content"], rendered))
+            else:
+                history.insert(0, {"role": "system", "content": system_with_context("", rendered)})
+        if rendered.states:
+            user_turn = dict(user_turn, content=f"{rendered.states}\n\nDOMANDA: {user_turn['content']}")
+        return history, user_turn
+
+    def forget(self, conversation_id: str):
+        """Conversazione eliminata o scaduta (listener dello store)."""
+        with self._lock:
+            self._release_locked(conversation_id)
+
+    def _use_locked(self, conversation_id: str, key: Tuple):
+        if self._profile_of.get(conversation_id) == key:
+            return
+        self._release_locked(conversation_id)
+        self._profile_of[conversation_id] = key
+        self._users.setdefault(key, set()).add(conversation_id)
+
+    def _release_locked(self, conversation_id: str):
+        key = self._profile_of.pop(conversation_id, None)
+        users = self._users.get(key)
+        if users is None:
+            return
+        users.discard(conversation_id)
+        if not users:
+            del self._users[key]
+            self._rendered.pop(key, None)
+
+    def invalidate(self) -> int:
+        """
+        Fa scadere tutti i rendering (aggiornati al prossimo turno).
+
+        Returns:
+            Numero di rendering scaduti
+        """
+        with self._lock:
+            for rendered in self._rendered.values():
+                rendered.rendered_at = float("-inf")
+            return len(self._rendered)
+
+    def _render_async(self, profile: ContextProfile, background: bool = False) -> Future:
+        """Rendering del profilo; richieste concorrenti condividono lo stesso Future."""
+        with self._lock:
+            future = self._pending.get(profile.key)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._render, profile)
+            self._pending[profile.key] = future
+            if background:
+                self.background_refreshes += 1
+        return future
+
+    def _render(self, profile: ContextProfile) -> RenderedContext:
+        started = time.perf_counter()
+        try:
+            system, states = self.render(profile)
+        except Exception:
+            with self._lock:
+                self.render_failures += 1
+                self._pending.pop(profile.key, None)
+            raise
+        rendered = RenderedContext(system, states, time.perf_counter() - started)
+        with self._lock:
+            # Un profilo rimasto senza conversazioni durante il rendering
+            # non torna in cache
+            if profile.key in self._users:
+                self._rendered[profile.key] = rendered
+                self._rendered.move_to_end(profile.key)
+                while len(self._rendered) > self.max_profiles:
+                    self._rendered.popitem(last=False)
+            self._pending.pop(profile.key, None)
+            self.renders += 1
+            self.render_time += rendered.render_time
+        return rendered
+
+    def _warm(self, conversation_id: str, system_prompt: str, done: Future):
+        if done.exception() is not None:
+            return
+        rendered = done.result()
+        messages = [
+            {"role": "system", "content": system_with_context(system_prompt, rendered)},
+            {"role": "user", "content": rendered.states},
+        ]
+        try:
+            result = self.warm(conversation_id, messages) or {}
+        except Exception as e:
+            with self._lock:
+                self.warmup_failures += 1
+            logger.warning(f"⚠️ Riscaldamento slot fallito per {conversation_id}: {e}")
+            return
+        evaluated = (result.get("timings") or {}).get("prompt_n") or 0
+        with self._lock:
+            self.warmups += 1
+            self.warmup_tokens += evaluated
+        logger.debug("🔥 Slot scaldato per %s (%s token valutati)", conversation_id, evaluated)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ttl": self.ttl,
+                "bound": self.bound,
+                "profiles": len(self._rendered),
+                "max_profiles": self.max_profiles,
+                "renders": self.renders,
+                "render_failures": self.render_failures,
+                "avg_render_ms": round(self.render_time / self.renders * 1000, 2) if self.renders else 0.0,
+                "background_refreshes": self.background_refreshes,
+                "hits": self.hits,
+                "waits": self.waits,
+                "warmups": self.warmups,
+                "warmup_failures": self.warmup_failures,
+                "warmup_tokens": self.warmup_tokens,
+            }
+
+
+def system_with_context(system_prompt: str, rendered: RenderedContext) -> str:
+    """System prompt della conversazione seguito dalla parte stabile del contesto."""
+    if not rendered.system:
+        return system_prompt
+    if not system_prompt:
+        return f"{CONTEXT_HEADER}\n\n{rendered.system}"
+    return f"{system_prompt}\n\n{CONTEXT_HEADER}\n\n{rendered.system}"
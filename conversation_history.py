@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Gestione della storia delle conversazioni lunghe.
+
+Invece di inviare a llama-server l'intera conversazione a ogni turno,
+il prompt contiene il system prompt (sempre), un riassunto dei turni
+vecchi e una finestra degli ultimi turni entro un budget di token.
+I turni che escono dalla finestra vengono riassunti dal modello in
+background, con priorità bassa, e il riassunto viene salvato nello
+store insieme alla conversazione.
+
+Strategie:
+- full: storia completa (comportamento originale);
+- window: finestra scorrevole per token, i turni vecchi vengono scartati;
+- summary: finestra scorrevole più riassunto progressivo dei turni vecchi.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from context_budget import TokenCounter
+from conversation_store import ConversationStore
+
+logger = logging.getLogger(__name__)
+
+HISTORY_STRATEGIES = ("full", "window", "summary")
+
+# Token di template per ogni messaggio (ruolo e separatori)
+MESSAGE_OVERHEAD = 4
+
+# Quando la finestra supera il budget, i turni vecchi vengono scartati
+# fino a scendere a questa frazione: la finestra resta poi ferma per
+# diversi turni e il prefisso del prompt resta in KV cache
+LOW_WATER = 0.6
+
+SUMMARY_HEADER = "RIASSUNTO DELLA CONVERSAZIONE PRECEDENTE:"
+
+SUMMARY_INSTRUCTIONS = (
+    "Riassumi la conversazione seguente tra un utente e il suo assistente "
+    "domestico. Conserva fatti, preferenze, dispositivi citati, richieste "
+    "ancora aperte e decisioni prese; ometti saluti e ripetizioni. "
+    "Rispondi solo con il riassunto, in forma di elenco puntato conciso."
+)
+
+
+class HistoryManager:
+    """
+    Costruisce i messaggi di un turno di conversazione entro un budget.
+
+    Lo stato della finestra (primo turno incluso) è tenuto per
+    conversazione in memoria; dopo un riavvio viene ricalcolato. Viene
+    scartato quando lo store elimina, fa scadere o ricrea la conversazione.
+    """
+
+    def __init__(
+        self,
+        store: ConversationStore,
+        counter: TokenCounter,
+        summarize: Optional[Callable[[List[Dict[str, Any]], int], str]] = None,
+        strategy: str = "summary",
+        max_history_tokens: int = 1024,
+        summary_tokens: int = 256
+    ):
+        """
+        Inizializza il gestore.
+
+        Args:
+            store: Store delle conversazioni
+            counter: Contatore di token
+            summarize: Funzione (messaggi, max_tokens) -> testo, usata per
+                i riassunti; senza, la strategia summary si comporta come window
+            strategy: Una di HISTORY_STRATEGIES
+            max_history_tokens: Token massimi della finestra (0 = tutto il
+                budget disponibile)
+            summary_tokens: Token massimi di un riassunto
+        """
+        if strategy not in HISTORY_STRATEGIES:
+            raise ValueError(f"Strategia storia non valida: '{strategy}'")
+        self.store = store
+        self.counter = counter
+        self.summarize = summarize
+        self.strategy = strategy
+        self.max_history_tokens = max_history_tokens
+        self.summary_tokens = summary_tokens
+
+        self._lock = threading.Lock()
+        # id conversazione -> indice assoluto del primo messaggio in finestra
+        self._window_start: Dict[str, int] = {}
+        self._summarizing: set = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+        store.add_removal_listener(self.forget)
+
+        self.turns = 0
+        self.window_moves = 0
+        self.messages_dropped = 0
+        self.summaries = 0
+        self.summary_failures = 0
+        self.summary_time = 0.0
+
+    def message_tokens(self, message: Dict[str, Any]) -> int:
+        """Token di un messaggio, compreso il template."""
+        n_tokens, _ = self.counter.count(str(message.get("content", "")))
+        return n_tokens + MESSAGE_OVERHEAD
+
+    def prepare(
+        self,
+        conversation_id: str,
+        history: List[Dict[str, Any]],
+        user_turn: Dict[str, Any],
+        token_budget: int
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Messaggi da inviare al modello per un nuovo turno.
+
+        Args:
+            conversation_id: ID della conversazione
+            history: Messaggi salvati (system prompt in testa)
+            user_turn: Nuovo messaggio dell'utente
+            token_budget: Token disponibili per il prompt
+
+        Returns:
+            (messaggi, report con token e turni inclusi)
+        """
+        with self._lock:
+            self.turns += 1
+        if self.strategy == "full":
+            return history + [user_turn], {"strategy": "full", "messages": len(history)}
+
+        head = 1 if history and history[0].get("role") == "system" else 0
+        system = [dict(history[0])] if head else []
+        body = history[head:]
+        trimmed = self.store.trimmed_count(conversation_id) or 0
+        # Indice assoluto di body[i] = base + i
+        base = head + trimmed
+
+        summary = self.store.get_summary(conversation_id) if self.strategy == "summary" else None
+        if summary and system:
+            system[0]["content"] = f"{system[0]['content']}\n\n{SUMMARY_HEADER}\n{summary['content']}"
+
+        fixed = sum(self.message_tokens(m) for m in system) + self.message_tokens(user_turn)
+        budget = max(token_budget - fixed, 0)
+        if self.max_history_tokens > 0:
+            budget = min(budget, self.max_history_tokens)
+
+        with self._lock:
+            start = self._window_start.get(conversation_id, 0)
+        if summary:
+            start = max(start, summary["upto"])
+        first = min(max(start - base, 0), len(body))
+
+        sizes = [self.message_tokens(m) for m in body[first:]]
+        used = sum(sizes)
+        if used > budget:
+            # Scarta i turni più vecchi fino alla soglia bassa, ripartendo
+            # sempre da un messaggio dell'utente
+            target = int(budget * LOW_WATER)
+            index = 0
+            while index < len(sizes) and (used > target or body[first + index].get("role") != "user"):
+                used -= sizes[index]
+                index += 1
+            first += index
+            with self._lock:
+                self.window_moves += 1
+                self.messages_dropped += index
+        window = body[first:]
+
+        with self._lock:
+            self._window_start[conversation_id] = base + first
+
+        summarized_upto = summary["upto"] if summary else 0
+        if self.strategy == "summary" and self.summarize and summarized_upto < base + first:
+            self._schedule_summary(conversation_id)
+
+        report = {
+            "strategy": self.strategy,
+            "history_tokens": used,
+            "history_budget": budget,
+            "messages": len(window),
+            "messages_excluded": len(body) - len(window),
+            "summary": summary is not None,
+        }
+        return system + window + [user_turn], report
+
+    def forget(self, conversation_id: str):
+        """Rimuove lo stato di una conversazione eliminata o scaduta (listener dello store)."""
+        with self._lock:
+            self._window_start.pop(conversation_id, None)
+
+    # ------------------------------------------------------------------
+    # Riassunto in background
+    # ------------------------------------------------------------------
+
+    def _schedule_summary(self, conversation_id: str):
+        with self._lock:
+            if conversation_id in self._summarizing:
+                return
+            self._summarizing.add(conversation_id)
+        self._executor.submit(self._update_summary, conversation_id)
+
+    def _update_summary(self, conversation_id: str):
+        try:
+            history = self.store.get_messages(conversation_id)
+            if history is None:
+                return
+            head = 1 if history and history[0].get("role") == "system" else 0
+            base = head + (self.store.trimmed_count(conversation_id) or 0)
+            summary = self.store.get_summary(conversation_id)
+            with self._lock:
+                window_start = self._window_start.get(conversation_id, 0)
+
+            # Messaggi usciti dalla finestra e non ancora riassunti;
+            # quelli eliminati dal troncamento dello store sono persi
+            upto = summary["upto"] if summary else 0
+            first = max(upto - base, 0)
+            pending = history[head:][first:max(window_start - base, 0)]
+            if not pending:
+                return
+
+            # Un blocco alla volta entro il budget del modello; il resto
+            # viene riassunto al turno successivo
+            chunk_budget = max(self.max_history_tokens, 4 * self.summary_tokens)
+            chunk, used = [], 0
+            for message in pending:
+                used += self.message_tokens(message)
+                if chunk and used > chunk_budget:
+                    break
+                chunk.append(message)
+
+            transcript = "\n".join(
+                f"{'Utente' if m.get('role') == 'user' else 'Assistente'}: {m.get('content', '')}"
+                for m in chunk
+            )
+            if summary:
+                transcript = f"Riassunto finora:\n{summary['content']}\n\nNuovi messaggi:\n{transcript}"
+
+            started = time.time()
+            content = self.summarize(
+                [
+                    {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                    {"role": "user", "content": transcript},
+                ],
+                self.summary_tokens
+            ).strip()
+            if not content:
+                raise ValueError("riassunto vuoto")
+
+            new_upto = base + first + len(chunk)
+            self.store.set_summary(conversation_id, content, new_upto)
+            with self._lock:
+                self.summaries += 1
+                self.summary_time += time.time() - started
+            logger.info(
+                f"📝 Conversazione {conversation_id} riassunta fino al messaggio {new_upto} "
+                f"({len(chunk)} messaggi in {time.time() - started:.1f}s)"
+            )
+        except Exception as e:
+            with self._lock:
+                self.summary_failures += 1
+            logger.warning(f"⚠️ Riassunto conversazione {conversation_id} fallito: {e}")
+        finally:
+            with self._lock:
+                self._summarizing.discard(conversation_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "strategy": self.strategy,
+                "max_history_tokens": self.max_history_tokens,
+                "turns": self.turns,
+                "window_moves": self.window_moves,
+                "messages_dropped": self.messages_dropped,
+                "summaries": self.summaries,
+                "summary_failures": self.summary_failures,
+                "summaries_running": len(self._summarizing),
+                "summary_avg_s": round(self.summary_time / self.summaries, 2) if self.summaries else 0.0,
+            }
@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+"""
+Storage delle conversazioni multi-turno.
+
+Due backend con la stessa interfaccia:
+- MemoryConversationStore: LRU in memoria con scadenza per inattività
+  e limiti su numero di conversazioni, messaggi e byte;
+- SQLiteConversationStore: persistente su SQLite con scrittura
+  differita a blocchi (write-behind) e cache LRU delle conversazioni
+  attive.
+"""
+
+import json
+import logging
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _message_size(message: Dict[str, Any]) -> int:
+    """Byte UTF-8 di contenuto e ruolo (il limite `max_bytes` è in byte)."""
+    content = str(message.get("content", ""))
+    return len(content.encode("utf-8")) + len(message.get("role", "").encode("utf-8"))
+
+
+class ConversationStore(ABC):
+    """Interfaccia comune dei backend di conversazione."""
+
+    def __init__(self, max_conversations: int, max_messages: int, idle_ttl: float):
+        """
+        Args:
+            max_conversations: Conversazioni massime conservate
+            max_messages: Messaggi massimi per conversazione (system escluso)
+            idle_ttl: Secondi di inattività dopo cui una conversazione scade
+                (0 = nessuna scadenza)
+        """
+        self.max_conversations = max_conversations
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self.evictions = {"lru": 0, "idle": 0, "memory": 0, "messages_trimmed": 0}
+        self._removal_listeners: List[Callable[[str], None]] = []
+
+    def add_removal_listener(self, callback: Callable[[str], None]):
+        """
+        Registra una callback (ID) chiamata quando una conversazione viene
+        eliminata, scade o viene ricreata con lo stesso ID.
+
+        Può essere chiamata con i lock dello store acquisiti: non deve
+        usare lo store.
+        """
+        self._removal_listeners.append(callback)
+
+    def _notify_removed(self, conversation_ids: Iterable[str]):
+        for conversation_id in conversation_ids:
+            for callback in self._removal_listeners:
+                try:
+                    callback(conversation_id)
+                except Exception as e:
+                    logger.error(f"❌ Errore in un listener delle conversazioni: {e}")
+
+    @abstractmethod
+    def create(self, conversation_id: str, messages: List[Dict[str, Any]]):
+        """Crea (o sostituisce) una conversazione con i messaggi iniziali."""
+
+    @abstractmethod
+    def exists(self, conversation_id: str) -> bool:
+        """True se la conversazione esiste."""
+
+    @abstractmethod
+    def get_messages(
+        self,
+        conversation_id: str,
+        offset: int = 0,
+        limit: Optional[int] = None
+    ) -> Optional[List[Dict[str, Any]]]:
+        """Messaggi della conversazione (None se non esiste)."""
+
+    @abstractmethod
+    def message_count(self, conversation_id: str) -> Optional[int]:
+        """Numero di messaggi (None se la conversazione non esiste)."""
+
+    @abstractmethod
+    def trimmed_count(self, conversation_id: str) -> Optional[int]:
+        """
+        Messaggi eliminati dal troncamento dall'inizio della conversazione.
+
+        Sommato alla posizione in `get_messages` (system escluso) dà un
+        indice assoluto che non cambia quando i messaggi vecchi vengono
+        eliminati.
+        """
+
+    @abstractmethod
+    def get_summary(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """Riassunto dei turni vecchi: {"content", "upto"} o None."""
+
+    @abstractmethod
+    def set_summary(self, conversation_id: str, content: str, upto: int) -> bool:
+        """
+        Salva il riassunto dei messaggi con indice assoluto minore di `upto`.
+
+        Returns:
+            False se la conversazione non esiste
+        """
+
+    @abstractmethod
+    def get_context_profile(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """Profilo di contesto HA associato alla conversazione, o None."""
+
+    @abstractmethod
+    def set_context_profile(self, conversation_id: str, profile: Optional[Dict[str, Any]]) -> bool:
+        """
+        Associa (o rimuove, con None) un profilo di contesto HA.
+
+        Returns:
+            False se la conversazione non esiste
+        """
+
+    @abstractmethod
+    def append(self, conversation_id: str, *messages: Dict[str, Any]) -> Optional[int]:
+        """
+        Aggiunge messaggi in coda.
+
+        Returns:
+            Nuovo numero di messaggi, o None se la conversazione non esiste
+        """
+
+    @abstractmethod
+    def delete(self, conversation_id: str) -> bool:
+        """Elimina la conversazione (False se non esiste)."""
+
+    @abstractmethod
+    def list(self, offset: int = 0, limit: int = 50) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Conversazioni ordinate dalla più recente.
+
+        Returns:
+            (pagina di {"id", "message_count", "last_access"}, totale)
+        """
+
+    @abstractmethod
+    def count(self) -> int:
+        """Numero di conversazioni conservate."""
+
+    @abstractmethod
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiche del backend (conversazioni, evizioni, ...)."""
+
+    def close(self):
+        """Rilascia le risorse (flush dei dati pendenti)."""
+
+    def _trim(self, messages: List[Dict[str, Any]]) -> int:
+        """
+        Elimina i messaggi più vecchi oltre `max_messages`.
+
+        Il system prompt iniziale viene sempre conservato.
+
+        Returns:
+            Numero di messaggi eliminati
+        """
+        head = 1 if messages and messages[0].get("role") == "system" else 0
+        excess = len(messages) - head - self.max_messages
+        if excess <= 0:
+            return 0
+        del messages[head:head + excess]
+        self.evictions["messages_trimmed"] += excess
+        return excess
+
+
+class _Conversation:
+    __slots__ = ("messages", "created_at", "last_access", "size", "trimmed", "summary", "context_profile")
+
+    def __init__(self, messages: List[Dict[str, Any]]):
+        self.messages = messages
+        self.created_at = self.last_access = time.time()
+        self.size = sum(_message_size(m) for m in messages)
+        self.trimmed = 0
+        self.summary: Optional[Dict[str, Any]] = None
+        self.context_profile: Optional[Dict[str, Any]] = None
+
+
+class MemoryConversationStore(ConversationStore):
+    """LRU in memoria con scadenza per inattività e limite di byte."""
+
+    def __init__(
+        self,
+        max_conversations: int = 200,
+        max_messages: int = 200,
+        idle_ttl: float = 86400,
+        max_bytes: int = 32 * 1024 * 1024
+    ):
+        """
+        Args:
+            max_conversations: Conversazioni massime conservate
+            max_messages: Messaggi massimi per conversazione (system escluso)
+            idle_ttl: Secondi di inattività dopo cui una conversazione scade
+            max_bytes: Dimensione massima complessiva del testo dei messaggi
+                (byte UTF-8)
+        """
+        super().__init__(max_conversations, max_messages, idle_ttl)
+        self.max_bytes = max_bytes
+        self._conversations: "OrderedDict[str, _Conversation]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _expire_locked(self):
+        if self.idle_ttl > 0:
+            cutoff = time.time() - self.idle_ttl
+            # L'OrderedDict è in ordine di accesso: i più vecchi sono in testa
+            while self._conversations:
+                conversation_id, conversation = next(iter(self._conversations.items()))
+                if conversation.last_access >= cutoff:
+                    break
+                self._remove_locked(conversation_id)
+                self.evictions["idle"] += 1
+
+        while len(self._conversations) > self.max_conversations:
+            self._remove_locked(next(iter(self._conversations)))
+            self.evictions["lru"] += 1
+
+        while self._bytes > self.max_bytes and len(self._conversations) > 1:
+            self._remove_locked(next(iter(self._conversations)))
+            self.evictions["memory"] += 1
+
+    def _remove_locked(self, conversation_id: str) -> Optional[_Conversation]:
+        conversation = self._conversations.pop(conversation_id, None)
+        if conversation is not None:
+            self._bytes -= conversation.size
+            self._notify_removed([conversation_id])
+        return conversation
+
+    def _touch_locked(self, conversation_id: str) -> Optional[_Conversation]:
+        self._expire_locked()
+        conversation = self._conversations.get(conversation_id)
+        if conversation is not None:
+            conversation.last_access = time.time()
+            self._conversations.move_to_end(conversation_id)
+        return conversation
+
+    def create(self, conversation_id: str, messages: List[Dict[str, Any]]):
+        with self._lock:
+            conversation = _Conversation(list(messages))
+            self._remove_locked(conversation_id)
+            self._conversations[conversation_id] = conversation
+            self._bytes += conversation.size
+            self._expire_locked()
+
+    def exists(self, conversation_id: str) -> bool:
+        with self._lock:
+            return self._touch_locked(conversation_id) is not None
+
+    def get_messages(self, conversation_id, offset=0, limit=None):
+        with self._lock:
+            conversation = self._touch_locked(conversation_id)
+            if conversation is None:
+                return None
+            end = None if limit is None else offset + limit
+            return list(conversation.messages[offset:end])
+
+    def message_count(self, conversation_id):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            return len(conversation.messages) if conversation else None
+
+    def trimmed_count(self, conversation_id):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            return conversation.trimmed if conversation else None
+
+    def get_summary(self, conversation_id):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            return dict(conversation.summary) if conversation and conversation.summary else None
+
+    def set_summary(self, conversation_id, content, upto):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None:
+                return False
+            conversation.summary = {"content": content, "upto": upto}
+            return True
+
+    def get_context_profile(self, conversation_id):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            return dict(conversation.context_profile) if conversation and conversation.context_profile else None
+
+    def set_context_profile(self, conversation_id, profile):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None:
+                return False
+            conversation.context_profile = dict(profile) if profile else None
+            return True
+
+    def append(self, conversation_id, *messages):
+        with self._lock:
+            conversation = self._touch_locked(conversation_id)
+            if conversation is None:
+                return None
+            conversation.messages.extend(messages)
+            added = sum(_message_size(m) for m in messages)
+            trimmed = self._trim(conversation.messages)
+            if trimmed:
+                conversation.trimmed += trimmed
+                added = sum(_message_size(m) for m in conversation.messages) - conversation.size
+            conversation.size += added
+            self._bytes += added
+            self._expire_locked()
+            return len(conversation.messages)
+
+    def delete(self, conversation_id):
+        with self._lock:
+            return self._remove_locked(conversation_id) is not None
+
+    def list(self, offset=0, limit=50):
+        with self._lock:
+            self._expire_locked()
+            ordered = list(reversed(self._conversations.items()))
+            page = [
+                {
+                    "id": conversation_id,
+                    "message_count": len(conversation.messages),
+                    "last_access": conversation.last_access,
+                }
+                for conversation_id, conversation in ordered[offset:offset + limit]
+            ]
+            return page, len(ordered)
+
+    def count(self):
+        with self._lock:
+            return len(self._conversations)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "conversations": len(self._conversations),
+                "bytes": self._bytes,
+                "max_conversations": self.max_conversations,
+                "max_bytes": self.max_bytes,
+                "evictions": dict(self.evictions),
+            }
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Conversazioni persistenti su SQLite.
+
+    Le conversazioni attive restano in una cache LRU in memoria; le
+    scritture vengono accodate e applicate a blocchi da un thread in
+    background ogni `flush_interval` secondi (o prima, se la coda
+    raggiunge `batch_size`). Le letture di conversazioni non in cache
+    forzano prima un flush, quindi non vedono mai dati vecchi.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            summary TEXT,
+            summary_upto INTEGER NOT NULL DEFAULT 0,
+            context_profile TEXT
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            conversation_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            PRIMARY KEY (conversation_id, seq)
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_last_access
+            ON conversations (last_access);
+    """
+
+    def __init__(
+        self,
+        path: str = "/data/conversations.db",
+        max_conversations: int = 1000,
+        max_messages: int = 200,
+        idle_ttl: float = 7 * 86400,
+        cache_size: int = 64,
+        flush_interval: float = 2.0,
+        batch_size: int = 100
+    ):
+        """
+        Args:
+            path: File del database SQLite
+            max_conversations: Conversazioni massime nel database
+            max_messages: Messaggi massimi per conversazione (system escluso)
+            idle_ttl: Secondi di inattività dopo cui una conversazione scade
+            cache_size: Conversazioni tenute in memoria
+            flush_interval: Secondi massimi prima di scrivere le modifiche
+            batch_size: Operazioni pendenti che forzano un flush anticipato
+        """
+        super().__init__(max_conversations, max_messages, idle_ttl)
+        self.path = path
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        self._migrate()
+        self._db_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        # id -> [messaggi, seq del prossimo messaggio, riassunto, profilo di contesto]
+        self._cache: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self._pending: List[Tuple[str, tuple]] = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.flushes = 0
+        self.rows_written = 0
+        self.write_errors = 0
+
+        self._writer = threading.Thread(target=self._run_writer, name="conversation-writer", daemon=True)
+        self._writer.start()
+
+    def _migrate(self):
+        """Aggiunge le colonne di riassunto e profilo ai database creati prima."""
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(conversations)")}
+        if "summary" not in columns:
+            self._db.execute("ALTER TABLE conversations ADD COLUMN summary TEXT")
+        if "summary_upto" not in columns:
+            self._db.execute(
+                "ALTER TABLE conversations ADD COLUMN summary_upto INTEGER NOT NULL DEFAULT 0"
+            )
+        if "context_profile" not in columns:
+            self._db.execute("ALTER TABLE conversations ADD COLUMN context_profile TEXT")
+
+    # ------------------------------------------------------------------
+    # Scrittura differita
+    # ------------------------------------------------------------------
+
+    def _queue(self, sql: str, params: tuple):
+        # Chiamato con self._lock acquisito
+        self._pending.append((sql, params))
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        """Scrive subito le operazioni pendenti."""
+        with self._db_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        """
+        Prende e scrive le operazioni pendenti (con `_db_lock` acquisito).
+
+        Prelievo e commit avvengono sotto lo stesso lock: una lettura dal
+        database non può trovare la coda vuota mentre un blocco non è
+        ancora scritto.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            self._db.execute("BEGIN")
+            for sql, params in pending:
+                self._db.execute(sql, params)
+            self._db.execute("COMMIT")
+            written = len(pending)
+        except sqlite3.Error as e:
+            self._db.execute("ROLLBACK")
+            # Un'operazione non valida non deve far perdere le altre del blocco
+            logger.warning(f"⚠️ Scrittura conversazioni fallita ({len(pending)} operazioni), "
+                           f"nuovo tentativo una per una: {e}")
+            written = 0
+            for sql, params in pending:
+                try:
+                    self._db.execute(sql, params)
+                    written += 1
+                except sqlite3.Error as error:
+                    self.write_errors += 1
+                    logger.error(f"❌ Operazione sulle conversazioni scartata: {error} ({sql.split('(')[0].strip()})")
+        self.flushes += 1
+        self.rows_written += written
+
+    def _run_writer(self):
+        last_sweep = 0.0
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            if time.time() - last_sweep > 60:
+                last_sweep = time.time()
+                self._enforce_limits()
+
+    def _enforce_limits(self):
+        """Applica scadenza per inattività e numero massimo di conversazioni."""
+        expired: List[str] = []
+        with self._db_lock:
+            if self.idle_ttl > 0:
+                cutoff = time.time() - self.idle_ttl
+                expired += [row[0] for row in self._db.execute(
+                    "SELECT id FROM conversations WHERE last_access < ?", (cutoff,)
+                )]
+                self.evictions["idle"] += len(expired)
+            overflow = [row[0] for row in self._db.execute(
+                "SELECT id FROM conversations WHERE id NOT IN ({}) ORDER BY last_access DESC "
+                "LIMIT -1 OFFSET ?".format(",".join("?" * len(expired))),
+                (*expired, self.max_conversations)
+            )]
+            self.evictions["lru"] += len(overflow)
+
+        with self._lock:
+            for conversation_id in expired + overflow:
+                self._cache.pop(conversation_id, None)
+                self._queue_delete(conversation_id)
+        if expired or overflow:
+            self.flush()
+            self._notify_removed(expired + overflow)
+
+    def _queue_delete(self, conversation_id: str):
+        self._queue("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+        self._queue("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+    # ------------------------------------------------------------------
+    # Cache
+    # ------------------------------------------------------------------
+
+    def _load(self, conversation_id: str) -> Optional[List[Any]]:
+        with self._lock:
+            entry = self._cache.get(conversation_id)
+            if entry is not None:
+                self._cache.move_to_end(conversation_id)
+                return entry
+
+        # Le modifiche pendenti devono essere su disco prima di leggere
+        with self._db_lock:
+            self._flush_locked()
+            row = self._db.execute(
+                "SELECT summary, summary_upto, context_profile FROM conversations WHERE id = ?",
+                (conversation_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            rows = self._db.execute(
+                "SELECT seq, role, content FROM messages WHERE conversation_id = ? ORDER BY seq",
+                (conversation_id,)
+            ).fetchall()
+
+        messages = [{"role": role, "content": content} for _, role, content in rows]
+        summary = {"content": row[0], "upto": row[1]} if row[0] else None
+        profile = json.loads(row[2]) if row[2] else None
+        entry = [messages, rows[-1][0] + 1 if rows else 0, summary, profile]
+        with self._lock:
+            entry = self._cache.setdefault(conversation_id, entry)
+            self._cache.move_to_end(conversation_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entry
+
+    # ------------------------------------------------------------------
+    # Interfaccia
+    # ------------------------------------------------------------------
+
+    def create(self, conversation_id, messages):
+        now = time.time()
+        # Lo stesso ID può esistere già su disco: lo stato legato va scartato
+        self._notify_removed([conversation_id])
+        with self._lock:
+            self._cache[conversation_id] = [list(messages), len(messages), None, None]
+            self._cache.move_to_end(conversation_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self._queue_delete(conversation_id)
+            self._queue(
+                "INSERT INTO conversations (id, created_at, last_access, message_count) "
+                "VALUES (?, ?, ?, ?)",
+                (conversation_id, now, now, len(messages))
+            )
+            for seq, message in enumerate(messages):
+                self._queue(
+                    "INSERT INTO messages (conversation_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                    (conversation_id, seq, message["role"], message["content"])
+                )
+
+    def exists(self, conversation_id):
+        return self._load(conversation_id) is not None
+
+    def get_messages(self, conversation_id, offset=0, limit=None):
+        entry = self._load(conversation_id)
+        if entry is None:
+            return None
+        with self._lock:
+            end = None if limit is None else offset + limit
+            return list(entry[0][offset:end])
+
+    def message_count(self, conversation_id):
+        entry = self._load(conversation_id)
+        return None if entry is None else len(entry[0])
+
+    def trimmed_count(self, conversation_id):
+        entry = self._load(conversation_id)
+        if entry is None:
+            return None
+        with self._lock:
+            return entry[1] - len(entry[0])
+
+    def get_summary(self, conversation_id):
+        entry = self._load(conversation_id)
+        return dict(entry[2]) if entry and entry[2] else None
+
+    def set_summary(self, conversation_id, content, upto):
+        entry = self._load(conversation_id)
+        if entry is None:
+            return False
+        with self._lock:
+            entry[2] = {"content": content, "upto": upto}
+            self._queue(
+                "UPDATE conversations SET summary = ?, summary_upto = ? WHERE id = ?",
+                (content, upto, conversation_id)
+            )
+        return True
+
+    def get_context_profile(self, conversation_id):
+        entry = self._load(conversation_id)
+        return dict(entry[3]) if entry and entry[3] else None
+
+    def set_context_profile(self, conversation_id, profile):
+        entry = self._load(conversation_id)
+        if entry is None:
+            return False
+        with self._lock:
+            entry[3] = dict(profile) if profile else None
+            self._queue(
+                "UPDATE conversations SET context_profile = ? WHERE id = ?",
+                (json.dumps(entry[3]) if entry[3] else None, conversation_id)
+            )
+        return True
+
+    def append(self, conversation_id, *messages):
+        entry = self._load(conversation_id)
+        if entry is None:
+            return None
+        now = time.time()
+        with self._lock:
+            history = entry[0]
+            for message in messages:
+                history.append(message)
+                self._queue(
+                    "INSERT INTO messages (conversation_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                    (conversation_id, entry[1], message["role"], message["content"])
+                )
+                entry[1] += 1
+
+            head = 1 if history and history[0].get("role") == "system" else 0
+            if self._trim(history):
+                # Su disco restano il system prompt e gli ultimi max_messages
+                self._queue(
+                    "DELETE FROM messages WHERE conversation_id = ? AND seq >= ? AND seq < ?",
+                    (conversation_id, head, entry[1] - (len(history) - head))
+                )
+            self._queue(
+                "UPDATE conversations SET last_access = ?, message_count = ? WHERE id = ?",
+                (now, len(history), conversation_id)
+            )
+            return len(history)
+
+    def delete(self, conversation_id):
+        if self._load(conversation_id) is None:
+            return False
+        with self._lock:
+            self._cache.pop(conversation_id, None)
+            self._queue_delete(conversation_id)
+        self._notify_removed([conversation_id])
+        return True
+
+    def list(self, offset=0, limit=50):
+        with self._db_lock:
+            self._flush_locked()
+            total = self._db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+            rows = self._db.execute(
+                "SELECT id, message_count, last_access FROM conversations "
+                "ORDER BY last_access DESC LIMIT ? OFFSET ?",
+                (limit, offset)
+            ).fetchall()
+        page = [
+            {"id": conversation_id, "message_count": count, "last_access": last_access}
+            for conversation_id, count, last_access in rows
+        ]
+        return page, total
+
+    def count(self):
+        with self._db_lock:
+            self._flush_locked()
+            return self._db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def get_stats(self):
+        with self._lock:
+            pending = len(self._pending)
+            cached = len(self._cache)
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "conversations": self.count(),
+            "cached": cached,
+            "pending_writes": pending,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "write_errors": self.write_errors,
+            "max_conversations": self.max_conversations,
+            "evictions": dict(self.evictions),
+        }
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self._writer.join(timeout=5)
+        self.flush()
+        with self._db_lock:
+            self._db.close()
@@ -0,0 +1,875 @@
+#!/usr/bin/env python3
+"""
+Storia delle entità HA in cache locale, per aggregati compatti nel prompt.
+
+Ogni entità è una serie a colonne (array numpy): istanti, valore, minimo e
+massimo del tratto, incremento del contatore. I valori sono float32, tranne
+per i contatori (float64: 12345.678 kWh non sta in 7 cifre significative).
+La serie è una funzione a gradini: ogni punto vale fino al successivo.
+Copre un intervallo [start, end] e viene estesa chiedendo al recorder solo
+i tratti mancanti; con il mirror connesso i nuovi stati arrivano da
+`state_changed` e la serie resta aggiornata senza altre richieste.
+
+Oltre `max_points` la metà più vecchia della serie viene compattata a
+circa un quarto dei punti: ogni gruppo diventa un punto con la media
+pesata sul tempo (l'integrale non cambia), il minimo e il massimo del
+gruppo e la somma degli incrementi. I dati recenti restano alla massima
+risoluzione, quelli vecchi perdono dettaglio ma non i totali.
+
+Gli intervalli più vecchi della conservazione del recorder (`raw_days`)
+usano le statistiche a lungo termine.
+
+"Quanta energia ieri?" diventa una riga come
+`- sensor.casa_energia (Energia casa): +12.4 kWh; per 4h: 0.8, 0.6, ...`
+invece di migliaia di righe di stato.
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from recorder import RecorderClient, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Stati non numerici con un valore: 1 = attivo, 0 = inattivo
+BINARY_VALUES = {
+    "on": 1.0, "open": 1.0, "home": 1.0, "playing": 1.0, "unlocked": 1.0, "detected": 1.0,
+    "off": 0.0, "closed": 0.0, "not_home": 0.0, "away": 0.0, "idle": 0.0, "paused": 0.0,
+    "locked": 0.0, "clear": 0.0,
+}
+BINARY_DOMAINS = (
+    "binary_sensor", "switch", "light", "fan", "input_boolean", "lock",
+    "cover", "person", "device_tracker", "media_player",
+)
+COUNTER_CLASSES = ("total", "total_increasing")
+
+# Parole chiave della domanda → device_class dei sensori da includere
+KEYWORDS = {
+    "energy": ("energia", "consumo", "consumi", "consumato", "kwh", "energy", "consumption", "consumed"),
+    "power": ("potenza", "watt", "power"),
+    "temperature": ("temperatura", "gradi", "caldo", "freddo", "temperature"),
+    "humidity": ("umidità", "umidita", "humidity"),
+    "gas": ("gas",),
+    "water": ("acqua", "water"),
+    "illuminance": ("luminosità", "luminosita", "lux", "illuminance"),
+}
+
+# "ultime N ore" e simili: (prefissi, secondi, etichetta singolare, plurale)
+PERIOD_UNITS = (
+    (("min",), 60, "ultimo minuto", "ultimi {} minuti"),
+    (("or", "hour"), 3600, "ultima ora", "ultime {} ore"),
+    (("giorn", "day"), 86400, "ultimo giorno", "ultimi {} giorni"),
+    (("settiman", "week"), 604800, "ultima settimana", "ultime {} settimane"),
+)
+
+# Entità massime aggiunte al prompt per domanda
+MAX_CONTEXT_ENTITIES = 6
+
+
+def numeric(state: Any) -> float:
+    """Valore numerico di uno stato HA (NaN se non rappresentabile)."""
+    try:
+        return float(state)
+    except (TypeError, ValueError):
+        return BINARY_VALUES.get(str(state).lower(), np.nan)
+
+
+def _counter_increments(values: np.ndarray, previous: float, resets: bool) -> np.ndarray:
+    """
+    Incremento di ogni punto rispetto al precedente valore valido.
+
+    Con `resets` un calo è un azzeramento del contatore (total_increasing):
+    l'incremento è il nuovo valore, come nelle statistiche di HA.
+    """
+    full = np.concatenate(([previous], values.astype(np.float64)))
+    finite = np.isfinite(full)
+    index = np.where(finite, np.arange(len(full)), 0)
+    np.maximum.accumulate(index, out=index)
+    filled = full[index]
+    delta = filled[1:] - filled[:-1]
+    if resets:
+        delta = np.where(delta < 0, filled[1:], delta)
+    return np.nan_to_num(delta, nan=0.0)
+
+
+def _last_finite(values: np.ndarray) -> float:
+    finite = values[np.isfinite(values)]
+    return float(finite[-1]) if len(finite) else np.nan
+
+
+class Series:
+    """Serie a gradini di un'entità su un intervallo coperto [start, end]."""
+
+    __slots__ = ("t", "v", "lo", "hi", "inc", "start", "end", "first", "counter", "resets", "dtype", "live", "session", "compactions")
+
+    def __init__(self, counter: bool = False, resets: bool = False):
+        self.dtype = np.float64 if counter else np.float32
+        self.t = np.empty(0, np.float64)
+        self.v = np.empty(0, self.dtype)
+        self.lo = np.empty(0, self.dtype)
+        self.hi = np.empty(0, self.dtype)
+        self.inc = np.empty(0, np.float64)
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+        # Primo valore grezzo (per l'incremento quando si aggiungono dati più vecchi)
+        self.first = np.nan
+        self.counter = counter
+        self.resets = resets
+        self.live = False
+        # Sessione del mirror in cui la serie è diventata live
+        self.session = -1
+        self.compactions = 0
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    def missing(self, start: float, end: float) -> List[Tuple[float, float]]:
+        """Tratti di [start, end] non ancora coperti."""
+        if self.start is None:
+            return [(start, end)]
+        ranges = []
+        if start < self.start:
+            ranges.append((start, self.start))
+        if end > self.end:
+            ranges.append((self.end, end))
+        return ranges
+
+    def merge(self, t: np.ndarray, v: np.ndarray, start: float, end: float):
+        """
+        Aggiunge i punti letti dal recorder per [start, end].
+
+        I punti già coperti vengono scartati: il primo punto restituito da
+        HA è lo stato in vigore all'inizio dell'intervallo, già noto.
+        """
+        if self.start is None:
+            self._set(t, v, self._increments(v, np.nan))
+            self.start, self.end = start, end
+            self.first = float(v[0]) if len(v) else np.nan
+        elif start < self.start:
+            keep = t < self.start
+            t, v = t[keep], v[keep]
+            if len(t):
+                inc = self.inc.copy()
+                if self.counter and len(inc):
+                    # Incremento tra i nuovi dati e il primo valore già presente
+                    inc[0] += _counter_increments(np.array([self.first]), _last_finite(v), self.resets)[0]
+                self._set(
+                    np.concatenate((t, self.t)),
+                    np.concatenate((v, self.v)),
+                    np.concatenate((self._increments(v, np.nan), inc)),
+                    lo=np.concatenate((v, self.lo)),
+                    hi=np.concatenate((v, self.hi)),
+                )
+                self.first = float(v[0])
+            self.start = start
+        else:
+            cutoff = max(self.end, self.t[-1]) if len(self.t) else self.end
+            keep = t > cutoff
+            self.append(t[keep], v[keep])
+            self.end = max(self.end, end)
+
+    def append(self, t: np.ndarray, v: np.ndarray):
+        """Punti successivi all'ultimo (dal recorder o dal mirror)."""
+        if not len(t):
+            return
+        if not len(self.t):
+            self.first = float(v[0])
+        inc = self._increments(v, _last_finite(self.v))
+        self._set(
+            np.concatenate((self.t, t)),
+            np.concatenate((self.v, v)),
+            np.concatenate((self.inc, inc)),
+            lo=np.concatenate((self.lo, v)),
+            hi=np.concatenate((self.hi, v)),
+        )
+
+    def compact(self, max_points: int) -> bool:
+        """
+        Compatta la metà più vecchia della serie finché supera `max_points`.
+
+        Ogni gruppo di punti consecutivi diventa un punto all'istante del
+        primo, con la media pesata sul tempo fino al punto successivo al
+        gruppo: l'integrale (e quindi la media di qualsiasi intervallo che
+        contiene interi gruppi) resta invariato. Per i contatori il valore
+        è l'ultimo del gruppo e gli incrementi vengono sommati.
+
+        Returns:
+            True se la serie è stata compattata
+        """
+        compacted = False
+        while len(self.t) > max_points:
+            self._compact_oldest_half()
+            compacted = True
+        return compacted
+
+    def _compact_oldest_half(self):
+        m = len(self.t) // 2
+        t = self.t
+        groups = max(m // 4, 1)
+        width = (t[m] - t[0]) / groups or 1.0
+        bucket = np.floor((t[:m] - t[0]) / width).astype(np.int64)
+        starts = np.flatnonzero(np.diff(bucket, prepend=-1))
+        ends = np.append(starts[1:], m)
+
+        v = self.v[:m].astype(np.float64)
+        finite = np.isfinite(v)
+        dt = t[1:m + 1] - t[:m]
+        weight = np.add.reduceat(np.where(finite, dt, 0.0), starts)
+        integral = np.add.reduceat(np.where(finite, v * dt, 0.0), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(weight > 0, integral / np.where(weight > 0, weight, 1.0), np.nan)
+        values = self.v[ends - 1] if self.counter else mean
+
+        self._set(
+            np.concatenate((t[starts], t[m:])),
+            np.concatenate((values, self.v[m:])),
+            np.concatenate((np.add.reduceat(self.inc[:m], starts), self.inc[m:])),
+            lo=np.concatenate((np.fmin.reduceat(self.lo[:m], starts), self.lo[m:])),
+            hi=np.concatenate((np.fmax.reduceat(self.hi[:m], starts), self.hi[m:])),
+        )
+        self.compactions += 1
+
+    def snapshot(self) -> "Series":
+        """Copia leggera (gli array vengono sostituiti, mai modificati)."""
+        copy = Series(self.counter, self.resets)
+        for name in ("t", "v", "lo", "hi", "inc", "start", "end", "first"):
+            setattr(copy, name, getattr(self, name))
+        return copy
+
+    def _increments(self, v: np.ndarray, previous: float) -> np.ndarray:
+        if not self.counter:
+            return np.zeros(len(v))
+        return _counter_increments(v, previous, self.resets)
+
+    def _set(self, t, v, inc, lo=None, hi=None):
+        self.t = t
+        self.v = v.astype(self.dtype, copy=False)
+        self.inc = inc
+        self.lo = (v if lo is None else lo).astype(self.dtype, copy=False)
+        self.hi = (v if hi is None else hi).astype(self.dtype, copy=False)
+
+
+def aggregate_series(series: Series, edges: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Media pesata sul tempo, minimo, massimo, incremento e ultimo valore per bucket.
+
+    Args:
+        series: Serie (copia da `snapshot()`)
+        edges: Estremi dei bucket, crescenti (B+1 valori per B bucket)
+
+    Returns:
+        {"mean", "min", "max", "change", "last"}: array di B valori (NaN senza dati)
+    """
+    t = series.t
+    buckets = len(edges) - 1
+    empty = np.full(buckets, np.nan)
+    if not len(t):
+        return {"mean": empty, "min": empty, "max": empty, "change": np.zeros(buckets), "last": empty}
+
+    v = series.v.astype(np.float64)
+    finite = np.isfinite(v)
+    v0 = np.where(finite, v, 0.0)
+    dt = np.maximum(np.append(t[1:], series.end) - t, 0.0)
+    integral = np.concatenate(([0.0], np.cumsum(v0 * dt)))
+    weight = np.concatenate(([0.0], np.cumsum(finite * dt)))
+
+    # Integrale da t[0] a ogni estremo: punto in vigore + tratto parziale
+    x = np.clip(edges, t[0], max(series.end, t[0]))
+    k = np.searchsorted(t, x, side="right") - 1
+    partial = x - t[k]
+    at_integral = integral[k] + v0[k] * partial
+    at_weight = weight[k] + finite[k] * partial
+    d_integral, d_weight = np.diff(at_integral), np.diff(at_weight)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(d_weight > 0, d_integral / np.where(d_weight > 0, d_weight, 1.0), np.nan)
+
+    # Minimo e massimo: punti in vigore durante il bucket
+    first = np.maximum(np.searchsorted(t, edges[:-1], side="right") - 1, 0)
+    last = np.searchsorted(t, edges[1:], side="left") - 1
+    lows, highs = np.full(buckets, np.nan), np.full(buckets, np.nan)
+    for i in range(buckets):
+        if last[i] >= first[i] and edges[i + 1] > t[0] and edges[i] < series.end:
+            lows[i] = np.fmin.reduce(series.lo[first[i]:last[i] + 1])
+            highs[i] = np.fmax.reduce(series.hi[first[i]:last[i] + 1])
+
+    cumulative = np.concatenate(([0.0], np.cumsum(series.inc)))
+    # Bucket chiusi a sinistra: un gruppo compattato porta i suoi incrementi all'istante iniziale
+    positions = np.searchsorted(t, edges, side="left")
+    change = np.diff(cumulative[positions])
+
+    filled = np.where(finite, np.arange(len(v)), 0)
+    np.maximum.accumulate(filled, out=filled)
+    last_values = np.where(last >= 0, v[filled[np.maximum(last, 0)]], np.nan)
+    return {"mean": mean, "min": lows, "max": highs, "change": change, "last": last_values}
+
+
+def aggregate_statistics(rows: List[Dict[str, Any]], edges: np.ndarray) -> Dict[str, np.ndarray]:
+    """Come `aggregate_series`, dalle righe delle statistiche a lungo termine."""
+    buckets = len(edges) - 1
+    sums = np.zeros(buckets)
+    counts = np.zeros(buckets)
+    lows, highs = np.full(buckets, np.nan), np.full(buckets, np.nan)
+    change = np.zeros(buckets)
+    last = np.full(buckets, np.nan)
+    for row in rows:
+        i = int(np.searchsorted(edges, row["start"], side="right")) - 1
+        if not 0 <= i < buckets:
+            continue
+        if row.get("mean") is not None:
+            sums[i] += row["mean"]
+            counts[i] += 1
+        if row.get("min") is not None:
+            lows[i] = np.fmin(lows[i], row["min"])
+        if row.get("max") is not None:
+            highs[i] = np.fmax(highs[i], row["max"])
+        change[i] += row.get("change") or 0.0
+        value = row.get("state", row.get("mean"))
+        if value is not None:
+            last[i] = value
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(counts > 0, sums / np.where(counts > 0, counts, 1), np.nan)
+    return {"mean": mean, "min": lows, "max": highs, "change": change, "last": last}
+
+
+def parse_period(text: str, now: Optional[datetime] = None) -> Optional[Tuple[datetime, datetime, str]]:
+    """
+    Intervallo di tempo citato in una domanda (italiano o inglese).
+
+    Riconosce "ieri", "oggi", "ultime N ore/giorni", "ultima ora",
+    "settimana scorsa", "questa settimana", "mese scorso", "questo mese"
+    e gli equivalenti inglesi.
+
+    Args:
+        text: Testo della domanda
+        now: Istante corrente con fuso orario (default: ora locale)
+
+    Returns:
+        (inizio, fine, etichetta) o None se il testo non cita un periodo
+    """
+    now = now or datetime.now().astimezone()
+    text = text.lower()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    match = re.search(r"\b(?:ultim[aeio]|last|past)\s+(\d+)?\s*([a-z]+)", text)
+    if match:
+        count = int(match.group(1) or 1)
+        for prefixes, seconds, singular, plural in PERIOD_UNITS:
+            if not match.group(2).startswith(prefixes):
+                continue
+            # "last week" è la settimana scorsa, non gli ultimi 7 giorni
+            if seconds == 604800 and not match.group(1) and not match.group(0).startswith("ultim"):
+                break
+            return now - timedelta(seconds=count * seconds), now, plural.format(count) if count > 1 else singular
+
+    if re.search(r"\b(?:ieri|yesterday)\b", text):
+        return midnight - timedelta(days=1), midnight, "ieri"
+    if re.search(r"\b(?:oggi|today|stamattina|this morning)\b", text):
+        return midnight, now, "oggi"
+
+    week_start = midnight - timedelta(days=midnight.weekday())
+    if re.search(r"\b(?:settimana scorsa|scorsa settimana|last week)\b", text):
+        return week_start - timedelta(weeks=1), week_start, "settimana scorsa"
+    if re.search(r"\b(?:questa settimana|this week)\b", text):
+        return week_start, now, "questa settimana"
+
+    month_start = midnight.replace(day=1)
+    if re.search(r"\b(?:mese scorso|scorso mese|last month)\b", text):
+        previous = (month_start - timedelta(days=1)).replace(day=1)
+        return previous, month_start, "mese scorso"
+    if re.search(r"\b(?:questo mese|this month)\b", text):
+        return month_start, now, "questo mese"
+    return None
+
+
+def parse_range(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    period: Optional[str] = None,
+    now: Optional[datetime] = None,
+    default_hours: float = 24.0
+) -> Tuple[datetime, datetime, str]:
+    """
+    Intervallo da parametri di richiesta: periodo in testo o start/end ISO 8601.
+
+    Args:
+        start: Inizio ISO 8601 (default: `default_hours` prima della fine)
+        end: Fine ISO 8601 (default: adesso)
+        period: Periodo in testo ("ieri", "ultime 6 ore", ...), alternativo a start/end
+        now: Istante corrente con fuso orario (default: ora locale)
+        default_hours: Durata senza start
+
+    Returns:
+        (inizio, fine, etichetta)
+
+    Raises:
+        ValueError: Se il periodo o le date non sono validi
+    """
+    now = now or datetime.now().astimezone()
+    if period:
+        parsed = parse_period(period, now)
+        if parsed is None:
+            raise ValueError(f"Periodo non riconosciuto: {period}")
+        return parsed
+    end_dt = _parse_datetime(end, now) if end else now
+    start_dt = _parse_datetime(start, now) if start else end_dt - timedelta(hours=default_hours)
+    if start_dt >= end_dt:
+        raise ValueError("'start' deve precedere 'end'")
+    return start_dt, end_dt, "periodo richiesto"
+
+
+def _parse_datetime(value: str, now: datetime) -> datetime:
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"Data non valida: {value}")
+    # Date senza fuso: ora locale, come in Home Assistant
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=now.tzinfo)
+
+
+def select_entities(
+    text: str,
+    states: Iterable[Dict[str, Any]],
+    areas: Optional[Dict[str, str]] = None,
+    limit: int = MAX_CONTEXT_ENTITIES
+) -> List[str]:
+    """
+    Entità a cui si riferisce una domanda sulla storia.
+
+    Sensori con la device_class delle parole chiave (energia, temperatura,
+    ...) ed entità il cui nome compare nel testo; se il testo cita
+    un'area, vengono preferite le entità di quell'area.
+
+    Args:
+        text: Testo della domanda
+        states: Stati correnti
+        areas: entity_id → nome dell'area
+        limit: Entità massime
+
+    Returns:
+        entity_id in ordine di pertinenza
+    """
+    text = text.lower()
+    classes = {cls for cls, words in KEYWORDS.items() if any(w in text for w in words)}
+    areas = areas or {}
+    mentioned_areas = {name.lower() for name in set(areas.values()) if name and name.lower() in text}
+
+    scored = []
+    for state in states:
+        entity_id = state.get("entity_id", "")
+        attributes = state.get("attributes") or {}
+        name = str(attributes.get("friendly_name") or "").lower()
+        score = 0
+        if name and name in text:
+            score += 4
+        if attributes.get("device_class") in classes and entity_id.startswith("sensor."):
+            score += 2
+            # Per l'energia contano i contatori, non i sensori istantanei
+            if attributes.get("state_class") in COUNTER_CLASSES:
+                score += 1
+        if not score:
+            continue
+        area = (areas.get(entity_id) or "").lower()
+        in_area = area in mentioned_areas or any(a in name for a in mentioned_areas)
+        scored.append((-score - (3 if in_area else 0), entity_id, in_area or score >= 4))
+
+    # Con un'area citata restano le sue entità, se ce ne sono
+    if mentioned_areas and any(keep for _, _, keep in scored):
+        scored = [item for item in scored if item[2]]
+    return [entity_id for _, entity_id, _ in sorted(scored)[:limit]]
+
+
+def _fmt(value: float) -> str:
+    if value is None or not np.isfinite(value):
+        return "-"
+    if abs(value) >= 100:
+        return f"{value:.0f}"
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+def _fmt_duration(seconds: float) -> str:
+    if seconds % 86400 == 0:
+        return f"{int(seconds // 86400)}g"
+    if seconds % 3600 == 0:
+        return f"{int(seconds // 3600)}h"
+    return f"{int(round(seconds / 60))}min"
+
+
+class HistoryCache:
+    """Cache delle serie storiche per entità, con estensione incrementale."""
+
+    def __init__(
+        self,
+        recorder: RecorderClient,
+        mirror=None,
+        max_series: int = 64,
+        max_points: int = 10000,
+        raw_days: float = 10.0,
+        live_window: float = 60.0,
+        statistics_cache: int = 128
+    ):
+        """
+        Args:
+            recorder: Client del recorder HA
+            mirror: StateMirror opzionale (metadati delle entità e aggiornamento live)
+            max_series: Entità massime in cache (LRU)
+            max_points: Punti massimi per serie prima della compattazione
+            raw_days: Giorni di storia conservati dal recorder (`purge_keep_days`);
+                gli intervalli più vecchi usano le statistiche a lungo termine
+            live_window: Una serie letta fino a meno di questi secondi fa
+                viene poi aggiornata dagli eventi del mirror
+            statistics_cache: Risposte delle statistiche (intervalli chiusi) in cache
+        """
+        self.recorder = recorder
+        self.mirror = mirror
+        self.max_series = max_series
+        self.max_points = max_points
+        self.raw_days = raw_days
+        self.live_window = live_window
+        self.statistics_cache = statistics_cache
+
+        self._lock = threading.Lock()
+        self._series: "OrderedDict[str, Series]" = OrderedDict()
+        self._statistics: "OrderedDict[Tuple, List[Dict[str, Any]]]" = OrderedDict()
+
+        self.queries = 0
+        self.hits = 0
+        self.fetches = 0
+        self.fetched_points = 0
+        self.live_points = 0
+        self.compactions = 0
+        self.evictions = 0
+        self.statistics_queries = 0
+        self.statistics_hits = 0
+
+        if mirror is not None:
+            mirror.add_listener(self._on_state_changed)
+            mirror.add_resync_listener(self._on_resync)
+
+    # ------------------------------------------------------------------
+    # Aggregati
+    # ------------------------------------------------------------------
+
+    def aggregate(
+        self,
+        entity_id: str,
+        start: float,
+        end: float,
+        buckets: int = 0,
+        now: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        Aggregati di un'entità su [start, end], in totale e per bucket.
+
+        Args:
+            entity_id: Entità
+            start: Inizio (secondi epoch)
+            end: Fine (secondi epoch)
+            buckets: Bucket di uguale durata (0 = solo il totale)
+            now: Istante corrente (default: time.time())
+
+        Returns:
+            {"entity_id", "name", "unit", "kind", "source", "start", "end",
+             "mean", "min", "max", "last", "change", "buckets": [...]}
+
+        Raises:
+            ValueError: Se l'intervallo non è valido
+        """
+        now = time.time() if now is None else now
+        end = min(end, now)
+        if not start < end:
+            raise ValueError("Intervallo non valido: 'start' deve precedere 'end'")
+        buckets = max(int(buckets), 0)
+        meta = self._meta(entity_id)
+        with self._lock:
+            self.queries += 1
+
+        # Totale e bucket insieme: il primo estremo è l'intero intervallo
+        edges = np.linspace(start, end, (buckets or 1) + 1)
+        bounds = np.array([start, end])
+        source = "history"
+        rows = self._statistics_rows(entity_id, start, end, now) if start < now - self.raw_days * 86400 else []
+        if rows:
+            source = "statistics"
+            total, stats = aggregate_statistics(rows, bounds), aggregate_statistics(rows, edges)
+        else:
+            series = self._ensure(entity_id, start, end, now, meta)
+            total, stats = aggregate_series(series, bounds), aggregate_series(series, edges)
+
+        result = {
+            "entity_id": entity_id,
+            "name": meta["name"],
+            "unit": meta["unit"],
+            "kind": meta["kind"],
+            "source": source,
+            "start": start,
+            "end": end,
+            "mean": _float(total["mean"][0]),
+            "min": _float(total["min"][0]),
+            "max": _float(total["max"][0]),
+            "last": _float(total["last"][0]),
+        }
+        if meta["kind"] == "counter":
+            result["change"] = _float(total["change"][0])
+        if buckets:
+            result["bucket_s"] = (end - start) / buckets
+            result["buckets"] = [
+                {
+                    "start": float(edges[i]),
+                    "mean": _float(stats["mean"][i]),
+                    "min": _float(stats["min"][i]),
+                    "max": _float(stats["max"][i]),
+                    **({"change": _float(stats["change"][i])} if meta["kind"] == "counter" else {}),
+                }
+                for i in range(buckets)
+            ]
+        return result
+
+    def statistics(
+        self,
+        statistic_ids: List[str],
+        start: float,
+        end: float,
+        period: str = "hour",
+        now: Optional[float] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """Statistiche a lungo termine, in cache per gli intervalli chiusi."""
+        now = time.time() if now is None else now
+        key = (tuple(sorted(statistic_ids)), start, end, period)
+        with self._lock:
+            self.statistics_queries += 1
+            cached = self._statistics.get(key)
+            if cached is not None:
+                self._statistics.move_to_end(key)
+                self.statistics_hits += 1
+                return cached
+        result = self.recorder.statistics(statistic_ids, start, end, period)
+        # Un intervallo concluso da più di un periodo non cambia più
+        if end < now - 3600:
+            with self._lock:
+                self._statistics[key] = result
+                while len(self._statistics) > self.statistics_cache:
+                    self._statistics.popitem(last=False)
+        return result
+
+    # ------------------------------------------------------------------
+    # Contesto per il prompt
+    # ------------------------------------------------------------------
+
+    def context(
+        self,
+        text: str,
+        entity_ids: Optional[List[str]] = None,
+        period: Optional[Tuple[datetime, datetime, str]] = None,
+        buckets: int = 6
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Blocco "STORICO" per una domanda che cita un periodo.
+
+        Args:
+            text: Domanda dell'utente
+            entity_ids: Entità da usare (default: scelte dal testo)
+            period: (inizio, fine, etichetta) (default: ricavato dal testo)
+            buckets: Valori intermedi per entità
+
+        Returns:
+            {"text", "entities", "period", "duration_ms"} o None se la
+            domanda non riguarda la storia
+        """
+        period = period or parse_period(text)
+        if period is None:
+            return None
+        if entity_ids is None:
+            if self.mirror is None or not self.mirror.ready:
+                return None
+            states = self.mirror.get_states()
+            names = self.mirror.get_areas()
+            areas = {s["entity_id"]: names.get(self.mirror.get_area(s["entity_id"])) for s in states}
+            entity_ids = select_entities(text, states, areas)
+        if not entity_ids:
+            return None
+
+        started = time.perf_counter()
+        start, end, label = period
+        lines = []
+        for entity_id in entity_ids[:MAX_CONTEXT_ENTITIES]:
+            try:
+                lines.append(self.render(self.aggregate(entity_id, start.timestamp(), end.timestamp(), buckets)))
+            except Exception as e:
+                logger.warning(f"⚠️ Storia di {entity_id} non disponibile: {e}")
+        if not lines:
+            return None
+        header = f"STORICO ({label}, {start:%d/%m %H:%M} – {end:%d/%m %H:%M}):"
+        return {
+            "text": "\n".join([header] + lines),
+            "entities": entity_ids[:MAX_CONTEXT_ENTITIES],
+            "period": {"label": label, "start": start.isoformat(), "end": end.isoformat()},
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+
+    @staticmethod
+    def render(result: Dict[str, Any]) -> str:
+        """Una riga di prompt con gli aggregati di `aggregate()`."""
+        unit = f" {result['unit']}" if result.get("unit") else ""
+        line = f"- {result['entity_id']}"
+        if result.get("name"):
+            line += f" ({result['name']})"
+        kind = result["kind"]
+        if kind == "counter":
+            change = result.get("change")
+            line += f": {'+' if change and change > 0 else ''}{_fmt(change)}{unit}"
+            series = [b.get("change") for b in result.get("buckets", [])]
+        elif kind == "binary":
+            mean = result.get("mean")
+            active = f"{_fmt(mean * 100)}%" if mean is not None else "-"
+            line += f": attivo {active} del tempo, ora {'attivo' if result.get('last') == 1 else 'inattivo'}"
+            series = []
+        else:
+            line += (f": media {_fmt(result.get('mean'))}{unit}, min {_fmt(result.get('min'))}, "
+                     f"max {_fmt(result.get('max'))}, ultimo {_fmt(result.get('last'))}")
+            series = [b.get("mean") for b in result.get("buckets", [])]
+        if series:
+            line += f"; per {_fmt_duration(result['bucket_s'])}: {', '.join(_fmt(x) for x in series)}"
+        return line
+
+    # ------------------------------------------------------------------
+    # Serie
+    # ------------------------------------------------------------------
+
+    def _ensure(self, entity_id: str, start: float, end: float, now: float, meta: Dict[str, Any]) -> Series:
+        """Serie che copre [start, end]: legge dal recorder solo i tratti mancanti."""
+        with self._lock:
+            series = self._series.get(entity_id)
+            if series is None:
+                series = Series(counter=meta["kind"] == "counter", resets=meta["resets"])
+                self._series[entity_id] = series
+                while len(self._series) > self.max_series:
+                    self._series.popitem(last=False)
+                    self.evictions += 1
+            self._series.move_to_end(entity_id)
+            if series.live:
+                if self._is_live(series):
+                    series.end = max(series.end, now)
+                else:
+                    series.live = False
+            session = self._session()
+            ranges = series.missing(start, end)
+            if not ranges:
+                self.hits += 1
+                return series.snapshot()
+
+        for range_start, range_end in ranges:
+            points = self.recorder.history(entity_id, range_start, range_end)
+            t = np.fromiter((p[0] for p in points), np.float64, len(points))
+            v = np.fromiter((numeric(p[1]) for p in points), np.float64, len(points))
+            with self._lock:
+                series.merge(t, v, range_start, range_end)
+                self.fetches += 1
+                self.fetched_points += len(points)
+                # Sessione cambiata durante la lettura: eventi persi, niente live
+                if range_end >= now - self.live_window and self._connected() and self._session() == session:
+                    series.live = True
+                    series.session = session
+                if series.compact(self.max_points):
+                    self.compactions += 1
+        with self._lock:
+            return series.snapshot()
+
+    def _statistics_rows(self, entity_id: str, start: float, end: float, now: float) -> List[Dict[str, Any]]:
+        period = "hour" if end - start <= 7 * 86400 else "day"
+        try:
+            return self.statistics([entity_id], start, end, period, now).get(entity_id) or []
+        except Exception as e:
+            logger.warning(f"⚠️ Statistiche di {entity_id} non disponibili: {e}")
+            return []
+
+    def _meta(self, entity_id: str) -> Dict[str, Any]:
+        state = self.mirror.get_state(entity_id) if self.mirror is not None else None
+        attributes = (state or {}).get("attributes") or {}
+        state_class = attributes.get("state_class")
+        if state_class in COUNTER_CLASSES:
+            kind = "counter"
+        elif entity_id.split(".", 1)[0] in BINARY_DOMAINS or (
+                state is not None and str(state.get("state")).lower() in BINARY_VALUES):
+            kind = "binary"
+        else:
+            kind = "measurement"
+        return {
+            "name": attributes.get("friendly_name"),
+            "unit": attributes.get("unit_of_measurement"),
+            "kind": kind,
+            "resets": state_class == "total_increasing",
+        }
+
+    def _connected(self) -> bool:
+        return self.mirror is not None and self.mirror.connected
+
+    def _session(self) -> int:
+        return self.mirror.session if self.mirror is not None else -1
+
+    def _is_live(self, series: Series) -> bool:
+        """Live solo nella stessa sessione del mirror: dopo una disconnessione il tratto mancante si rilegge."""
+        return series.live and series.session == self._session() and self._connected()
+
+    def _on_state_changed(self, entity_id: str, old_state, new_state):
+        if not new_state:
+            return
+        with self._lock:
+            series = self._series.get(entity_id)
+            if series is None or not series.live:
+                return
+            if not self._is_live(series):
+                # Stato riportato dal riallineamento dopo una disconnessione:
+                # i cambi intermedi vanno riletti dal recorder
+                series.live = False
+                return
+            changed = new_state.get("last_changed") or new_state.get("last_updated")
+            try:
+                t = parse_timestamp(changed) if changed else time.time()
+            except ValueError:
+                return
+            if len(series) and t <= series.t[-1]:
+                # Cambio dei soli attributi: lo stato è lo stesso
+                return
+            series.append(np.array([t]), np.array([numeric(new_state.get("state"))]))
+            series.end = max(series.end, t)
+            self.live_points += 1
+            if series.compact(self.max_points):
+                self.compactions += 1
+
+    def _on_resync(self):
+        # Eventi persi durante la disconnessione: il tratto mancante si rilegge
+        with self._lock:
+            for series in self._series.values():
+                series.live = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "series": len(self._series),
+                "points": sum(len(s) for s in self._series.values()),
+                "live_series": sum(1 for s in self._series.values() if s.live),
+                "queries": self.queries,
+                "hits": self.hits,
+                "fetches": self.fetches,
+                "fetched_points": self.fetched_points,
+                "live_points": self.live_points,
+                "compactions": self.compactions,
+                "evictions": self.evictions,
+                "statistics_queries": self.statistics_queries,
+                "statistics_hits": self.statistics_hits,
+            }
+        stats["recorder"] = self.recorder.get_stats()
+        return stats
+
+
+def _float(value: Any) -> Optional[float]:
+    value = float(value)
+    return round(value, 4) if np.isfinite(value) else None
+
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Indice delle entità Home Assistant per `/api/ha/entities`.
+
+Tiene, accanto agli stati del mirror, indici secondari per dominio,
+area, device_class e stato: un filtro è un'intersezione di insiemi,
+non una scansione di tutte le entità. Sopra l'indice:
+- proiezione dei campi (`fields=entity_id,state,attributes.friendly_name`),
+  così i client ricevono solo ciò che usano;
+- paginazione a cursore, ordinata per entity_id e stabile tra le pagine;
+- ETag calcolato dai `last_updated` delle entità della pagina: una pagina
+  di luci resta valida finché non cambia una luce, anche se i sensori
+  cambiano ogni secondo.
+"""
+
+import base64
+import binascii
+import hashlib
+import logging
+import threading
+import time
+from bisect import bisect_right, insort
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Filtri serviti dagli indici secondari (parametro → indice)
+INDEXED_FILTERS = (
+    ("domain", "domain"),
+    ("area", "area"),
+    ("device_class", "device_class"),
+    ("state", "state"),
+)
+
+# Campo virtuale: area dell'entità dai registri HA
+AREA_FIELD = "area_id"
+
+# Entità massime per pagina
+MAX_PAGE_SIZE = 5000
+
+
+def encode_cursor(entity_id: str) -> str:
+    return base64.urlsafe_b64encode(entity_id.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    """
+    Raises:
+        ValueError: Se il cursore non è valido
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return base64.b64decode(padded, altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError("Cursore non valido")
+
+
+class EntityQuery:
+    """Filtri, proiezione e pagina richiesti."""
+
+    __slots__ = ("filters", "attributes", "fields", "cursor", "limit")
+
+    def __init__(
+        self,
+        filters: Optional[Dict[str, Tuple[str, ...]]] = None,
+        attributes: Optional[Dict[str, str]] = None,
+        fields: Optional[Tuple[str, ...]] = None,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None
+    ):
+        """
+        Args:
+            filters: Filtri indicizzati (domain, area, device_class, state);
+                più valori per lo stesso filtro sono in OR
+            attributes: Attributi richiesti con il loro valore (confronto testuale)
+            fields: Campi da restituire (None = stato completo)
+            cursor: entity_id dopo cui iniziare
+            limit: Entità massime restituite (None = tutte)
+        """
+        self.filters = filters or {}
+        self.attributes = attributes or {}
+        self.fields = fields
+        self.cursor = cursor
+        self.limit = limit
+
+    @classmethod
+    def from_args(cls, args) -> "EntityQuery":
+        """
+        Query dai parametri della richiesta.
+
+        `domain=light,switch&area=cucina&attributes.unit_of_measurement=°C`
+        `&fields=entity_id,state,attributes.friendly_name&limit=100&cursor=...`
+
+        Raises:
+            ValueError: Se un parametro non è valido
+        """
+        filters = {}
+        for param, name in INDEXED_FILTERS:
+            values = _split(args.get(param))
+            if values:
+                filters[name] = values
+        attributes = {
+            key.split(".", 1)[1]: value
+            for key, value in args.items()
+            if key.startswith("attributes.") and key != "attributes."
+        }
+        fields = _split(args.get("fields"))
+
+        limit = args.get("limit")
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise ValueError("'limit' deve essere un intero")
+            if limit < 1:
+                raise ValueError("'limit' deve essere almeno 1")
+            limit = min(limit, MAX_PAGE_SIZE)
+
+        cursor = args.get("cursor")
+        return cls(filters, attributes, fields, decode_cursor(cursor) if cursor else None, limit)
+
+
+class EntityPage:
+    """Risultato di una query."""
+
+    __slots__ = ("entities", "total", "next_cursor", "etag")
+
+    def __init__(self, entities: List[Dict[str, Any]], total: int, next_cursor: Optional[str], etag: str):
+        self.entities = entities
+        self.total = total
+        self.next_cursor = next_cursor
+        self.etag = etag
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "entities": self.entities,
+            "count": len(self.entities),
+            "total": self.total,
+            "next_cursor": self.next_cursor,
+        }
+
+
+class EntityIndex:
+    """Stati delle entità con indici secondari, aggiornati dal mirror."""
+
+    def __init__(self, mirror=None):
+        """
+        Args:
+            mirror: StateMirror da cui ricevere i cambi di stato e le aree
+                (None = indice statico, popolato con `from_states`)
+        """
+        self.mirror = mirror
+        self._lock = threading.Lock()
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self._sorted: List[str] = []
+        self._indexes: Dict[str, Dict[str, Set[str]]] = {name: {} for _, name in INDEXED_FILTERS}
+        self._area_version = -1
+
+        self.queries = 0
+        self.query_time = 0.0
+        self.returned = 0
+        self.not_modified = 0
+
+        if mirror is not None:
+            mirror.add_listener(self._on_state_changed)
+
+    @classmethod
+    def from_states(cls, states: Iterable[Dict[str, Any]]) -> "EntityIndex":
+        """Indice statico da una lista di stati (es. `GET /api/states`)."""
+        index = cls()
+        for state in states:
+            if state and state.get("entity_id"):
+                index._add(state["entity_id"], state)
+        return index
+
+    @property
+    def ready(self) -> bool:
+        return self.mirror is None or self.mirror.ready
+
+    # ------------------------------------------------------------------
+    # Query
+    # ------------------------------------------------------------------
+
+    def query(self, query: EntityQuery) -> EntityPage:
+        """
+        Esegue una query sull'indice.
+
+        Args:
+            query: Filtri, proiezione e pagina
+
+        Returns:
+            Pagina di entità (proiettate se richiesto) con cursore ed ETag
+        """
+        started = time.perf_counter()
+        with self._lock:
+            self._refresh_areas()
+            candidates = self._candidates(query.filters)
+            start = bisect_right(candidates, query.cursor) if query.cursor else 0
+            if query.attributes:
+                matched, total, more = self._scan(candidates, start, query)
+            else:
+                total = len(candidates)
+                end = start + query.limit if query.limit else total
+                matched = candidates[start:end]
+                more = end < total
+            states = [self._states[entity_id] for entity_id in matched]
+            area_version = self._area_version
+
+        next_cursor = encode_cursor(matched[-1]) if more and matched else None
+
+        entities = states if query.fields is None else [self._project(s, query.fields) for s in states]
+        etag = self._etag(states, query, next_cursor, total, area_version)
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.queries += 1
+            self.query_time += elapsed
+            self.returned += len(entities)
+        return EntityPage(entities, total, next_cursor, etag)
+
+    def record_not_modified(self):
+        """Conta una risposta 304 (ETag invariato)."""
+        with self._lock:
+            self.not_modified += 1
+
+    def select(self, domains: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Stati completi ordinati per entity_id, opzionalmente per dominio.
+
+        Percorso interno (costruzione del prompt): niente ETag né
+        statistiche, che riguardano solo le query di /api/ha/entities.
+        """
+        with self._lock:
+            candidates = self._candidates({"domain": tuple(domains)} if domains else {})
+            return [self._states[entity_id] for entity_id in candidates]
+
+    def _candidates(self, filters: Dict[str, Tuple[str, ...]]) -> List[str]:
+        """entity_id ordinati che soddisfano i filtri indicizzati."""
+        if not filters:
+            return self._sorted
+        sets = []
+        for name, values in filters.items():
+            index = self._indexes[name]
+            if name == "area":
+                values = self._resolve_areas(values)
+            if len(values) == 1:
+                sets.append(index.get(values[0], set()))
+            else:
+                sets.append(set().union(*(index.get(value, ()) for value in values)))
+        sets.sort(key=len)
+        return sorted(sets[0].intersection(*sets[1:]))
+
+    def _scan(self, candidates: List[str], start: int, query: EntityQuery) -> Tuple[List[str], int, bool]:
+        """
+        Filtro sugli attributi (non indicizzati) in un solo passaggio.
+
+        Returns:
+            (pagina, totale delle corrispondenze, altre corrispondenze dopo la pagina)
+        """
+        matched, total, more = [], 0, False
+        for position, entity_id in enumerate(candidates):
+            attributes = self._states[entity_id].get("attributes") or {}
+            if all(str(attributes.get(key)) == value for key, value in query.attributes.items()):
+                total += 1
+                if position < start:
+                    continue
+                if not query.limit or len(matched) < query.limit:
+                    matched.append(entity_id)
+                else:
+                    more = True
+        return matched, total, more
+
+    def _project(self, state: Dict[str, Any], fields: Tuple[str, ...]) -> Dict[str, Any]:
+        projected: Dict[str, Any] = {"entity_id": state["entity_id"]}
+        for field in fields:
+            if field.startswith("attributes."):
+                name = field.split(".", 1)[1]
+                attributes = state.get("attributes") or {}
+                if name in attributes:
+                    projected.setdefault("attributes", {})[name] = attributes[name]
+            elif field == AREA_FIELD:
+                projected[AREA_FIELD] = self.mirror.get_area(state["entity_id"]) if self.mirror else None
+            elif field in state:
+                projected[field] = state[field]
+        return projected
+
+    @staticmethod
+    def _etag(states, query: EntityQuery, next_cursor: Optional[str], total: int, area_version: int) -> str:
+        digest = hashlib.blake2b(digest_size=12)
+        digest.update(repr((query.fields, next_cursor, total)).encode("utf-8"))
+        if (query.fields and AREA_FIELD in query.fields) or "area" in query.filters:
+            digest.update(str(area_version).encode("ascii"))
+        for state in states:
+            digest.update(f"{state['entity_id']}\0{state.get('last_updated', '')}\0".encode("utf-8"))
+        return digest.hexdigest()
+
+    # ------------------------------------------------------------------
+    # Aggiornamenti
+    # ------------------------------------------------------------------
+
+    def _on_state_changed(self, entity_id: str, old_state, new_state):
+        with self._lock:
+            if old_state is not None:
+                self._remove(entity_id, old_state)
+            if new_state is not None:
+                self._add(entity_id, new_state)
+
+    def _keys(self, entity_id: str, state: Dict[str, Any]) -> Iterable[Tuple[str, Optional[str]]]:
+        yield "domain", entity_id.split(".", 1)[0]
+        yield "device_class", (state.get("attributes") or {}).get("device_class")
+        yield "state", state.get("state")
+        if self.mirror is not None:
+            yield "area", self.mirror.get_area(entity_id)
+
+    def _add(self, entity_id: str, state: Dict[str, Any]):
+        if entity_id not in self._states:
+            insort(self._sorted, entity_id)
+        self._states[entity_id] = state
+        for name, key in self._keys(entity_id, state):
+            if key is not None:
+                self._indexes[name].setdefault(key, set()).add(entity_id)
+
+    def _remove(self, entity_id: str, state: Dict[str, Any]):
+        if self._states.pop(entity_id, None) is not None:
+            position = bisect_right(self._sorted, entity_id) - 1
+            if position >= 0 and self._sorted[position] == entity_id:
+                del self._sorted[position]
+        for name, key in self._keys(entity_id, state):
+            bucket = self._indexes[name].get(key)
+            if bucket is not None:
+                bucket.discard(entity_id)
+                if not bucket:
+                    del self._indexes[name][key]
+
+    def _refresh_areas(self):
+        """Ricostruisce l'indice delle aree se i registri sono cambiati."""
+        if self.mirror is None or self.mirror.registry_version == self._area_version:
+            return
+        self._area_version = self.mirror.registry_version
+        index: Dict[str, Set[str]] = {}
+        for entity_id in self._sorted:
+            area_id = self.mirror.get_area(entity_id)
+            if area_id:
+                index.setdefault(area_id, set()).add(entity_id)
+        self._indexes["area"] = index
+
+    def _resolve_areas(self, values: Tuple[str, ...]) -> Tuple[str, ...]:
+        """Accetta sia area_id sia il nome dell'area (senza distinzione di maiuscole)."""
+        if self.mirror is None:
+            return values
+        by_name = {name.lower(): area_id for area_id, name in self.mirror.get_areas().items()}
+        return tuple(by_name.get(value.lower(), value) for value in values)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entities": len(self._states),
+                "keys": {name: len(index) for name, index in self._indexes.items()},
+                "queries": self.queries,
+                "avg_query_ms": round(self.query_time / self.queries * 1000, 3) if self.queries else 0.0,
+                "returned": self.returned,
+                "not_modified": self.not_modified,
+            }
+
+
+def _split(value: Optional[str]) -> Optional[Tuple[str, ...]]:
+    if not value:
+        return None
+    parts = tuple(part.strip() for part in value.split(",") if part.strip())
+    return parts or None
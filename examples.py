@@ -3,8 +3,9 @@ Esempi di utilizzo dell'addon Llama.cpp per Home Assistant.
 Questi script dimostrano come interagire con le API.
 """
 
+import json
 import requests
-from typing import Optional
+from typing import Iterator, Optional, Union
 
 
 class LlamaHomeAssistant:
@@ -23,7 +24,8 @@ class LlamaHomeAssistant:
         self,
         message: str,
         temperature: float = 0.7,
-        max_tokens: int = 512
+        max_tokens: int = 512,
+        tools: Union[bool, list] = False
     ) -> dict:
         """
         Invia un messaggio singolo al chatbot.
@@ -32,21 +34,66 @@ class LlamaHomeAssistant:
             message: Testo del messaggio
             temperature: Creatività della risposta (0.0-2.0)
             max_tokens: Massimo numero di token nella risposta
+            tools: Lascia al modello lettura stati e chiamata dei servizi HA
+                (True o lista di domini)
         
         Returns:
-            Dizionario con risposta e usage info
+            Dizionario con risposta e usage info (e `tool_calls` con i tool)
         """
+        payload = {
+            "message": message,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        if tools:
+            payload["tools"] = tools
         response = requests.post(
             f"{self.base_url}/api/chat",
+            json=payload,
+            timeout=120
+        )
+        response.raise_for_status()
+        return response.json()
+    
+    def chat_batch(
+        self,
+        messages: list,
+        temperature: float = 0.7,
+        max_tokens: int = 512
+    ) -> Iterator[dict]:
+        """
+        Invia più domande indipendenti in una sola richiesta.
+        
+        Le domande vengono eseguite in parallelo sugli slot di llama-server
+        con un solo contesto Home Assistant.
+        
+        Args:
+            messages: Lista di domande
+            temperature: Creatività delle risposte (0.0-2.0)
+            max_tokens: Massimo numero di token per risposta
+        
+        Yields:
+            Un risultato per domanda ({"index", "response"} o {"index", "error"}),
+            nell'ordine in cui vengono completate
+        """
+        response = requests.post(
+            f"{self.base_url}/api/chat/batch",
             json={
-                "message": message,
+                "prompts": messages,
                 "temperature": temperature,
-                "max_tokens": max_tokens
+                "max_tokens": max_tokens,
+                "stream": True
             },
-            timeout=120
+            stream=True,
+            timeout=600
         )
         response.raise_for_status()
-        return response.json()
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: ") or line == "data: [DONE]":
+                continue
+            event = json.loads(line[len("data: "):])
+            if not event.get("done"):
+                yield event
     
     def start_conversation(self, system_prompt: Optional[str] = None) -> str:
         """
@@ -230,10 +277,15 @@ def example_batch_questions():
         "Come posso monitorare i consumi elettrici?"
     ]
     
-    for i, question in enumerate(questions, 1):
-        print(f"[{i}] Domanda: {question}")
-        result = client.chat(question, temperature=0.7, max_tokens=200)
-        print(f"    Risposta: {result['response'][:100]}...")
+    # Una sola richiesta: le domande girano in parallelo e le risposte
+    # arrivano man mano che sono pronte
+    for result in client.chat_batch(questions, temperature=0.7, max_tokens=200):
+        i = result['index']
+        print(f"[{i + 1}] Domanda: {questions[i]}")
+        if 'error' in result:
+            print(f"    Errore: {result['error']}")
+        else:
+            print(f"    Risposta: {result['response'][:100]}...")
         print()
 
 
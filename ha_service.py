@@ -4,31 +4,70 @@ Home Assistant Service Integration per Llama.cpp addon.
 Espone servizi HA per dialogare con il chatbot LLM.
 """
 
+import json
 import logging
 import os
-import sys
 import time
-from typing import Any, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, Optional, Tuple
 
 import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
+from prometheus_client import CONTENT_TYPE_LATEST
+
+import metrics
+from addon_options import get_option
+from log_setup import (
+    PayloadSampler,
+    Preview,
+    log_llama_request,
+    log_llama_response,
+    setup_logging,
+)
+from asgi_server import serve
+from context_budget import TokenCounter, fit_lines
+from context_cache import ContextCache
+from entity_history import HistoryCache, parse_range
+from entity_index import EntityIndex, EntityQuery
+from conversation_context import ContextProfile, ConversationContexts
+from conversation_history import HistoryManager
+from conversation_store import (
+    ConversationStore,
+    MemoryConversationStore,
+    SQLiteConversationStore,
+)
+from ha_state_mirror import MirrorClient, StateMirror
+from ha_tools import TOOL_INSTRUCTIONS, ToolAgent, ToolCatalog
+from http_pool import HTTPPool
+from intent_router import IntentRouter
+from llm_scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    AdmissionError,
+    LLMScheduler,
+    parse_deadline,
+    parse_priority,
+)
+from prompt_builder import PromptBuilder, PromptCacheStats, slot_for
+from recorder import STATISTIC_PERIODS, RecorderClient
+from rag_index import KINDS as RAG_KINDS, RAGIndex, VectorStore
+from response_cache import Embedder, ResponseCache, context_fingerprint
+from service_batch import ServiceBatcher
+from service_catalog import ServiceCatalog
+from startup import StartupOrchestrator, llama_probe, warm_slots
+from structured_output import SchemaCompiler, SchemaError, StructuredOutputError
+from supervisor_api import SupervisorAPI
 
 # Importa modulo integrazione HA
 from ha_integration import HomeAssistantClient, HAContextBuilder
 
-# Configurazione logging - force flush per visibilità immediata
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    stream=sys.stdout,
-    force=True
-)
+# Logging in coda (scritto da un thread dedicato) al livello `log_level`
+log_writer = setup_logging(get_option('log_level', 'info'))
 logger = logging.getLogger(__name__)
 
-# Force unbuffered output
-sys.stdout.reconfigure(line_buffering=True)
-sys.stderr.reconfigure(line_buffering=True)
+# Anteprime dei messaggi (solo a livello debug) su una frazione delle richieste
+payload_sampler = PayloadSampler(float(get_option('log_payload_sample', 0.1)))
 
 logger.info("=" * 80)
 logger.info("🚀 HA Service Starting...")
@@ -38,201 +77,1359 @@ logger.info("=" * 80)
 app = Flask(__name__)
 CORS(app)
 
-# URL del server llama.cpp locale
-LLAMA_SERVER_URL = "http://localhost:8080"
+# URL del server llama.cpp locale (sovrascrivibile per i benchmark)
+LLAMA_SERVER_URL = os.environ.get("LLAMA_SERVER_URL", "http://localhost:8080")
+
+# Porta dell'API (sovrascrivibile per i benchmark)
+HA_SERVICE_PORT = int(os.environ.get("HA_SERVICE_PORT", 5000))
+
+# Pool HTTP condiviso (keep-alive) per llama-server e Supervisor API
+http_pool = HTTPPool(
+    pool_size=int(get_option('http_pool_size', 10)),
+    timeouts={"llama_chat": (5, int(get_option('llm_timeout', 120)))},
+    observer=metrics.observe_upstream
+)
 
 # Inizializza client Home Assistant
 ha_client = HomeAssistantClient()
-ha_context = HAContextBuilder(ha_client)
+supervisor_api = SupervisorAPI(http_pool)
+
+# Mirror degli stati via WebSocket: le letture non interrogano il Supervisor
+state_mirror = StateMirror(supervisor_api)
+STATE_MIRROR_ENABLED = bool(get_option('state_mirror', True)) and supervisor_api.available
+ha_states = MirrorClient(ha_client, state_mirror)
+entity_index = EntityIndex(state_mirror)
+
+# Catalogo dei servizi: letto una volta, aggiornato dagli eventi service_*
+service_catalog = ServiceCatalog(ha_states, state_mirror)
+ha_context = HAContextBuilder(ha_states)
+
+# Storia delle entità dal recorder: serie in cache, lette solo per i tratti
+# mancanti; le domande con un periodo ricevono aggregati nel prompt
+recorder = RecorderClient(supervisor_api)
+history_cache = HistoryCache(recorder, state_mirror)
+HISTORY_CONTEXT = bool(get_option('history_context', True))
+# Valori intermedi per entità nel prompt (ogni bucket finisce nel testo)
+MAX_PROMPT_BUCKETS = 48
 
-# Sessioni di conversazione (storage in memoria)
-conversations: Dict[str, list] = {}
+# Cache del contesto HA (evita fetch e rendering completi a ogni richiesta)
+context_cache = ContextCache(ha_context, ttl=float(get_option('context_cache_ttl', 30)))
+
+# Layout del prompt: "cache" ordina il contenuto per la prompt cache di llama-server
+PROMPT_LAYOUT = get_option('prompt_layout', 'cache')
+LLAMA_SLOTS = int(get_option('parallel_requests', 1))
+
+# Controllo di ammissione: al massimo LLAMA_SLOTS generazioni in corso
+LLM_QUEUE_SIZE = int(get_option('llm_queue_size', 16))
+llm_scheduler = LLMScheduler(
+    slots=LLAMA_SLOTS,
+    max_queue=LLM_QUEUE_SIZE,
+    default_deadline=float(get_option('llm_queue_timeout', 60))
+)
+
+# Budget di token: il prompt deve stare nel contesto insieme alla risposta
+CONTEXT_SIZE = int(get_option('context_size', 2048))
+CONTEXT_SAFETY_MARGIN = 64
+token_counter = TokenCounter(http_pool, LLAMA_SERVER_URL)
+prompt_builder = PromptBuilder(ha_states, state_mirror, token_counter, entity_index, service_catalog)
+prompt_stats = PromptCacheStats()
+
+# Cache delle risposte di /api/chat (opt-in); livello semantico con
+# similarità > 0, richiede llama-server con /embedding attivo
+RESPONSE_CACHE_SIMILARITY = float(get_option('response_cache_similarity', 0))
+response_cache = ResponseCache(
+    max_entries=int(get_option('response_cache_size', 512)),
+    ttl=float(get_option('response_cache_ttl', 3600)),
+    embedder=Embedder(http_pool, LLAMA_SERVER_URL) if RESPONSE_CACHE_SIMILARITY > 0 else None,
+    similarity=RESPONSE_CACHE_SIMILARITY
+) if get_option('response_cache', False) else None
+
+# Indice RAG (opt-in): embedding di entità, aree, automazioni e documenti;
+# /api/chat riceve solo i chunk pertinenti invece dell'elenco delle entità.
+# Con `rag_embedding_model_url` run.sh avvia un llama-server di embedding dedicato
+RAG_EMBEDDING_MODEL = get_option('rag_embedding_model_url', '')
+EMBEDDING_SERVER_URL = os.environ.get(
+    "EMBEDDING_SERVER_URL", "http://localhost:8081" if RAG_EMBEDDING_MODEL else LLAMA_SERVER_URL
+)
+RAG_TOP_K = int(get_option('rag_top_k', 8))
+RAG_INDEX_PATH = os.environ.get("RAG_INDEX_PATH", "/data/rag")
+rag_index = RAGIndex(
+    Embedder(http_pool, EMBEDDING_SERVER_URL),
+    VectorStore(RAG_INDEX_PATH, model=RAG_EMBEDDING_MODEL or get_option('model_name', '')),
+    mirror=state_mirror,
+    api=supervisor_api,
+    docs_paths=[get_option('rag_docs_path', '/share/llamacpp/docs')]
+) if get_option('rag_index', False) and STATE_MIRROR_ENABLED else None
+
+# Schemi delle risposte strutturate compilati una volta (grammatica + validatore)
+schema_compiler = SchemaCompiler()
+
+# Tool calling: servizi HA come tool OpenAI, schemi in cache. I domini
+# esposti di default vengono da `tool_domains` (vuoto = tutti)
+DEFAULT_TOOL_DOMAINS = "light,switch,cover,climate,fan,media_player,scene,script,lock"
+TOOL_DOMAINS = [
+    d.strip() for d in str(get_option('tool_domains', DEFAULT_TOOL_DOMAINS)).split(',') if d.strip()
+] or None
+tool_catalog = ToolCatalog(service_catalog)
+tool_agent = ToolAgent(
+    ha_states,
+    tool_catalog,
+    max_rounds=int(get_option('tool_max_rounds', 4)),
+    # Un servizio chiamato dal modello cambia gli stati: contesto obsoleto
+    on_service_call=lambda domain, service: context_cache.invalidate(),
+    observer=metrics.observe_tool_call
+)
+
+# Chiamate di servizio in blocco: unione delle compatibili, resto in parallelo
+service_batcher = ServiceBatcher(
+    ha_states,
+    max_workers=int(get_option('service_call_parallel', 8)),
+    on_service_call=lambda domain, service: context_cache.invalidate()
+)
+
+# Percorso rapido: i comandi semplici vanno direttamente a call_service
+intent_router = IntentRouter(
+    ha_states,
+    state_mirror,
+    on_service_call=lambda domain, service: context_cache.invalidate()
+) if get_option('intent_fast_path', True) else None
+
+# Sessioni di conversazione (LRU in memoria o SQLite persistente)
+def create_conversation_store() -> ConversationStore:
+    """Crea il backend delle conversazioni configurato nelle opzioni."""
+    limits = {
+        "max_conversations": int(get_option('conversation_max', 200)),
+        "max_messages": int(get_option('conversation_max_messages', 200)),
+        "idle_ttl": float(get_option('conversation_idle_hours', 24)) * 3600,
+    }
+    if get_option('conversation_store', 'memory') == 'sqlite':
+        return SQLiteConversationStore(path="/data/conversations.db", **limits)
+    return MemoryConversationStore(
+        max_bytes=int(get_option('conversation_memory_mb', 32)) * 1024 * 1024,
+        **limits
+    )
+
+
+conversations = create_conversation_store()
+
+
+def summarize_history(messages: list, max_tokens: int) -> str:
+    """Riassume i turni vecchi di una conversazione (priorità background)."""
+    result = call_llama_api(
+        messages,
+        temperature=0.2,
+        max_tokens=max_tokens,
+        priority=PRIORITY_BACKGROUND
+    )
+    return result['choices'][0]['message']['content']
+
+
+# Finestra di storia per turno (system prompt fisso + riassunto + ultimi turni)
+history_manager = HistoryManager(
+    conversations,
+    token_counter,
+    summarize=summarize_history,
+    strategy=get_option('history_strategy', 'summary'),
+    max_history_tokens=int(get_option('history_max_tokens', 1024))
+)
+
+
+def render_conversation_context(profile: ContextProfile) -> Tuple[str, str]:
+    """Contesto HA di un profilo di conversazione (catalogo e stati)."""
+    with metrics.Timer(metrics.CONTEXT_BUILD.labels("conversation").observe):
+        return prompt_builder.render_context(
+            include_entities=profile.include_entities,
+            include_services=profile.include_services,
+            include_system=True,
+            entity_domains=profile.entity_domains,
+            token_budget=CONVERSATION_CONTEXT_TOKENS
+        )
+
+
+def warm_conversation_slot(conversation_id: str, messages: list) -> Dict[str, Any]:
+    """Valuta il prefisso nello slot della conversazione senza generare (priorità background)."""
+    if not startup.ready:
+        raise RuntimeError(f"servizio in avvio ({startup.phase})")
+    return call_llama_api(
+        messages,
+        temperature=0.0,
+        max_tokens=0,
+        extra_params={
+            "n_predict": 0,
+            "cache_prompt": True,
+            "id_slot": slot_for(conversation_id, LLAMA_SLOTS)
+        },
+        priority=PRIORITY_BACKGROUND
+    )
+
+
+# Contesto HA delle conversazioni: prefetch all'avvio, slot scaldato, aggiornamento in background
+CONVERSATION_CONTEXT_TOKENS = int(get_option('conversation_context_tokens', 1536))
+CONTEXT_PREFETCH_TIMEOUT = 10.0
+conversation_contexts = ConversationContexts(
+    conversations,
+    render_conversation_context,
+    warm=warm_conversation_slot if get_option('conversation_warmup', True) else None,
+    ttl=float(get_option('context_cache_ttl', 30))
+)
+conversations.add_removal_listener(conversation_contexts.forget)
 
 
-def wait_for_llama_server(max_retries: int = 30, delay: int = 2) -> bool:
+def startup_warmup() -> Dict[str, Any]:
+    """Generazione breve per slot con il prompt di `/api/chat` (contesto HA compreso)."""
+    messages, _ = build_chat_messages(
+        "ok",
+        include_entities=True,
+        include_services=False,
+        entity_domains=None,
+        prompt_layout=PROMPT_LAYOUT,
+        token_budget=default_token_budget(WARMUP_TOKENS)
+    )
+    return warm_slots(
+        lambda prompt, slot: call_llama_api(
+            prompt,
+            temperature=0.0,
+            max_tokens=WARMUP_TOKENS,
+            extra_params={"cache_prompt": True, "id_slot": slot},
+            priority=PRIORITY_BACKGROUND
+        ),
+        messages,
+        LLAMA_SLOTS
+    )
+
+
+def prefetch_states():
+    """Stati HA: dal mirror (attende il primo riallineamento) o dalla REST API."""
+    if not (STATE_MIRROR_ENABLED and state_mirror.wait_ready(timeout=30)):
+        ha_states.get_states()
+
+
+# Avvio: API subito disponibile, modello e cache HA preparati in background
+WARMUP_TOKENS = 4
+startup = StartupOrchestrator(
+    probe=llama_probe(lambda: http_pool.get(f"{LLAMA_SERVER_URL}/health", endpoint="llama_health")),
+    warmup=startup_warmup if get_option('startup_warmup', True) else None,
+    prefetch={
+        "states": prefetch_states,
+        "services": lambda: tool_catalog.get_tools(TOOL_DOMAINS),
+        "context": lambda: context_cache.get(),
+        "config": lambda: prompt_builder.render_context(include_entities=False, include_services=False),
+    },
+    timeout=float(get_option('startup_timeout', 900))
+)
+
+# Statistiche dei componenti esportate su /metrics (lette solo allo scrape)
+metrics.registry.register(metrics.StatsCollector({
+    "llm_queue": llm_scheduler.get_stats,
+    "conversation_store": conversations.get_stats,
+    "context_cache": context_cache.get_stats,
+    "response_cache": lambda: response_cache.get_stats() if response_cache else None,
+    "state_mirror": state_mirror.get_stats,
+    "entity_index": entity_index.get_stats,
+    "service_catalog": service_catalog.get_stats,
+    "entity_history": history_cache.get_stats,
+    "rag_index": lambda: rag_index.get_stats() if rag_index else None,
+    "http_pool": http_pool.get_stats,
+    "startup": startup.get_stats,
+}))
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+# Endpoint che richiedono il modello: 503 finché l'avvio non è completo
+STARTUP_GATED_ENDPOINTS = {"chat", "chat_batch", "send_message"}
+
+
+@app.before_request
+def require_startup_ready():
+    if startup.ready or request.endpoint not in STARTUP_GATED_ENDPOINTS:
+        return None
+    response = jsonify({
+        "error": "Servizio in avvio, riprova tra poco",
+        "phase": startup.phase
+    })
+    response.status_code = 503
+    response.headers["Retry-After"] = str(startup.retry_after())
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Registra durata ed esito della richiesta a risposta chiusa (stream compresi)."""
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    method = request.method
+    status = response.status_code
+    started = g.get('request_started', time.perf_counter())
+    response.call_on_close(
+        lambda: metrics.observe_request(endpoint, method, status, time.perf_counter() - started)
+    )
+    return response
+
+
+def page_args(default_limit: int, max_limit: int = 500) -> Tuple[int, int]:
+    """
+    Legge i parametri di paginazione `offset` e `limit` dalla query string.
+    
+    Raises:
+        ValueError: Se i parametri non sono interi validi
+    """
+    offset = int(request.args.get('offset', 0))
+    limit = int(request.args.get('limit', default_limit))
+    if offset < 0 or limit < 1:
+        raise ValueError("offset deve essere >= 0 e limit >= 1")
+    return offset, min(limit, max_limit)
+
+
+def validate_messages(messages: list) -> None:
     """
-    Attende che il server llama.cpp sia pronto.
+    Verifica il formato dei messaggi OpenAI.
     
     Args:
-        max_retries: Numero massimo di tentativi
-        delay: Secondi tra un tentativo e l'altro
+        messages: Lista di messaggi nel formato OpenAI
     
-    Returns:
-        True se il server è pronto, False altrimenti
+    Raises:
+        ValueError: Se la lista o uno dei messaggi non è valido
     """
-    logger.info("Attesa avvio server llama.cpp...")
-    for i in range(max_retries):
-        try:
-            response = requests.get(f"{LLAMA_SERVER_URL}/health", timeout=5)
-            if response.status_code == 200:
-                logger.info("Server llama.cpp pronto!")
-                return True
-        except requests.exceptions.RequestException:
-            pass
-        
-        if i < max_retries - 1:
-            time.sleep(delay)
+    if not isinstance(messages, list) or not messages:
+        logger.error(f"❌ Messaggi invalidi: deve essere una lista non vuota, ricevuto: {type(messages)}")
+        raise ValueError("messages deve essere una lista non vuota")
     
-    logger.error("Timeout: server llama.cpp non disponibile")
-    return False
+    for idx, msg in enumerate(messages):
+        if not isinstance(msg, dict):
+            logger.error(f"❌ Messaggio [{idx}] invalido: deve essere un dict, ricevuto: {type(msg)}")
+            raise ValueError(f"Messaggio [{idx}] deve essere un dict")
+        if 'role' not in msg or 'content' not in msg:
+            logger.error(f"❌ Messaggio [{idx}] incompleto: {msg}")
+            raise ValueError(f"Messaggio [{idx}] deve avere 'role' e 'content'")
+        if msg['role'] not in ['system', 'user', 'assistant', 'tool']:
+            logger.error(f"❌ Messaggio [{idx}] role invalido: {msg['role']}")
+            raise ValueError(f"Role deve essere 'system', 'user', 'assistant' o 'tool', non '{msg['role']}'")
 
 
 def call_llama_api(
     messages: list,
     temperature: float = 0.7,
     max_tokens: int = 512,
-    stream: bool = False
+    extra_params: Optional[Dict[str, Any]] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    deadline: Optional[float] = None
 ) -> Dict[str, Any]:
     """
     Chiama l'API OpenAI-compatible di llama-server.
     
+    La chiamata attende uno slot libero nello scheduler LLM.
+    
     Args:
         messages: Lista di messaggi nel formato OpenAI
         temperature: Creatività delle risposte (0.0-2.0)
         max_tokens: Numero massimo di token nella risposta
-        stream: Se True, restituisce streaming response
+        extra_params: Parametri llama-server aggiuntivi (es. cache_prompt, id_slot)
+        priority: Priorità in coda (interattiva o background)
+        deadline: Attesa massima in coda in secondi
     
     Returns:
         Risposta dal modello LLM
+    
+    Raises:
+        AdmissionError: Coda piena o scadenza raggiunta
     """
     url = f"{LLAMA_SERVER_URL}/v1/chat/completions"
     
     # ✅ VALIDAZIONE: Verifica formato messaggi
-    if not isinstance(messages, list) or not messages:
-        logger.error(f"❌ Messaggi invalidi: deve essere una lista non vuota, ricevuto: {type(messages)}")
-        raise ValueError("messages deve essere una lista non vuota")
+    validate_messages(messages)
     
-    for idx, msg in enumerate(messages):
-        if not isinstance(msg, dict):
-            logger.error(f"❌ Messaggio [{idx}] invalido: deve essere un dict, ricevuto: {type(msg)}")
-            raise ValueError(f"Messaggio [{idx}] deve essere un dict")
-        if 'role' not in msg or 'content' not in msg:
-            logger.error(f"❌ Messaggio [{idx}] incompleto: {msg}")
-            raise ValueError(f"Messaggio [{idx}] deve avere 'role' e 'content'")
-        if msg['role'] not in ['system', 'user', 'assistant']:
-            logger.error(f"❌ Messaggio [{idx}] role invalido: {msg['role']}")
-            raise ValueError(f"Role deve essere 'system', 'user' o 'assistant', non '{msg['role']}'")
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": False
+    }
+    if extra_params:
+        payload.update(extra_params)
+    
+    log_llama_request(logger, payload, stream=False, sampler=payload_sampler)
+    
+    with llm_scheduler.acquire(priority, deadline) as ticket:
+        metrics.observe_queue_wait(priority, ticket.wait_time)
+        if ticket.wait_time > 0.1:
+            logger.info("⏳ Attesa in coda LLM: %.2fs", ticket.wait_time)
+        return _post_chat_completion(url, payload)
+
+
+
+def _post_chat_completion(url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Esegue la POST non-streaming verso llama-server e ne registra l'esito."""
+    try:
+        response = http_pool.post(url, endpoint="llama_chat", json=payload)
+        response.raise_for_status()
+        result = response.json()
+        
+        log_llama_response(logger, response.status_code, result, sampler=payload_sampler)
+        return result
+    except requests.exceptions.RequestException as e:
+        error_response = getattr(e, 'response', None)
+        if error_response is not None:
+            logger.error(
+                "❌ Errore HTTP %s da llama-server: %s",
+                error_response.status_code, Preview(error_response.text, 500)
+            )
+            logger.debug("Response headers: %s", error_response.headers)
+        else:
+            logger.error("❌ Errore chiamata API llama.cpp: %s", e)
+        raise
+
+
+def stream_llama_api(
+    messages: list,
+    temperature: float = 0.7,
+    max_tokens: int = 512,
+    extra_params: Optional[Dict[str, Any]] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Chiama l'API OpenAI-compatible di llama-server in modalità streaming.
+    
+    Legge gli eventi SSE di `/v1/chat/completions` man mano che arrivano
+    e restituisce i chunk decodificati, senza attendere la fine della
+    generazione.
+    
+    Args:
+        messages: Lista di messaggi nel formato OpenAI
+        temperature: Creatività delle risposte (0.0-2.0)
+        max_tokens: Numero massimo di token nella risposta
+        extra_params: Parametri llama-server aggiuntivi (es. cache_prompt, id_slot)
+    
+    Yields:
+        Chunk `chat.completion.chunk` restituiti da llama-server
+    """
+    url = f"{LLAMA_SERVER_URL}/v1/chat/completions"
+    validate_messages(messages)
     
     payload = {
         "messages": messages,
         "temperature": temperature,
         "max_tokens": max_tokens,
-        "stream": stream
+        "stream": True,
+        "stream_options": {"include_usage": True}
     }
+    if extra_params:
+        payload.update(extra_params)
     
-    # 🔍 DEBUG: Log dettagliato della richiesta
-    logger.info("=" * 80)
-    logger.info("📤 CHIAMATA LLAMA API")
-    logger.info(f"URL: {url}")
-    logger.info(f"Temperature: {temperature}, Max tokens: {max_tokens}, Stream: {stream}")
-    logger.info(f"Numero messaggi: {len(messages)}")
-    for idx, msg in enumerate(messages):
-        content_preview = str(msg.get('content', ''))[:200]
-        content_len = len(str(msg.get('content', '')))
-        logger.info(f"  [{idx}] role={msg.get('role')}, content_len={content_len}")
-        logger.info(f"       preview: {content_preview}{'...' if content_len > 200 else ''}")
-    logger.info("=" * 80)
+    log_llama_request(logger, payload, stream=True, sampler=payload_sampler)
+    
+    try:
+        response = http_pool.post(url, endpoint="llama_chat", json=payload, stream=True)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"❌ Errore chiamata API llama.cpp (stream): {e}")
+        raise
+    
+    try:
+        if response.status_code != 200:
+            logger.error(
+                "❌ Errore HTTP %s da llama-server (stream): %s",
+                response.status_code, Preview(response.text, 500)
+            )
+        response.raise_for_status()
+        
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            yield json.loads(data)
+    finally:
+        # Chiude la connessione anche se il client si disconnette a metà
+        response.close()
+
+
+def record_completion(result: Dict[str, Any]) -> Optional[Dict[str, int]]:
+    """
+    Registra `usage` e `timings` di una risposta di llama-server.
+    
+    Returns:
+        Riepilogo della prompt cache per la richiesta (o None)
+    """
+    metrics.observe_completion(result)
+    return prompt_stats.record(result)
+
+
+def sse_event(data: Dict[str, Any]) -> str:
+    """Serializza un evento Server-Sent Events."""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_chat_response(
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    on_complete=None,
+    extra_params: Optional[Dict[str, Any]] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    deadline: Optional[float] = None
+) -> Response:
+    """
+    Costruisce una risposta SSE che inoltra i delta di llama-server.
+    
+    Ogni evento contiene `{"delta": "..."}`; l'evento finale contiene
+    `{"done": true, "response": "...", "usage": {...}}` seguito da
+    `data: [DONE]`.
+    
+    Args:
+        messages: Lista di messaggi nel formato OpenAI
+        temperature: Creatività delle risposte (0.0-2.0)
+        max_tokens: Numero massimo di token nella risposta
+        on_complete: Callback opzionale invocata con il testo completo
+            quando lo stream termina correttamente; può restituire un
+            dict di campi extra da aggiungere all'evento finale
+        extra_params: Parametri llama-server aggiuntivi (es. cache_prompt, id_slot)
+        priority: Priorità in coda (interattiva o background)
+        deadline: Attesa massima in coda in secondi
+    
+    Returns:
+        Risposta Flask `text/event-stream`
+    
+    Raises:
+        AdmissionError: Coda piena o scadenza raggiunta (prima dello stream)
+    """
+    # Lo slot viene occupato subito, così un rifiuto arriva come 429/503
+    # invece che a stream già aperto; lo si libera a fine generazione
+    ticket = llm_scheduler.acquire(priority, deadline)
+    metrics.observe_queue_wait(priority, ticket.wait_time)
+    
+    def generate():
+        try:
+            yield from _generate()
+        finally:
+            ticket.release()
+    
+    def _generate():
+        parts = []
+        usage: Dict[str, Any] = {}
+        timings: Dict[str, Any] = {}
+        try:
+            for chunk in stream_llama_api(messages, temperature, max_tokens, extra_params):
+                if chunk.get('usage'):
+                    usage = chunk['usage']
+                if chunk.get('timings'):
+                    timings = chunk['timings']
+                choices = chunk.get('choices') or []
+                if not choices:
+                    continue
+                delta = choices[0].get('delta', {}).get('content')
+                if delta:
+                    parts.append(delta)
+                    yield sse_event({"delta": delta})
+        except Exception as e:
+            logger.error(f"❌ Errore durante lo streaming: {e}")
+            yield sse_event({"error": str(e)})
+            return
+        
+        response_text = ''.join(parts)
+        final = {"done": True, "response": response_text, "usage": usage}
+        prompt_cache = record_completion({"usage": usage, "timings": timings})
+        if prompt_cache:
+            final["prompt_cache"] = prompt_cache
+        if on_complete is not None:
+            final.update(on_complete(response_text) or {})
+        yield sse_event(final)
+        yield "data: [DONE]\n\n"
+    
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Se il client chiude prima che il generatore parta, lo slot va comunque liberato
+    response.call_on_close(ticket.release)
+    return response
+
+
+def admission_error_response(error: AdmissionError):
+    """Risposta HTTP per una richiesta rifiutata dallo scheduler LLM."""
+    response = jsonify({
+        "error": str(error),
+        "queue": llm_scheduler.get_stats()
+    })
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.status_code
+
+
+def chat_completion(
+    messages: list,
+    user_message: str,
+    temperature: float,
+    max_tokens: int,
+    priority: int = PRIORITY_INTERACTIVE,
+    deadline: Optional[float] = None,
+    use_cache: bool = False,
+    schema=None
+) -> Dict[str, Any]:
+    """
+    Genera la risposta a una domanda singola (o la prende dalla cache).
+    
+    Con uno schema la generazione è vincolata dalla grammatica e la
+    risposta viene validata una sola volta, senza nuovi tentativi.
+    
+    Args:
+        messages: Messaggi già costruiti con il contesto HA
+        user_message: Domanda dell'utente (in coda all'ultimo messaggio)
+        temperature: Temperatura per la generazione
+        max_tokens: Numero massimo di token da generare
+        priority: PRIORITY_INTERACTIVE o PRIORITY_BACKGROUND
+        deadline: Attesa massima in coda in secondi
+        use_cache: Consulta e aggiorna la cache delle risposte
+        schema: CompiledSchema per una risposta JSON strutturata
+    
+    Returns:
+        {"response", "usage", ...} come restituito da `/api/chat`
+        (più "data" con il JSON decodificato se c'è uno schema)
+    
+    Raises:
+        AdmissionError: Se lo scheduler LLM rifiuta la richiesta
+        StructuredOutputError: Se la risposta non è conforme allo schema
+    """
+    use_cache = use_cache and response_cache is not None
+    if use_cache:
+        cache_params = {"temperature": temperature, "max_tokens": max_tokens}
+        if schema is not None:
+            cache_params["schema"] = schema.hash
+        fingerprint = context_fingerprint(messages, user_message)
+        hit = response_cache.lookup(user_message, cache_params, fingerprint)
+        if hit:
+            reply = {
+                "response": hit["response"],
+                "usage": hit["usage"],
+                "cached": {k: hit[k] for k in ("tier", "similarity", "age_s")}
+            }
+            if schema is not None:
+                reply["data"] = schema.parse(hit["response"])
+            return reply
+    
+    extra_params = {"cache_prompt": True}
+    if schema is not None:
+        # Istruzione in coda all'ultimo messaggio: il prefisso resta invariato
+        messages = messages[:-1] + [dict(messages[-1])]
+        messages[-1]["content"] = f"{messages[-1]['content']}\n\n{schema.instructions()}"
+        extra_params.update(schema.llama_params())
+    
+    # Il prefisso stabile resta nella KV cache: llama-server sceglie lo
+    # slot con il prefisso più simile, senza pinning esplicito
+    result = call_llama_api(
+        messages, temperature, max_tokens, extra_params, priority, deadline
+    )
+    response_text = result['choices'][0]['message']['content']
+    
+    reply = {
+        "response": response_text,
+        "usage": result.get('usage', {})
+    }
+    prompt_cache = record_completion(result)
+    if prompt_cache:
+        reply["prompt_cache"] = prompt_cache
+    if schema is not None:
+        reply["data"] = schema.parse(response_text, result['choices'][0].get('finish_reason'))
+    if use_cache:
+        response_cache.store(
+            user_message, cache_params, fingerprint, response_text, reply["usage"]
+        )
+    return reply
+
+
+def record_route(route: str, started: float):
+    """Latenza di una richiesta con azioni per percorso (statistiche e metriche)."""
+    elapsed = time.perf_counter() - started
+    metrics.CHAT_ROUTE.labels(route).observe(elapsed)
+    if intent_router:
+        intent_router.record_route(route, elapsed)
+
+
+def fast_path_reply(user_message: str, domains: Optional[list]) -> Optional[Dict[str, Any]]:
+    """
+    Esegue il messaggio come comando diretto, se riconosciuto con certezza.
+    
+    Args:
+        user_message: Messaggio dell'utente
+        domains: Domini ammessi
+    
+    Returns:
+        Risposta di `/api/chat` o None se il messaggio va al LLM
+    """
+    match, reason = intent_router.match(user_message, domains)
+    if match is None:
+        logger.debug("Percorso rapido non applicabile (%s): LLM", reason)
+        return None
+    result = intent_router.execute(match)
+    logger.info(f"⚡ Comando diretto: {match.domain}.{match.service} su {', '.join(match.entity_ids)}")
+    return {
+        "response": match.describe(),
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        "intent": match.to_dict(),
+        "changed": [
+            {"entity_id": s.get("entity_id"), "state": s.get("state")}
+            for s in (result if isinstance(result, list) else [])
+        ]
+    }
+
+
+def chat_with_tools(
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    domains: Optional[list] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    deadline: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Genera la risposta lasciando al modello l'uso dei tool HA.
+    
+    Il modello può leggere stati e chiamare servizi; le chiamate
+    indipendenti di uno stesso turno vengono eseguite in parallelo e i
+    risultati rimandati al modello per al massimo `tool_max_rounds` round.
+    Ogni round occupa uno slot LLM solo per la durata della generazione.
+    
+    Args:
+        messages: Messaggi già costruiti con il contesto HA
+        temperature: Temperatura per la generazione
+        max_tokens: Numero massimo di token per round
+        domains: Domini dei servizi esposti come tool (None = `tool_domains`)
+        priority: PRIORITY_INTERACTIVE o PRIORITY_BACKGROUND
+        deadline: Attesa massima in coda in secondi (per round)
+    
+    Returns:
+        {"response", "usage", "tool_calls", "rounds", ...}
+    
+    Raises:
+        AdmissionError: Se lo scheduler LLM rifiuta uno dei round
+    """
+    messages = [dict(m) for m in messages]
+    if messages and messages[0].get("role") == "system":
+        messages[0]["content"] = f"{messages[0]['content']}\n\n{TOOL_INSTRUCTIONS}"
+    
+    def complete(round_messages: list, tool_params: Dict[str, Any]) -> Dict[str, Any]:
+        return call_llama_api(
+            round_messages,
+            temperature,
+            max_tokens,
+            {"cache_prompt": True, **tool_params},
+            priority,
+            deadline
+        )
+    
+    outcome = tool_agent.run(messages, complete, domains or TOOL_DOMAINS)
+    prompt_cache = None
+    for result in outcome["results"]:
+        prompt_cache = record_completion(result) or prompt_cache
+    
+    reply = {
+        "response": outcome["response"],
+        "usage": outcome["usage"],
+        "tool_calls": outcome["tool_calls"],
+        "rounds": outcome["rounds"]
+    }
+    if outcome["truncated"]:
+        reply["truncated"] = True
+    if prompt_cache:
+        reply["prompt_cache"] = prompt_cache
+    return reply
+
+
+def default_token_budget(max_tokens: int) -> int:
+    """Token disponibili per il prompt dato `context_size` e la risposta attesa."""
+    return max(CONTEXT_SIZE - max_tokens - CONTEXT_SAFETY_MARGIN, 0)
+
+
+def parse_token_count(value: Any, name: str) -> int:
+    """
+    Valida un numero di token del body (max_tokens, context_budget).
+
+    Raises:
+        ValueError: Se non è un intero tra 1 e `context_size`
+    """
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= CONTEXT_SIZE:
+        raise ValueError(f"'{name}' deve essere un intero tra 1 e {CONTEXT_SIZE}")
+    return value
+
+
+def parse_temperature(value: Any) -> float:
+    """
+    Valida la temperatura di campionamento del body.
+
+    Raises:
+        ValueError: Se non è un numero tra 0 e 2
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 2:
+        raise ValueError("'temperature' deve essere un numero tra 0 e 2")
+    return float(value)
+
+
+def build_chat_messages(
+    user_message: str,
+    include_entities: bool,
+    include_services: bool,
+    entity_domains: Optional[list],
+    prompt_layout: str = 'cache',
+    token_budget: Optional[int] = None
+) -> Tuple[list, Optional[Dict[str, Any]]]:
+    """
+    Costruisce i messaggi per `/api/chat` con il contesto Home Assistant.
+    
+    Con layout "cache" istruzioni e catalogo entità/servizi formano un
+    system prompt stabile, mentre gli stati correnti vengono messi nel
+    messaggio utente; il layout "legacy" inserisce l'intero contesto nel
+    system prompt.
+    
+    Args:
+        user_message: Messaggio dell'utente
+        include_entities: Include le entità HA
+        include_services: Include i servizi HA
+        entity_domains: Domini a cui limitare le entità
+        prompt_layout: "cache" o "legacy"
+        token_budget: Token massimi per il prompt (None = nessun limite)
+    
+    Returns:
+        (lista di messaggi nel formato OpenAI, report token usati/budget)
+    """
+    with metrics.Timer(metrics.CONTEXT_BUILD.labels(prompt_layout).observe):
+        return _build_chat_messages(
+            user_message,
+            include_entities,
+            include_services,
+            entity_domains,
+            prompt_layout,
+            token_budget
+        )
+
+
+def _build_chat_messages(
+    user_message: str,
+    include_entities: bool,
+    include_services: bool,
+    entity_domains: Optional[list],
+    prompt_layout: str,
+    token_budget: Optional[int]
+) -> Tuple[list, Optional[Dict[str, Any]]]:
+    if prompt_layout == 'cache' and (include_entities or include_services):
+        try:
+            return prompt_builder.build(
+                user_message,
+                include_entities=include_entities,
+                include_services=include_services,
+                include_system=True,
+                entity_domains=entity_domains,
+                token_budget=token_budget
+            )
+        except Exception as e:
+            logger.warning(f"Impossibile ottenere contesto HA: {e}")
+            include_entities = include_services = False
+    
+    # Costruisci contesto Home Assistant
+    ha_context_text = ""
+    if include_entities or include_services:
+        try:
+            ha_context_text = context_cache.get(
+                include_entities=include_entities,
+                include_services=include_services,
+                include_system=True,
+                entity_domains=entity_domains
+            )
+        except Exception as e:
+            logger.warning(f"Impossibile ottenere contesto HA: {e}")
+            ha_context_text = ""
+    
+    # Crea messaggio nel formato OpenAI con contesto HA
+    system_prompt = "Sei un assistente virtuale per Home Assistant. "
+    report = None
+    if ha_context_text:
+        system_prompt += "Hai accesso alle seguenti informazioni sul sistema:\n\n"
+        if token_budget is not None:
+            # Il contesto legacy è testo opaco: si tagliano le righe in coda
+            available = (token_budget - token_counter.estimate(system_prompt)
+                         - token_counter.estimate(user_message) - CONTEXT_SAFETY_MARGIN)
+            lines = ha_context_text.split("\n")
+            kept = fit_lines(lines, available, token_counter)
+            ha_context_text = "\n".join(kept)
+            report = {"budget": token_budget, "trimmed": len(kept) < len(lines)}
+        system_prompt += ha_context_text
+    else:
+        system_prompt += "Aiuti gli utenti a gestire la loro casa intelligente."
+    
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    if report is not None:
+        used, exact = token_counter.count(system_prompt + "\n" + user_message)
+        report.update({"used": used, "exact": exact})
+    return messages, report
+
+
+def history_context(user_message: str, history: Any) -> Optional[Dict[str, Any]]:
+    """
+    Aggregati storici per la domanda (blocco "STORICO" del prompt).
+
+    Args:
+        user_message: Messaggio dell'utente
+        history: true (entità e periodo ricavati dal testo), false, o
+            {"entity_ids": [...], "period": "ieri" | "start"/"end", "buckets": 6}
+            con buckets tra 0 e MAX_PROMPT_BUCKETS
+
+    Returns:
+        Risultato di `HistoryCache.context()` o None
+
+    Raises:
+        ValueError: Se i parametri non sono validi
+    """
+    if not history:
+        return None
+    if history is True:
+        return history_cache.context(user_message)
+    if not isinstance(history, dict):
+        raise ValueError("'history' deve essere un booleano o un oggetto")
+    entity_ids = history.get('entity_ids')
+    if entity_ids is not None and not (
+            isinstance(entity_ids, list) and all(isinstance(e, str) for e in entity_ids)):
+        raise ValueError("'history.entity_ids' deve essere una lista di entity_id")
+    buckets = history.get('buckets', 6)
+    if isinstance(buckets, bool) or not isinstance(buckets, int) or not 0 <= buckets <= MAX_PROMPT_BUCKETS:
+        raise ValueError(f"'history.buckets' deve essere un intero tra 0 e {MAX_PROMPT_BUCKETS}")
+    period = None
+    if any(history.get(key) for key in ('period', 'start', 'end')):
+        period = parse_range(history.get('start'), history.get('end'), history.get('period'))
+    return history_cache.context(
+        user_message,
+        entity_ids=entity_ids,
+        period=period,
+        buckets=buckets
+    )
+
+
+def rag_context(user_message: str, rag: Any) -> Optional[Dict[str, Any]]:
+    """
+    Chunk dell'indice RAG pertinenti alla domanda (blocco "CONTESTO PERTINENTE").
+
+    Args:
+        user_message: Messaggio dell'utente
+        rag: true, false o il numero di chunk da usare
+
+    Returns:
+        Risultato di `RAGIndex.context()` o None (indice disattivato, vuoto
+        o embedding non disponibili)
+
+    Raises:
+        ValueError: Se il parametro non è valido
+    """
+    if rag is False or rag is None or rag_index is None:
+        return None
+    if rag is True:
+        k = RAG_TOP_K
+    elif isinstance(rag, int) and 1 <= rag <= 50:
+        k = rag
+    else:
+        raise ValueError("'rag' deve essere un booleano o un intero tra 1 e 50")
+    return rag_index.context(user_message, k)
+
+
+def with_block(messages: list, user_message: str, block: str) -> list:
+    """Antepone un blocco di contesto all'ultimo messaggio (la domanda resta in coda)."""
+    last = messages[-1]
+    content = last["content"]
+    if content == user_message:
+        content = f"DOMANDA: {user_message}"
+    return messages[:-1] + [dict(last, content=f"{block}\n\n{content}")]
+
+
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    """
+    Endpoint per conversazione singola con il chatbot.
+    
+    Body JSON:
+        {
+            "message": "Ciao, come stai?",
+            "temperature": 0.7,  # opzionale
+            "max_tokens": 512,   # opzionale
+            "include_entities": true,  # opzionale, include contesto entità HA
+            "include_services": false, # opzionale, include contesto servizi HA
+            "entity_domains": ["light", "switch"],  # opzionale, filtra per domini
+            "stream": false,     # opzionale, risposta SSE token per token
+            "prompt_layout": "cache",  # opzionale, "cache" o "legacy"
+            "context_budget": 1400,    # opzionale, token massimi per il prompt
+            "priority": "interactive", # opzionale, "interactive" o "background"
+            "deadline": 30,            # opzionale, attesa massima in coda (s)
+            "cache": true,             # opzionale, default true solo con temperature 0
+            "tools": true,             # opzionale, tool HA (true o lista di domini)
+            "fast_path": true,         # opzionale, comandi semplici senza LLM (con "tools")
+            "json_schema": {...},      # opzionale, risposta JSON conforme allo schema
+            "history": true,           # opzionale, aggregati storici (true o {"entity_ids", "period", ...})
+            "rag": true                # opzionale, chunk dall'indice RAG (true, false o il numero di chunk)
+        }
+    
+    Returns:
+        {
+            "response": "Risposta del bot",
+            "usage": {...},
+            "prompt_cache": {"prompt_tokens": 900, "prompt_evaluated": 40, ...},
+            "context_tokens": {"budget": 1472, "used": 910, "trimmed": false, ...},
+            "cached": {"tier": "exact", "similarity": 1.0, "age_s": 12.5},  # solo se dalla cache
+            "tool_calls": [{"name": "light__turn_on", "arguments": {...}, "status": "ok", ...}],
+            "rounds": 2,  # solo con "tools"
+            "intent": {"service": "light.turn_on", "entity_ids": [...], ...},  # solo dal percorso rapido
+            "data": {...},  # solo con "json_schema": la risposta decodificata e validata
+            "history": {"entities": [...], "period": {"label": "ieri", ...}, "duration_ms": 4.1},
+            "rag": {"hits": [{"id": "entity:light.cucina", "kind": "entity", "score": 0.82}, ...], "duration_ms": 9.3}
+        }
+        
+        Con l'opzione `rag_index` la domanda viene confrontata con l'indice
+        semantico di entità, aree, automazioni e documenti: il prompt riceve
+        solo i chunk più simili (blocco "CONTESTO PERTINENTE", entità con lo
+        stato corrente) invece dell'elenco delle entità. Se l'indice non è
+        pronto si usa il contesto completo.
+        
+        Se la domanda cita un periodo ("ieri", "ultime 6 ore", "mese
+        scorso", ...) e dei sensori pertinenti (energia, temperatura, ...)
+        o un nome di entità, il prompt riceve un blocco "STORICO" con gli
+        aggregati (totale, media, minimo, massimo e pochi valori
+        intermedi) invece delle righe di stato grezze (opzione
+        `history_context`, parametro "history").
+        
+        Con "json_schema" la generazione è vincolata da una grammatica
+        ricavata dallo schema (compilata una volta per schema) e "data"
+        contiene il JSON già validato; 502 se la risposta non è conforme
+        (es. troncata da max_tokens). Non compatibile con "stream" e "tools".
+        
+        Con "tools" il modello può leggere gli stati e chiamare i servizi HA
+        in autonomia (tool calling nativo di llama-server); la risposta
+        arriva dopo l'esecuzione dei tool. Non compatibile con "stream".
+        I comandi semplici e univoci ("accendi la luce del soggiorno")
+        vengono eseguiti direttamente senza il modello (opzione
+        `intent_fast_path`); gli altri proseguono verso il LLM.
+        
+        Con l'opzione `response_cache` le risposte non in streaming vengono
+        riutilizzate per lo stesso messaggio (normalizzato), stessi
+        parametri e stesso contesto HA.
+        
+        Con "stream": true restituisce `text/event-stream` con eventi
+        `{"delta": "..."}` e un evento finale `{"done": true, ...}`.
+        
+        429 se la coda LLM è piena, 503 se la scadenza passa in coda.
+    """
+    try:
+        data = request.get_json()
+        if not data or 'message' not in data:
+            return jsonify({"error": "Campo 'message' richiesto"}), 400
+        
+        try:
+            priority = parse_priority(data.get('priority'))
+            deadline = parse_deadline(data.get('deadline'))
+            max_tokens = parse_token_count(data.get('max_tokens', 512), 'max_tokens')
+            token_budget = data.get('context_budget')
+            if token_budget is not None:
+                token_budget = parse_token_count(token_budget, 'context_budget')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        user_message = data['message']
+        temperature = data.get('temperature', 0.7)
+        include_entities = data.get('include_entities', True)
+        include_services = data.get('include_services', False)
+        entity_domains = data.get('entity_domains')
+        stream = bool(data.get('stream', False))
+        tools = data.get('tools', False)
+        if tools and stream:
+            return jsonify({"error": "'tools' non è compatibile con 'stream'"}), 400
+        if tools and not (tools is True or isinstance(tools, list)):
+            return jsonify({"error": "'tools' deve essere true o una lista di domini"}), 400
+        schema = None
+        if data.get('json_schema') is not None:
+            if stream or tools:
+                return jsonify({"error": "'json_schema' non è compatibile con 'stream' e 'tools'"}), 400
+            try:
+                schema = schema_compiler.compile(data['json_schema'])
+            except SchemaError as e:
+                return jsonify({"error": str(e)}), 400
+        
+        domains = tools if isinstance(tools, list) else None
+        started = time.perf_counter()
+        if tools and intent_router and data.get('fast_path', True):
+            reply = fast_path_reply(user_message, domains or TOOL_DOMAINS)
+            if reply:
+                record_route("fast_path", started)
+                return jsonify(reply)
+        
+        try:
+            rag = rag_context(user_message, data.get('rag', True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if rag and 'include_entities' not in data:
+            # I chunk pertinenti sostituiscono l'elenco completo delle entità
+            include_entities = False
+        
+        if token_budget is None:
+            token_budget = default_token_budget(max_tokens)
+        messages, context_report = build_chat_messages(
+            user_message,
+            include_entities,
+            include_services,
+            entity_domains,
+            data.get('prompt_layout', PROMPT_LAYOUT),
+            token_budget
+        )
+        try:
+            history = history_context(user_message, data.get('history', HISTORY_CONTEXT))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            logger.warning(f"Impossibile ottenere la storia HA: {e}")
+            history = None
+        extra = {}
+        if context_report:
+            extra["context_tokens"] = context_report
+        if history:
+            messages = with_block(messages, user_message, history.pop("text"))
+            extra["history"] = history
+        if rag:
+            messages = with_block(messages, user_message, rag.pop("text"))
+            extra["rag"] = rag
+        if stream:
+            return stream_chat_response(
+                messages,
+                temperature,
+                max_tokens,
+                on_complete=lambda _: extra or None,
+                extra_params={"cache_prompt": True},
+                priority=priority,
+                deadline=deadline
+            )
+        
+        if tools:
+            # Le azioni hanno effetti sulla casa: niente cache delle risposte
+            reply = chat_with_tools(
+                messages,
+                temperature,
+                max_tokens,
+                domains,
+                priority,
+                deadline
+            )
+            reply.update(extra)
+            record_route("llm", started)
+            return jsonify(reply)
+        
+        # Chiamata al modello (o risposta dalla cache)
+        reply = chat_completion(
+            messages,
+            user_message,
+            temperature,
+            max_tokens,
+            priority,
+            deadline,
+            use_cache=bool(data.get('cache', temperature == 0)),
+            schema=schema
+        )
+        reply.update(extra)
+        
+        return jsonify(reply)
+    
+    except AdmissionError as e:
+        logger.warning(f"Richiesta /api/chat rifiutata: {e}")
+        return admission_error_response(e)
+    except StructuredOutputError as e:
+        logger.warning(f"Risposta strutturata non valida: {e}")
+        return jsonify({
+            "error": str(e),
+            "response": e.text,
+            "finish_reason": e.finish_reason
+        }), 502
+    except Exception as e:
+        logger.error(f"Errore in /api/chat: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# Domande massime per richiesta a /api/chat/batch
+MAX_BATCH_SIZE = 64
+
+
+def parse_batch_item(item: Any, index: int, defaults: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Normalizza una domanda di `/api/chat/batch`.
     
-    try:
-        response = requests.post(url, json=payload, timeout=120)
-        
-        # 🔍 DEBUG: Log della risposta
-        logger.info(f"📥 RISPOSTA LLAMA: status={response.status_code}")
-        if response.status_code != 200:
-            logger.error(f"❌ Errore HTTP {response.status_code}")
-            logger.error(f"Response headers: {dict(response.headers)}")
-            logger.error(f"Response body: {response.text}")
-        
-        response.raise_for_status()
-        result = response.json()
-        
-        # Log successo
-        if 'choices' in result and len(result['choices']) > 0:
-            response_preview = result['choices'][0].get('message', {}).get('content', '')[:100]
-            logger.info(f"✅ Risposta OK: {response_preview}...")
-        
-        return result
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Errore chiamata API llama.cpp: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            logger.error(f"Response status: {e.response.status_code}")
-            logger.error(f"Response headers: {dict(e.response.headers)}")
-            logger.error(f"Response body: {e.response.text}")
-        raise
+    Raises:
+        ValueError: Se la domanda non è una stringa o un oggetto con `message`,
+            o se `temperature` o `max_tokens` non sono validi
+    """
+    if isinstance(item, str):
+        item = {"message": item}
+    if not isinstance(item, dict) or not isinstance(item.get('message'), str) or not item['message']:
+        raise ValueError("Ogni domanda deve essere una stringa o un oggetto con 'message'")
+    return {
+        "index": index,
+        "id": item.get('id', index),
+        "message": item['message'],
+        "temperature": parse_temperature(item.get('temperature', defaults['temperature'])),
+        "max_tokens": parse_token_count(item.get('max_tokens', defaults['max_tokens']), 'max_tokens'),
+    }
 
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
+def with_question(messages: list, placeholder: str, question: str) -> list:
+    """Copia dei messaggi con `question` al posto del testo in coda all'ultimo."""
+    content = messages[-1]["content"]
+    if content.endswith(placeholder):
+        content = content[:len(content) - len(placeholder)] + question
+    else:
+        content = question
+    return messages[:-1] + [{"role": messages[-1]["role"], "content": content}]
+
+
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
     """
-    Endpoint per conversazione singola con il chatbot.
+    Esegue più domande indipendenti con un solo contesto Home Assistant.
+    
+    Il contesto viene costruito una volta per tutte le domande; le
+    generazioni vengono distribuite sugli slot paralleli di llama-server
+    (`parallel_requests`) e ogni risultato viene inviato appena pronto.
     
     Body JSON:
         {
-            "message": "Ciao, come stai?",
-            "temperature": 0.7,  # opzionale
-            "max_tokens": 512,   # opzionale
-            "include_entities": true,  # opzionale, include contesto entità HA
-            "include_services": false, # opzionale, include contesto servizi HA
-            "entity_domains": ["light", "switch"]  # opzionale, filtra per domini
+            "prompts": [
+                "Quali luci sono accese?",
+                {"id": "temp", "message": "Che temperatura c'è?", "max_tokens": 128}
+            ],
+            "temperature": 0.7,          # opzionale, default per ogni domanda
+            "max_tokens": 512,           # opzionale, default per ogni domanda
+            "include_entities": true,    # opzionale
+            "include_services": false,   # opzionale
+            "entity_domains": ["light"], # opzionale
+            "stream": true,              # opzionale, risultati SSE man mano
+            "priority": "background",    # opzionale, default "background"
+            "deadline": 300              # opzionale, attesa massima in coda (s)
         }
     
     Returns:
-        {
-            "response": "Risposta del bot",
-            "usage": {...}
-        }
+        Con "stream": true (default) `text/event-stream` con un evento per
+        domanda completata, in ordine di completamento:
+            {"index": 0, "id": 0, "response": "...", "usage": {...}}
+            {"index": 1, "id": "temp", "error": "...", "status": 429}
+        e un evento finale {"done": true, "completed": 1, "failed": 1, ...}.
+        
+        Con "stream": false un unico JSON con "results" nell'ordine delle
+        domande.
     """
     try:
         data = request.get_json()
-        if not data or 'message' not in data:
-            return jsonify({"error": "Campo 'message' richiesto"}), 400
+        prompts = data.get('prompts') if isinstance(data, dict) else None
+        if not isinstance(prompts, list) or not prompts:
+            return jsonify({"error": "Campo 'prompts' richiesto (lista non vuota)"}), 400
+        if len(prompts) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"Al massimo {MAX_BATCH_SIZE} domande per richiesta"}), 400
         
-        user_message = data['message']
-        temperature = data.get('temperature', 0.7)
-        max_tokens = data.get('max_tokens', 512)
-        include_entities = data.get('include_entities', True)
-        include_services = data.get('include_services', False)
-        entity_domains = data.get('entity_domains')
+        try:
+            priority = parse_priority(data.get('priority', 'background'))
+            deadline = parse_deadline(data.get('deadline'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        stream = bool(data.get('stream', True))
+        defaults = {
+            "temperature": data.get('temperature', 0.7),
+            "max_tokens": data.get('max_tokens', 512),
+        }
+        
+        items, results = [], {}
+        for index, prompt in enumerate(prompts):
+            try:
+                items.append(parse_batch_item(prompt, index, defaults))
+            except ValueError as e:
+                results[index] = {"index": index, "id": index, "error": str(e), "status": 400}
+        
+        # Contesto unico: le entità vengono ordinate per rilevanza rispetto a
+        # tutte le domande, il budget è quello della domanda più lunga
+        started = time.time()
+        messages, context_report, placeholder = [], None, ""
+        if items:
+            placeholder = "\n".join(item["message"] for item in items)
+            max_tokens = max(item["max_tokens"] for item in items)
+            longest = max(token_counter.estimate(item["message"]) for item in items)
+            token_budget = (default_token_budget(max_tokens)
+                            + token_counter.estimate(placeholder) - longest)
+            messages, context_report = build_chat_messages(
+                placeholder,
+                data.get('include_entities', True),
+                data.get('include_services', False),
+                data.get('entity_domains'),
+                PROMPT_LAYOUT,
+                token_budget
+            )
         
-        # Costruisci contesto Home Assistant
-        ha_context_text = ""
-        if include_entities or include_services:
+        def run_item(item: Dict[str, Any]) -> Dict[str, Any]:
             try:
-                ha_context_text = ha_context.build_full_context(
-                    include_entities=include_entities,
-                    include_services=include_services,
-                    include_system=True,
-                    entity_domains=entity_domains
+                reply = chat_completion(
+                    with_question(messages, placeholder, item["message"]),
+                    item["message"],
+                    item["temperature"],
+                    item["max_tokens"],
+                    priority,
+                    deadline,
+                    use_cache=item["temperature"] == 0
                 )
+                return {"index": item["index"], "id": item["id"], **reply}
+            except AdmissionError as e:
+                return {"index": item["index"], "id": item["id"], "error": str(e), "status": e.status_code}
             except Exception as e:
-                logger.warning(f"Impossibile ottenere contesto HA: {e}")
-                ha_context_text = ""
+                logger.error(f"Errore nella domanda {item['index']} di /api/chat/batch: {e}")
+                return {"index": item["index"], "id": item["id"], "error": str(e), "status": 500}
         
-        # Crea messaggio nel formato OpenAI con contesto HA
-        system_prompt = "Sei un assistente virtuale per Home Assistant. "
-        if ha_context_text:
-            system_prompt += "Hai accesso alle seguenti informazioni sul sistema:\n\n" + ha_context_text
-        else:
-            system_prompt += "Aiuti gli utenti a gestire la loro casa intelligente."
+        def run_batch() -> Iterator[Dict[str, Any]]:
+            # Non più thread degli slot: l'eccesso attende qui, non nella
+            # coda dello scheduler, e non la riempie a danno delle altre richieste
+            yield from results.values()
+            if not items:
+                return
+            executor = ThreadPoolExecutor(
+                max_workers=min(len(items), LLAMA_SLOTS),
+                thread_name_prefix="chat-batch"
+            )
+            try:
+                futures = [executor.submit(run_item, item) for item in items]
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                # Client disconnesso: le domande non ancora partite si annullano
+                executor.shutdown(wait=False, cancel_futures=True)
         
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ]
+        def summary(done: list) -> Dict[str, Any]:
+            failed = sum(1 for r in done if "error" in r)
+            report = {
+                "completed": len(done) - failed,
+                "failed": failed,
+                "elapsed_s": round(time.time() - started, 2)
+            }
+            if context_report:
+                report["context_tokens"] = context_report
+            return report
         
-        # Chiamata al modello
-        result = call_llama_api(messages, temperature, max_tokens)
+        if not stream:
+            done = sorted(run_batch(), key=lambda r: r["index"])
+            return jsonify({"results": done, **summary(done)})
         
-        # Estrai risposta
-        response_text = result['choices'][0]['message']['content']
+        def generate() -> Iterator[str]:
+            done = []
+            for result in run_batch():
+                done.append(result)
+                yield sse_event(result)
+            yield sse_event({"done": True, **summary(done)})
+            yield "data: [DONE]\n\n"
         
-        return jsonify({
-            "response": response_text,
-            "usage": result.get('usage', {})
-        })
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
     
     except Exception as e:
-        logger.error(f"Errore in /api/chat: {e}")
+        logger.error(f"Errore in /api/chat/batch: {e}")
         return jsonify({"error": str(e)}), 500
 
 
@@ -243,14 +1440,26 @@ def start_conversation():
     
     Body JSON:
         {
-            "system_prompt": "Sei un assistente..."  # opzionale
+            "system_prompt": "Sei un assistente...",  # opzionale
+            "ha_context": {                           # opzionale (o true)
+                "include_entities": true,
+                "include_services": false,
+                "entity_domains": ["light", "climate"]
+            },
+            "warm": true  # opzionale, scalda lo slot llama-server con il contesto
         }
     
     Returns:
         {
             "conversation_id": "abc123",
-            "message": "Conversazione avviata"
+            "message": "Conversazione avviata",
+            "ha_context": {...}  # solo se richiesto: profilo legato alla conversazione
         }
+        
+        Con "ha_context" ogni turno include il contesto Home Assistant:
+        viene preparato subito in background (e lo slot della conversazione
+        scaldato con `n_predict=0`), poi aggiornato in background quando
+        scade (`context_cache_ttl`).
     """
     try:
         data = request.get_json() or {}
@@ -259,20 +1468,34 @@ def start_conversation():
             "Sei un assistente virtuale utile e cortese per Home Assistant."
         )
         
+        profile = None
+        if data.get('ha_context'):
+            try:
+                profile = ContextProfile.from_dict(data['ha_context'])
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        
         # Genera ID conversazione
         conversation_id = f"conv_{int(time.time())}_{os.urandom(4).hex()}"
         
         # Inizializza conversazione
-        conversations[conversation_id] = [
+        conversations.create(conversation_id, [
             {"role": "system", "content": system_prompt}
-        ]
-        
-        logger.info(f"Avviata conversazione {conversation_id}")
+        ])
         
-        return jsonify({
+        reply = {
             "conversation_id": conversation_id,
             "message": "Conversazione avviata con successo"
-        })
+        }
+        if profile is not None:
+            conversation_contexts.bind(
+                conversation_id, profile, system_prompt, warm=bool(data.get('warm', True))
+            )
+            reply["ha_context"] = profile.to_dict()
+        
+        logger.info(f"Avviata conversazione {conversation_id}")
+        
+        return jsonify(reply)
     
     except Exception as e:
         logger.error(f"Errore in /api/conversation/start: {e}")
@@ -291,55 +1514,130 @@ def send_message(conversation_id: str):
         {
             "message": "Qual è la temperatura in casa?",
             "temperature": 0.7,  # opzionale
-            "max_tokens": 512    # opzionale
+            "max_tokens": 512,   # opzionale
+            "stream": false,     # opzionale, risposta SSE token per token
+            "priority": "interactive",  # opzionale, "interactive" o "background"
+            "deadline": 30       # opzionale, attesa massima in coda (s)
         }
     
     Returns:
         {
             "response": "Risposta del bot",
-            "usage": {...}
+            "usage": {...},
+            "history": {...}  # token e messaggi della storia inviati al modello
         }
+        
+        La storia inviata al modello è limitata a `history_max_tokens`:
+        system prompt sempre incluso, turni vecchi riassunti in background
+        (strategia `history_strategy`).
+        
+        Se la conversazione ha un profilo "ha_context", il catalogo HA
+        segue il system prompt e gli stati correnti precedono la domanda
+        (solo nel prompt: nella storia resta il messaggio originale).
+        
+        Con "stream": true restituisce `text/event-stream`; la risposta
+        completa viene salvata nella conversazione a fine stream.
+        
+        429 se la coda LLM è piena, 503 se la scadenza passa in coda.
     """
     try:
-        if conversation_id not in conversations:
+        history = conversations.get_messages(conversation_id)
+        if history is None:
             return jsonify({"error": "Conversazione non trovata"}), 404
         
         data = request.get_json()
         if not data or 'message' not in data:
             return jsonify({"error": "Campo 'message' richiesto"}), 400
         
+        try:
+            priority = parse_priority(data.get('priority'))
+            deadline = parse_deadline(data.get('deadline'))
+            max_tokens = parse_token_count(data.get('max_tokens', 512), 'max_tokens')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         user_message = data['message']
         temperature = data.get('temperature', 0.7)
-        max_tokens = data.get('max_tokens', 512)
+        stream = bool(data.get('stream', False))
         
-        # Aggiungi messaggio utente alla conversazione
-        conversations[conversation_id].append({
-            "role": "user",
-            "content": user_message
-        })
+        # Slot fisso per conversazione: la storia precedente resta in KV cache
+        extra_params = {
+            "cache_prompt": True,
+            "id_slot": slot_for(conversation_id, LLAMA_SLOTS)
+        }
+        
+        # Il turno viene salvato solo a generazione completata; il contesto
+        # HA (se legato alla conversazione) entra solo nel prompt
+        user_turn = {"role": "user", "content": user_message}
+        model_history, model_turn = conversation_contexts.compose(
+            history,
+            user_turn,
+            conversation_contexts.get(conversation_id, timeout=CONTEXT_PREFETCH_TIMEOUT)
+        )
+        messages, history_report = history_manager.prepare(
+            conversation_id,
+            model_history,
+            model_turn,
+            default_token_budget(max_tokens)
+        )
+        
+        if stream:
+            def save_response(response_text: str) -> Dict[str, Any]:
+                count = conversations.append(
+                    conversation_id,
+                    user_turn,
+                    {"role": "assistant", "content": response_text}
+                )
+                return {
+                    "message_count": (count or len(history) + 2) - 1,
+                    "history": history_report
+                }
+            
+            return stream_chat_response(
+                messages,
+                temperature,
+                max_tokens,
+                on_complete=save_response,
+                extra_params=extra_params,
+                priority=priority,
+                deadline=deadline
+            )
         
-        # Chiamata al modello con storia completa
+        # Chiamata al modello con la finestra di storia
         result = call_llama_api(
-            conversations[conversation_id],
+            messages,
             temperature,
-            max_tokens
+            max_tokens,
+            extra_params,
+            priority,
+            deadline
         )
         
         # Estrai risposta
         response_text = result['choices'][0]['message']['content']
         
-        # Aggiungi risposta alla conversazione
-        conversations[conversation_id].append({
-            "role": "assistant",
-            "content": response_text
-        })
+        # Aggiungi domanda e risposta alla conversazione
+        count = conversations.append(
+            conversation_id,
+            user_turn,
+            {"role": "assistant", "content": response_text}
+        )
         
-        return jsonify({
+        reply = {
             "response": response_text,
             "usage": result.get('usage', {}),
-            "message_count": len(conversations[conversation_id]) - 1  # -1 per system prompt
-        })
+            "message_count": (count or len(history) + 2) - 1,  # -1 per system prompt
+            "history": history_report
+        }
+        prompt_cache = record_completion(result)
+        if prompt_cache:
+            reply["prompt_cache"] = prompt_cache
+        
+        return jsonify(reply)
     
+    except AdmissionError as e:
+        logger.warning(f"Richiesta /api/conversation/{conversation_id}/message rifiutata: {e}")
+        return admission_error_response(e)
     except Exception as e:
         logger.error(f"Errore in /api/conversation/{conversation_id}/message: {e}")
         return jsonify({"error": str(e)}), 500
@@ -348,24 +1646,41 @@ def send_message(conversation_id: str):
 @app.route('/api/conversation/<conversation_id>/history', methods=['GET'])
 def get_conversation_history(conversation_id: str):
     """
-    Ottiene la storia di una conversazione.
+    Ottiene la storia di una conversazione (paginata).
     
     Args:
         conversation_id: ID della conversazione
     
+    Query params:
+        offset: Indice del primo messaggio (default: 0)
+        limit: Numero massimo di messaggi (default: 100)
+    
     Returns:
         {
             "conversation_id": "abc123",
-            "messages": [...]
+            "messages": [...],
+            "total": 42,
+            "next_offset": 100  # null se non ci sono altri messaggi
         }
     """
     try:
-        if conversation_id not in conversations:
+        try:
+            offset, limit = page_args(default_limit=100)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        messages = conversations.get_messages(conversation_id, offset, limit)
+        if messages is None:
             return jsonify({"error": "Conversazione non trovata"}), 404
+        total = conversations.message_count(conversation_id) or 0
         
         return jsonify({
             "conversation_id": conversation_id,
-            "messages": conversations[conversation_id]
+            "messages": messages,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "next_offset": offset + limit if offset + limit < total else None
         })
     
     except Exception as e:
@@ -387,10 +1702,9 @@ def delete_conversation(conversation_id: str):
         }
     """
     try:
-        if conversation_id not in conversations:
+        if not conversations.delete(conversation_id):
             return jsonify({"error": "Conversazione non trovata"}), 404
         
-        del conversations[conversation_id]
         logger.info(f"Eliminata conversazione {conversation_id}")
         
         return jsonify({
@@ -405,28 +1719,48 @@ def delete_conversation(conversation_id: str):
 @app.route('/api/conversations', methods=['GET'])
 def list_conversations():
     """
-    Lista tutte le conversazioni attive.
+    Lista le conversazioni attive, dalla più recente (paginata).
+    
+    Query params:
+        offset: Indice della prima conversazione (default: 0)
+        limit: Numero massimo di conversazioni (default: 50)
     
     Returns:
         {
             "conversations": [
                 {
                     "id": "abc123",
-                    "message_count": 5
+                    "message_count": 5,
+                    "last_access": 1729512345.0
                 }
-            ]
+            ],
+            "total": 12,
+            "next_offset": null
         }
     """
     try:
+        try:
+            offset, limit = page_args(default_limit=50)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        page, total = conversations.list(offset, limit)
         conv_list = [
             {
-                "id": conv_id,
-                "message_count": len(messages) - 1  # -1 per system prompt
+                "id": conv["id"],
+                "message_count": conv["message_count"] - 1,  # -1 per system prompt
+                "last_access": conv["last_access"]
             }
-            for conv_id, messages in conversations.items()
+            for conv in page
         ]
         
-        return jsonify({"conversations": conv_list})
+        return jsonify({
+            "conversations": conv_list,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "next_offset": offset + limit if offset + limit < total else None
+        })
     
     except Exception as e:
         logger.error(f"Errore in /api/conversations: {e}")
@@ -440,24 +1774,61 @@ def health():
     
     Returns:
         {
-            "status": "ok",
-            "llama_server": "ok"
+            "status": "ok",  # o la fase di avvio: starting, downloading, loading, warming, failed
+            "llama_server": "ok",
+            "startup": {"phase": "ready", "time_to_ready_s": 41.2, "phases_s": {...}, ...}
         }
     """
     try:
         # Verifica stato server llama.cpp
-        response = requests.get(f"{LLAMA_SERVER_URL}/health", timeout=5)
+        response = http_pool.get(f"{LLAMA_SERVER_URL}/health", endpoint="llama_health")
         llama_status = "ok" if response.status_code == 200 else "error"
     except Exception:
         llama_status = "error"
     
     return jsonify({
-        "status": "ok",
+        "status": "ok" if startup.ready else startup.phase,
         "llama_server": llama_status,
-        "active_conversations": len(conversations)
+        "startup": startup.get_stats(),
+        "active_conversations": conversations.count(),
+        "http_pool": http_pool.get_stats(),
+        "context_cache": context_cache.get_stats(),
+        "state_mirror": state_mirror.get_stats(),
+        "entity_index": entity_index.get_stats(),
+        "service_catalog": service_catalog.get_stats(),
+        "entity_history": history_cache.get_stats(),
+        "rag_index": rag_index.get_stats() if rag_index else None,
+        "prompt_cache": prompt_stats.get_stats(),
+        "token_counter": token_counter.get_stats(),
+        "llm_queue": llm_scheduler.get_stats(),
+        "conversation_store": conversations.get_stats(),
+        "conversation_history": history_manager.get_stats(),
+        "conversation_context": conversation_contexts.get_stats(),
+        "response_cache": response_cache.get_stats() if response_cache else None,
+        "tools": tool_agent.get_stats(),
+        "service_batch": service_batcher.get_stats(),
+        "structured_output": schema_compiler.get_stats(),
+        "intent_router": intent_router.get_stats() if intent_router else None
     })
 
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Metriche in formato Prometheus.
+    
+    Istogrammi di latenza (richieste, costruzione del contesto, chiamate
+    a Supervisor e llama-server, attesa in coda, timings di llama-server),
+    contatori di errori per endpoint e di token, più le statistiche dei
+    componenti riportate anche in `/api/health`.
+    """
+    try:
+        return Response(metrics.generate_latest_text(), content_type=CONTENT_TYPE_LATEST)
+    except Exception as e:
+        logger.error(f"Errore in /metrics: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/api/models', methods=['GET'])
 def get_models():
     """
@@ -469,7 +1840,7 @@ def get_models():
         }
     """
     try:
-        response = requests.get(f"{LLAMA_SERVER_URL}/v1/models", timeout=5)
+        response = http_pool.get(f"{LLAMA_SERVER_URL}/v1/models", endpoint="llama_models")
         response.raise_for_status()
         return jsonify(response.json())
     
@@ -483,28 +1854,57 @@ def get_models():
 @app.route('/api/ha/entities', methods=['GET'])
 def get_ha_entities():
     """
-    Ottiene tutte le entità di Home Assistant.
+    Interroga le entità di Home Assistant.
+    
+    Filtri e ordinamento usano l'indice delle entità (nessuna chiamata
+    al Supervisor con il mirror attivo). Senza `fields` e `limit` la
+    risposta contiene tutti gli stati completi, come in passato.
     
     Query params:
-        domain: Filtra per dominio (opzionale)
+        domain: Domini, separati da virgola (opzionale)
+        area: area_id o nomi di area, separati da virgola (opzionale)
+        device_class: device_class, separate da virgola (opzionale)
+        state: Stati, separati da virgola (opzionale)
+        attributes.<nome>: Valore richiesto per l'attributo (opzionale)
+        fields: Campi da restituire, es. "state,attributes.friendly_name,area_id"
+        limit: Entità per pagina (max 5000)
+        cursor: `next_cursor` della pagina precedente
+    
+    Headers:
+        If-None-Match: ETag di una risposta precedente (304 se invariata)
     
     Returns:
         {
-            "entities": [...]
+            "entities": [...],
+            "count": 100,
+            "total": 431,
+            "next_cursor": "..." | null
         }
     """
     try:
-        domain = request.args.get('domain')
-        states = ha_client.get_states()
-        
-        if not states:
-            return jsonify({"error": "Impossibile ottenere entità"}), 500
+        try:
+            query = EntityQuery.from_args(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Filtra per dominio se richiesto
-        if domain:
-            states = [s for s in states if s.get('entity_id', '').startswith(f'{domain}.')]
+        if entity_index.ready:
+            index = entity_index
+        else:
+            # Mirror non ancora pronto: indice temporaneo dagli stati REST
+            states = ha_client.get_states()
+            if not states:
+                return jsonify({"error": "Impossibile ottenere entità"}), 500
+            index = EntityIndex.from_states(states)
         
-        return jsonify({"entities": states})
+        page = index.query(query)
+        if request.if_none_match.contains(page.etag):
+            entity_index.record_not_modified()
+            response = Response(status=304)
+        else:
+            response = jsonify(page.to_dict())
+        response.set_etag(page.etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
     
     except Exception as e:
         logger.error(f"Errore in /api/ha/entities: {e}")
@@ -524,7 +1924,7 @@ def get_ha_entity(entity_id: str):
         }
     """
     try:
-        states = ha_client.get_states(entity_id)
+        states = ha_states.get_states(entity_id)
         
         if not states or not states[0]:
             return jsonify({"error": f"Entità '{entity_id}' non trovata"}), 404
@@ -536,23 +1936,239 @@ def get_ha_entity(entity_id: str):
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/ha/history/<path:entity_id>', methods=['GET'])
+def get_ha_history(entity_id: str):
+    """
+    Aggregati storici di un'entità, dalla cache locale delle serie.
+    
+    Query string:
+        period: periodo in testo ("ieri", "ultime 6 ore", "last week", ...)
+        start, end: in alternativa, ISO 8601 (default: ultime 24 ore)
+        buckets: valori intermedi di uguale durata (default 24, max 1000)
+    
+    Returns:
+        {
+            "entity_id": "sensor.energia_casa",
+            "kind": "counter",  # "counter", "measurement" o "binary"
+            "source": "history",  # o "statistics" oltre la conservazione del recorder
+            "period": "ieri",
+            "mean": ..., "min": ..., "max": ..., "last": ..., "change": 12.4,
+            "buckets": [{"start": 1760652000.0, "mean": ..., "change": ...}, ...]
+        }
+    """
+    try:
+        try:
+            start, end, label = parse_range(
+                request.args.get('start'), request.args.get('end'), request.args.get('period')
+            )
+            buckets = min(max(int(request.args.get('buckets', 24)), 0), 1000)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        result = history_cache.aggregate(entity_id, start.timestamp(), end.timestamp(), buckets)
+        result["period"] = label
+        return jsonify(result)
+    
+    except Exception as e:
+        logger.error(f"Errore in /api/ha/history/{entity_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/ha/statistics', methods=['GET'])
+def get_ha_statistics():
+    """
+    Statistiche a lungo termine del recorder (medie, minimi, massimi, variazioni).
+    
+    Query string:
+        statistic_id: uno o più ID separati da virgola (per i sensori, l'entity_id)
+        period: "5minute", "hour", "day", "week" o "month" (default "hour")
+        start, end: ISO 8601 (default: ultime 24 ore)
+    
+    Returns:
+        {
+            "statistics": {"sensor.energia_casa": [{"start": ..., "end": ..., "mean": ..., "change": ...}]},
+            "period": "hour"
+        }
+    """
+    try:
+        statistic_ids = [s.strip() for s in request.args.get('statistic_id', '').split(',') if s.strip()]
+        period = request.args.get('period', 'hour')
+        if not statistic_ids:
+            return jsonify({"error": "Parametro 'statistic_id' richiesto"}), 400
+        if period not in STATISTIC_PERIODS:
+            return jsonify({"error": f"'period' deve essere uno di: {', '.join(STATISTIC_PERIODS)}"}), 400
+        try:
+            start, end, _ = parse_range(request.args.get('start'), request.args.get('end'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        statistics = history_cache.statistics(statistic_ids, start.timestamp(), end.timestamp(), period)
+        return jsonify({"statistics": statistics, "period": period})
+    
+    except Exception as e:
+        logger.error(f"Errore in /api/ha/statistics: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def rag_disabled_response():
+    return jsonify({"error": "Indice RAG disattivato (opzioni 'rag_index' e 'state_mirror')"}), 404
+
+
+@app.route('/api/rag/search', methods=['GET'])
+def rag_search():
+    """
+    Ricerca semantica nell'indice RAG.
+    
+    Query string:
+        q: testo da cercare
+        k: numero di risultati (default `rag_top_k`, max 50)
+        kind: tipi separati da virgola ("entity", "area", "automation", "document")
+    
+    Returns:
+        {
+            "results": [{"id": "entity:light.cucina", "kind": "entity", "text": "...", "score": 0.82}],
+            "duration_ms": 8.4
+        }
+    """
+    if rag_index is None:
+        return rag_disabled_response()
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({"error": "Parametro 'q' richiesto"}), 400
+        try:
+            k = int(request.args.get('k', RAG_TOP_K))
+        except ValueError:
+            return jsonify({"error": "'k' deve essere un intero"}), 400
+        if not 1 <= k <= 50:
+            return jsonify({"error": "'k' deve essere tra 1 e 50"}), 400
+        kinds = [kind.strip() for kind in request.args.get('kind', '').split(',') if kind.strip()] or None
+        if kinds and any(kind not in RAG_KINDS for kind in kinds):
+            return jsonify({"error": f"'kind' deve essere tra: {', '.join(RAG_KINDS)}"}), 400
+        
+        started = time.perf_counter()
+        try:
+            results = rag_index.search(query, k, kinds)
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 503
+        return jsonify({
+            "results": results,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+        })
+    
+    except Exception as e:
+        logger.error(f"Errore in /api/rag/search: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/rag/documents', methods=['POST'])
+def rag_add_document():
+    """
+    Aggiunge (o sostituisce) un documento nell'indice RAG.
+    
+    Il documento viene salvato in /data/rag/documents e diviso in chunk
+    per paragrafi; gli embedding vengono calcolati in background.
+    
+    Body JSON:
+        {"id": "manuale-caldaia", "text": "...", "title": "Manuale caldaia"}
+    
+    Returns:
+        202 {"id": "manuale-caldaia", "chunks": 4}
+    """
+    if rag_index is None:
+        return rag_disabled_response()
+    try:
+        data = request.get_json() or {}
+        try:
+            chunks = rag_index.add_document(data.get('id'), data.get('text'), data.get('title'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 503
+        return jsonify({"id": data['id'], "chunks": chunks}), 202
+    
+    except Exception as e:
+        logger.error(f"Errore in /api/rag/documents: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/rag/documents/<doc_id>', methods=['DELETE'])
+def rag_remove_document(doc_id):
+    """Rimuove un documento caricato con POST /api/rag/documents."""
+    if rag_index is None:
+        return rag_disabled_response()
+    try:
+        if not rag_index.remove_document(doc_id):
+            return jsonify({"error": f"Documento {doc_id} non trovato"}), 404
+        return jsonify({"id": doc_id, "deleted": True})
+    
+    except Exception as e:
+        logger.error(f"Errore in /api/rag/documents: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/rag/reindex', methods=['POST'])
+def rag_reindex():
+    """
+    Ricontrolla tutte le sorgenti dell'indice RAG in background.
+    
+    Solo i chunk il cui testo è cambiato vengono ricalcolati.
+    
+    Returns:
+        202 {"pending": 1240}
+    """
+    if rag_index is None:
+        return rag_disabled_response()
+    try:
+        rag_index.reindex()
+        return jsonify({"pending": rag_index.get_stats()["pending"]}), 202
+    
+    except Exception as e:
+        logger.error(f"Errore in /api/rag/reindex: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/api/ha/services', methods=['GET'])
 def get_ha_services():
     """
-    Ottiene tutti i servizi disponibili in Home Assistant.
+    Ottiene i servizi disponibili in Home Assistant dal catalogo in cache.
+    
+    Query params:
+        domain: Domini, separati da virgola (opzionale)
+        format: "full" (default, come `GET /api/services`) o "compact"
+            (per ogni servizio solo campi, obbligatori e target)
+    
+    Headers:
+        If-None-Match: ETag di una risposta precedente (304 se invariata)
     
     Returns:
         {
-            "services": {...}
+            "services": [...] | {"light": {"turn_on": {"fields": [...]}}},
+            "hash": "..."
         }
     """
     try:
-        services = ha_client.get_services()
-        
-        if not services:
-            return jsonify({"error": "Impossibile ottenere servizi"}), 500
+        output = request.args.get('format', 'full')
+        if output not in ('full', 'compact'):
+            return jsonify({"error": "'format' deve essere 'full' o 'compact'"}), 400
+        domains = [d.strip() for d in request.args.get('domain', '').split(',') if d.strip()] or None
         
-        return jsonify({"services": services})
+        try:
+            digest = service_catalog.etag(domains)
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 500
+        etag = f"{output}-{digest}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            services = (
+                service_catalog.get_compact(domains) if output == 'compact'
+                else service_catalog.get_services(domains)
+            )
+            response = jsonify({"services": services, "hash": digest})
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
     
     except Exception as e:
         logger.error(f"Errore in /api/ha/services: {e}")
@@ -593,6 +2209,9 @@ def call_ha_service():
         if result is None:
             return jsonify({"error": "Errore chiamata servizio"}), 500
         
+        # Lo stato delle entità è cambiato: il contesto in cache è obsoleto
+        context_cache.invalidate()
+        
         return jsonify({
             "success": True,
             "result": result
@@ -603,6 +2222,53 @@ def call_ha_service():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/ha/service/call/batch', methods=['POST'])
+def call_ha_services_batch():
+    """
+    Chiama più servizi di Home Assistant in una sola richiesta.
+    
+    Le chiamate con stesso dominio, servizio e dati vengono unite in una
+    chiamata con più entity_id; le altre vengono eseguite in parallelo
+    (al più `service_call_parallel`), mantenendo l'ordine tra chiamate
+    sulle stesse entità.
+    
+    Body JSON:
+        {
+            "calls": [
+                {"domain": "light", "service": "turn_off", "entity_id": "light.cucina"},
+                {"domain": "light", "service": "turn_off", "entity_id": ["light.sala", "light.bagno"]},
+                {"domain": "cover", "service": "close_cover", "entity_id": "cover.sala", "data": {}}
+            ],
+            "merge": true  # opzionale, default true
+        }
+    
+    Returns:
+        {
+            "success": true,
+            "results": [{"index": 0, "status": "ok", "dispatch": 0, "merged": 2,
+                         "duration_ms": 35.2, "changed": [...]}, ...],
+            "calls": 3,
+            "dispatches": 2,
+            "duration_ms": 36.0
+        }
+    """
+    try:
+        data = request.get_json()
+        if not data or 'calls' not in data:
+            return jsonify({"error": "Campo 'calls' richiesto"}), 400
+        
+        try:
+            result = service_batcher.run(data['calls'], merge=bool(data.get('merge', True)))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        return jsonify(result)
+    
+    except Exception as e:
+        logger.error(f"Errore in /api/ha/service/call/batch: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/api/ha/config', methods=['GET'])
 def get_ha_config():
     """
@@ -636,6 +2302,7 @@ def get_ha_context():
         services: Include servizi (default: false)
         system: Include info di sistema (default: true)
         domains: Lista domini separati da virgola (es: light,switch)
+        refresh: Se true ignora la cache e ricostruisce il contesto
     
     Returns:
         {
@@ -650,7 +2317,10 @@ def get_ha_context():
         
         entity_domains = domains_param.split(',') if domains_param else None
         
-        context = ha_context.build_full_context(
+        if request.args.get('refresh', 'false').lower() == 'true':
+            context_cache.invalidate()
+        
+        context = context_cache.get(
             include_entities=include_entities,
             include_services=include_services,
             include_system=include_system,
@@ -664,31 +2334,108 @@ def get_ha_context():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/ha/context/invalidate', methods=['POST'])
+def invalidate_ha_context():
+    """
+    Invalida la cache del contesto Home Assistant.
+    
+    Vengono riletti anche il catalogo e le info di sistema del prompt e il
+    catalogo dei servizi usato per i tool; scade il contesto delle
+    conversazioni (aggiornato al turno successivo).
+    
+    Returns:
+        {
+            "invalidated": 3,
+            "cache": {...}
+        }
+    """
+    try:
+        removed = context_cache.invalidate()
+        prompt_builder.invalidate()
+        tool_catalog.invalidate()
+        conversation_contexts.invalidate()
+        if intent_router:
+            intent_router.invalidate()
+        logger.info(f"Cache contesto HA invalidata ({removed} voci)")
+        
+        return jsonify({
+            "invalidated": removed,
+            "cache": context_cache.get_stats()
+        })
+    
+    except Exception as e:
+        logger.error(f"Errore in /api/ha/context/invalidate: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/chat/cache/invalidate', methods=['POST'])
+def invalidate_response_cache():
+    """
+    Svuota la cache delle risposte di `/api/chat`.
+    
+    Returns:
+        {
+            "invalidated": 12,
+            "cache": {...}
+        }
+    """
+    try:
+        if response_cache is None:
+            return jsonify({"error": "Cache delle risposte disattivata (opzione response_cache)"}), 404
+        
+        removed = response_cache.invalidate()
+        logger.info(f"Cache risposte invalidata ({removed} voci)")
+        
+        return jsonify({
+            "invalidated": removed,
+            "cache": response_cache.get_stats()
+        })
+    
+    except Exception as e:
+        logger.error(f"Errore in /api/chat/cache/invalidate: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 def main():
     """Main entry point."""
     logger.info("=" * 80)
     logger.info("🔧 Initializing HA Service...")
     logger.info("=" * 80)
     
-    # Attendi che llama-server sia pronto
-    logger.info("⏳ Waiting for llama-server...")
-    if not wait_for_llama_server():
-        logger.error("❌ Impossibile connettersi al server llama.cpp")
-        sys.exit(1)
+    # Avvia il mirror degli stati HA
+    if STATE_MIRROR_ENABLED:
+        state_mirror.start()
+    else:
+        logger.info("Mirror stati HA disattivato, uso la REST API per ogni richiesta")
     
-    logger.info("✅ Llama-server ready!")
+    # Indice RAG: si aggiorna dagli eventi del mirror
+    # (senza mirror l'indice non viene creato: non resterebbe aggiornato)
+    if rag_index is not None:
+        logger.info(f"🧭 Indice RAG attivo (embedding da {EMBEDDING_SERVER_URL})")
+        rag_index.start()
+    elif get_option('rag_index', False):
+        logger.warning("⚠️ Indice RAG disattivato: richiede il mirror degli stati")
     
-    # Avvia Flask app
+    # Download, caricamento e riscaldamento del modello proseguono in
+    # background: l'API risponde subito con la fase corrente
+    logger.info("⏳ Avvio in background (llama-server, cache HA, riscaldamento)...")
+    startup.start()
+    
+    # Avvia l'app Flask dietro uvicorn (ASGI)
     logger.info("=" * 80)
-    logger.info("🚀 Starting Flask API server on port 5000...")
+    logger.info("🚀 Starting ASGI API server on port %s...", HA_SERVICE_PORT)
     logger.info("=" * 80)
     
-    # Disable Flask's default logging to avoid duplicates
-    import logging as flask_logging
-    log = flask_logging.getLogger('werkzeug')
-    log.setLevel(flask_logging.WARNING)
-    
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+    serve(
+        app,
+        host='0.0.0.0',
+        port=HA_SERVICE_PORT,
+        api_workers=int(get_option('api_workers', 8)),
+        # Ogni richiesta in coda occupa un thread mentre attende lo slot
+        llm_workers=max(int(get_option('llm_workers', 4)), LLAMA_SLOTS + LLM_QUEUE_SIZE),
+        # Coda LLM piena o thread esauriti: 429 prima di occupare un thread
+        admission=llm_scheduler.check_admission
+    )
 
 
 if __name__ == '__main__':
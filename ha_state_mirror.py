@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Mirror in memoria degli stati delle entità Home Assistant.
+Resta sincronizzato tramite la WebSocket API (eventi state_changed)
+e si riallinea via REST a ogni (ri)connessione. Dai registri di entità,
+dispositivi e aree ricava l'area di ogni entità, ricaricata agli eventi
+`*_registry_updated`.
+"""
+
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import websocket
+
+from supervisor_api import SupervisorAPI
+
+logger = logging.getLogger(__name__)
+
+# Eventi che invalidano la mappa entità → area
+REGISTRY_EVENTS = ("entity_registry_updated", "device_registry_updated", "area_registry_updated")
+
+
+class StateMirror:
+    """
+    Copia indicizzata di tutti gli stati HA, aggiornata in background.
+
+    Gli stati sono indicizzati per entity_id e per dominio; le letture
+    non generano traffico verso il Supervisor.
+    """
+
+    def __init__(
+        self,
+        api: SupervisorAPI,
+        reconnect_delay: float = 1.0,
+        max_reconnect_delay: float = 60.0,
+        ping_interval: float = 30.0
+    ):
+        """
+        Inizializza il mirror.
+
+        Args:
+            api: Client Supervisor (fornisce URL REST/WebSocket e token)
+            reconnect_delay: Attesa iniziale prima di riconnettersi (secondi)
+            max_reconnect_delay: Attesa massima tra due tentativi (secondi)
+            ping_interval: Inattività dopo la quale viene inviato un ping
+        """
+        self.api = api
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.ping_interval = ping_interval
+
+        self._lock = threading.RLock()
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self._by_domain: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._areas: Dict[str, str] = {}
+        self._area_names: Dict[str, str] = {}
+        self._registry_stale = False
+        self._listeners: List[Callable[[str, Optional[Dict], Optional[Dict]], None]] = []
+        self._event_listeners: Dict[str, List[Callable[[Dict[str, Any]], None]]] = {}
+        self._resync_listeners: List[Callable[[], None]] = []
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._ws = None
+        self._msg_id = 0
+
+        self.connected = False
+        # Incrementata a ogni disconnessione: chi segue gli eventi sa che
+        # quelli della sessione precedente sono finiti (anche durante il
+        # riallineamento, che riporta solo l'ultimo stato)
+        self.session = 0
+        self.events_applied = 0
+        self.resyncs = 0
+        self.reconnects = 0
+        self.last_event_at: Optional[float] = None
+        self.registry_version = 0
+
+    # ------------------------------------------------------------------
+    # Letture
+    # ------------------------------------------------------------------
+
+    @property
+    def ready(self) -> bool:
+        """True dopo il primo riallineamento completo."""
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def get_state(self, entity_id: str) -> Optional[Dict[str, Any]]:
+        """Stato di una singola entità (None se non esiste)."""
+        with self._lock:
+            return self._states.get(entity_id)
+
+    def get_states(self, domain: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Lista degli stati, opzionalmente filtrata per dominio.
+
+        Gli oggetti restituiti sono condivisi con il mirror e vanno
+        trattati in sola lettura.
+        """
+        with self._lock:
+            if domain:
+                return list(self._by_domain.get(domain, {}).values())
+            return list(self._states.values())
+
+    def domains(self) -> List[str]:
+        with self._lock:
+            return sorted(self._by_domain)
+
+    def get_area(self, entity_id: str) -> Optional[str]:
+        """area_id dell'entità (propria o del dispositivo), None se non assegnata."""
+        with self._lock:
+            return self._areas.get(entity_id)
+
+    def get_areas(self) -> Dict[str, str]:
+        """Aree note: area_id → nome."""
+        with self._lock:
+            return dict(self._area_names)
+
+    def add_listener(self, callback: Callable[[str, Optional[Dict], Optional[Dict]], None]):
+        """
+        Registra una callback invocata a ogni cambio di stato.
+
+        La callback riceve (entity_id, old_state, new_state); viene
+        chiamata dal thread del mirror e non deve bloccare.
+        """
+        self._listeners.append(callback)
+
+    def subscribe(self, event_type: str, callback: Callable[[Dict[str, Any]], None]):
+        """
+        Registra una callback per un altro tipo di evento HA.
+
+        Va chiamata prima di `start()`: la sottoscrizione viene fatta a
+        ogni connessione. La callback riceve i `data` dell'evento dal
+        thread del mirror e non deve bloccare.
+        """
+        self._event_listeners.setdefault(event_type, []).append(callback)
+
+    def add_resync_listener(self, callback: Callable[[], None]):
+        """
+        Registra una callback invocata dopo ogni riallineamento.
+
+        Durante una disconnessione gli eventi vanno persi: chi li segue
+        può rileggere il proprio stato.
+        """
+        self._resync_listeners.append(callback)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "connected": self.connected,
+                "entities": len(self._states),
+                "domains": len(self._by_domain),
+                "areas": len(self._area_names),
+                "registry_version": self.registry_version,
+                "events_applied": self.events_applied,
+                "resyncs": self.resyncs,
+                "reconnects": self.reconnects,
+                "last_event_age": (
+                    round(time.time() - self.last_event_at, 1) if self.last_event_at else None
+                ),
+            }
+
+    # ------------------------------------------------------------------
+    # Aggiornamenti
+    # ------------------------------------------------------------------
+
+    def _set(self, entity_id: str, new_state: Optional[Dict[str, Any]]):
+        domain = entity_id.split(".", 1)[0]
+        with self._lock:
+            old_state = self._states.get(entity_id)
+            if new_state is None:
+                self._states.pop(entity_id, None)
+                bucket = self._by_domain.get(domain)
+                if bucket is not None:
+                    bucket.pop(entity_id, None)
+                    if not bucket:
+                        del self._by_domain[domain]
+            else:
+                self._states[entity_id] = new_state
+                self._by_domain.setdefault(domain, {})[entity_id] = new_state
+
+        for callback in self._listeners:
+            try:
+                callback(entity_id, old_state, new_state)
+            except Exception as e:
+                logger.warning(f"Listener mirror fallito per {entity_id}: {e}")
+
+    def apply_event(self, event: Dict[str, Any]):
+        """Applica un evento `state_changed` della WebSocket API."""
+        data = event.get("data", {})
+        entity_id = data.get("entity_id")
+        if not entity_id:
+            return
+        self._set(entity_id, data.get("new_state"))
+        with self._lock:
+            self.events_applied += 1
+            self.last_event_at = time.time()
+
+    def resync(self):
+        """Riallinea il mirror con `GET /api/states`."""
+        states = self.api.get("/states")
+        fresh = {s["entity_id"]: s for s in states if s.get("entity_id")}
+
+        with self._lock:
+            removed = [eid for eid in self._states if eid not in fresh]
+        for entity_id in removed:
+            self._set(entity_id, None)
+        for entity_id, state in fresh.items():
+            self._set(entity_id, state)
+
+        with self._lock:
+            self.resyncs += 1
+        self._ready.set()
+        logger.info(f"🔄 Mirror stati HA riallineato: {len(fresh)} entità")
+        for callback in self._resync_listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Listener di riallineamento fallito: {e}")
+
+    def load_registries(self):
+        """Ricarica la mappa entità → area dai registri (WebSocket API)."""
+        try:
+            entities = self._call({"type": "config/entity_registry/list"}) or []
+            devices = self._call({"type": "config/device_registry/list"}) or []
+            areas = self._call({"type": "config/area_registry/list"}) or []
+        except RuntimeError as e:
+            logger.warning(f"⚠️ Registri HA non disponibili, aree non indicizzate: {e}")
+            return
+
+        device_areas = {d["id"]: d.get("area_id") for d in devices if d.get("id")}
+        mapping = {}
+        for entry in entities:
+            # L'area dell'entità prevale su quella del dispositivo
+            area_id = entry.get("area_id") or device_areas.get(entry.get("device_id"))
+            if area_id and entry.get("entity_id"):
+                mapping[entry["entity_id"]] = area_id
+        names = {a["area_id"]: a.get("name") or a["area_id"] for a in areas if a.get("area_id")}
+
+        with self._lock:
+            self._areas = mapping
+            self._area_names = names
+            self.registry_version += 1
+        logger.info(f"🏷️ Registri HA caricati: {len(names)} aree, {len(mapping)} entità con area")
+
+    # ------------------------------------------------------------------
+    # WebSocket
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Avvia il thread di sottoscrizione in background."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ha-state-mirror", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Ferma il thread e chiude la connessione."""
+        self._stop.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _next_id(self) -> int:
+        self._msg_id += 1
+        return self._msg_id
+
+    def _send(self, payload: Dict[str, Any]):
+        self._ws.send(json.dumps(payload))
+
+    def _recv(self) -> Dict[str, Any]:
+        return json.loads(self._ws.recv())
+
+    def _call(self, payload: Dict[str, Any]) -> Any:
+        """
+        Esegue un comando WebSocket e ne attende il risultato.
+
+        Gli eventi ricevuti nel frattempo vengono applicati.
+
+        Raises:
+            RuntimeError: Se Home Assistant risponde con un errore
+        """
+        msg_id = self._next_id()
+        self._send(dict(payload, id=msg_id))
+        while True:
+            message = self._recv()
+            if message.get("type") == "event":
+                self._dispatch(message)
+            elif message.get("id") == msg_id and message.get("type") == "result":
+                if not message.get("success"):
+                    raise RuntimeError(f"{payload['type']}: {message.get('error')}")
+                return message.get("result")
+
+    def _dispatch(self, message: Dict[str, Any]):
+        event = message.get("event", {})
+        if event.get("event_type", "state_changed") == "state_changed":
+            self.apply_event(event)
+        elif event.get("event_type") in REGISTRY_EVENTS:
+            self._registry_stale = True
+        for callback in self._event_listeners.get(event.get("event_type"), ()):
+            try:
+                callback(event.get("data", {}))
+            except Exception as e:
+                logger.warning(f"Listener evento {event.get('event_type')} fallito: {e}")
+
+    def _connect(self):
+        self._ws = websocket.create_connection(self.api.ws_url, timeout=10)
+        self._msg_id = 0
+
+        message = self._recv()
+        if message.get("type") != "auth_required":
+            raise ConnectionError(f"Handshake inatteso: {message}")
+        self._send({"type": "auth", "access_token": self.api.token})
+        message = self._recv()
+        if message.get("type") != "auth_ok":
+            raise ConnectionError(f"Autenticazione WebSocket fallita: {message}")
+
+        self._send({"id": self._next_id(), "type": "subscribe_events", "event_type": "state_changed"})
+        message = self._recv()
+        if not message.get("success"):
+            raise ConnectionError(f"Sottoscrizione state_changed fallita: {message}")
+
+        for event_type in REGISTRY_EVENTS + tuple(self._event_listeners):
+            try:
+                self._call({"type": "subscribe_events", "event_type": event_type})
+            except RuntimeError as e:
+                logger.warning(f"⚠️ Sottoscrizione {event_type} fallita: {e}")
+
+        self.connected = True
+        logger.info("🔌 WebSocket HA connesso, sottoscritto a state_changed")
+
+    def _listen(self):
+        self._ws.settimeout(self.ping_interval)
+        while not self._stop.is_set():
+            try:
+                message = self._recv()
+            except websocket.WebSocketTimeoutException:
+                self._send({"id": self._next_id(), "type": "ping"})
+                continue
+            if message.get("type") == "event":
+                self._dispatch(message)
+            if self._registry_stale:
+                self._registry_stale = False
+                self.load_registries()
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self._stop.is_set():
+            try:
+                self._connect()
+                # Riallineamento dopo la sottoscrizione: nessun evento perso
+                self.resync()
+                self._registry_stale = False
+                self.load_registries()
+                delay = self.reconnect_delay
+                self._listen()
+            except Exception as e:
+                if self._stop.is_set():
+                    break
+                logger.warning(f"⚠️ WebSocket HA disconnesso: {e}; nuovo tentativo tra {delay:.0f}s")
+            finally:
+                self.connected = False
+                self.session += 1
+                if self._ws is not None:
+                    try:
+                        self._ws.close()
+                    except Exception:
+                        pass
+                    self._ws = None
+
+            if self._stop.wait(delay):
+                break
+            self.reconnects += 1
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+
+class MirrorClient:
+    """
+    Adattatore che serve `get_states` dal mirror.
+
+    Espone la stessa interfaccia di `HomeAssistantClient`: le letture
+    degli stati usano il mirror quando è pronto, tutto il resto (e le
+    letture prima del primo riallineamento) passa al client REST.
+    """
+
+    def __init__(self, client, mirror: StateMirror):
+        self._client = client
+        self.mirror = mirror
+
+    def get_states(self, entity_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        if not self.mirror.ready:
+            return self._client.get_states(entity_id) if entity_id else self._client.get_states()
+        if entity_id:
+            state = self.mirror.get_state(entity_id)
+            return [state] if state else []
+        return self.mirror.get_states()
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+"""
+Tool calling nativo per i servizi di Home Assistant.
+
+I servizi restituiti da `get_services()` diventano tool in formato
+OpenAI (`<dominio>__<servizio>`) con i parametri ricavati dai selector
+dei campi; a questi si aggiungono due tool di lettura degli stati.
+Gli schemi vengono costruiti una sola volta per insieme di domini e
+riutilizzati finché il catalogo dei servizi non cambia.
+
+`ToolAgent` esegue il ciclo modello → tool → modello: le chiamate di uno
+stesso turno vengono eseguite in parallelo, tranne quelle che toccano le
+stesse entità (eseguite in ordine), e i round sono limitati.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from context_budget import compact_attributes
+from service_catalog import flatten_fields
+
+logger = logging.getLogger(__name__)
+
+# Separatore tra dominio e servizio nel nome del tool (il punto non è
+# ammesso nei nomi delle funzioni OpenAI)
+NAME_SEPARATOR = "__"
+
+# Lunghezza massima del risultato di un tool rimandato al modello
+MAX_RESULT_CHARS = 2000
+
+# Lunghezza massima delle descrizioni negli schemi (occupano prompt)
+MAX_DESCRIPTION_CHARS = 120
+
+# Entità massime restituite da find_entities
+MAX_FOUND_ENTITIES = 25
+
+# Insiemi di tool in cache (uno per combinazione di domini, LRU)
+MAX_TOOL_SETS = 32
+
+TOOL_INSTRUCTIONS = (
+    "Per leggere stati aggiornati o agire sui dispositivi usa gli strumenti "
+    "disponibili; chiama insieme le azioni indipendenti."
+)
+
+STATE_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_entity_state",
+            "description": "Stato attuale e attributi principali di una o più entità",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "entity_ids": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "ID delle entità, es. light.soggiorno",
+                    }
+                },
+                "required": ["entity_ids"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_entities",
+            "description": "Cerca entità per dominio e/o testo nel nome o nell'ID",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "domain": {"type": "string", "description": "Dominio, es. light"},
+                    "query": {"type": "string", "description": "Testo da cercare"},
+                },
+            },
+        },
+    },
+]
+
+
+def _short(text: Any) -> str:
+    text = " ".join(str(text or "").split())
+    if len(text) > MAX_DESCRIPTION_CHARS:
+        text = text[:MAX_DESCRIPTION_CHARS - 1] + "…"
+    return text
+
+
+def selector_schema(selector: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    JSON Schema di un campo a partire dal suo selector HA.
+
+    Args:
+        selector: Selector del campo, es. {"number": {"min": 0, "max": 255}}
+
+    Returns:
+        Schema del parametro (string se il selector non è noto)
+    """
+    if not selector:
+        return {"type": "string"}
+    kind, config = next(iter(selector.items()))
+    config = config or {}
+    if kind == "number":
+        schema = {"type": "number"}
+        for key in ("min", "max"):
+            if isinstance(config.get(key), (int, float)):
+                schema["minimum" if key == "min" else "maximum"] = config[key]
+        return schema
+    if kind == "boolean":
+        return {"type": "boolean"}
+    if kind == "select":
+        options = [o["value"] if isinstance(o, dict) else o for o in config.get("options", [])]
+        schema = {"type": "string"}
+        if options and not config.get("custom_value"):
+            schema["enum"] = [str(o) for o in options]
+        if config.get("multiple"):
+            return {"type": "array", "items": schema}
+        return schema
+    if kind == "color_rgb":
+        return {"type": "array", "items": {"type": "integer"}, "minItems": 3, "maxItems": 3}
+    if kind in ("object", "action"):
+        return {"type": "object"}
+    if kind in ("entity", "device", "area", "floor", "label") and config.get("multiple"):
+        return {"type": "array", "items": {"type": "string"}}
+    return {"type": "string"}
+
+
+def service_tool(domain: str, service: str, spec: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Tool OpenAI per un servizio HA.
+
+    Args:
+        domain: Dominio del servizio
+        service: Nome del servizio
+        spec: Descrizione del servizio restituita da `get_services()`
+
+    Returns:
+        Definizione del tool ({"type": "function", "function": {...}})
+    """
+    properties: Dict[str, Any] = {}
+    required: List[str] = []
+    if spec.get("target") is not None or not spec.get("fields"):
+        properties["entity_id"] = {
+            "anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "string"}}],
+            "description": f"Entità {domain} su cui agire",
+        }
+    for name, field in flatten_fields(spec.get("fields", {})):
+        schema = selector_schema(field.get("selector"))
+        description = _short(field.get("description") or field.get("name"))
+        if description:
+            schema["description"] = description
+        properties[name] = schema
+        if field.get("required"):
+            required.append(name)
+
+    parameters: Dict[str, Any] = {"type": "object", "properties": properties}
+    if required:
+        parameters["required"] = required
+    return {
+        "type": "function",
+        "function": {
+            "name": f"{domain}{NAME_SEPARATOR}{service}",
+            "description": _short(spec.get("description") or spec.get("name") or f"{domain}.{service}"),
+            "parameters": parameters,
+        },
+    }
+
+
+class ToolCatalog:
+    """
+    Schemi dei tool generati dai servizi HA, in cache.
+
+    Gli schemi per un insieme di domini vengono costruiti una volta sola
+    per versione del catalogo dei servizi; la chiave contiene solo i
+    domini esistenti e la cache tiene al più MAX_TOOL_SETS insiemi.
+    """
+
+    def __init__(self, services):
+        """
+        Inizializza il catalogo.
+
+        Args:
+            services: ServiceCatalog condiviso
+        """
+        self.services = services
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._tools: "OrderedDict[Optional[Tuple[str, ...]], Tuple[List[Dict[str, Any]], Dict[str, Tuple[str, str]]]]" = OrderedDict()
+        self.builds = 0
+        self.hits = 0
+
+    def get_tools(
+        self,
+        domains: Optional[Iterable[str]] = None
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Tuple[str, str]]]:
+        """
+        Tool disponibili per i domini richiesti.
+
+        Args:
+            domains: Domini dei servizi esposti (None = tutti)
+
+        Returns:
+            (lista di tool, nome del tool -> (dominio, servizio))
+        """
+        version, services = self.services.snapshot(tuple(sorted(set(domains))) if domains else None)
+        # Domini sconosciuti fuori dalla chiave: liste arbitrarie dei client
+        # non creano nuove voci
+        key = tuple(entry["domain"] for entry in services) if domains else None
+        with self._lock:
+            if version != self._version:
+                self._tools.clear()
+                self._version = version
+            cached = self._tools.get(key)
+            if cached is not None:
+                self._tools.move_to_end(key)
+                self.hits += 1
+                return cached
+
+            tools = list(STATE_TOOLS)
+            names: Dict[str, Tuple[str, str]] = {}
+            for entry in services:
+                domain = entry["domain"]
+                for service, spec in sorted((entry.get("services") or {}).items()):
+                    tool = service_tool(domain, service, spec or {})
+                    tools.append(tool)
+                    names[tool["function"]["name"]] = (domain, service)
+            self._tools[key] = (tools, names)
+            while len(self._tools) > MAX_TOOL_SETS:
+                self._tools.popitem(last=False)
+            self.builds += 1
+            return tools, names
+
+    def invalidate(self):
+        """Forza la rilettura dei servizi alla prossima richiesta."""
+        self.services.invalidate()
+        with self._lock:
+            self._tools.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "catalog_version": self._version,
+                "tool_sets": len(self._tools),
+                "builds": self.builds,
+                "hits": self.hits,
+            }
+
+
+def _entity_ids(value: Any) -> List[str]:
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(",") if v.strip()]
+    if isinstance(value, list):
+        return [str(v) for v in value]
+    return []
+
+
+class ToolAgent:
+    """Ciclo di tool calling tra llama-server e Home Assistant."""
+
+    def __init__(
+        self,
+        client,
+        catalog: ToolCatalog,
+        max_rounds: int = 4,
+        max_workers: int = 8,
+        on_service_call: Optional[Callable[[str, str], None]] = None,
+        observer: Optional[Callable[[str, str, float], None]] = None
+    ):
+        """
+        Inizializza l'agente.
+
+        Args:
+            client: Client HA (stati e `call_service`)
+            catalog: Catalogo dei tool
+            max_rounds: Chiamate massime al modello per richiesta
+            max_workers: Tool eseguiti in parallelo al massimo
+            on_service_call: Callback (dominio, servizio) dopo ogni servizio
+                chiamato con successo (es. invalidazione delle cache)
+            observer: Callback (dominio, esito, secondi) per le metriche
+        """
+        self.client = client
+        self.catalog = catalog
+        self.max_rounds = max(1, max_rounds)
+        self.on_service_call = on_service_call
+        self.observer = observer
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ha-tool")
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.rounds = 0
+        self.calls = 0
+        self.errors = 0
+        self.truncated = 0
+
+    def run(
+        self,
+        messages: List[Dict[str, Any]],
+        complete: Callable[[List[Dict[str, Any]], Dict[str, Any]], Dict[str, Any]],
+        domains: Optional[Iterable[str]] = None
+    ) -> Dict[str, Any]:
+        """
+        Esegue il ciclo fino alla risposta finale del modello.
+
+        All'ultimo round il modello riceve `tool_choice: none` e deve
+        rispondere; i tool restano nel prompt, così il prefisso non
+        cambia e llama-server riusa la KV cache.
+
+        Args:
+            messages: Messaggi iniziali (non vengono modificati)
+            complete: Funzione (messaggi, parametri extra) -> risposta di
+                llama-server
+            domains: Domini dei servizi esposti come tool (None = tutti)
+
+        Returns:
+            {"response", "usage", "tool_calls", "rounds", "truncated", "results"}
+        """
+        tools, names = self.catalog.get_tools(domains)
+        messages = [dict(m) for m in messages]
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        executed: List[Dict[str, Any]] = []
+        results: List[Dict[str, Any]] = []
+        truncated = False
+
+        for round_index in range(1, self.max_rounds + 1):
+            final = round_index == self.max_rounds
+            result = complete(messages, {
+                "tools": tools,
+                "tool_choice": "none" if final else "auto",
+                "parallel_tool_calls": True,
+            })
+            results.append(result)
+            for key in usage:
+                usage[key] += (result.get("usage") or {}).get(key, 0) or 0
+
+            message = result["choices"][0]["message"]
+            calls = message.get("tool_calls") or []
+            if not calls:
+                break
+            if final:
+                truncated = True
+                break
+
+            for index, call in enumerate(calls):
+                call.setdefault("id", f"call_{round_index}_{index}")
+                call.setdefault("type", "function")
+            messages.append({"role": "assistant", "content": message.get("content") or "", "tool_calls": calls})
+            for call, outcome in zip(calls, self.execute(calls, names)):
+                executed.append(outcome)
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": call["id"],
+                    "content": outcome["content"],
+                })
+
+        with self._lock:
+            self.runs += 1
+            self.rounds += len(results)
+            self.truncated += int(truncated)
+
+        return {
+            "response": results[-1]["choices"][0]["message"].get("content") or "",
+            "usage": usage,
+            "tool_calls": [{k: v for k, v in call.items() if k != "content"} for call in executed],
+            "rounds": len(results),
+            "truncated": truncated,
+            "results": results,
+        }
+
+    def execute(
+        self,
+        calls: List[Dict[str, Any]],
+        names: Dict[str, Tuple[str, str]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Esegue le chiamate di un turno del modello.
+
+        Le chiamate sono raggruppate per entità: un gruppo viene eseguito
+        in ordine, gruppi diversi in parallelo.
+
+        Returns:
+            Esiti nello stesso ordine delle chiamate
+        """
+        parsed = [self._parse(call) for call in calls]
+
+        # Union-find sulle chiamate che condividono entità: una chiamata su
+        # più entità unisce i gruppi di tutte
+        parent = list(range(len(parsed)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        owner: Dict[str, int] = {}
+        for index, (_, arguments, _) in enumerate(parsed):
+            for entity in _entity_ids(arguments.get("entity_id")) + _entity_ids(arguments.get("entity_ids")):
+                if entity in owner:
+                    parent[find(index)] = find(owner[entity])
+                else:
+                    owner[entity] = index
+
+        by_root: Dict[int, List[int]] = {}
+        for index in range(len(parsed)):
+            by_root.setdefault(find(index), []).append(index)
+        groups = list(by_root.values())
+
+        outcomes: List[Optional[Dict[str, Any]]] = [None] * len(calls)
+
+        def run_group(indexes: List[int]):
+            for index in indexes:
+                name, arguments, error = parsed[index]
+                outcomes[index] = self._invoke(name, arguments, error, names)
+
+        if len(groups) == 1:
+            run_group(groups[0])
+        else:
+            for future in [self._executor.submit(run_group, g) for g in groups]:
+                future.result()
+        return outcomes
+
+    @staticmethod
+    def _parse(call: Dict[str, Any]) -> Tuple[str, Dict[str, Any], Optional[str]]:
+        function = call.get("function") or {}
+        arguments = function.get("arguments") or {}
+        if isinstance(arguments, str):
+            try:
+                arguments = json.loads(arguments) if arguments.strip() else {}
+            except ValueError as e:
+                return function.get("name", ""), {}, f"argomenti non validi: {e}"
+        if not isinstance(arguments, dict):
+            return function.get("name", ""), {}, "gli argomenti devono essere un oggetto JSON"
+        return function.get("name", ""), arguments, None
+
+    def _invoke(
+        self,
+        name: str,
+        arguments: Dict[str, Any],
+        error: Optional[str],
+        names: Dict[str, Tuple[str, str]]
+    ) -> Dict[str, Any]:
+        started = time.perf_counter()
+        domain = names[name][0] if name in names else "state"
+        try:
+            if error:
+                raise ValueError(error)
+            if name == "get_entity_state":
+                result = self._get_entity_state(arguments)
+            elif name == "find_entities":
+                result = self._find_entities(arguments)
+            elif name in names:
+                result = self._call_service(names[name], arguments)
+            else:
+                domain = "unknown"
+                raise ValueError(f"tool sconosciuto o non abilitato: '{name}'")
+            status, failure = "ok", None
+            content = json.dumps(result, ensure_ascii=False, default=str)
+        except Exception as e:
+            status, failure = "error", str(e)
+            content = json.dumps({"error": failure}, ensure_ascii=False)
+            logger.warning(f"⚠️ Tool {name} fallito: {e}")
+
+        elapsed = time.perf_counter() - started
+        if len(content) > MAX_RESULT_CHARS:
+            content = content[:MAX_RESULT_CHARS] + "…"
+        with self._lock:
+            self.calls += 1
+            self.errors += int(status == "error")
+        if self.observer:
+            self.observer(domain, status, elapsed)
+
+        outcome = {
+            "name": name,
+            "arguments": arguments,
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 1),
+            "content": content,
+        }
+        if failure:
+            outcome["error"] = failure
+        return outcome
+
+    def _get_entity_state(self, arguments: Dict[str, Any]) -> List[Dict[str, Any]]:
+        entity_ids = _entity_ids(arguments.get("entity_ids") or arguments.get("entity_id"))
+        if not entity_ids:
+            raise ValueError("'entity_ids' richiesto")
+        found = []
+        for entity_id in entity_ids:
+            states = self.client.get_states(entity_id)
+            if not states:
+                found.append({"entity_id": entity_id, "error": "entità non trovata"})
+                continue
+            state = states[0]
+            found.append({
+                "entity_id": entity_id,
+                "name": state.get("attributes", {}).get("friendly_name"),
+                "state": state.get("state"),
+                "attributes": compact_attributes(state),
+            })
+        return found
+
+    def _find_entities(self, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        domain = str(arguments.get("domain") or "").strip().lower()
+        query = str(arguments.get("query") or "").strip().lower()
+        matches = []
+        for state in self.client.get_states() or []:
+            entity_id = state.get("entity_id", "")
+            name = str(state.get("attributes", {}).get("friendly_name") or "")
+            if domain and not entity_id.startswith(f"{domain}."):
+                continue
+            if query and query not in entity_id.lower() and query not in name.lower():
+                continue
+            matches.append({"entity_id": entity_id, "name": name, "state": state.get("state")})
+        return {"total": len(matches), "entities": matches[:MAX_FOUND_ENTITIES]}
+
+    def _call_service(self, target: Tuple[str, str], arguments: Dict[str, Any]) -> Dict[str, Any]:
+        domain, service = target
+        data = dict(arguments)
+        entity_id = data.pop("entity_id", None)
+        if isinstance(entity_id, list):
+            entity_id = ",".join(str(e) for e in entity_id)
+        result = self.client.call_service(domain, service, entity_id, **data)
+        if result is None:
+            raise RuntimeError(f"chiamata {domain}.{service} fallita")
+        logger.info(f"🔧 Tool: {domain}.{service} su {entity_id or '-'}")
+        if self.on_service_call:
+            self.on_service_call(domain, service)
+        changed = [
+            {"entity_id": s.get("entity_id"), "state": s.get("state")}
+            for s in (result if isinstance(result, list) else [])
+        ]
+        return {"success": True, "changed": changed}
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "max_rounds": self.max_rounds,
+                "runs": self.runs,
+                "rounds": self.rounds,
+                "calls": self.calls,
+                "errors": self.errors,
+                "truncated": self.truncated,
+            }
+        stats["catalog"] = self.catalog.get_stats()
+        return stats
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Trasporto HTTP condiviso con connection pooling e keep-alive.
+Usato sia per le chiamate a llama-server sia per la Supervisor API.
+"""
+
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Timeout (connect, read) in secondi per tipo di endpoint
+DEFAULT_TIMEOUTS: Dict[str, Union[float, tuple]] = {
+    "llama_health": (2, 5),
+    "llama_models": (2, 5),
+    "llama_tokenize": (2, 10),
+    "llama_embedding": (2, 10),
+    "llama_chat": (5, 120),
+    "supervisor": (5, 10),
+    "default": (5, 30),
+}
+
+# Keep-alive TCP: rileva connessioni morte senza aspettare il timeout di lettura
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+
+class ConnectionStats:
+    """Contatori thread-safe di richieste e nuove connessioni."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            reused = max(self.requests - self.new_connections, 0)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": reused,
+                "reuse_ratio": round(reused / self.requests, 3) if self.requests else 0.0,
+            }
+
+
+def _counting_pool(base_cls, stats: ConnectionStats):
+    """Crea una sottoclasse del pool urllib3 che conta le nuove connessioni."""
+    class CountingPool(base_cls):
+        def _new_conn(self):
+            stats.record_new_connection()
+            return super()._new_conn()
+
+    CountingPool.__name__ = f"Counting{base_cls.__name__}"
+    return CountingPool
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter con keep-alive TCP e conteggio delle connessioni."""
+
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = KEEPALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self.stats),
+            "https": _counting_pool(HTTPSConnectionPool, self.stats),
+        }
+
+    def send(self, request, **kwargs):
+        self.stats.record_request()
+        return super().send(request, **kwargs)
+
+
+class HTTPPool:
+    """
+    Sessione HTTP condivisa con pool di connessioni persistenti.
+
+    Tutte le chiamate passano da un'unica `requests.Session`, così le
+    connessioni TCP verso llama-server e Supervisor vengono riutilizzate
+    invece di essere aperte (e lasciate in TIME_WAIT) a ogni richiesta.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        timeouts: Optional[Dict[str, Union[float, tuple]]] = None,
+        observer: Optional[Callable[[str, float], None]] = None
+    ):
+        """
+        Inizializza il pool.
+
+        Args:
+            pool_size: Numero massimo di connessioni persistenti per host
+            timeouts: Timeout per tipo di endpoint (sovrascrive i default)
+            observer: Funzione (tipo di endpoint, secondi) chiamata a ogni
+                richiesta, anche fallita (es. metriche)
+        """
+        self.pool_size = pool_size
+        self.observer = observer
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+
+        self.stats = ConnectionStats()
+        self.session = requests.Session()
+        self.session.headers["Connection"] = "keep-alive"
+        adapter = PooledAdapter(
+            self.stats,
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            pool_block=False,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def timeout_for(self, endpoint: str) -> Union[float, tuple]:
+        """Restituisce il timeout configurato per un tipo di endpoint."""
+        return self.timeouts.get(endpoint, self.timeouts["default"])
+
+    def request(self, method: str, url: str, endpoint: str = "default", **kwargs) -> requests.Response:
+        """
+        Esegue una richiesta HTTP sul pool condiviso.
+
+        Args:
+            method: Metodo HTTP
+            url: URL completo
+            endpoint: Tipo di endpoint, usato per scegliere il timeout
+            **kwargs: Parametri aggiuntivi per `requests.Session.request`
+
+        Returns:
+            Risposta HTTP
+        """
+        kwargs.setdefault("timeout", self.timeout_for(endpoint))
+        if self.observer is None:
+            return self.session.request(method, url, **kwargs)
+        started = time.perf_counter()
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            self.observer(endpoint, time.perf_counter() - started)
+
+    def get(self, url: str, endpoint: str = "default", **kwargs) -> requests.Response:
+        return self.request("GET", url, endpoint, **kwargs)
+
+    def post(self, url: str, endpoint: str = "default", **kwargs) -> requests.Response:
+        return self.request("POST", url, endpoint, **kwargs)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiche di riutilizzo delle connessioni."""
+        stats = self.stats.snapshot()
+        stats["pool_size"] = self.pool_size
+        return stats
+
+    def close(self):
+        """Chiude tutte le connessioni del pool."""
+        self.session.close()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+"""
+Percorso rapido deterministico per i comandi semplici.
+
+Frasi come "accendi la luce del soggiorno" vengono riconosciute con una
+piccola grammatica di verbi (it/en) e un indice invertito dei nomi delle
+entità, e tradotte direttamente in una chiamata di servizio senza
+passare dal modello. Se il comando non è univoco (più entità possibili,
+frasi composte, condizioni, domande) il router rinuncia e la richiesta
+prosegue verso il LLM.
+
+Stanze e zone vengono riconosciute tramite le parole del friendly name,
+dell'entity_id e, se il mirror conosce i registri, del nome dell'area
+assegnata all'entità o al suo dispositivo.
+"""
+
+import re
+import threading
+import time
+import unicodedata
+from collections import deque
+from typing import Any, Callable, Deque, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from context_budget import DOMAIN_KEYWORDS
+
+# Verbi riconosciuti (forme normalizzate, anche di due parole) → azione
+VERBS = {
+    "accendi": "on", "accendere": "on", "attiva": "on", "attivare": "on",
+    "turn on": "on", "switch on": "on",
+    "spegni": "off", "spegnere": "off", "disattiva": "off", "disattivare": "off",
+    "turn off": "off", "switch off": "off",
+    "apri": "open", "aprire": "open", "alza": "open", "open": "open", "raise": "open",
+    "chiudi": "close", "chiudere": "close", "abbassa": "close", "close": "close", "lower": "close",
+    "inverti": "toggle", "toggle": "toggle",
+    "imposta": "set", "regola": "set", "porta": "set", "metti": "set", "set": "set",
+}
+
+# Servizio per azione e dominio; i domini assenti non sono gestiti
+SERVICES = {
+    "on": {
+        "light": "turn_on", "switch": "turn_on", "fan": "turn_on", "input_boolean": "turn_on",
+        "media_player": "turn_on", "climate": "turn_on", "scene": "turn_on", "script": "turn_on",
+        "cover": "open_cover",
+    },
+    "off": {
+        "light": "turn_off", "switch": "turn_off", "fan": "turn_off", "input_boolean": "turn_off",
+        "media_player": "turn_off", "climate": "turn_off", "cover": "close_cover",
+    },
+    "open": {"cover": "open_cover"},
+    "close": {"cover": "close_cover"},
+    "toggle": {"light": "toggle", "switch": "toggle", "fan": "toggle", "input_boolean": "toggle", "cover": "toggle"},
+    # "imposta" richiede un valore: percentuale o gradi
+    "set": {"light": "turn_on", "cover": "set_cover_position", "climate": "set_temperature", "fan": "set_percentage"},
+}
+
+# Descrizione dell'azione nella risposta
+ACTION_LABELS = {
+    "on": "accensione", "off": "spegnimento", "open": "apertura",
+    "close": "chiusura", "toggle": "commutazione", "set": "impostazione",
+}
+
+KEYWORDS = dict(DOMAIN_KEYWORDS)
+KEYWORDS.update({
+    "fan": ("ventilatore", "ventola", "fan"),
+    "scene": ("scena", "scene"),
+    "script": ("script",),
+})
+
+# Parole chiave al plurale: il comando può riguardare più entità
+PLURAL_KEYWORDS = {
+    "luci", "lampade", "lights", "lamps", "prese", "plugs", "switches", "tapparelle",
+    "tende", "serrande", "persiane", "blinds", "covers", "ventilatori", "fans",
+}
+ALL_WORDS = {"tutte", "tutti", "all", "every"}
+
+# Parole che indicano una richiesta non esprimibile come singolo comando
+COMPLEX_WORDS = {
+    "e", "and", "poi", "then", "se", "if", "quando", "when", "tra", "fra", "dopo", "after",
+    "alle", "minuti", "minutes", "ore", "hours", "non", "not", "perche", "why", "come", "how",
+    "quanto", "quanti", "quale", "quali", "cosa", "what", "which", "tranne", "except",
+}
+
+STOPWORDS = {
+    "il", "lo", "la", "i", "gli", "le", "l", "un", "uno", "una", "del", "dello", "della",
+    "dei", "degli", "delle", "di", "da", "in", "nel", "nello", "nella", "nei", "negli",
+    "nelle", "al", "allo", "alla", "ai", "agli", "sul", "sulla", "per", "favore", "puoi",
+    "potresti", "mi", "ti", "ci", "a", "an", "the", "of", "on", "please", "can", "could",
+    "you", "my", "mio", "mia", "miei", "mie", "su", "to", "grazie", "thanks", "ok", "ehi", "hey",
+}
+
+POLITE_PREFIX = {"per", "favore", "puoi", "potresti", "please", "can", "could", "you", "ehi", "hey", "mi"}
+
+_VALUE_RE = re.compile(
+    r"(?P<value>\d+(?:[.,]\d+)?)\s*(?P<unit>%|per cento|percento|percent|gradi|grado|°c?|degrees)"
+)
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Campioni conservati per i percentili di latenza di ogni percorso
+LATENCY_SAMPLES = 512
+
+
+def normalize(text: str) -> str:
+    """Minuscole senza accenti."""
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def stem(token: str) -> str:
+    """Radice grezza: singolare e plurale (luce/luci, blind/blinds) coincidono."""
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        token = token[:-1]
+    if len(token) > 3 and token[-1] in "aeio":
+        token = token[:-1]
+    return token
+
+
+class IntentMatch:
+    """Comando riconosciuto: servizio, entità e dati."""
+
+    __slots__ = ("action", "domain", "service", "entity_ids", "names", "data", "confidence")
+
+    def __init__(
+        self,
+        action: str,
+        domain: str,
+        service: str,
+        entity_ids: List[str],
+        names: List[str],
+        data: Dict[str, Any],
+        confidence: float
+    ):
+        self.action = action
+        self.domain = domain
+        self.service = service
+        self.entity_ids = entity_ids
+        self.names = names
+        self.data = data
+        self.confidence = confidence
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "service": f"{self.domain}.{self.service}",
+            "entity_ids": self.entity_ids,
+            "data": self.data,
+            "confidence": round(self.confidence, 2),
+        }
+
+    def describe(self) -> str:
+        return f"Fatto: {ACTION_LABELS[self.action]} di {', '.join(self.names)}."
+
+
+class _Entity:
+    __slots__ = ("entity_id", "domain", "name", "tokens", "name_tokens", "area_tokens")
+
+    def __init__(
+        self, entity_id: str, name: str, tokens: FrozenSet[str], name_tokens: FrozenSet[str],
+        area_tokens: FrozenSet[str] = frozenset()
+    ):
+        self.entity_id = entity_id
+        self.domain = entity_id.split(".", 1)[0]
+        self.name = name
+        self.tokens = tokens
+        self.name_tokens = name_tokens
+        self.area_tokens = area_tokens
+
+
+class IntentRouter:
+    """
+    Riconosce i comandi semplici e li esegue senza il LLM.
+
+    L'indice (radice → entità) viene ricostruito solo quando cambia
+    l'insieme delle entità, un friendly name o i registri delle aree,
+    come il catalogo del prompt; senza mirror viene ricostruito al più ogni `ttl` secondi.
+    """
+
+    def __init__(
+        self,
+        client,
+        mirror=None,
+        min_confidence: float = 0.5,
+        max_entities: int = 20,
+        ttl: float = 60.0,
+        on_service_call: Optional[Callable[[str, str], None]] = None
+    ):
+        """
+        Inizializza il router.
+
+        Args:
+            client: Client con interfaccia HomeAssistantClient
+            mirror: StateMirror opzionale (cambi strutturali → nuovo indice)
+            min_confidence: Quota minima del nome dell'entità citata nel
+                comando (1 = nome completo)
+            max_entities: Entità massime per un comando al plurale
+            ttl: Validità dell'indice senza mirror, in secondi
+            on_service_call: Callback (dominio, servizio) dopo ogni servizio
+        """
+        self.client = client
+        self.mirror = mirror
+        self.min_confidence = min_confidence
+        self.max_entities = max_entities
+        self.ttl = ttl
+        self.on_service_call = on_service_call
+
+        self._lock = threading.Lock()
+        self._version = 0
+        self._index_version = -1
+        self._index_registry = -1
+        self._index_built_at = 0.0
+        self._entities: Dict[str, _Entity] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        self._keywords = {
+            stem(normalize(word)): domain for domain, words in KEYWORDS.items() for word in words
+        }
+
+        self.matched = 0
+        self.fallbacks: Dict[str, int] = {}
+        self.index_builds = 0
+        self._latency: Dict[str, Deque[float]] = {}
+        self._route_counts: Dict[str, int] = {}
+        self._route_time: Dict[str, float] = {}
+
+        if mirror is not None:
+            mirror.add_listener(self._on_state_changed)
+
+    def _on_state_changed(self, entity_id: str, old_state, new_state):
+        if old_state is None or new_state is None or (
+            old_state.get("attributes", {}).get("friendly_name")
+            != new_state.get("attributes", {}).get("friendly_name")
+        ):
+            with self._lock:
+                self._version += 1
+
+    def invalidate(self):
+        """Forza la ricostruzione dell'indice."""
+        with self._lock:
+            self._version += 1
+
+    # ------------------------------------------------------------------
+    # Indice
+    # ------------------------------------------------------------------
+
+    def _tokens(self, text: str) -> List[str]:
+        return [stem(t) for t in _TOKEN_RE.findall(normalize(text).replace("_", " "))]
+
+    def _ensure_index(self):
+        with self._lock:
+            registry = self.mirror.registry_version if self.mirror is not None else 0
+            fresh = self._index_version == self._version and self._index_registry == registry
+            if self.mirror is None or not self.mirror.ready:
+                fresh = fresh and time.time() - self._index_built_at < self.ttl
+            if fresh:
+                return
+            version = self._version
+
+        area_names = self.mirror.get_areas() if self.mirror is not None else {}
+
+        entities: Dict[str, _Entity] = {}
+        postings: Dict[str, Set[str]] = {}
+        for state in self.client.get_states() or []:
+            entity_id = state.get("entity_id", "")
+            domain = entity_id.split(".", 1)[0]
+            if not any(domain in services for services in SERVICES.values()):
+                continue
+            name = str(state.get("attributes", {}).get("friendly_name") or entity_id)
+            tokens = set(self._tokens(name)) | set(self._tokens(entity_id.split(".", 1)[-1]))
+            tokens = {t for t in tokens if t and t not in STOPWORDS}
+            name_tokens = frozenset(t for t in tokens if self._keywords.get(t) != domain)
+            area = area_names.get(self.mirror.get_area(entity_id)) if area_names else None
+            # Le parole dell'area restano fuori dal nome: "luce del soggiorno"
+            # trova le luci dell'area senza abbassarne la confidenza
+            area_tokens = frozenset(
+                t for t in self._tokens(area or "") if t and t not in STOPWORDS
+            ) - name_tokens
+            tokens |= area_tokens
+            entities[entity_id] = _Entity(entity_id, name, frozenset(tokens), name_tokens, area_tokens)
+            for token in tokens:
+                postings.setdefault(token, set()).add(entity_id)
+
+        with self._lock:
+            self._entities = entities
+            self._postings = postings
+            self._index_version = version
+            self._index_registry = registry
+            self._index_built_at = time.time()
+            self.index_builds += 1
+
+    # ------------------------------------------------------------------
+    # Riconoscimento
+    # ------------------------------------------------------------------
+
+    def match(
+        self,
+        text: str,
+        domains: Optional[Iterable[str]] = None
+    ) -> Tuple[Optional[IntentMatch], Optional[str]]:
+        """
+        Prova a tradurre il testo in una chiamata di servizio.
+
+        Args:
+            text: Messaggio dell'utente
+            domains: Domini ammessi (None = tutti quelli gestiti)
+
+        Returns:
+            (comando, None) se riconosciuto con certezza, altrimenti
+            (None, motivo del rinvio al LLM)
+        """
+        match, reason = self._match(text, set(domains) if domains else None)
+        with self._lock:
+            if match:
+                self.matched += 1
+            else:
+                self.fallbacks[reason] = self.fallbacks.get(reason, 0) + 1
+        return match, reason
+
+    def _match(self, text: str, allowed: Optional[Set[str]]) -> Tuple[Optional[IntentMatch], Optional[str]]:
+        normalized = normalize(text).strip()
+        if not normalized or "?" in normalized or len(normalized) > 120:
+            return None, "not_command"
+
+        data: Dict[str, Any] = {}
+        value_match = _VALUE_RE.search(normalized)
+        unit = None
+        if value_match:
+            unit = "percent" if value_match.group("unit") in ("%", "per cento", "percento", "percent") else "degrees"
+            value = float(value_match.group("value").replace(",", "."))
+            normalized = normalized[:value_match.start()] + " " + normalized[value_match.end():]
+        raw = _TOKEN_RE.findall(normalized)
+        if any(t.isdigit() for t in raw):
+            return None, "complex"
+        if any(t in COMPLEX_WORDS for t in raw):
+            return None, "complex"
+
+        # Verbo all'inizio, dopo eventuali formule di cortesia
+        start = 0
+        while start < len(raw) and raw[start] in POLITE_PREFIX:
+            start += 1
+        action = None
+        for size in (2, 1):
+            phrase = " ".join(raw[start:start + size])
+            if len(raw) >= start + size and phrase in VERBS:
+                action = VERBS[phrase]
+                start += size
+                break
+        if action is None:
+            return None, "no_verb"
+        if action == "set" and unit is None:
+            return None, "complex"
+        if unit is not None and action not in ("set", "on"):
+            # Un valore ha senso solo con "imposta" o con "accendi ... al 40%"
+            return None, "complex"
+
+        plural = False
+        keyword_domains: Set[str] = set()
+        query: Set[str] = set()
+        for token in raw[start:]:
+            if token in STOPWORDS:
+                continue
+            if token in ALL_WORDS:
+                plural = True
+                continue
+            stemmed = stem(token)
+            domain = self._keywords.get(stemmed)
+            if domain in SERVICES[action]:
+                keyword_domains.add(domain)
+                plural = plural or token in PLURAL_KEYWORDS
+                continue
+            query.add(stemmed)
+
+        candidates = set(SERVICES[action])
+        if keyword_domains:
+            candidates &= keyword_domains
+        if action == "set" or unit is not None:
+            candidates &= {"light", "cover", "fan"} if unit == "percent" else {"climate"}
+            if action == "on":
+                candidates &= {"light"}
+        if allowed is not None:
+            candidates &= allowed
+        if not candidates:
+            return None, "unsupported_domain"
+
+        self._ensure_index()
+        with self._lock:
+            entities = self._entities
+            postings = self._postings
+
+        if query:
+            found = None
+            for token in query:
+                ids = postings.get(token, set())
+                found = set(ids) if found is None else found & ids
+                if not found:
+                    return None, "no_match"
+            matches = [entities[e] for e in sorted(found) if entities[e].domain in candidates]
+        elif keyword_domains:
+            # Solo il tipo di dispositivo: tutte le entità al plurale,
+            # l'unica entità del dominio al singolare ("il termostato")
+            matches = sorted(
+                (e for e in entities.values() if e.domain in candidates), key=lambda e: e.entity_id
+            )
+            if not plural and len(matches) != 1:
+                return None, "no_target"
+        else:
+            return None, "no_target"
+        if not matches:
+            return None, "no_match"
+
+        if len(matches) > 1 and not plural:
+            # Più entità contengono le parole: vale solo il nome esatto
+            exact = [
+                e for e in matches
+                if query in (e.name_tokens, e.name_tokens | e.area_tokens)
+            ]
+            if len(exact) != 1:
+                return None, "ambiguous"
+            matches = exact
+        if len({e.domain for e in matches}) > 1:
+            return None, "ambiguous"
+        if len(matches) > self.max_entities:
+            return None, "too_many"
+
+        # Quota del nome citata; chi è trovato solo per l'area vale 1
+        confidence = min(
+            (len(query & e.name_tokens) / len(e.name_tokens) if query & e.name_tokens else 1.0)
+            for e in matches
+        ) if query else 1.0
+        if confidence < self.min_confidence:
+            return None, "low_confidence"
+
+        domain = matches[0].domain
+        if action == "set":
+            if domain == "light":
+                data["brightness_pct"] = max(0, min(100, int(value)))
+            elif domain == "cover":
+                data["position"] = max(0, min(100, int(value)))
+            elif domain == "fan":
+                data["percentage"] = max(0, min(100, int(value)))
+            else:
+                data["temperature"] = value
+        elif unit == "percent" and domain == "light":
+            data["brightness_pct"] = max(0, min(100, int(value)))
+
+        matches.sort(key=lambda e: e.entity_id)
+        return IntentMatch(
+            action,
+            domain,
+            SERVICES[action][domain],
+            [e.entity_id for e in matches],
+            [e.name for e in matches],
+            data,
+            confidence
+        ), None
+
+    # ------------------------------------------------------------------
+    # Esecuzione e statistiche
+    # ------------------------------------------------------------------
+
+    def execute(self, match: IntentMatch) -> List[Dict[str, Any]]:
+        """
+        Chiama il servizio del comando.
+
+        Returns:
+            Stati cambiati restituiti da Home Assistant
+
+        Raises:
+            RuntimeError: Se la chiamata al servizio fallisce
+        """
+        result = self.client.call_service(
+            match.domain, match.service, ",".join(match.entity_ids), **match.data
+        )
+        if result is None:
+            raise RuntimeError(f"Errore chiamata servizio {match.domain}.{match.service}")
+        if self.on_service_call:
+            self.on_service_call(match.domain, match.service)
+        return result
+
+    def record_route(self, route: str, seconds: float):
+        """Registra la latenza di una richiesta servita da un percorso."""
+        with self._lock:
+            samples = self._latency.get(route)
+            if samples is None:
+                samples = self._latency[route] = deque(maxlen=LATENCY_SAMPLES)
+            samples.append(seconds)
+            self._route_counts[route] = self._route_counts.get(route, 0) + 1
+            self._route_time[route] = self._route_time.get(route, 0.0) + seconds
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            routes = {}
+            for route, samples in self._latency.items():
+                ordered = sorted(samples)
+                routes[route] = {
+                    "requests": self._route_counts[route],
+                    "avg_ms": round(1000 * self._route_time[route] / self._route_counts[route], 2),
+                    "p50_ms": round(1000 * ordered[len(ordered) // 2], 2),
+                    "p95_ms": round(1000 * ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+                }
+            return {
+                "matched": self.matched,
+                "fallbacks": dict(self.fallbacks),
+                "entities_indexed": len(self._entities),
+                "index_builds": self.index_builds,
+                "routes": routes,
+            }
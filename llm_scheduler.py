@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Controllo di ammissione per le chiamate a llama-server.
+
+Limita le generazioni in corso al numero di slot di llama-server
+(`parallel_requests`) e tiene le richieste in eccesso in una coda
+limitata con priorità e scadenza. Quando la coda è piena le richieste
+vengono rifiutate subito invece di accumularsi dentro llama-server fino
+al timeout.
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Attesa massima in coda richiedibile da un client (secondi)
+MAX_DEADLINE = 600
+
+PRIORITIES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "background": PRIORITY_BACKGROUND,
+}
+
+
+class AdmissionError(Exception):
+    """Richiesta non ammessa; `status_code` è il codice HTTP da restituire."""
+
+    status_code = 503
+    retry_after = 1
+
+
+class QueueFullError(AdmissionError):
+    """Coda piena: il client deve riprovare più tardi."""
+
+    status_code = 429
+
+
+class DeadlineExceededError(AdmissionError):
+    """Scadenza raggiunta prima che si liberasse uno slot."""
+
+    status_code = 503
+
+
+def parse_priority(value: Any) -> int:
+    """
+    Converte la priorità di una richiesta ("interactive"/"background").
+
+    Raises:
+        ValueError: Se la priorità non è riconosciuta
+    """
+    if value is None:
+        return PRIORITY_INTERACTIVE
+    if value not in PRIORITIES:
+        raise ValueError(f"Priorità non valida: '{value}' (ammesse: {', '.join(PRIORITIES)})")
+    return PRIORITIES[value]
+
+
+def parse_deadline(value: Any) -> Optional[float]:
+    """
+    Converte la scadenza di una richiesta (secondi di attesa massima in coda).
+
+    Raises:
+        ValueError: Se non è un numero tra 0 e MAX_DEADLINE
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 < value <= MAX_DEADLINE:
+        raise ValueError(f"'deadline' deve essere un numero di secondi tra 0 e {MAX_DEADLINE}")
+    return float(value)
+
+
+class Ticket:
+    """Slot assegnato a una richiesta; `release` è idempotente."""
+
+    def __init__(self, scheduler: "LLMScheduler", priority: int, deadline: float):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.granted = threading.Event()
+        self.rejected: Optional[AdmissionError] = None
+        self.wait_time = 0.0
+        self._released = False
+
+    def release(self):
+        self.scheduler._release(self)
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class LLMScheduler:
+    """
+    Semaforo a priorità per le generazioni LLM.
+
+    Le richieste interattive passano davanti a quelle di background;
+    a parità di priorità l'ordine è FIFO. Con la coda piena, una
+    richiesta più prioritaria scavalca (e fa rifiutare) l'ultima in coda
+    di priorità inferiore.
+    """
+
+    def __init__(self, slots: int = 1, max_queue: int = 16, default_deadline: float = 60.0):
+        """
+        Inizializza lo scheduler.
+
+        Args:
+            slots: Generazioni contemporanee (slot di llama-server)
+            max_queue: Richieste massime in attesa
+            default_deadline: Attesa massima in coda in secondi
+        """
+        self.slots = slots
+        self.max_queue = max_queue
+        self.default_deadline = default_deadline
+
+        self._lock = threading.Lock()
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_deadline = 0
+        self._waits: deque = deque(maxlen=512)
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE, deadline: Optional[float] = None) -> Ticket:
+        """
+        Attende uno slot libero.
+
+        Args:
+            priority: PRIORITY_INTERACTIVE o PRIORITY_BACKGROUND
+            deadline: Attesa massima in secondi (default: default_deadline)
+
+        Returns:
+            Ticket da rilasciare a fine generazione (usabile con `with`)
+
+        Raises:
+            QueueFullError: Coda piena
+            DeadlineExceededError: Nessuno slot libero entro la scadenza
+        """
+        wait_limit = self.default_deadline if deadline is None else deadline
+        ticket = Ticket(self, priority, time.monotonic() + wait_limit)
+
+        with self._lock:
+            if self._in_flight < self.slots and not self._queue:
+                self._grant(ticket)
+                return ticket
+
+            if len(self._queue) >= self.max_queue:
+                worst = max(self._queue) if self._queue else None
+                if worst is None or worst[0] <= priority:
+                    self.rejected_full += 1
+                    raise QueueFullError(
+                        f"Coda LLM piena ({self.max_queue} richieste in attesa)"
+                    )
+                # Scavalca la richiesta meno prioritaria più recente
+                self._queue.remove(worst)
+                heapq.heapify(self._queue)
+                self.rejected_full += 1
+                worst[2].rejected = QueueFullError("Richiesta scavalcata da una più prioritaria")
+                worst[2].granted.set()
+
+            heapq.heappush(self._queue, (priority, next(self._seq), ticket))
+
+        ticket.granted.wait(max(ticket.deadline - time.monotonic(), 0))
+
+        with self._lock:
+            if ticket.granted.is_set():
+                if ticket.rejected is not None:
+                    raise ticket.rejected
+                return ticket
+            # Scaduto: esce dalla coda
+            self._queue = [entry for entry in self._queue if entry[2] is not ticket]
+            heapq.heapify(self._queue)
+            self.rejected_deadline += 1
+        raise DeadlineExceededError(f"Nessuno slot LLM libero entro {wait_limit:.0f}s")
+
+    def check_admission(self, workers_busy: bool = False):
+        """
+        Controllo anticipato, prima che la richiesta occupi un thread.
+
+        Rifiuta se tutti i thread del pool LLM sono occupati o se slot e
+        coda sono pieni e nessuna richiesta in coda potrebbe essere
+        scavalcata (la priorità della nuova richiesta non è ancora nota:
+        si assume interattiva).
+
+        Args:
+            workers_busy: Tutti i thread che eseguono le richieste LLM sono occupati
+
+        Raises:
+            QueueFullError: Se la richiesta non potrebbe entrare in coda
+        """
+        with self._lock:
+            full = (
+                self._in_flight >= self.slots
+                and len(self._queue) >= self.max_queue
+                and all(entry[0] <= PRIORITY_INTERACTIVE for entry in self._queue)
+            )
+            if workers_busy or full:
+                self.rejected_full += 1
+                if workers_busy:
+                    raise QueueFullError("Tutti i thread LLM sono occupati")
+                raise QueueFullError(f"Coda LLM piena ({self.max_queue} richieste in attesa)")
+
+    def _grant(self, ticket: Ticket):
+        # Chiamato con il lock acquisito
+        self._in_flight += 1
+        self.admitted += 1
+        ticket.wait_time = time.monotonic() - ticket.enqueued_at
+        self._waits.append(ticket.wait_time)
+        ticket.granted.set()
+
+    def _release(self, ticket: Ticket):
+        with self._lock:
+            # Test-and-set sotto il lock: chiamate concorrenti (fine dello
+            # stream e call_on_close) liberano lo slot una volta sola
+            if ticket._released:
+                return
+            ticket._released = True
+            self._in_flight -= 1
+            now = time.monotonic()
+            while self._queue and self._in_flight < self.slots:
+                _, _, ticket = heapq.heappop(self._queue)
+                if ticket.deadline <= now:
+                    # Il thread in attesa se ne accorgerà allo scadere
+                    continue
+                self._grant(ticket)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Profondità della coda, slot occupati e tempi di attesa."""
+        with self._lock:
+            waits = sorted(self._waits)
+            by_priority = {name: 0 for name in PRIORITIES}
+            for priority, _, _ in self._queue:
+                for name, value in PRIORITIES.items():
+                    if value == priority:
+                        by_priority[name] += 1
+            return {
+                "slots": self.slots,
+                "in_flight": self._in_flight,
+                "queue_depth": len(self._queue),
+                "queue_by_priority": by_priority,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected_full,
+                "rejected_deadline": self.rejected_deadline,
+                "wait_avg_ms": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+                "wait_p95_ms": round(1000 * waits[math.ceil(0.95 * len(waits)) - 1], 1) if waits else 0.0,
+                "wait_max_ms": round(1000 * waits[-1], 1) if waits else 0.0,
+            }
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Logging del servizio.
+
+I thread delle richieste mettono i record in una coda senza formattarli;
+un thread dedicato li formatta e li scrive a blocchi, con un solo flush
+per blocco invece di una scrittura per riga. Il livello segue l'opzione
+`log_level` dell'add-on.
+
+Per i log sul percorso caldo ci sono oggetti pigri (`Preview`,
+`MessagesPreview`, `LogFields`) il cui testo viene calcolato solo se il
+record viene davvero scritto, e `PayloadSampler` per registrare le
+anteprime dei messaggi solo su una frazione delle richieste.
+"""
+
+import atexit
+import itertools
+import logging
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler
+from typing import Any, Dict, List, Optional, TextIO
+
+LOG_FORMAT = "[HA-SERVICE] %(asctime)s - %(levelname)s - %(message)s"
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+
+_STOP = object()
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler che non formatta il messaggio nel thread chiamante.
+
+    Il `QueueHandler` standard unisce messaggio e argomenti prima di
+    accodare (per poter serializzare il record); qui il record resta
+    nello stesso processo e la formattazione avviene nel thread di
+    scrittura.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and not record.exc_text:
+            # Il traceback va catturato ora, prima che i frame cambino
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+
+class QueuedLogWriter:
+    """Thread che formatta i record in coda e li scrive a blocchi."""
+
+    def __init__(
+        self,
+        log_queue: "queue.SimpleQueue",
+        stream: TextIO,
+        formatter: logging.Formatter,
+        batch_size: int = 256
+    ):
+        """
+        Args:
+            log_queue: Coda alimentata da `DeferredQueueHandler`
+            stream: Destinazione (stdout)
+            formatter: Formatter dei record
+            batch_size: Record massimi scritti con un solo flush
+        """
+        self.queue = log_queue
+        self.stream = stream
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self.records = 0
+        self.writes = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Scrive i record rimasti e ferma il thread."""
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(record is _STOP for record in batch)
+            self._write([record for record in batch if record is not _STOP])
+            if stop:
+                return
+
+    def _write(self, records: List[logging.LogRecord]):
+        if not records:
+            return
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception as e:
+                lines.append(f"Errore di formattazione del log ({record.msg!r}): {e}")
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except Exception:
+            return
+        self.records += len(records)
+        self.writes += 1
+
+
+def setup_logging(
+    level: str = "info",
+    stream: Optional[TextIO] = None,
+    fmt: str = LOG_FORMAT
+) -> QueuedLogWriter:
+    """
+    Configura il logging con scrittura in coda.
+
+    Sostituisce gli handler del root logger: tutti i logger del processo
+    (uvicorn compreso, se propagato) passano dalla coda.
+
+    Args:
+        level: Livello dell'opzione `log_level` (debug, info, warning, error)
+        stream: Destinazione (default: stdout)
+        fmt: Formato delle righe
+
+    Returns:
+        Writer avviato (fermato automaticamente all'uscita)
+    """
+    log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+    writer = QueuedLogWriter(log_queue, stream or sys.stdout, logging.Formatter(fmt))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(LEVELS.get(str(level).lower(), logging.INFO))
+
+    writer.start()
+    atexit.register(writer.stop)
+    return writer
+
+
+class Preview:
+    """Anteprima troncata di un testo, calcolata solo se il log viene scritto."""
+
+    __slots__ = ("text", "limit")
+
+    def __init__(self, text: Any, limit: int = 200):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = str(self.text)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... (+{len(text) - self.limit} caratteri)"
+
+
+class MessagesPreview:
+    """Ruolo, lunghezza e anteprima di ogni messaggio (pigro)."""
+
+    __slots__ = ("messages", "limit")
+
+    def __init__(self, messages: List[Dict[str, Any]], limit: int = 200):
+        self.messages = messages
+        self.limit = limit
+
+    def __str__(self) -> str:
+        lines = []
+        for idx, message in enumerate(self.messages):
+            content = str(message.get("content", ""))
+            lines.append(
+                f"  [{idx}] role={message.get('role')} content_len={len(content)} "
+                f"preview={Preview(content, self.limit)}"
+            )
+        return "\n".join(lines)
+
+
+class LogFields:
+    """Campi `chiave=valore` per righe di log strutturate (pigro)."""
+
+    __slots__ = ("fields",)
+
+    def __init__(self, **fields: Any):
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return " ".join(f"{key}={value}" for key, value in self.fields.items())
+
+
+class PayloadSampler:
+    """Seleziona una richiesta ogni 1/rate per i log dei payload."""
+
+    def __init__(self, rate: float = 0.1):
+        """
+        Args:
+            rate: Frazione di richieste campionate (0 = nessuna, 1 = tutte)
+        """
+        self.rate = rate
+        self._every = int(round(1 / rate)) if rate > 0 else 0
+        self._counter = itertools.count()
+
+    def sample(self) -> bool:
+        if not self._every:
+            return False
+        return next(self._counter) % self._every == 0
+
+
+def log_llama_request(
+    logger: logging.Logger,
+    payload: Dict[str, Any],
+    stream: bool,
+    sampler: Optional[PayloadSampler] = None
+):
+    """Log (debug) di una richiesta a llama-server; anteprime campionate."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    messages = payload["messages"]
+    logger.debug(
+        "📤 Chiamata llama-server %s",
+        LogFields(
+            messages=len(messages),
+            temperature=payload.get("temperature"),
+            max_tokens=payload.get("max_tokens"),
+            stream=stream,
+            id_slot=payload.get("id_slot"),
+        )
+    )
+    if sampler is not None and sampler.sample():
+        logger.debug("📤 Messaggi:\n%s", MessagesPreview(messages))
+
+
+def log_llama_response(
+    logger: logging.Logger,
+    status: int,
+    result: Dict[str, Any],
+    sampler: Optional[PayloadSampler] = None
+):
+    """Log (debug) di una risposta di llama-server; anteprima campionata."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    usage = result.get("usage") or {}
+    logger.debug(
+        "📥 Risposta llama-server %s",
+        LogFields(
+            status=status,
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+        )
+    )
+    if sampler is not None and sampler.sample() and result.get("choices"):
+        logger.debug(
+            "📥 Risposta: %s", Preview(result["choices"][0].get("message", {}).get("content", ""))
+        )
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Metriche Prometheus del servizio.
+
+Sul percorso delle richieste si aggiornano solo istogrammi e contatori
+(poche operazioni in memoria per richiesta). Le statistiche già tenute
+dai singoli componenti (scheduler, cache, mirror) vengono lette solo
+al momento dello scrape tramite `StatsCollector`.
+"""
+
+import time
+from typing import Any, Callable, Dict, Optional
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+registry = CollectorRegistry()
+
+REQUEST_LATENCY = Histogram(
+    "ha_llm_request_duration_seconds",
+    "Durata delle richieste HTTP (fino alla fine della risposta, stream compresi)",
+    ["endpoint", "method"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+    registry=registry,
+)
+REQUEST_ERRORS = Counter(
+    "ha_llm_request_errors_total",
+    "Risposte HTTP con stato >= 400",
+    ["endpoint", "status"],
+    registry=registry,
+)
+CONTEXT_BUILD = Histogram(
+    "ha_llm_context_build_seconds",
+    "Tempo di costruzione del prompt con il contesto Home Assistant",
+    ["layout"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+    registry=registry,
+)
+UPSTREAM_LATENCY = Histogram(
+    "ha_llm_upstream_request_seconds",
+    "Durata delle chiamate HTTP in uscita (Supervisor, llama-server) fino agli header",
+    ["endpoint"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+    registry=registry,
+)
+QUEUE_WAIT = Histogram(
+    "ha_llm_queue_wait_seconds",
+    "Attesa in coda prima di ottenere uno slot di llama-server",
+    ["priority"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60),
+    registry=registry,
+)
+PROMPT_EVAL = Histogram(
+    "ha_llm_prompt_eval_seconds",
+    "Tempo di valutazione del prompt in llama-server (timings.prompt_ms)",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    registry=registry,
+)
+GENERATION_SPEED = Histogram(
+    "ha_llm_generation_tokens_per_second",
+    "Velocità di generazione di llama-server (timings.predicted_per_second)",
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200),
+    registry=registry,
+)
+PROMPT_TOKENS = Counter(
+    "ha_llm_prompt_tokens",
+    "Token di prompt (usage.prompt_tokens)",
+    registry=registry,
+)
+PROMPT_TOKENS_EVALUATED = Counter(
+    "ha_llm_prompt_tokens_evaluated",
+    "Token di prompt effettivamente valutati, esclusi quelli in KV cache (timings.prompt_n)",
+    registry=registry,
+)
+COMPLETION_TOKENS = Counter(
+    "ha_llm_completion_tokens",
+    "Token generati (usage.completion_tokens)",
+    registry=registry,
+)
+CHAT_ROUTE = Histogram(
+    "ha_llm_chat_route_seconds",
+    "Durata delle richieste /api/chat con azioni per percorso (fast_path o llm)",
+    ["route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60),
+    registry=registry,
+)
+TOOL_CALLS = Histogram(
+    "ha_llm_tool_call_seconds",
+    "Durata dei tool eseguiti per il modello, per dominio ed esito",
+    ["domain", "status"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    registry=registry,
+)
+
+PRIORITY_NAMES = {0: "interactive", 1: "background"}
+
+
+def observe_request(endpoint: str, method: str, status: int, seconds: float):
+    """Registra durata ed eventuale errore di una richiesta HTTP."""
+    REQUEST_LATENCY.labels(endpoint, method).observe(seconds)
+    if status >= 400:
+        REQUEST_ERRORS.labels(endpoint, str(status)).inc()
+
+
+def observe_upstream(endpoint: str, seconds: float):
+    """Callback per `HTTPPool`: durata di una chiamata in uscita."""
+    UPSTREAM_LATENCY.labels(endpoint).observe(seconds)
+
+
+def observe_queue_wait(priority: int, seconds: float):
+    QUEUE_WAIT.labels(PRIORITY_NAMES.get(priority, str(priority))).observe(seconds)
+
+
+def observe_tool_call(domain: str, status: str, seconds: float):
+    """Callback per `ToolAgent`: durata ed esito di un tool."""
+    TOOL_CALLS.labels(domain, status).observe(seconds)
+
+
+def observe_completion(result: Dict[str, Any]):
+    """Registra `usage` e `timings` di una risposta di llama-server."""
+    usage = result.get("usage") or {}
+    timings = result.get("timings") or {}
+    if usage.get("prompt_tokens"):
+        PROMPT_TOKENS.inc(usage["prompt_tokens"])
+    if usage.get("completion_tokens"):
+        COMPLETION_TOKENS.inc(usage["completion_tokens"])
+    if timings.get("prompt_n") is not None:
+        PROMPT_TOKENS_EVALUATED.inc(timings["prompt_n"])
+    if timings.get("prompt_ms") is not None:
+        PROMPT_EVAL.observe(timings["prompt_ms"] / 1000.0)
+    if timings.get("predicted_per_second"):
+        GENERATION_SPEED.observe(timings["predicted_per_second"])
+
+
+def generate_latest_text() -> bytes:
+    """Esposizione testuale del registro (contenuto di /metrics)."""
+    return generate_latest(registry)
+
+
+class Timer:
+    """Misura un blocco `with` e passa la durata a `observe`."""
+
+    __slots__ = ("observe", "started")
+
+    def __init__(self, observe: Callable[[float], None]):
+        self.observe = observe
+        self.started = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.observe(time.perf_counter() - self.started)
+
+
+class StatsCollector:
+    """
+    Espone come metriche le statistiche dei componenti.
+
+    Le sorgenti sono funzioni senza argomenti che restituiscono il dict
+    di `get_stats()`; vengono chiamate solo durante lo scrape.
+    """
+
+    def __init__(self, sources: Dict[str, Callable[[], Optional[Dict[str, Any]]]]):
+        self.sources = sources
+
+    def collect(self):
+        stats = {}
+        for name, source in self.sources.items():
+            try:
+                stats[name] = source() or {}
+            except Exception:
+                stats[name] = {}
+
+        queue = stats.get("llm_queue", {})
+        yield _gauge("ha_llm_queue_in_flight", "Generazioni in corso", queue.get("in_flight"))
+        yield _gauge("ha_llm_queue_depth", "Richieste in attesa di uno slot", queue.get("queue_depth"))
+        yield _gauge("ha_llm_queue_slots", "Slot di llama-server", queue.get("slots"))
+        yield _counter("ha_llm_queue_admitted", "Richieste ammesse dallo scheduler", queue.get("admitted"))
+        rejected = CounterMetricFamily(
+            "ha_llm_queue_rejected", "Richieste rifiutate dallo scheduler", labels=["reason"]
+        )
+        rejected.add_metric(["queue_full"], queue.get("rejected_queue_full", 0))
+        rejected.add_metric(["deadline"], queue.get("rejected_deadline", 0))
+        yield rejected
+
+        conversations = stats.get("conversation_store", {})
+        yield _gauge("ha_llm_conversations", "Conversazioni conservate", conversations.get("conversations"))
+
+        for cache in ("context_cache", "response_cache"):
+            cache_stats = stats.get(cache, {})
+            hits = cache_stats.get("hits")
+            if hits is None:
+                hits = cache_stats.get("hits_exact", 0) + cache_stats.get("hits_semantic", 0)
+            yield _counter(f"ha_llm_{cache}_hits", f"Hit della {cache}", hits)
+            yield _counter(f"ha_llm_{cache}_misses", f"Miss della {cache}", cache_stats.get("misses"))
+
+        mirror = stats.get("state_mirror", {})
+        yield _gauge("ha_llm_state_mirror_connected", "Mirror WebSocket connesso (1/0)",
+                     1 if mirror.get("connected") else 0)
+        yield _gauge("ha_llm_state_mirror_entities", "Entità nel mirror degli stati", mirror.get("entities"))
+        yield _counter("ha_llm_state_mirror_events", "Eventi state_changed applicati", mirror.get("events_applied"))
+
+        index = stats.get("entity_index", {})
+        yield _counter("ha_llm_entity_index_queries", "Query su /api/ha/entities", index.get("queries"))
+        yield _counter("ha_llm_entity_index_not_modified", "Risposte 304 di /api/ha/entities", index.get("not_modified"))
+
+        history = stats.get("entity_history", {})
+        yield _gauge("ha_llm_history_points", "Punti nelle serie storiche in cache", history.get("points"))
+        yield _counter("ha_llm_history_queries", "Aggregati storici calcolati", history.get("queries"))
+        yield _counter("ha_llm_history_fetches", "Letture della storia dal recorder", history.get("fetches"))
+        yield _counter("ha_llm_history_live_points", "Punti aggiunti dal mirror senza letture", history.get("live_points"))
+
+        rag = stats.get("rag_index", {})
+        yield _gauge("ha_llm_rag_chunks", "Chunk nell'indice RAG", rag.get("chunks"))
+        yield _gauge("ha_llm_rag_pending", "Sorgenti in attesa di indicizzazione", rag.get("pending"))
+        yield _counter("ha_llm_rag_embedded", "Chunk con embedding calcolato", rag.get("embedded"))
+        yield _counter("ha_llm_rag_searches", "Ricerche nell'indice RAG", rag.get("searches"))
+
+        pool = stats.get("http_pool", {})
+        yield _counter("ha_llm_http_requests", "Richieste HTTP in uscita", pool.get("requests"))
+        yield _counter("ha_llm_http_new_connections", "Connessioni TCP aperte", pool.get("new_connections"))
+
+        startup = stats.get("startup", {})
+        yield _gauge("ha_llm_ready", "Avvio completato, modello pronto (1/0)", 1 if startup.get("ready") else 0)
+        phases = GaugeMetricFamily(
+            "ha_llm_startup_phase_seconds", "Durata delle fasi di avvio", labels=["phase"]
+        )
+        for phase, seconds in (startup.get("phases_s") or {}).items():
+            phases.add_metric([phase], seconds)
+        yield phases
+
+
+def _gauge(name: str, documentation: str, value: Any) -> GaugeMetricFamily:
+    return GaugeMetricFamily(name, documentation, value=float(value or 0))
+
+
+def _counter(name: str, documentation: str, value: Any) -> CounterMetricFamily:
+    return CounterMetricFamily(name, documentation, value=float(value or 0))
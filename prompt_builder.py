@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+Costruzione del prompt ottimizzata per la prompt cache di llama-server.
+
+Il contenuto è ordinato dal più stabile al più volatile:
+istruzioni fisse → catalogo entità/servizi → stati correnti → domanda.
+Così il prefisso (system prompt) resta identico tra una richiesta e
+l'altra e llama-server può riutilizzare la KV cache dello slot.
+"""
+
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from context_budget import (
+    TokenCounter,
+    compact_attributes,
+    fit_lines,
+    relevance_rank,
+    static_rank,
+)
+
+BASE_INSTRUCTIONS = (
+    "Sei un assistente virtuale per Home Assistant. "
+    "Rispondi in modo conciso usando solo le informazioni fornite sul sistema."
+)
+
+# Attributi utili a descrivere un'entità nel catalogo (cambiano di rado)
+CATALOG_ATTRIBUTES = ("device_class", "unit_of_measurement")
+
+# Quota del budget riservata al catalogo quando il contesto non ci sta
+CATALOG_BUDGET_SHARE = 0.4
+
+# Token aggiunti dal chat template per ogni messaggio (stima prudente)
+TEMPLATE_OVERHEAD = 16
+
+# Cataloghi in cache (uno per combinazione di domini, servizi e budget)
+MAX_CATALOG_ENTRIES = 32
+
+# Le info di sistema (nome, versione HA, fuso orario) vengono rilette dopo
+# questo intervallo, oltre che a ogni evento core_config_updated
+SYSTEM_INFO_TTL = 3600
+
+
+def slot_for(key: str, n_slots: int) -> int:
+    """
+    Slot llama-server stabile per una chiave (es. ID conversazione).
+
+    Args:
+        key: Chiave da mappare
+        n_slots: Numero di slot (`--parallel`)
+
+    Returns:
+        Indice dello slot in [0, n_slots)
+    """
+    if n_slots <= 1:
+        return 0
+    return zlib.crc32(key.encode("utf-8")) % n_slots
+
+
+class PromptCacheStats:
+    """Confronta i token di prompt totali con quelli realmente valutati."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.prompt_evaluated = 0
+
+    def record(self, result: Dict[str, Any]) -> Optional[Dict[str, int]]:
+        """
+        Registra `usage.prompt_tokens` e `timings.prompt_n` di una risposta.
+
+        Returns:
+            Riepilogo per la singola richiesta, o None se mancano i dati
+        """
+        usage = result.get("usage") or {}
+        timings = result.get("timings") or {}
+        total = usage.get("prompt_tokens")
+        evaluated = timings.get("prompt_n")
+        if total is None or evaluated is None:
+            return None
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += total
+            self.prompt_evaluated += evaluated
+        return {
+            "prompt_tokens": total,
+            "prompt_evaluated": evaluated,
+            "prompt_reused": max(total - evaluated, 0),
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            reused = max(self.prompt_tokens - self.prompt_evaluated, 0)
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "prompt_evaluated": self.prompt_evaluated,
+                "prompt_reused": reused,
+                "reduction": round(reused / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+            }
+
+
+class PromptBuilder:
+    """
+    Assembla i messaggi per `/api/chat` con layout prefix-cache friendly.
+
+    Il catalogo (elenco entità e servizi) viene renderizzato in modo
+    deterministico e rigenerato solo quando cambia l'insieme delle
+    entità; gli stati correnti finiscono nel messaggio utente.
+    """
+
+    def __init__(
+        self,
+        client,
+        mirror=None,
+        counter: Optional[TokenCounter] = None,
+        index=None,
+        services=None
+    ):
+        """
+        Inizializza il builder.
+
+        Args:
+            client: Client con interfaccia HomeAssistantClient
+            mirror: StateMirror opzionale; se presente i cambi strutturali
+                (entità aggiunte/rimosse/rinominate) invalidano il catalogo
+            counter: TokenCounter opzionale per misurare e limitare il prompt
+            index: EntityIndex opzionale; se pronto gli stati dei domini
+                richiesti vengono letti dall'indice, già ordinati
+            services: ServiceCatalog opzionale; se presente l'elenco dei
+                servizi viene dal catalogo e si rigenera solo quando cambia
+        """
+        self.client = client
+        self.mirror = mirror
+        self.counter = counter
+        self.index = index
+        self.services = services
+        self._lock = threading.Lock()
+        self._catalog_version = 0
+        self._catalog_cache: "OrderedDict[Tuple, Tuple[int, Tuple[str, int]]]" = OrderedDict()
+        # (testo, istante di lettura)
+        self._system_info: Optional[Tuple[str, float]] = None
+
+        if mirror is not None:
+            mirror.add_listener(self._on_state_changed)
+            mirror.subscribe("core_config_updated", lambda data: self.invalidate())
+
+    def _on_state_changed(self, entity_id: str, old_state, new_state):
+        if old_state is None or new_state is None or (
+            _catalog_line(old_state) != _catalog_line(new_state)
+        ):
+            with self._lock:
+                self._catalog_version += 1
+
+    def invalidate(self):
+        """Forza la rigenerazione di catalogo e info di sistema."""
+        with self._lock:
+            self._catalog_version += 1
+            self._system_info = None
+
+    def _states(self, entity_domains: Optional[Iterable[str]]) -> List[Dict[str, Any]]:
+        if self.index is not None and self.index.ready:
+            return self.index.select(entity_domains)
+        states = self.client.get_states() or []
+        if entity_domains:
+            prefixes = tuple(f"{d}." for d in entity_domains)
+            states = [s for s in states if s.get("entity_id", "").startswith(prefixes)]
+        return sorted(states, key=lambda s: s.get("entity_id", ""))
+
+    def _render_system_info(self) -> str:
+        with self._lock:
+            cached = self._system_info
+        if cached is not None and time.monotonic() - cached[1] < SYSTEM_INFO_TTL:
+            return cached[0]
+        config = self.client.get_config() or {}
+        parts = [
+            f"{label}: {config[key]}"
+            for key, label in (
+                ("location_name", "Casa"),
+                ("version", "Versione HA"),
+                ("time_zone", "Fuso orario"),
+            )
+            if config.get(key)
+        ]
+        text = "\n".join(parts)
+        # Configurazione non disponibile (es. HA in avvio): si riprova alla prossima richiesta
+        if text:
+            with self._lock:
+                self._system_info = (text, time.monotonic())
+        return text
+
+    def _render_services(self) -> str:
+        if self.services is not None:
+            return self.services.render()
+        services = self.client.get_services() or []
+        lines = []
+        for entry in sorted(services, key=lambda e: e.get("domain", "")):
+            names = sorted(entry.get("services", {}))
+            if names:
+                lines.append(f"{entry.get('domain')}: {', '.join(names)}")
+        return "\n".join(lines)
+
+    def _render_catalog(
+        self,
+        states: List[Dict[str, Any]],
+        include_services: bool,
+        entity_domains: Optional[Iterable[str]],
+        budget: Optional[int] = None
+    ) -> Tuple[str, int]:
+        """
+        Renderizza il catalogo, eventualmente ridotto a `budget` token.
+
+        La selezione dipende solo dagli stati e dal budget, mai dal
+        messaggio utente, così il system prompt resta riutilizzabile.
+
+        Returns:
+            (testo del catalogo, numero di entità incluse)
+        """
+        services_version = self.services.version if include_services and self.services is not None else None
+        key = (tuple(sorted(entity_domains)) if entity_domains else None, include_services, budget, services_version)
+        use_cache = self.mirror is not None and self.mirror.ready
+        with self._lock:
+            version = self._catalog_version
+            cached = self._catalog_cache.get(key)
+            if cached is not None:
+                self._catalog_cache.move_to_end(key)
+        if use_cache and cached is not None and cached[0] == version:
+            return cached[1]
+
+        entity_lines = [_catalog_line(s) for s in (static_rank(states) if budget is not None else states)]
+        service_lines = self._render_services().split("\n") if include_services else []
+        service_lines = [line for line in service_lines if line]
+        if budget is not None:
+            entity_lines = fit_lines(entity_lines, budget, self.counter)
+            used = sum(self.counter.estimate(line) for line in entity_lines)
+            service_lines = fit_lines(service_lines, budget - used, self.counter)
+            entity_lines.sort()
+
+        sections = []
+        if entity_lines:
+            sections.append("ENTITÀ DISPONIBILI:\n" + "\n".join(entity_lines))
+        if service_lines:
+            sections.append("SERVIZI DISPONIBILI:\n" + "\n".join(service_lines))
+        result = ("\n\n".join(sections), len(entity_lines))
+
+        with self._lock:
+            self._catalog_cache[key] = (version, result)
+            self._catalog_cache.move_to_end(key)
+            while len(self._catalog_cache) > MAX_CATALOG_ENTRIES:
+                self._catalog_cache.popitem(last=False)
+        return result
+
+    def build(
+        self,
+        user_message: str,
+        include_entities: bool = True,
+        include_services: bool = False,
+        include_system: bool = True,
+        entity_domains: Optional[Iterable[str]] = None,
+        token_budget: Optional[int] = None
+    ) -> Tuple[List[Dict[str, str]], Optional[Dict[str, Any]]]:
+        """
+        Costruisce la lista di messaggi OpenAI.
+
+        Se il contesto completo supera `token_budget`, il catalogo viene
+        ridotto alle entità più importanti (ordinamento stabile) e gli
+        stati correnti a quelle più rilevanti per il messaggio.
+
+        Args:
+            user_message: Messaggio dell'utente
+            include_entities: Include le entità HA
+            include_services: Include i servizi HA
+            include_system: Include le informazioni di sistema
+            entity_domains: Domini a cui limitare le entità
+            token_budget: Token massimi per l'intero prompt (None = nessun limite)
+
+        Returns:
+            (messaggi [system, user], report token o None senza TokenCounter)
+        """
+        system_parts, state_lines, states, catalog_count, trimmed = self._compose(
+            [BASE_INSTRUCTIONS],
+            user_message,
+            include_entities,
+            include_services,
+            include_system,
+            entity_domains,
+            token_budget
+        )
+        messages = self._assemble(system_parts, state_lines, user_message)
+
+        if self.counter is None:
+            return messages, None
+
+        system_tokens, exact_system = self.counter.count(messages[0]["content"])
+        user_tokens, exact_user = self.counter.count(messages[1]["content"])
+        used = system_tokens + user_tokens + 2 * TEMPLATE_OVERHEAD
+
+        # La stima locale può sbagliare: un secondo passaggio corregge lo sforamento
+        if token_budget is not None and used > token_budget and state_lines:
+            overflow = used - token_budget
+            keep_budget = sum(self.counter.estimate(line) for line in state_lines) - overflow
+            state_lines = fit_lines(state_lines, max(keep_budget, 0), self.counter)
+            messages = self._assemble(system_parts, state_lines, user_message)
+            user_tokens, exact_user = self.counter.count(messages[1]["content"])
+            used = system_tokens + user_tokens + 2 * TEMPLATE_OVERHEAD
+            trimmed = True
+
+        report = {
+            "budget": token_budget,
+            "used": used,
+            "system_tokens": system_tokens,
+            "user_tokens": user_tokens,
+            "exact": exact_system and exact_user,
+            "trimmed": trimmed,
+            "entities_total": len(states),
+            "entities_catalog": catalog_count,
+            "entities_states": len(state_lines),
+        }
+        return messages, report
+
+    def render_context(
+        self,
+        include_entities: bool = True,
+        include_services: bool = False,
+        include_system: bool = True,
+        entity_domains: Optional[Iterable[str]] = None,
+        token_budget: Optional[int] = None
+    ) -> Tuple[str, str]:
+        """
+        Contesto HA senza istruzioni né domanda, per le conversazioni.
+
+        Args:
+            include_entities: Include le entità HA
+            include_services: Include i servizi HA
+            include_system: Include le informazioni di sistema
+            entity_domains: Domini a cui limitare le entità
+            token_budget: Token massimi per catalogo e stati (None = nessun limite)
+
+        Returns:
+            (parte stabile per il system prompt, blocco "STATO ATTUALE")
+        """
+        system_parts, state_lines, _, _, _ = self._compose(
+            [],
+            "",
+            include_entities,
+            include_services,
+            include_system,
+            entity_domains,
+            token_budget
+        )
+        states = "STATO ATTUALE:\n" + "\n".join(state_lines) if state_lines else ""
+        return "\n\n".join(system_parts), states
+
+    def _compose(
+        self,
+        system_parts: List[str],
+        user_message: str,
+        include_entities: bool,
+        include_services: bool,
+        include_system: bool,
+        entity_domains: Optional[Iterable[str]],
+        token_budget: Optional[int]
+    ) -> Tuple[List[str], List[str], List[Dict[str, Any]], int, bool]:
+        """
+        Sezioni del system prompt e righe di stato entro il budget.
+
+        Returns:
+            (sezioni del system prompt, righe di stato, stati, entità nel
+            catalogo, True se il contesto è stato ridotto)
+        """
+        system_parts = list(system_parts)
+        if include_system:
+            info = self._render_system_info()
+            if info:
+                system_parts.append("SISTEMA:\n" + info)
+
+        states = self._states(entity_domains) if include_entities else []
+        catalog, catalog_count = self._render_catalog(states, include_services, entity_domains)
+        state_lines = [_state_line(s) for s in states]
+
+        trimmed = False
+        if token_budget is not None and self.counter is not None:
+            fixed = self.counter.count("\n\n".join(system_parts))[0] + 2 * TEMPLATE_OVERHEAD
+            available = token_budget - fixed - self.counter.estimate(user_message)
+            needed = self.counter.estimate(catalog) + sum(self.counter.estimate(line) for line in state_lines)
+            if needed > available:
+                trimmed = True
+                # Budget del catalogo indipendente dal messaggio e arrotondato,
+                # così il system prompt non cambia da una richiesta all'altra
+                catalog_budget = max(int((token_budget - fixed) * CATALOG_BUDGET_SHARE) // 64 * 64, 0)
+                catalog, catalog_count = self._render_catalog(
+                    states, include_services, entity_domains, catalog_budget
+                )
+                state_lines = self._fit_states(
+                    states, user_message, catalog, available - self.counter.estimate(catalog)
+                )
+
+        if catalog:
+            system_parts.append(catalog)
+        return system_parts, state_lines, states, catalog_count, trimmed
+
+    def _fit_states(
+        self,
+        states: List[Dict[str, Any]],
+        user_message: str,
+        catalog: str,
+        budget: int
+    ) -> List[str]:
+        # Le entità escluse dal catalogo portano con sé il friendly_name
+        in_catalog = {
+            line[2:].split(" ", 1)[0] for line in catalog.split("\n") if line.startswith("- ")
+        }
+        # Nome dell'area dai registri del mirror: gli stati HA non la riportano
+        areas = None
+        names = self.mirror.get_areas() if self.mirror is not None else {}
+        if names:
+            areas = {
+                s.get("entity_id", ""): names.get(self.mirror.get_area(s.get("entity_id", "")))
+                for s in states
+            }
+        lines = []
+        for state in relevance_rank(states, user_message, areas):
+            line = _state_line(state)
+            if state.get("entity_id") not in in_catalog:
+                name = state.get("attributes", {}).get("friendly_name")
+                if name:
+                    line = f"{line} ({name})"
+            lines.append(line)
+        return fit_lines(lines, budget, self.counter)
+
+    @staticmethod
+    def _assemble(
+        system_parts: List[str],
+        state_lines: List[str],
+        user_message: str
+    ) -> List[Dict[str, str]]:
+        user_parts = []
+        if state_lines:
+            user_parts.append("STATO ATTUALE:\n" + "\n".join(state_lines))
+        user_parts.append(f"DOMANDA: {user_message}" if user_parts else user_message)
+        return [
+            {"role": "system", "content": "\n\n".join(system_parts)},
+            {"role": "user", "content": "\n\n".join(user_parts)},
+        ]
+
+
+def _catalog_line(state: Dict[str, Any]) -> str:
+    attributes = state.get("attributes", {})
+    line = f"- {state.get('entity_id')}"
+    name = attributes.get("friendly_name")
+    if name:
+        line += f" ({name})"
+    extra = [str(attributes[a]) for a in CATALOG_ATTRIBUTES if attributes.get(a)]
+    if extra:
+        line += f" [{', '.join(extra)}]"
+    return line
+
+
+def _state_line(state: Dict[str, Any]) -> str:
+    unit = state.get("attributes", {}).get("unit_of_measurement")
+    value = f"{state.get('state')} {unit}" if unit else str(state.get("state"))
+    attributes = compact_attributes(state)
+    if attributes:
+        value += f" [{attributes}]"
+    return f"{state.get('entity_id')}={value}"
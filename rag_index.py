@@ -0,0 +1,731 @@
+#!/usr/bin/env python3
+"""
+Indice semantico (RAG) su entità, aree, automazioni e documenti.
+
+Ogni elemento diventa uno o più testi brevi ("chunk") con il proprio
+embedding, calcolato da llama-server. I vettori stanno in un file mappato
+in memoria (`vectors.npy`), i metadati in `index.json`: al riavvio
+l'indice viene riaperto e si ricalcolano solo i chunk il cui testo è
+cambiato (hash del testo).
+
+Gli aggiornamenti sono incrementali: un thread in background raccoglie le
+sorgenti cambiate (nuove entità, nomi o aree modificati, automazioni
+ricaricate, documenti aggiunti) e ricalcola in blocco solo quelle. Gli
+stati non fanno parte del testo indicizzato: il cambio di uno stato non
+genera embedding, lo stato corrente viene letto dal mirror al momento
+della risposta.
+
+`/api/chat` riceve così solo i `k` chunk più simili alla domanda, invece
+dell'elenco completo delle entità: il prompt resta piccolo anche in case
+con migliaia di entità.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("entity", "area", "automation", "document")
+DOCUMENT_SUFFIXES = (".md", ".txt")
+
+# Lunghezza massima di un chunk (caratteri)
+MAX_CHUNK_CHARS = 800
+
+# Entità elencate al massimo nel testo di un'area
+MAX_AREA_MEMBERS = 20
+
+# Nel prompt solo i chunk con punteggio almeno pari a questa frazione del migliore
+RELATIVE_SCORE_CUTOFF = 0.5
+
+_DOCUMENT_ID_RE = re.compile(r"^[\w.-]{1,100}$")
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def chunk_text(text: str, title: str, max_chars: int = MAX_CHUNK_CHARS) -> List[str]:
+    """
+    Divide un documento in chunk di paragrafi interi.
+
+    I titoli Markdown aprono una nuova sezione; ogni chunk inizia con il
+    titolo del documento e della sezione, così resta comprensibile da solo.
+
+    Args:
+        text: Testo del documento
+        title: Titolo del documento
+        max_chars: Lunghezza massima di un chunk
+
+    Returns:
+        Chunk in ordine
+    """
+    chunks: List[str] = []
+    section, parts, size = "", [], 0
+
+    def flush():
+        nonlocal parts, size
+        if parts:
+            header = f"{title} – {section}" if section else title
+            chunks.append(header + "\n" + "\n".join(parts))
+        parts, size = [], 0
+
+    for block in re.split(r"\n\s*\n", text):
+        block = block.strip()
+        heading = re.match(r"#+\s*(.+)", block)
+        if heading:
+            flush()
+            section = heading.group(1).strip()
+            block = block.split("\n", 1)[1].strip() if "\n" in block else ""
+        if not block:
+            continue
+        for piece in _split_long(block, max_chars):
+            if parts and size + len(piece) > max_chars:
+                flush()
+            parts.append(piece)
+            size += len(piece) + 1
+    flush()
+    return chunks
+
+
+def _split_long(block: str, max_chars: int) -> List[str]:
+    """Paragrafo troppo lungo: diviso per frasi, e le frasi lunghe per caratteri."""
+    if len(block) <= max_chars:
+        return [block]
+    pieces, current = [], ""
+    for sentence in re.split(r"(?<=[.!?])\s+", block):
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            pieces.append(current)
+            current = ""
+        while len(sentence) > max_chars:
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        current = f"{current} {sentence}".strip()
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+class VectorStore:
+    """
+    Vettori normalizzati su file mappato in memoria, con metadati JSON.
+
+    Le righe cancellate vengono azzerate e riusate; il file raddoppia
+    quando è pieno. La ricerca è un prodotto matrice-vettore sulle righe
+    in uso, letto dalla page cache.
+    """
+
+    def __init__(self, directory: str, model: str = "", initial_capacity: int = 1024):
+        """
+        Args:
+            directory: Cartella dei file dell'indice
+            model: Identificativo del modello di embedding; se cambia
+                l'indice viene ricostruito
+            initial_capacity: Righe allocate alla creazione
+        """
+        self.directory = directory
+        self.model = model
+        self.initial_capacity = initial_capacity
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.meta_path = os.path.join(directory, "index.json")
+
+        self._lock = threading.RLock()
+        self._matrix: Optional[np.ndarray] = None
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._ids: List[Optional[str]] = []
+        self._kinds = np.zeros(0, np.int8)
+        self._free: List[int] = []
+        self._used = 0
+        self._changed = False
+        self._load()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def dim(self) -> Optional[int]:
+        return None if self._matrix is None else self._matrix.shape[1]
+
+    def get(self, chunk_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._entries.get(chunk_id)
+
+    def ids(self, source: Optional[str] = None) -> List[str]:
+        """ID dei chunk, tutti o di una sorgente."""
+        with self._lock:
+            return [cid for cid, e in self._entries.items() if source is None or e["source"] == source]
+
+    def sources(self) -> Set[str]:
+        with self._lock:
+            return {e["source"] for e in self._entries.values()}
+
+    def upsert(self, entries: List[Dict[str, Any]], vectors: np.ndarray):
+        """
+        Inserisce o sostituisce chunk.
+
+        Args:
+            entries: {"id", "kind", "source", "text", "hash"} per chunk
+            vectors: Matrice (chunk × dimensione) con righe di norma 1
+        """
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != vectors.shape[1]:
+                if self._matrix is not None:
+                    logger.info("🧭 Dimensione degli embedding cambiata, indice RAG ricostruito")
+                self._reset(vectors.shape[1])
+            for entry, vector in zip(entries, vectors):
+                current = self._entries.get(entry["id"])
+                row = current["row"] if current else self._allocate()
+                self._matrix[row] = vector
+                self._ids[row] = entry["id"]
+                self._kinds[row] = KINDS.index(entry["kind"])
+                self._entries[entry["id"]] = dict(entry, row=row)
+            self._changed = True
+
+    def delete(self, chunk_ids: Iterable[str]) -> int:
+        with self._lock:
+            deleted = 0
+            for chunk_id in chunk_ids:
+                entry = self._entries.pop(chunk_id, None)
+                if entry is None:
+                    continue
+                row = entry["row"]
+                self._matrix[row] = 0
+                self._ids[row] = None
+                self._kinds[row] = -1
+                self._free.append(row)
+                deleted += 1
+            self._changed = self._changed or deleted > 0
+            return deleted
+
+    def search(self, vector: np.ndarray, k: int, kinds: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """
+        I `k` chunk più simili (similarità coseno).
+
+        Returns:
+            (id, punteggio) in ordine decrescente
+        """
+        with self._lock:
+            n = self._used
+            if not n or self._matrix is None or vector.shape[0] != self._matrix.shape[1]:
+                return []
+            mask = self._kinds[:n] >= 0
+            if kinds:
+                mask &= np.isin(self._kinds[:n], [KINDS.index(kind) for kind in kinds])
+            k = min(k, int(mask.sum()))
+            if k <= 0:
+                return []
+            scores = np.where(mask, self._matrix[:n] @ vector, -np.inf)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self._ids[i], float(scores[i])) for i in top]
+
+    def flush(self):
+        """Scrive su disco vettori e metadati (se cambiati)."""
+        with self._lock:
+            if not self._changed or self._matrix is None:
+                return
+            self._matrix.flush()
+            meta = {"version": 1, "model": self.model, "dim": self._matrix.shape[1], "entries": self._entries}
+            tmp = self.meta_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp, self.meta_path)
+            self._changed = False
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return 0 if self._matrix is None else int(self._matrix.nbytes)
+
+    def count_by_kind(self) -> Dict[str, int]:
+        with self._lock:
+            counts = np.bincount(self._kinds[:self._used][self._kinds[:self._used] >= 0], minlength=len(KINDS))
+            return {kind: int(counts[i]) for i, kind in enumerate(KINDS)}
+
+    def _load(self):
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            matrix = np.lib.format.open_memmap(self.vectors_path, mode="r+")
+        except (OSError, ValueError):
+            return
+        if meta.get("model") != self.model or matrix.ndim != 2 or matrix.shape[1] != meta.get("dim"):
+            logger.info("🧭 Modello di embedding cambiato, indice RAG ricostruito")
+            return
+        entries = meta.get("entries") or {}
+        self._matrix = matrix
+        self._entries = entries
+        self._ids = [None] * matrix.shape[0]
+        self._kinds = np.full(matrix.shape[0], -1, np.int8)
+        for chunk_id, entry in entries.items():
+            self._ids[entry["row"]] = chunk_id
+            self._kinds[entry["row"]] = KINDS.index(entry["kind"])
+        self._used = max((e["row"] for e in entries.values()), default=-1) + 1
+        self._free = [row for row in range(self._used) if self._ids[row] is None]
+        logger.info(f"🧭 Indice RAG caricato: {len(entries)} chunk ({matrix.shape[1]} dimensioni)")
+
+    def _reset(self, dim: int):
+        self._entries = {}
+        self._free = []
+        self._used = 0
+        self._matrix = None
+        self._resize(dim, self.initial_capacity)
+
+    def _allocate(self) -> int:
+        if self._free:
+            return self._free.pop()
+        if self._used == self._matrix.shape[0]:
+            self._resize(self._matrix.shape[1], self._matrix.shape[0] * 2)
+        self._used += 1
+        return self._used - 1
+
+    def _resize(self, dim: int, capacity: int):
+        """Nuovo file con `capacity` righe; le righe in uso vengono copiate."""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.vectors_path + ".tmp"
+        matrix = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(capacity, dim))
+        kinds = np.full(capacity, -1, np.int8)
+        ids: List[Optional[str]] = [None] * capacity
+        if self._matrix is not None and self._used:
+            matrix[:self._used] = self._matrix[:self._used]
+            kinds[:self._used] = self._kinds[:self._used]
+            ids[:self._used] = self._ids[:self._used]
+        matrix.flush()
+        os.replace(tmp, self.vectors_path)
+        self._matrix, self._kinds, self._ids = matrix, kinds, ids
+        self._changed = True
+
+
+class RAGIndex:
+    """Indicizzazione incrementale e ricerca dei chunk pertinenti a una domanda."""
+
+    def __init__(
+        self,
+        embedder,
+        store: VectorStore,
+        mirror=None,
+        api=None,
+        docs_paths: Iterable[str] = (),
+        batch_size: int = 32,
+        debounce: float = 1.0,
+        retry: float = 60.0
+    ):
+        """
+        Args:
+            embedder: Embedder di llama-server (`embed`, `embed_many`)
+            store: Archivio dei vettori
+            mirror: StateMirror (entità, aree, eventi)
+            api: Client Supervisor per la configurazione delle automazioni
+            docs_paths: Cartelle di documenti (.md, .txt) da indicizzare
+            batch_size: Testi per richiesta di embedding
+            debounce: Attesa per raggruppare le modifiche prima di indicizzare
+            retry: Attesa dopo un errore degli embedding
+        """
+        self.embedder = embedder
+        self.store = store
+        self.mirror = mirror
+        self.api = api
+        # I documenti caricati via API stanno accanto all'indice
+        self.uploads_path = os.path.join(store.directory, "documents")
+        self.docs_paths = [p for p in docs_paths if p] + [self.uploads_path]
+        self.batch_size = batch_size
+        self.debounce = debounce
+        self.retry = retry
+
+        self._lock = threading.Lock()
+        self._dirty: Set[str] = set()
+        self._in_progress = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._registry_version: Optional[int] = None
+        self._automation_configs: Dict[str, Dict[str, Any]] = {}
+
+        self.embedded = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.embedding_failures = 0
+        self.searches = 0
+        self.last_run: Optional[Dict[str, Any]] = None
+
+        if mirror is not None:
+            mirror.add_listener(self._on_state_changed)
+            mirror.subscribe("automation_reloaded", lambda data: self._on_automations_reloaded())
+
+    # ------------------------------------------------------------------
+    # Interfaccia
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Avvia l'indicizzazione in background (prima passata completa)."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="rag-index", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        """Indice in aggiornamento e non vuoto (un indice fermo su disco è vecchio)."""
+        return self._thread is not None and len(self.store) > 0
+
+    def reindex(self):
+        """Ricontrolla tutte le sorgenti; vengono ricalcolati solo i testi cambiati."""
+        self._mark(self._all_sources())
+
+    def add_document(self, doc_id: str, text: str, title: Optional[str] = None) -> int:
+        """
+        Salva un documento e lo mette in coda per l'indicizzazione.
+
+        Returns:
+            Numero di chunk del documento
+
+        Raises:
+            ValueError: Se l'ID o il testo non sono validi
+            RuntimeError: Se l'indicizzazione non è avviata
+        """
+        if self._thread is None:
+            raise RuntimeError("Indicizzazione RAG non avviata")
+        if not _DOCUMENT_ID_RE.match(doc_id or ""):
+            raise ValueError("'id' deve contenere solo lettere, cifre, '.', '-' e '_' (max 100)")
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError("'text' deve essere un testo non vuoto")
+        if title:
+            text = f"# {title}\n\n{text}"
+        os.makedirs(self.uploads_path, exist_ok=True)
+        path = os.path.join(self.uploads_path, f"{doc_id}.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        self._mark([f"document:{path}"])
+        return len(chunk_text(text, title or doc_id))
+
+    def remove_document(self, doc_id: str) -> bool:
+        """Elimina un documento caricato via API (i chunk vengono rimossi in background)."""
+        if not _DOCUMENT_ID_RE.match(doc_id or ""):
+            return False
+        path = os.path.join(self.uploads_path, f"{doc_id}.md")
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        self._mark([f"document:{path}"])
+        return True
+
+    def search(self, query: str, k: int = 8, kinds: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Chunk più simili alla domanda.
+
+        Returns:
+            {"id", "kind", "source", "text", "score"} in ordine di punteggio
+
+        Raises:
+            RuntimeError: Se l'embedding della domanda non è disponibile
+        """
+        vector = self.embedder.embed(query)
+        if vector is None:
+            raise RuntimeError("Embedding non disponibile")
+        with self._lock:
+            self.searches += 1
+        hits = []
+        for chunk_id, score in self.store.search(vector, k, kinds):
+            entry = self.store.get(chunk_id)
+            if entry is not None:
+                hits.append({
+                    "id": chunk_id,
+                    "kind": entry["kind"],
+                    "source": entry["source"],
+                    "text": entry["text"],
+                    "score": round(score, 4),
+                })
+        return hits
+
+    def context(self, query: str, k: int = 8) -> Optional[Dict[str, Any]]:
+        """
+        Blocco "CONTESTO PERTINENTE" per il prompt di una domanda.
+
+        Le entità riportano lo stato corrente (dal mirror), gli altri
+        chunk il proprio testo. I chunk molto meno simili del migliore
+        vengono scartati.
+
+        Returns:
+            {"text", "hits", "duration_ms"} o None se l'indice è vuoto o gli
+            embedding non sono disponibili
+        """
+        if not self.ready:
+            return None
+        started = time.perf_counter()
+        try:
+            hits = self.search(query, k)
+        except RuntimeError:
+            return None
+        if not hits:
+            return None
+        hits = [hit for hit in hits if hit["score"] >= hits[0]["score"] * RELATIVE_SCORE_CUTOFF]
+        lines = [self._render(hit) for hit in hits]
+        return {
+            "text": "CONTESTO PERTINENTE:\n" + "\n".join(lines),
+            "hits": [{"id": h["id"], "kind": h["kind"], "score": h["score"]} for h in hits],
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "pending": len(self._dirty) + self._in_progress,
+                "embedded": self.embedded,
+                "unchanged": self.unchanged,
+                "deleted": self.deleted,
+                "embedding_failures": self.embedding_failures,
+                "searches": self.searches,
+                "last_run": self.last_run,
+            }
+        stats.update({
+            "chunks": len(self.store),
+            "by_kind": self.store.count_by_kind(),
+            "dim": self.store.dim,
+            "size_bytes": self.store.size_bytes(),
+        })
+        return stats
+
+    # ------------------------------------------------------------------
+    # Indicizzazione
+    # ------------------------------------------------------------------
+
+    def _run(self):
+        if self.mirror is not None:
+            while not self.mirror.wait_ready(timeout=5):
+                if self._stop.is_set():
+                    return
+        self.reindex()
+        while not self._stop.is_set():
+            self._wake.wait(timeout=5.0)
+            self._wake.clear()
+            self._check_registry()
+            # Le modifiche arrivano a raffiche (riallineamento, reload): si raggruppano
+            if self._stop.wait(self.debounce):
+                break
+            with self._lock:
+                sources, self._dirty = self._dirty, set()
+                self._in_progress = len(sources)
+            ok = not sources or self._process(sources)
+            with self._lock:
+                self._in_progress = 0
+            if not ok:
+                self._stop.wait(self.retry)
+
+    def _process(self, sources: Set[str]) -> bool:
+        """
+        Ricalcola le sorgenti indicate.
+
+        Returns:
+            False se gli embedding non erano disponibili (sorgenti rimesse in coda)
+        """
+        started = time.perf_counter()
+        members = self._area_members() if any(s.startswith("area:") for s in sources) else {}
+        pending: List[Dict[str, Any]] = []
+        deleted = unchanged = 0
+        for source in sources:
+            try:
+                chunks = self._build(source, members)
+            except Exception as e:
+                logger.warning(f"⚠️ Indicizzazione di {source} fallita: {e}")
+                continue
+            wanted = {chunk_id for chunk_id, _, _ in chunks}
+            deleted += self.store.delete([cid for cid in self.store.ids(source) if cid not in wanted])
+            for chunk_id, kind, text in chunks:
+                digest = text_hash(text)
+                current = self.store.get(chunk_id)
+                if current is not None and current["hash"] == digest:
+                    unchanged += 1
+                    continue
+                pending.append({"id": chunk_id, "kind": kind, "source": source, "text": text, "hash": digest})
+
+        embedded, ok = 0, True
+        for i in range(0, len(pending), self.batch_size):
+            batch = pending[i:i + self.batch_size]
+            vectors = self.embedder.embed_many([entry["text"] for entry in batch])
+            if vectors is None:
+                # Embedding non disponibili (es. modello in caricamento): si riprova
+                self._mark(entry["source"] for entry in pending[i:])
+                ok = False
+                break
+            self.store.upsert(batch, vectors)
+            embedded += len(batch)
+        self.store.flush()
+
+        duration = time.perf_counter() - started
+        with self._lock:
+            self.embedded += embedded
+            self.unchanged += unchanged
+            self.deleted += deleted
+            if not ok:
+                self.embedding_failures += 1
+            self.last_run = {
+                "sources": len(sources),
+                "embedded": embedded,
+                "unchanged": unchanged,
+                "deleted": deleted,
+                "duration_s": round(duration, 2),
+            }
+        if embedded or deleted:
+            logger.info(f"🧭 Indice RAG aggiornato: {embedded} chunk calcolati, {deleted} rimossi, "
+                        f"{unchanged} invariati in {duration:.1f}s")
+        return ok
+
+    def _build(self, source: str, members: Dict[str, List[str]]) -> List[Tuple[str, str, str]]:
+        """Chunk (id, tipo, testo) di una sorgente; vuoto se la sorgente non esiste più."""
+        kind, _, key = source.partition(":")
+        if kind == "document":
+            return self._document_chunks(source, key)
+        if self.mirror is None:
+            return []
+        if kind == "area":
+            name = self.mirror.get_areas().get(key)
+            if not name:
+                return []
+            names = sorted(members.get(key, []))
+            text = f"Area {name}: {len(names)} entità"
+            if names:
+                text += " (" + ", ".join(names[:MAX_AREA_MEMBERS]) + (", ..." if len(names) > MAX_AREA_MEMBERS else "") + ")"
+            return [(source, "area", text)]
+        state = self.mirror.get_state(key)
+        if state is None:
+            return []
+        if kind == "automation":
+            return [(source, "automation", self._automation_text(state))]
+        return [(source, "entity", self._entity_text(state))]
+
+    def _entity_text(self, state: Dict[str, Any]) -> str:
+        entity_id = state["entity_id"]
+        attributes = state.get("attributes") or {}
+        parts = [f"{attributes.get('friendly_name') or entity_id} ({entity_id})", f"dominio {entity_id.split('.', 1)[0]}"]
+        if attributes.get("device_class"):
+            parts.append(f"tipo {attributes['device_class']}")
+        area = self.mirror.get_areas().get(self.mirror.get_area(entity_id))
+        if area:
+            parts.append(f"area {area}")
+        if attributes.get("unit_of_measurement"):
+            parts.append(f"unità {attributes['unit_of_measurement']}")
+        return ", ".join(parts)
+
+    def _automation_text(self, state: Dict[str, Any]) -> str:
+        entity_id = state["entity_id"]
+        attributes = state.get("attributes") or {}
+        config = self._automation_config(attributes.get("id"))
+        text = f"{config.get('alias') or attributes.get('friendly_name') or entity_id} ({entity_id}), automazione"
+        if config.get("description"):
+            text += f": {config['description']}"
+        for label, keys in (("Quando", ("triggers", "trigger")), ("Azioni", ("actions", "action"))):
+            value = next((config[key] for key in keys if config.get(key)), None)
+            if value:
+                text += f". {label}: {json.dumps(value, ensure_ascii=False, separators=(',', ':'))[:300]}"
+        return text[:MAX_CHUNK_CHARS]
+
+    def _automation_config(self, automation_id: Optional[str]) -> Dict[str, Any]:
+        """Configurazione dell'automazione (alias, descrizione, trigger, azioni), in cache."""
+        if not automation_id or self.api is None:
+            return {}
+        with self._lock:
+            cached = self._automation_configs.get(automation_id)
+        if cached is not None:
+            return cached
+        try:
+            config = self.api.get(f"/config/automation/config/{automation_id}") or {}
+        except Exception as e:
+            # Automazioni in YAML senza id o API non raggiungibile: solo il nome
+            logger.debug(f"Configurazione automazione {automation_id} non disponibile: {e}")
+            config = {}
+        with self._lock:
+            self._automation_configs[automation_id] = config
+        return config
+
+    def _document_chunks(self, source: str, path: str) -> List[Tuple[str, str, str]]:
+        try:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return []
+        title = os.path.splitext(os.path.basename(path))[0]
+        return [(f"{source}#{i}", "document", chunk) for i, chunk in enumerate(chunk_text(text, title))]
+
+    def _all_sources(self) -> Set[str]:
+        # Anche le sorgenti già indicizzate: quelle sparite vengono rimosse
+        sources = set(self.store.sources())
+        if self.mirror is not None:
+            for state in self.mirror.get_states():
+                sources.add(_state_source(state["entity_id"]))
+            sources.update(f"area:{area_id}" for area_id in self.mirror.get_areas())
+        for directory in self.docs_paths:
+            for root, _, files in os.walk(directory):
+                sources.update(
+                    f"document:{os.path.join(root, name)}" for name in files if name.endswith(DOCUMENT_SUFFIXES)
+                )
+        return sources
+
+    def _area_members(self) -> Dict[str, List[str]]:
+        members: Dict[str, List[str]] = defaultdict(list)
+        for state in self.mirror.get_states():
+            area_id = self.mirror.get_area(state["entity_id"])
+            if area_id:
+                members[area_id].append((state.get("attributes") or {}).get("friendly_name") or state["entity_id"])
+        return members
+
+    def _check_registry(self):
+        """Registri cambiati (aree, nomi): si ricontrollano entità e aree."""
+        if self.mirror is None or self.mirror.registry_version == self._registry_version:
+            return
+        self._registry_version = self.mirror.registry_version
+        self._mark(s for s in self._all_sources() if not s.startswith("document:"))
+
+    def _mark(self, sources: Iterable[str]):
+        with self._lock:
+            self._dirty.update(sources)
+        self._wake.set()
+
+    def _on_state_changed(self, entity_id: str, old_state, new_state):
+        # Lo stato non è nel testo indicizzato: contano solo nome, tipo e unità
+        if old_state is not None and new_state is not None and _descriptor(old_state) == _descriptor(new_state):
+            return
+        sources = [_state_source(entity_id)]
+        area_id = self.mirror.get_area(entity_id)
+        if area_id:
+            sources.append(f"area:{area_id}")
+        self._mark(sources)
+
+    def _on_automations_reloaded(self):
+        with self._lock:
+            self._automation_configs.clear()
+        self._mark(f"automation:{s['entity_id']}" for s in self.mirror.get_states("automation"))
+
+    def _render(self, hit: Dict[str, Any]) -> str:
+        if hit["kind"] in ("entity", "automation") and self.mirror is not None:
+            state = self.mirror.get_state(hit["source"].split(":", 1)[1])
+            if state is not None:
+                attributes = state.get("attributes") or {}
+                unit = attributes.get("unit_of_measurement")
+                value = f"{state.get('state')} {unit}" if unit else str(state.get("state"))
+                return f"- {hit['text']} = {value}"
+        return "- " + hit["text"].replace("\n", ": ", 1).replace("\n", " ")
+
+
+def _state_source(entity_id: str) -> str:
+    return f"{'automation' if entity_id.startswith('automation.') else 'entity'}:{entity_id}"
+
+
+def _descriptor(state: Dict[str, Any]) -> Tuple[Any, ...]:
+    attributes = state.get("attributes") or {}
+    return attributes.get("friendly_name"), attributes.get("device_class"), attributes.get("unit_of_measurement")
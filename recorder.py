@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Accesso al recorder di Home Assistant: storia degli stati e statistiche.
+
+- Storia: `GET /api/history/period/<inizio>` (REST) con `minimal_response`
+  e `no_attributes`, una sola entità per richiesta;
+- statistiche a lungo termine (medie orarie/giornaliere, somme dei
+  contatori): `recorder/statistics_during_period`, disponibile solo sulla
+  WebSocket API. Usa una connessione dedicata, aperta alla prima richiesta
+  e separata da quella del mirror degli stati.
+"""
+
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Tuple
+
+import websocket
+
+from supervisor_api import SupervisorAPI
+
+logger = logging.getLogger(__name__)
+
+# Storie lunghe (giorni di un sensore al minuto) superano il timeout standard
+HISTORY_TIMEOUT = (5, 60)
+
+STATISTIC_PERIODS = ("5minute", "hour", "day", "week", "month")
+
+
+def to_iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def parse_timestamp(value: Any) -> float:
+    """Timestamp di HA (ISO 8601 o millisecondi epoch) in secondi epoch."""
+    if isinstance(value, (int, float)):
+        return value / 1000.0
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+
+
+class RecorderClient:
+    """Storia e statistiche dal recorder, via Supervisor."""
+
+    def __init__(self, api: SupervisorAPI, ws_timeout: float = 30.0):
+        """
+        Args:
+            api: Client Supervisor (URL REST/WebSocket e token)
+            ws_timeout: Attesa massima di una risposta WebSocket in secondi
+        """
+        self.api = api
+        self.ws_timeout = ws_timeout
+        # Contatori e connessione separati: le statistiche non aspettano
+        # una risposta WebSocket in corso
+        self._lock = threading.Lock()
+        self._ws_lock = threading.Lock()
+        self._ws = None
+        self._msg_id = 0
+
+        self.history_requests = 0
+        self.history_rows = 0
+        self.statistics_requests = 0
+
+    def history(self, entity_id: str, start: float, end: float) -> List[Tuple[float, str]]:
+        """
+        Cambi di stato di un'entità nell'intervallo.
+
+        Il primo elemento è lo stato in vigore a `start` (HA lo riporta
+        con `last_changed` pari all'inizio dell'intervallo).
+
+        Args:
+            entity_id: Entità
+            start: Inizio (secondi epoch)
+            end: Fine (secondi epoch)
+
+        Returns:
+            Lista di (timestamp, stato) in ordine di tempo
+
+        Raises:
+            requests.exceptions.RequestException: In caso di errore HTTP
+        """
+        result = self.api.get(
+            f"/history/period/{to_iso(start)}",
+            params={
+                "filter_entity_id": entity_id,
+                "end_time": to_iso(end),
+                "minimal_response": "",
+                "no_attributes": "",
+                "significant_changes_only": "0",
+            },
+            timeout=HISTORY_TIMEOUT,
+        )
+        rows = result[0] if result else []
+        points = [
+            (parse_timestamp(row.get("last_changed") or row.get("last_updated")), row.get("state"))
+            for row in rows
+            if row.get("last_changed") or row.get("last_updated")
+        ]
+        with self._lock:
+            self.history_requests += 1
+            self.history_rows += len(points)
+        return points
+
+    def statistics(
+        self,
+        statistic_ids: Iterable[str],
+        start: float,
+        end: float,
+        period: str = "hour",
+        types: Iterable[str] = ("mean", "min", "max", "change")
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Statistiche a lungo termine (`recorder/statistics_during_period`).
+
+        Args:
+            statistic_ids: ID delle statistiche (per i sensori, l'entity_id)
+            start: Inizio (secondi epoch)
+            end: Fine (secondi epoch)
+            period: "5minute", "hour", "day", "week" o "month"
+            types: Valori richiesti ("mean", "min", "max", "sum", "state", "change")
+
+        Returns:
+            statistic_id → righe {"start", "end", "mean", ...} con start/end in secondi epoch
+
+        Raises:
+            ValueError: Se il periodo non è valido
+            RuntimeError: Se Home Assistant risponde con un errore
+        """
+        if period not in STATISTIC_PERIODS:
+            raise ValueError(f"Periodo non valido: {period}")
+        result = self._call({
+            "type": "recorder/statistics_during_period",
+            "start_time": to_iso(start),
+            "end_time": to_iso(end),
+            "statistic_ids": list(statistic_ids),
+            "period": period,
+            "types": list(types),
+        }) or {}
+        with self._lock:
+            self.statistics_requests += 1
+        for rows in result.values():
+            for row in rows:
+                row["start"] = parse_timestamp(row["start"])
+                if row.get("end") is not None:
+                    row["end"] = parse_timestamp(row["end"])
+        return result
+
+    def _call(self, payload: Dict[str, Any]) -> Any:
+        """Comando sulla connessione dedicata; riconnette una volta se è caduta."""
+        with self._ws_lock:
+            for attempt in (1, 2):
+                try:
+                    if self._ws is None:
+                        self._connect()
+                    self._msg_id += 1
+                    msg_id = self._msg_id
+                    self._ws.send(json.dumps(dict(payload, id=msg_id)))
+                    while True:
+                        message = json.loads(self._ws.recv())
+                        if message.get("id") == msg_id and message.get("type") == "result":
+                            break
+                except (OSError, websocket.WebSocketException) as e:
+                    self._close()
+                    if attempt == 2:
+                        raise
+                    logger.debug(f"Connessione recorder persa ({e}), nuovo tentativo")
+                    continue
+                if not message.get("success"):
+                    raise RuntimeError(f"{payload['type']}: {message.get('error')}")
+                return message.get("result")
+
+    def _connect(self):
+        self._ws = websocket.create_connection(self.api.ws_url, timeout=self.ws_timeout)
+        self._msg_id = 0
+        try:
+            message = json.loads(self._ws.recv())
+            if message.get("type") != "auth_required":
+                raise websocket.WebSocketException(f"Handshake inatteso: {message}")
+            self._ws.send(json.dumps({"type": "auth", "access_token": self.api.token}))
+            message = json.loads(self._ws.recv())
+            if message.get("type") != "auth_ok":
+                raise RuntimeError(f"Autenticazione WebSocket fallita: {message}")
+        except Exception:
+            # Mai riusare una connessione non autenticata
+            self._close()
+            raise
+
+    def _close(self):
+        if self._ws is not None:
+            try:
+                self._ws.close()
+            except Exception:
+                pass
+            self._ws = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "history_requests": self.history_requests,
+                "history_rows": self.history_rows,
+                "statistics_requests": self.statistics_requests,
+                # Lettura senza _ws_lock: non attende i comandi in corso
+                "connected": self._ws is not None,
+            }
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Cache delle risposte di `/api/chat`.
+
+Le automazioni fanno spesso la stessa domanda con lo stesso contesto:
+invece di rigenerare la risposta, la si restituisce dalla cache.
+
+Due livelli:
+- esatto: chiave su messaggio normalizzato, parametri di campionamento
+  e impronta del contesto (il prompt senza la domanda);
+- semantico (opzionale): embedding del messaggio calcolato con
+  `/embedding` di llama-server e ricerca per similarità coseno tra le
+  risposte con stessi parametri e stesso contesto.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import requests
+
+logger = logging.getLogger(__name__)
+
+_SPACES_RE = re.compile(r"\s+")
+
+# Dopo un errore di /embedding il livello semantico resta spento per un po'
+EMBEDDING_RETRY_SECONDS = 300
+
+# Più testi in una richiesta: la risposta arriva dopo tutti gli embedding
+EMBEDDING_BATCH_TIMEOUT = (2, 60)
+
+
+def normalize_message(text: str) -> str:
+    """Minuscole, spazi compattati, punteggiatura finale rimossa."""
+    return _SPACES_RE.sub(" ", text.strip().lower()).rstrip(" ?!.")
+
+
+def context_fingerprint(messages: List[Dict[str, Any]], user_message: str) -> str:
+    """
+    Impronta del prompt esclusa la domanda dell'utente.
+
+    La domanda è sempre in coda all'ultimo messaggio: togliendola resta
+    il contesto (istruzioni, catalogo, stati) effettivamente visto dal
+    modello, che cambia con lo stato della casa.
+    """
+    parts = [m.get("content", "") for m in messages]
+    if parts and parts[-1].endswith(user_message):
+        parts[-1] = parts[-1][:len(parts[-1]) - len(user_message)]
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+class Embedder:
+    """Embedding dei testi tramite `/embedding` di llama-server (con cache)."""
+
+    def __init__(self, pool, llama_url: str, cache_size: int = 256):
+        """
+        Inizializza l'embedder.
+
+        Args:
+            pool: HTTPPool condiviso
+            llama_url: URL base di llama-server
+            cache_size: Numero massimo di embedding memorizzati
+        """
+        self.pool = pool
+        self.llama_url = llama_url
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disabled_until = 0.0
+        self.calls = 0
+        self.errors = 0
+
+    def embed(self, text: str) -> Optional[np.ndarray]:
+        """
+        Vettore normalizzato del testo.
+
+        Returns:
+            Vettore float32 di norma 1, o None se `/embedding` non è
+            disponibile (llama-server avviato senza supporto embedding)
+        """
+        with self._lock:
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+                return vector
+            if time.time() < self._disabled_until:
+                return None
+
+        try:
+            response = self.pool.post(
+                f"{self.llama_url}/embedding", endpoint="llama_embedding", json={"content": text}
+            )
+            response.raise_for_status()
+            vector = np.asarray(_parse_embedding(response.json()), dtype=np.float32)
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+            self._failed(e)
+            return None
+
+        norm = float(np.linalg.norm(vector))
+        if norm > 0:
+            vector /= norm
+        with self._lock:
+            self.calls += 1
+            self._cache[text] = vector
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return vector
+
+    def embed_many(self, texts: List[str]) -> Optional[np.ndarray]:
+        """
+        Vettori normalizzati di più testi con una sola richiesta (`/v1/embeddings`).
+
+        Returns:
+            Matrice float32 (testi × dimensione) con righe di norma 1, o
+            None se gli embedding non sono disponibili
+        """
+        with self._lock:
+            if time.time() < self._disabled_until:
+                return None
+        try:
+            response = self.pool.post(
+                f"{self.llama_url}/v1/embeddings",
+                endpoint="llama_embedding",
+                json={"input": texts},
+                timeout=EMBEDDING_BATCH_TIMEOUT
+            )
+            response.raise_for_status()
+            data = sorted(response.json()["data"], key=lambda item: item["index"])
+            matrix = np.asarray([item["embedding"] for item in data], dtype=np.float32)
+            if matrix.ndim != 2 or matrix.shape[0] != len(texts):
+                raise ValueError(f"attesi {len(texts)} embedding, ricevuti {len(data)}")
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+            self._failed(e)
+            return None
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms > 0, norms, 1.0)
+        with self._lock:
+            self.calls += 1
+        return matrix
+
+    def _failed(self, error: Exception):
+        with self._lock:
+            self.errors += 1
+            self._disabled_until = time.time() + EMBEDDING_RETRY_SECONDS
+        logger.warning(
+            f"⚠️ Embedding non disponibile, nuovo tentativo tra {EMBEDDING_RETRY_SECONDS}s: {error}"
+        )
+
+
+def _parse_embedding(payload: Any) -> List[float]:
+    # Formati di /embedding: {"embedding": [...]} oppure
+    # [{"index": 0, "embedding": [[...]]}] nelle versioni recenti
+    # (o {"data": [{"embedding": [...]}]} come /v1/embeddings)
+    if isinstance(payload, dict) and "data" in payload:
+        payload = payload["data"]
+    if isinstance(payload, list):
+        payload = payload[0]
+    vector = payload["embedding"]
+    if vector and isinstance(vector[0], list):
+        vector = vector[0]
+    if not vector:
+        raise ValueError("embedding vuoto")
+    return vector
+
+
+class _Entry:
+    __slots__ = ("response", "usage", "created_at", "group", "row")
+
+    def __init__(self, response: str, usage: Dict[str, Any], group: str, row: Optional[int]):
+        self.response = response
+        self.usage = usage
+        self.created_at = time.time()
+        self.group = group
+        self.row = row
+
+
+class ResponseCache:
+    """
+    Cache LRU con scadenza delle risposte del modello.
+
+    Gli embedding sono righe di una matrice preallocata: la ricerca
+    semantica è un solo prodotto matrice-vettore.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        ttl: float = 3600,
+        embedder: Optional[Embedder] = None,
+        similarity: float = 0.95
+    ):
+        """
+        Inizializza la cache.
+
+        Args:
+            max_entries: Risposte massime conservate
+            ttl: Validità di una risposta in secondi
+            embedder: Embedder per il livello semantico (None = solo esatto)
+            similarity: Similarità coseno minima per un hit semantico
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embedder = embedder
+        self.similarity = similarity
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._vectors: Optional[np.ndarray] = None
+        self._row_keys: List[Optional[str]] = [None] * max_entries
+        self._free_rows = list(range(max_entries - 1, -1, -1))
+
+        self.hits_exact = 0
+        self.hits_semantic = 0
+        self.misses = 0
+        self.evictions = {"lru": 0, "ttl": 0}
+        self.lookup_time = 0.0
+
+    @staticmethod
+    def _group(params: Dict[str, Any], fingerprint: str) -> str:
+        return hashlib.sha1(
+            (json.dumps(params, sort_keys=True) + fingerprint).encode("utf-8")
+        ).hexdigest()
+
+    @staticmethod
+    def _key(normalized: str, group: str) -> str:
+        return hashlib.sha1(f"{group}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    def lookup(
+        self,
+        message: str,
+        params: Dict[str, Any],
+        fingerprint: str
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Cerca una risposta per il messaggio.
+
+        Args:
+            message: Messaggio dell'utente
+            params: Parametri di campionamento (temperature, max_tokens, ...)
+            fingerprint: Impronta del contesto (`context_fingerprint`)
+
+        Returns:
+            {"response", "usage", "tier", "similarity", "age_s"} o None
+        """
+        started = time.perf_counter()
+        normalized = normalize_message(message)
+        group = self._group(params, fingerprint)
+        key = self._key(normalized, group)
+
+        with self._lock:
+            entry = self._get_locked(key)
+            if entry is not None:
+                self.hits_exact += 1
+                self.lookup_time += time.perf_counter() - started
+                return self._result(entry, "exact", 1.0)
+
+        vector = self.embedder.embed(normalized) if self.embedder and self.similarity > 0 else None
+        with self._lock:
+            if vector is not None and self._vectors is not None and len(vector) == self._vectors.shape[1]:
+                scores = self._vectors @ vector
+                for row in np.argsort(-scores):
+                    score = float(scores[row])
+                    if score < self.similarity:
+                        break
+                    candidate_key = self._row_keys[row]
+                    candidate = self._entries.get(candidate_key) if candidate_key else None
+                    if candidate is None or candidate.group != group:
+                        continue
+                    if self._get_locked(candidate_key) is None:
+                        continue
+                    self.hits_semantic += 1
+                    self.lookup_time += time.perf_counter() - started
+                    return self._result(candidate, "semantic", score)
+            self.misses += 1
+            self.lookup_time += time.perf_counter() - started
+            return None
+
+    def store(
+        self,
+        message: str,
+        params: Dict[str, Any],
+        fingerprint: str,
+        response: str,
+        usage: Optional[Dict[str, Any]] = None
+    ):
+        """Memorizza la risposta generata per il messaggio."""
+        normalized = normalize_message(message)
+        group = self._group(params, fingerprint)
+        key = self._key(normalized, group)
+        vector = self.embedder.embed(normalized) if self.embedder and self.similarity > 0 else None
+
+        with self._lock:
+            self._remove_locked(key)
+            while len(self._entries) >= self.max_entries:
+                self._remove_locked(next(iter(self._entries)))
+                self.evictions["lru"] += 1
+
+            row = None
+            if vector is not None:
+                if self._vectors is None or self._vectors.shape[1] != len(vector):
+                    # Primo vettore (o modello cambiato): si alloca la matrice
+                    self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                row = self._free_rows.pop()
+                self._vectors[row] = vector
+                self._row_keys[row] = key
+            self._entries[key] = _Entry(response, usage or {}, group, row)
+
+    def invalidate(self) -> int:
+        """
+        Svuota la cache.
+
+        Returns:
+            Numero di risposte rimosse
+        """
+        with self._lock:
+            removed = len(self._entries)
+            for key in list(self._entries):
+                self._remove_locked(key)
+            return removed
+
+    def _get_locked(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry.created_at > self.ttl:
+            self._remove_locked(key)
+            self.evictions["ttl"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove_locked(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.row is not None:
+            self._vectors[entry.row] = 0
+            self._row_keys[entry.row] = None
+            self._free_rows.append(entry.row)
+
+    @staticmethod
+    def _result(entry: _Entry, tier: str, similarity: float) -> Dict[str, Any]:
+        return {
+            "response": entry.response,
+            "usage": entry.usage,
+            "tier": tier,
+            "similarity": round(similarity, 4),
+            "age_s": round(time.time() - entry.created_at, 1),
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits_exact + self.hits_semantic + self.misses
+            hits = self.hits_exact + self.hits_semantic
+            stats = {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits_exact": self.hits_exact,
+                "hits_semantic": self.hits_semantic,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "lookup_avg_ms": round(1000 * self.lookup_time / lookups, 2) if lookups else 0.0,
+                "evictions": dict(self.evictions),
+                "semantic": self.embedder is not None and self.similarity > 0,
+            }
+        if self.embedder is not None:
+            stats["embedding_calls"] = self.embedder.calls
+            stats["embedding_errors"] = self.embedder.errors
+        return stats
@@ -15,11 +15,70 @@ LOG_LEVEL=$(bashio::config 'log_level')
 
 MODEL_PATH="/data/models/${MODEL_NAME}.gguf"
 
-# Download del modello se non esiste
+# Fasi di avvio lette da ha_service per /api/health
+export ADDON_STATUS_FILE="/tmp/llamacpp_status.json"
+
+write_status() {
+    # $1 = fase, $2 = byte attesi (opzionale), $3 = errore (opzionale)
+    printf '{"phase": "%s", "model": "%s", "partial_path": "%s", "total_bytes": %s, "error": "%s", "at": %s}\n' \
+        "$1" "$MODEL_NAME" "${MODEL_PATH}.part" "${2:-0}" "${3:-}" "$(date +%s)" > "${ADDON_STATUS_FILE}.tmp"
+    mv "${ADDON_STATUS_FILE}.tmp" "$ADDON_STATUS_FILE"
+}
+
+write_status "starting"
+
+# Avvia subito il servizio Home Assistant: risponde su /api/health durante
+# download e caricamento e prepara in parallelo le cache HA
+bashio::log.info "Avvio servizio Home Assistant API..."
+# Il prefisso [HA-SERVICE] è già nel formato dei log: nessuna pipe per riga
+python3 /ha_service.py &
+HA_SERVICE_PID=$!
+bashio::log.info "Servizio HA avviato con PID: ${HA_SERVICE_PID}"
+
+# Indice RAG con modello di embedding dedicato: secondo llama-server sulla
+# porta 8081 (solo locale), scaricato e avviato in background
+RAG_MODEL_URL=$(bashio::config 'rag_embedding_model_url')
+if bashio::config.true 'rag_index' && [ -n "$RAG_MODEL_URL" ] && [ "$RAG_MODEL_URL" != "null" ]; then
+    RAG_MODEL_PATH="/data/models/embedding-$(basename "${RAG_MODEL_URL%%\?*}")"
+    (
+        if [ ! -f "$RAG_MODEL_PATH" ]; then
+            bashio::log.info "Download modello di embedding da ${RAG_MODEL_URL}..."
+            mkdir -p /data/models
+            curl -sL --fail --retry 5 --retry-delay 2 -C - -o "${RAG_MODEL_PATH}.part" "$RAG_MODEL_URL" \
+                || { bashio::log.error "Download del modello di embedding fallito"; exit 1; }
+            mv "${RAG_MODEL_PATH}.part" "$RAG_MODEL_PATH"
+        fi
+        bashio::log.info "Avvio llama-server di embedding: ${RAG_MODEL_PATH}"
+        # ubatch pari al contesto: ogni testo viene valutato in un solo passo
+        exec llama-server \
+            --model "$RAG_MODEL_PATH" \
+            --embeddings \
+            --ctx-size 2048 \
+            --batch-size 2048 \
+            --ubatch-size 2048 \
+            --threads "$THREADS" \
+            --host 127.0.0.1 \
+            --port 8081
+    ) &
+fi
+
+# Download del modello se non esiste (ripreso se interrotto)
 if [ ! -f "$MODEL_PATH" ]; then
     bashio::log.info "Download modello da ${MODEL_URL}..."
     mkdir -p /data/models
-    curl -L -o "$MODEL_PATH" "$MODEL_URL"
+    TOTAL_BYTES=$(curl -sIL "$MODEL_URL" | tr -d '\r' | awk 'tolower($1) == "content-length:" { size = $2 } END { print size + 0 }')
+    write_status "downloading" "$TOTAL_BYTES"
+    if command -v aria2c > /dev/null 2>&1; then
+        # Più connessioni in parallelo sullo stesso file
+        aria2c --quiet=true --continue=true --max-connection-per-server=8 --split=8 \
+            --min-split-size=16M --file-allocation=none --max-tries=5 --retry-wait=2 \
+            --dir="$(dirname "$MODEL_PATH")" --out="$(basename "$MODEL_PATH").part" "$MODEL_URL" \
+            || { write_status "failed" "$TOTAL_BYTES" "Download del modello fallito"; exit 1; }
+    else
+        curl -L --fail --retry 5 --retry-delay 2 -C - -o "${MODEL_PATH}.part" "$MODEL_URL" \
+            || { write_status "failed" "$TOTAL_BYTES" "Download del modello fallito"; exit 1; }
+    fi
+    mv "${MODEL_PATH}.part" "$MODEL_PATH"
     bashio::log.info "Download completato: ${MODEL_PATH}"
 else
     bashio::log.info "Modello già presente: ${MODEL_PATH}"
@@ -28,17 +87,11 @@ fi
 # Verifica che il modello esista
 if [ ! -f "$MODEL_PATH" ]; then
     bashio::log.error "Modello non trovato: ${MODEL_PATH}"
+    write_status "failed" 0 "Modello non trovato"
     exit 1
 fi
 
-# Avvia il servizio Home Assistant in background
-bashio::log.info "Avvio servizio Home Assistant API..."
-python3 /ha_service.py 2>&1 | sed 's/^/[HA-SERVICE] /' &
-HA_SERVICE_PID=$!
-bashio::log.info "Servizio HA avviato con PID: ${HA_SERVICE_PID}"
-
-# Aspetta che il servizio sia pronto
-sleep 2
+write_status "loading"
 
 # Avvia llama-server con configurazione
 bashio::log.info "Avvio llama-server..."
@@ -55,4 +108,3 @@ exec llama-server \
     --host 0.0.0.0 \
     --port 8080 \
     --jinja
-    --jinja
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Chiamate di servizio HA in blocco per `/api/ha/service/call/batch`.
+
+Le chiamate compatibili (stesso dominio, servizio e dati) vengono unite in
+un'unica chiamata con più entity_id: "spegni 30 luci" diventa una sola
+richiesta al Supervisor. Le chiamate che restano vengono eseguite in
+parallelo, con un numero limitato di thread; quelle che toccano le stesse
+entità restano in ordine, come in `ToolAgent.execute`.
+
+Un'unione non scavalca mai un'altra chiamata sulla stessa entità:
+[a off, a on, b off] diventa "off a,b" poi "on a", mentre
+[a off, a on, a off] resta di tre chiamate.
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Chiamate massime per richiesta
+MAX_BATCH_CALLS = 200
+
+
+class ServiceCall:
+    """Una chiamata della richiesta, validata."""
+
+    __slots__ = ("index", "domain", "service", "entity_ids", "data")
+
+    def __init__(self, index: int, domain: str, service: str, entity_ids: List[str], data: Dict[str, Any]):
+        self.index = index
+        self.domain = domain
+        self.service = service
+        self.entity_ids = entity_ids
+        self.data = data
+
+    @classmethod
+    def from_dict(cls, index: int, raw: Any) -> "ServiceCall":
+        """
+        Raises:
+            ValueError: Se la chiamata non è valida
+        """
+        if not isinstance(raw, dict):
+            raise ValueError(f"calls[{index}]: deve essere un oggetto")
+        domain, service = raw.get("domain"), raw.get("service")
+        if not isinstance(domain, str) or not domain or not isinstance(service, str) or not service:
+            raise ValueError(f"calls[{index}]: campi 'domain' e 'service' richiesti")
+        entity_id = raw.get("entity_id")
+        if isinstance(entity_id, str):
+            entity_ids = [e.strip() for e in entity_id.split(",") if e.strip()]
+        elif isinstance(entity_id, list) and all(isinstance(e, str) for e in entity_id):
+            entity_ids = [e for e in entity_id if e]
+        elif entity_id is None:
+            entity_ids = []
+        else:
+            raise ValueError(f"calls[{index}]: 'entity_id' deve essere una stringa o una lista")
+        data = raw.get("data") or {}
+        if not isinstance(data, dict):
+            raise ValueError(f"calls[{index}]: 'data' deve essere un oggetto")
+        return cls(index, domain, service, entity_ids, data)
+
+    @property
+    def merge_key(self) -> Tuple[str, str, str]:
+        return self.domain, self.service, json.dumps(self.data, sort_keys=True, default=str)
+
+
+class Dispatch:
+    """Una chiamata verso HA: una o più chiamate della richiesta unite."""
+
+    __slots__ = ("index", "calls", "entity_ids")
+
+    def __init__(self, index: int, call: ServiceCall):
+        self.index = index
+        self.calls = [call]
+        self.entity_ids = list(dict.fromkeys(call.entity_ids))
+
+    def add(self, call: ServiceCall):
+        self.calls.append(call)
+        seen = set(self.entity_ids)
+        self.entity_ids.extend(e for e in dict.fromkeys(call.entity_ids) if e not in seen)
+
+
+def plan(calls: List[ServiceCall], merge: bool = True) -> List[List[Dispatch]]:
+    """
+    Raggruppa le chiamate in dispatch e i dispatch in catene.
+
+    Args:
+        calls: Chiamate della richiesta, in ordine
+        merge: Se False ogni chiamata resta un dispatch a sé
+
+    Returns:
+        Catene di dispatch: ogni catena va eseguita in ordine, catene
+        diverse possono andare in parallelo
+    """
+    dispatches: List[Dispatch] = []
+    open_by_key: Dict[Tuple[str, str, str], Dispatch] = {}
+    last_touch: Dict[str, int] = {}
+    for call in calls:
+        target = open_by_key.get(call.merge_key) if merge and call.entity_ids else None
+        # Unione solo se nessun dispatch successivo ha toccato le stesse entità
+        if target is not None and all(last_touch.get(e, -1) <= target.index for e in call.entity_ids):
+            target.add(call)
+        else:
+            target = Dispatch(len(dispatches), call)
+            dispatches.append(target)
+            if call.entity_ids:
+                open_by_key[call.merge_key] = target
+        for entity_id in call.entity_ids:
+            last_touch[entity_id] = target.index
+
+    # Catene: union-find sui dispatch che condividono entità
+    parent = list(range(len(dispatches)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owner: Dict[str, int] = {}
+    for dispatch in dispatches:
+        for entity_id in dispatch.entity_ids:
+            if entity_id in owner:
+                parent[find(dispatch.index)] = find(owner[entity_id])
+            else:
+                owner[entity_id] = dispatch.index
+
+    chains: Dict[int, List[Dispatch]] = {}
+    for dispatch in dispatches:
+        chains.setdefault(find(dispatch.index), []).append(dispatch)
+    return list(chains.values())
+
+
+class ServiceBatcher:
+    """Esegue blocchi di chiamate di servizio con unione e parallelismo limitato."""
+
+    def __init__(
+        self,
+        client,
+        max_workers: int = 8,
+        on_service_call: Optional[Callable[[str, str], None]] = None
+    ):
+        """
+        Args:
+            client: Client HA (espone `call_service`)
+            max_workers: Chiamate verso HA in parallelo al massimo
+            on_service_call: Callback (dominio, servizio) dopo ogni dispatch
+                riuscito (es. invalidazione delle cache)
+        """
+        self.client = client
+        self.max_workers = max(1, max_workers)
+        self.on_service_call = on_service_call
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ha-service-batch")
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.calls = 0
+        self.dispatches = 0
+        self.errors = 0
+
+    def run(self, raw_calls: Any, merge: bool = True) -> Dict[str, Any]:
+        """
+        Esegue un blocco di chiamate.
+
+        Args:
+            raw_calls: Lista di {"domain", "service", "entity_id", "data"}
+            merge: Unisce le chiamate compatibili
+
+        Returns:
+            {"success", "results", "calls", "dispatches", "duration_ms"}; i
+            risultati sono nello stesso ordine delle chiamate
+
+        Raises:
+            ValueError: Se la richiesta non è valida
+        """
+        if not isinstance(raw_calls, list) or not raw_calls:
+            raise ValueError("'calls' deve essere una lista non vuota")
+        if len(raw_calls) > MAX_BATCH_CALLS:
+            raise ValueError(f"Al massimo {MAX_BATCH_CALLS} chiamate per richiesta")
+        calls = [ServiceCall.from_dict(i, raw) for i, raw in enumerate(raw_calls)]
+
+        started = time.perf_counter()
+        chains = plan(calls, merge)
+        results: List[Optional[Dict[str, Any]]] = [None] * len(calls)
+
+        def run_chain(chain: List[Dispatch]):
+            for dispatch in chain:
+                for call, result in zip(dispatch.calls, self._dispatch(dispatch)):
+                    results[call.index] = result
+
+        if len(chains) == 1:
+            run_chain(chains[0])
+        else:
+            for future in [self._executor.submit(run_chain, chain) for chain in chains]:
+                future.result()
+
+        dispatches = sum(len(chain) for chain in chains)
+        failed = sum(1 for r in results if r["status"] != "ok")
+        with self._lock:
+            self.batches += 1
+            self.calls += len(calls)
+            self.dispatches += dispatches
+            self.errors += failed
+        return {
+            "success": failed == 0,
+            "results": results,
+            "calls": len(calls),
+            "dispatches": dispatches,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+
+    def _dispatch(self, dispatch: Dispatch) -> List[Dict[str, Any]]:
+        """Esegue un dispatch e restituisce l'esito di ciascuna chiamata unita."""
+        first = dispatch.calls[0]
+        entity_id = ",".join(dispatch.entity_ids) or None
+        started = time.perf_counter()
+        try:
+            changed = self.client.call_service(first.domain, first.service, entity_id, **first.data)
+            if changed is None:
+                raise RuntimeError(f"chiamata {first.domain}.{first.service} fallita")
+            error = None
+        except Exception as e:
+            changed, error = [], str(e)
+            logger.warning(f"⚠️ Servizio {first.domain}.{first.service} su {entity_id or '-'} fallito: {e}")
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+
+        if error is None:
+            logger.info(f"🔧 Servizio {first.domain}.{first.service} su {entity_id or '-'} ({len(dispatch.calls)} chiamate)")
+            if self.on_service_call:
+                self.on_service_call(first.domain, first.service)
+
+        changed = changed if isinstance(changed, list) else []
+        outcomes = []
+        for call in dispatch.calls:
+            outcome = {
+                "index": call.index,
+                "domain": call.domain,
+                "service": call.service,
+                "entity_id": call.entity_ids,
+                "status": "ok" if error is None else "error",
+                "dispatch": dispatch.index,
+                "merged": len(dispatch.calls),
+                "duration_ms": elapsed_ms,
+            }
+            if error is None:
+                targets = set(call.entity_ids)
+                outcome["changed"] = [
+                    {"entity_id": s.get("entity_id"), "state": s.get("state")}
+                    for s in changed
+                    if not targets or s.get("entity_id") in targets
+                ]
+            else:
+                outcome["error"] = error
+            outcomes.append(outcome)
+        return outcomes
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "batches": self.batches,
+                "calls": self.calls,
+                "dispatches": self.dispatches,
+                "merged_calls": self.calls - self.dispatches,
+                "errors": self.errors,
+            }
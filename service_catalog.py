@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Catalogo dei servizi Home Assistant, letto una volta e aggiornato per delta.
+
+Il catalogo completo (`GET /api/services`, con descrizioni e selector di
+ogni campo) viene letto all'avvio e normalizzato per dominio. Poi resta
+valido finché non arrivano eventi dal mirror:
+- `service_removed`: il servizio viene tolto localmente, senza richieste;
+- `service_registered`: il catalogo viene riletto dopo `debounce` secondi
+  (un'integrazione registra molti servizi insieme) e si sostituiscono solo
+  i domini cambiati.
+
+Ogni dominio ha un hash del proprio contenuto: l'ETag di
+`/api/ha/services` e la versione usata da chi costruisce schemi o prompt
+cambiano solo se cambiano i domini interessati. Senza mirror (o con il
+WebSocket disconnesso) il catalogo viene riletto al più ogni `ttl` secondi.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SERVICE_EVENTS = ("service_registered", "service_removed")
+
+
+def flatten_fields(fields: Dict[str, Any]) -> Iterable[Tuple[str, Dict[str, Any]]]:
+    """Campi di un servizio come (nome, descrizione), sezioni comprese."""
+    # Le sezioni (es. advanced_fields) contengono a loro volta "fields"
+    for name, field in (fields or {}).items():
+        if isinstance(field, dict) and isinstance(field.get("fields"), dict):
+            yield from flatten_fields(field["fields"])
+        elif isinstance(field, dict):
+            yield name, field
+
+
+def compact_service(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Forma compatta di un servizio: nomi dei campi, obbligatori e target.
+
+    Args:
+        spec: Descrizione del servizio restituita da `get_services()`
+
+    Returns:
+        {"fields": [...], "required": [...], "target": true}, senza le chiavi vuote
+    """
+    compact: Dict[str, Any] = {}
+    fields = sorted(flatten_fields(spec.get("fields") or {}))
+    if fields:
+        compact["fields"] = [name for name, _ in fields]
+        required = [name for name, field in fields if field.get("required")]
+        if required:
+            compact["required"] = required
+    if spec.get("target") is not None:
+        compact["target"] = True
+    return compact
+
+
+def _domain_hash(services: Dict[str, Any]) -> str:
+    payload = json.dumps(services, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class ServiceCatalog:
+    """Servizi HA per dominio, con forma compatta, rendering e hash."""
+
+    def __init__(self, client, mirror=None, ttl: float = 300.0, debounce: float = 2.0):
+        """
+        Args:
+            client: Client HA (espone `get_services()`)
+            mirror: StateMirror opzionale da cui ricevere gli eventi dei servizi
+            ttl: Validità del catalogo senza eventi (mirror assente o disconnesso)
+            debounce: Attesa prima di rileggere dopo `service_registered`
+        """
+        self.client = client
+        self.mirror = mirror
+        self.ttl = ttl
+        self.debounce = debounce
+
+        self._lock = threading.RLock()
+        self._domains: Dict[str, Dict[str, Any]] = {}
+        self._compact: Dict[str, Dict[str, Any]] = {}
+        self._hashes: Dict[str, str] = {}
+        self._loaded_at: Optional[float] = None
+        self._stale = False
+        self._timer: Optional[threading.Timer] = None
+        self._rendered: Dict[Optional[Tuple[str, ...]], Tuple[int, str]] = {}
+
+        self.version = 0
+        self.loads = 0
+        self.load_failures = 0
+        self.domains_changed = 0
+        self.events = 0
+        self.removed_locally = 0
+
+        if mirror is not None:
+            for event_type in SERVICE_EVENTS:
+                mirror.subscribe(event_type, lambda data, kind=event_type: self._on_event(kind, data))
+            mirror.add_resync_listener(self._schedule_refresh)
+
+    # ------------------------------------------------------------------
+    # Letture
+    # ------------------------------------------------------------------
+
+    def get_services(self, domains: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """Servizi nel formato di `GET /api/services`, ordinati per dominio."""
+        return self.snapshot(domains)[1]
+
+    def snapshot(self, domains: Optional[Iterable[str]] = None) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        Versione del catalogo e servizi, letti insieme.
+
+        Raises:
+            RuntimeError: Se il catalogo non è mai stato letto e il
+                Supervisor non risponde
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return self.version, [
+                {"domain": domain, "services": self._domains[domain]}
+                for domain in self._select(domains)
+            ]
+
+    def get_compact(self, domains: Optional[Iterable[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """Forma compatta: dominio → servizio → campi, obbligatori e target."""
+        self._ensure_loaded()
+        with self._lock:
+            return {domain: self._compact[domain] for domain in self._select(domains)}
+
+    def render(self, domains: Optional[Iterable[str]] = None) -> str:
+        """
+        Elenco sintetico per il prompt, una riga per dominio.
+
+        Returns:
+            Righe "dominio: servizio1, servizio2" ordinate per dominio
+        """
+        self._ensure_loaded()
+        key = tuple(sorted(set(domains))) if domains else None
+        with self._lock:
+            cached = self._rendered.get(key)
+            if cached is not None and cached[0] == self.version:
+                return cached[1]
+            lines = [
+                f"{domain}: {', '.join(sorted(self._domains[domain]))}"
+                for domain in self._select(domains)
+                if self._domains[domain]
+            ]
+            text = "\n".join(lines)
+            self._rendered[key] = (self.version, text)
+            return text
+
+    def etag(self, domains: Optional[Iterable[str]] = None) -> str:
+        """Hash dei domini selezionati: cambia solo se cambia uno di essi."""
+        self._ensure_loaded()
+        with self._lock:
+            digest = hashlib.blake2b(digest_size=12)
+            for domain in self._select(domains):
+                digest.update(f"{domain}\0{self._hashes[domain]}\0".encode("utf-8"))
+            return digest.hexdigest()
+
+    def _select(self, domains: Optional[Iterable[str]]) -> List[str]:
+        if not domains:
+            return sorted(self._domains)
+        return sorted(set(domains) & set(self._domains))
+
+    # ------------------------------------------------------------------
+    # Aggiornamenti
+    # ------------------------------------------------------------------
+
+    def refresh(self) -> int:
+        """
+        Rilegge il catalogo e sostituisce i domini cambiati.
+
+        Returns:
+            Numero di domini aggiunti, cambiati o rimossi
+
+        Raises:
+            RuntimeError: Se il Supervisor non risponde e non c'è un catalogo precedente
+        """
+        services = self.client.get_services()
+        with self._lock:
+            if services is None:
+                self.load_failures += 1
+                if self._loaded_at is None:
+                    raise RuntimeError("Impossibile ottenere i servizi di Home Assistant")
+                # Supervisor non raggiungibile: si tiene il catalogo precedente
+                return 0
+
+            fresh = {entry.get("domain"): entry.get("services") or {} for entry in services if entry.get("domain")}
+            changed = 0
+            for domain in set(self._domains) - set(fresh):
+                self._drop_domain(domain)
+                changed += 1
+            for domain, domain_services in fresh.items():
+                domain_hash = _domain_hash(domain_services)
+                if self._hashes.get(domain) != domain_hash:
+                    self._set_domain(domain, domain_services, domain_hash)
+                    changed += 1
+
+            self._loaded_at = time.monotonic()
+            self._stale = False
+            self.loads += 1
+            if changed:
+                self.version += 1
+                self.domains_changed += changed
+        if changed:
+            logger.info(f"🧰 Catalogo servizi aggiornato: {changed} domini cambiati")
+        return changed
+
+    def invalidate(self):
+        """Forza la rilettura alla prossima richiesta."""
+        with self._lock:
+            self._stale = True
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded_at is not None and not self._stale and not self._expired():
+                return
+        self.refresh()
+
+    def _expired(self) -> bool:
+        # Con il WebSocket connesso valgono gli eventi, non il TTL
+        if self.mirror is not None and self.mirror.connected:
+            return False
+        return time.monotonic() - self._loaded_at > self.ttl
+
+    def _set_domain(self, domain: str, services: Dict[str, Any], domain_hash: Optional[str] = None):
+        self._domains[domain] = services
+        self._compact[domain] = {name: compact_service(spec or {}) for name, spec in services.items()}
+        self._hashes[domain] = domain_hash or _domain_hash(services)
+
+    def _drop_domain(self, domain: str):
+        self._domains.pop(domain, None)
+        self._compact.pop(domain, None)
+        self._hashes.pop(domain, None)
+
+    def _on_event(self, kind: str, data: Dict[str, Any]):
+        domain, service = data.get("domain"), data.get("service")
+        if not domain or not service:
+            return
+        with self._lock:
+            self.events += 1
+            if self._loaded_at is None:
+                return
+            if kind == "service_removed":
+                services = self._domains.get(domain)
+                if services is None or service not in services:
+                    return
+                services = {name: spec for name, spec in services.items() if name != service}
+                if services:
+                    self._set_domain(domain, services)
+                else:
+                    self._drop_domain(domain)
+                self.version += 1
+                self.removed_locally += 1
+                return
+        # La descrizione del nuovo servizio non è nell'evento: si rilegge
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        """Rilettura in background dopo `debounce` secondi (eventi raggruppati)."""
+        with self._lock:
+            if self._loaded_at is None or self._timer is not None:
+                return
+            self._timer = threading.Timer(self.debounce, self._background_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f"⚠️ Aggiornamento catalogo servizi fallito: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "domains": len(self._domains),
+                "services": sum(len(services) for services in self._domains.values()),
+                "version": self.version,
+                "loads": self.loads,
+                "load_failures": self.load_failures,
+                "domains_changed": self.domains_changed,
+                "events": self.events,
+                "removed_locally": self.removed_locally,
+                "age_s": round(time.monotonic() - self._loaded_at, 1) if self._loaded_at is not None else None,
+            }
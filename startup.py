@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Orchestrazione dell'avvio dell'add-on.
+
+L'API parte subito, prima che il modello sia scaricato e caricato, e
+riporta la fase corrente in `/api/health`:
+
+    starting → downloading → loading → warming → ready
+
+- downloading / loading: lette dal file di stato scritto da run.sh
+  (download del modello, avvio di llama-server) e dalle risposte di
+  `/health` di llama-server (503 "Loading model");
+- warming: una generazione di prova per slot, che carica i pesi e
+  lascia in KV cache il prefisso del prompt di `/api/chat`;
+- ready: l'evento di prontezza viene segnalato a chi è in attesa.
+
+Il controllo di llama-server usa un backoff esponenziale, ripartendo dal
+minimo a ogni cambio di fase del file di stato. Il timeout conta solo
+dalla fine del download; scaduto, il servizio passa a "failed" ma i
+controlli proseguono e una risposta positiva tardiva lo riporta verso
+"ready". Stati, servizi e
+configurazione HA vengono letti in parallelo, mentre il modello si
+carica, così le cache sono già pronte alla prima richiesta.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("starting", "downloading", "loading", "warming", "ready")
+FAILED = "failed"
+
+# File di stato scritto da run.sh (fase, modello, dimensione attesa)
+STATUS_FILE = os.environ.get("ADDON_STATUS_FILE", "/tmp/llamacpp_status.json")
+
+
+class Backoff:
+    """Attese crescenti esponenzialmente tra `initial` e `maximum` secondi."""
+
+    def __init__(self, initial: float = 0.25, maximum: float = 5.0, factor: float = 2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self._next = initial
+
+    def next(self) -> float:
+        delay = self._next
+        self._next = min(self._next * self.factor, self.maximum)
+        return delay
+
+    def reset(self):
+        self._next = self.initial
+
+
+def read_status_file(path: str = STATUS_FILE) -> Optional[Dict[str, Any]]:
+    """Contenuto del file di stato di run.sh, o None se assente o incompleto."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class StartupOrchestrator:
+    """Porta il servizio da avviato a pronto e ne traccia le fasi."""
+
+    def __init__(
+        self,
+        probe: Callable[[], Tuple[bool, Optional[str]]],
+        warmup: Optional[Callable[[], Dict[str, Any]]] = None,
+        prefetch: Optional[Dict[str, Callable[[], Any]]] = None,
+        status_file: str = STATUS_FILE,
+        backoff: Optional[Backoff] = None,
+        prefetch_timeout: float = 30.0,
+        timeout: float = 0.0
+    ):
+        """
+        Args:
+            probe: Controllo di llama-server: (pronto, motivo se non pronto);
+                il motivo "loading" indica il caricamento del modello
+            warmup: Generazione di riscaldamento, restituisce un riepilogo
+            prefetch: Letture da eseguire in parallelo all'avvio (nome → funzione)
+            status_file: File di stato di run.sh
+            backoff: Attese tra i controlli di llama-server
+            prefetch_timeout: Attesa massima delle letture prima di "ready"
+            timeout: Secondi massimi per raggiungere llama-server dopo il
+                download del modello (0 = nessun limite)
+        """
+        self.probe = probe
+        self.warmup = warmup
+        self.prefetch = prefetch or {}
+        self.status_file = status_file
+        self.backoff = backoff or Backoff()
+        self.prefetch_timeout = prefetch_timeout
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = time.monotonic()
+        self.phase = "starting"
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self._phase_started = self._started
+        self.probes = 0
+        self.download: Optional[Dict[str, Any]] = None
+        self.prefetched: Dict[str, Dict[str, Any]] = {}
+        self.warmup_result: Optional[Dict[str, Any]] = None
+
+    # ------------------------------------------------------------------
+    # Interfaccia
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Avvia l'orchestrazione in un thread in background."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="startup", daemon=True)
+            self._thread.start()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Attende la fase "ready" (True se raggiunta entro il timeout)."""
+        return self._ready.wait(timeout)
+
+    def notify(self):
+        """Sveglia subito il controllo (es. dopo un cambio del file di stato)."""
+        self._wake.set()
+
+    def retry_after(self) -> int:
+        """Secondi suggeriti ai client per riprovare (header Retry-After)."""
+        return 2 if self.phase == "warming" else 10 if self.phase == "downloading" else 5
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            timings = dict(self.timings)
+            if self.phase not in ("ready", FAILED):
+                timings[self.phase] = time.monotonic() - self._phase_started
+            stats = {
+                "phase": self.phase,
+                "ready": self.ready,
+                "uptime_s": round(time.monotonic() - self._started, 1),
+                "time_to_ready_s": round(self.timings["total"], 2) if "total" in self.timings else None,
+                "phases_s": {name: round(value, 2) for name, value in timings.items() if name != "total"},
+                "llama_probes": self.probes,
+                "prefetch": dict(self.prefetched),
+                "warmup": self.warmup_result,
+                "error": self.error,
+            }
+        download = self._download_progress()
+        if download:
+            stats["download"] = download
+        return stats
+
+    # ------------------------------------------------------------------
+    # Fasi
+    # ------------------------------------------------------------------
+
+    def _set_phase(self, phase: str):
+        with self._lock:
+            if phase == self.phase:
+                return
+            now = time.monotonic()
+            self.timings[self.phase] = self.timings.get(self.phase, 0.0) + now - self._phase_started
+            previous, self.phase, self._phase_started = self.phase, phase, now
+        logger.info("🚦 Avvio: %s → %s (%.1fs)", previous, phase, self.timings[previous])
+
+    def _run(self):
+        executor = ThreadPoolExecutor(max_workers=max(len(self.prefetch), 1), thread_name_prefix="startup-prefetch")
+        futures = [executor.submit(self._prefetch_one, name, fn) for name, fn in self.prefetch.items()]
+        try:
+            if not self._wait_llama():
+                return
+            self._set_phase("warming")
+            if self.warmup is not None:
+                self._run_warmup()
+            # Il riscaldamento usa le cache appena lette: di solito sono già pronte
+            wait(futures, timeout=self.prefetch_timeout)
+            self._set_phase("ready")
+            with self._lock:
+                self.timings["total"] = time.monotonic() - self._started
+            self._ready.set()
+            logger.info("✅ Servizio pronto in %.1fs", self.timings["total"])
+        except Exception as e:
+            self._fail(f"Errore durante l'avvio: {e}")
+        finally:
+            executor.shutdown(wait=False)
+
+    def _wait_llama(self) -> bool:
+        """Attende llama-server con backoff; aggiorna downloading/loading."""
+        last_file_phase = None
+        # Il download può durare ore: il timeout parte quando è finito
+        clock_started: Optional[float] = None
+        while True:
+            status = read_status_file(self.status_file) or {}
+            file_phase = status.get("phase")
+            if file_phase != last_file_phase:
+                # Nuova fase di run.sh: si ricomincia dai controlli ravvicinati
+                last_file_phase = file_phase
+                self.backoff.reset()
+            if file_phase == "downloading":
+                clock_started = None
+                self.download = status
+                if self.phase != FAILED:
+                    self._set_phase("downloading")
+            elif file_phase == "failed":
+                self._fail(status.get("error") or "Avvio fallito in run.sh")
+                return False
+
+            if file_phase != "downloading":
+                if clock_started is None:
+                    clock_started = time.monotonic()
+                ok, reason = self.probe()
+                with self._lock:
+                    self.probes += 1
+                if ok:
+                    if self.phase == FAILED:
+                        logger.info("♻️ llama-server raggiungibile dopo il timeout: avvio ripreso")
+                        with self._lock:
+                            self.error = None
+                    return True
+                if (reason == "loading" or file_phase == "loading") and self.phase != FAILED:
+                    self._set_phase("loading")
+
+            if (
+                self.timeout and clock_started is not None and self.phase != FAILED
+                and time.monotonic() - clock_started > self.timeout
+            ):
+                # Si continua a controllare: llama-server può ancora arrivare
+                self._fail(f"llama-server non disponibile dopo {self.timeout:.0f}s")
+            self._wake.wait(self.backoff.next())
+            self._wake.clear()
+
+    def _run_warmup(self):
+        started = time.perf_counter()
+        try:
+            result = self.warmup() or {}
+            result["duration_s"] = round(time.perf_counter() - started, 2)
+            logger.info("🔥 Riscaldamento modello completato in %.1fs", result["duration_s"])
+        except Exception as e:
+            # Un riscaldamento fallito non blocca il servizio
+            result = {"error": str(e), "duration_s": round(time.perf_counter() - started, 2)}
+            logger.warning(f"⚠️ Riscaldamento modello fallito: {e}")
+        with self._lock:
+            self.warmup_result = result
+
+    def _prefetch_one(self, name: str, fn: Callable[[], Any]):
+        started = time.perf_counter()
+        try:
+            fn()
+            entry = {"ok": True}
+        except Exception as e:
+            entry = {"ok": False, "error": str(e)}
+            logger.warning(f"⚠️ Lettura anticipata '{name}' fallita: {e}")
+        entry["duration_s"] = round(time.perf_counter() - started, 3)
+        with self._lock:
+            self.prefetched[name] = entry
+
+    def _fail(self, error: str):
+        logger.error(f"❌ {error}")
+        with self._lock:
+            self.error = error
+        self._set_phase(FAILED)
+
+    def _download_progress(self) -> Optional[Dict[str, Any]]:
+        """Byte scaricati (dimensione del file parziale) rispetto al totale atteso."""
+        status = self.download
+        if not status or self.phase != "downloading":
+            return None
+        progress = {"model": status.get("model")}
+        partial = status.get("partial_path")
+        total = status.get("total_bytes") or 0
+        try:
+            done = os.path.getsize(partial) if partial else 0
+        except OSError:
+            done = 0
+        progress["downloaded_bytes"] = done
+        if total:
+            progress["total_bytes"] = total
+            progress["percent"] = round(min(done / total, 1.0) * 100, 1)
+        return progress
+
+
+def llama_probe(get: Callable[[], Any]) -> Callable[[], Tuple[bool, Optional[str]]]:
+    """
+    Controllo di `/health` di llama-server.
+
+    Args:
+        get: Funzione che esegue la GET su /health e restituisce la risposta
+
+    Returns:
+        Funzione () -> (pronto, "loading" | "unreachable" | "error")
+    """
+    def probe() -> Tuple[bool, Optional[str]]:
+        try:
+            response = get()
+        except Exception:
+            return False, "unreachable"
+        if response.status_code == 200:
+            return True, None
+        # llama-server risponde 503 mentre carica il modello
+        return False, "loading" if response.status_code == 503 else "error"
+    return probe
+
+
+def warm_slots(
+    complete: Callable[[List[Dict[str, str]], int], Dict[str, Any]],
+    messages: List[Dict[str, str]],
+    slots: int
+) -> Dict[str, Any]:
+    """
+    Una generazione breve per slot con lo stesso prompt, in parallelo.
+
+    Args:
+        complete: Funzione (messaggi, slot) → risposta di llama-server
+        messages: Prompt di riscaldamento
+        slots: Numero di slot di llama-server
+
+    Returns:
+        Riepilogo: slot scaldati e token di prompt valutati
+    """
+    slots = max(slots, 1)
+    with ThreadPoolExecutor(max_workers=slots, thread_name_prefix="startup-warmup") as executor:
+        results = list(executor.map(lambda slot: complete(messages, slot), range(slots)))
+    evaluated = sum((result.get("timings") or {}).get("prompt_n") or 0 for result in results)
+    return {"slots": slots, "prompt_tokens": evaluated}
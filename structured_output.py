@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Risposte strutturate (JSON) vincolate da grammatica.
+
+Lo schema JSON di una richiesta viene compilato una sola volta per hash:
+validatore `jsonschema` e grammatica GBNF per llama-server, che durante
+il campionamento scarta i token che renderebbero l'output non conforme.
+Per i costrutti che la conversione locale non gestisce (pattern, limiti
+numerici, $ref, ...) lo schema viene passato a llama-server come
+`json_schema` e convertito lì.
+
+L'output viene validato una sola volta: con la grammatica l'unico caso
+non valido è la risposta troncata da `max_tokens`, che un nuovo tentativo
+non risolverebbe.
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from jsonschema import Draft202012Validator
+from jsonschema.exceptions import SchemaError as _JSONSchemaError
+
+# Primitive della grammatica (stessa forma delle grammatiche JSON di llama.cpp)
+PRIMITIVES = {
+    "space": '| " " | "\\n" [ \\t]{0,20}',
+    "char": '[^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\bfnrt] | "u" [0-9a-fA-F]{4})',
+    "integral-part": '[0] | [1-9] [0-9]{0,15}',
+    "decimal-part": '[0-9]{1,16}',
+    "string": '"\\"" char* "\\"" space',
+    "number": '("-"? integral-part) ("." decimal-part)? ([eE] [-+]? integral-part)? space',
+    "integer": '("-"? integral-part) space',
+    "boolean": '("true" | "false") space',
+    "null": '"null" space',
+    "object": '"{" space ( string ":" space value ( "," space string ":" space value )* )? "}" space',
+    "array": '"[" space ( value ( "," space value )* )? "]" space',
+    "value": 'object | array | string | number | boolean | null',
+}
+
+# Dipendenze tra primitive (per includere solo le regole usate)
+PRIMITIVE_DEPS = {
+    "string": ("char", "space"),
+    "number": ("integral-part", "decimal-part", "space"),
+    "integer": ("integral-part", "space"),
+    "boolean": ("space",),
+    "null": ("space",),
+    "object": ("string", "value", "space"),
+    "array": ("value", "space"),
+    "value": ("object", "array", "string", "number", "boolean", "null"),
+}
+
+# Parole chiave senza effetto sulla forma dell'output
+ANNOTATIONS = {"title", "description", "default", "examples", "$schema", "$id", "$comment", "additionalProperties"}
+
+# Parole chiave convertite localmente; il resto passa a llama-server
+SUPPORTED = ANNOTATIONS | {
+    "type", "properties", "required", "items", "minItems", "maxItems",
+    "enum", "const", "anyOf", "minLength", "maxLength",
+}
+
+_RULE_NAME_RE = re.compile(r"[^a-zA-Z0-9-]+")
+
+
+class SchemaError(ValueError):
+    """Schema JSON non valido."""
+
+
+class StructuredOutputError(Exception):
+    """Risposta del modello non conforme allo schema."""
+
+    def __init__(self, message: str, text: str, finish_reason: Optional[str] = None):
+        super().__init__(message)
+        self.text = text
+        self.finish_reason = finish_reason
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _literal(value: Any) -> str:
+    """Valore JSON come letterale GBNF."""
+    text = json.dumps(value, ensure_ascii=False)
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '" space'
+
+
+class _GrammarBuilder:
+    def __init__(self):
+        self.rules: "OrderedDict[str, str]" = OrderedDict()
+        self.primitives: set = set()
+
+    def primitive(self, name: str) -> str:
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            if current not in self.primitives:
+                self.primitives.add(current)
+                pending.extend(PRIMITIVE_DEPS.get(current, ()))
+        return name
+
+    def add(self, name: str, body: str) -> str:
+        name = _RULE_NAME_RE.sub("-", name).strip("-") or "rule"
+        for existing, existing_body in self.rules.items():
+            if existing_body == body:
+                return existing
+        candidate, index = name, 1
+        while candidate in self.rules or candidate in PRIMITIVES:
+            index += 1
+            candidate = f"{name}-{index}"
+        self.rules[candidate] = body
+        return candidate
+
+    def visit(self, schema: Any, name: str) -> str:
+        if schema is True or schema == {}:
+            return self.primitive("value")
+        if not isinstance(schema, dict):
+            raise _Unsupported()
+        unsupported = set(schema) - SUPPORTED
+        if unsupported:
+            raise _Unsupported()
+
+        if "const" in schema:
+            return self.add(name, _literal(schema["const"]))
+        if "enum" in schema:
+            return self.add(name, " | ".join(_literal(v) for v in schema["enum"]))
+        if "anyOf" in schema:
+            options = [self.visit(s, f"{name}-{i}") for i, s in enumerate(schema["anyOf"])]
+            return self.add(name, " | ".join(options))
+
+        kind = schema.get("type")
+        if isinstance(kind, list):
+            options = [self.visit({**schema, "type": k}, f"{name}-{k}") for k in kind]
+            return self.add(name, " | ".join(options))
+        if kind is None:
+            if "properties" in schema:
+                kind = "object"
+            elif "items" in schema:
+                kind = "array"
+            else:
+                return self.primitive("value")
+
+        if kind == "string":
+            if "minLength" in schema or "maxLength" in schema:
+                low = int(schema.get("minLength", 0))
+                high = schema.get("maxLength")
+                repeat = f"{{{low},{'' if high is None else int(high)}}}"
+                self.primitive("char")
+                self.primitive("space")
+                return self.add(name, f'"\\"" char{repeat} "\\"" space')
+            return self.primitive("string")
+        if kind in ("number", "integer", "boolean", "null"):
+            return self.primitive(kind)
+        if kind == "object":
+            return self._object(schema, name)
+        if kind == "array":
+            return self._array(schema, name)
+        raise _Unsupported()
+
+    def _object(self, schema: Dict[str, Any], name: str) -> str:
+        properties = schema.get("properties") or {}
+        required = [p for p in schema.get("required", []) if p in properties]
+        if any(p not in properties for p in schema.get("required", [])):
+            raise _Unsupported()
+        if not properties:
+            if schema.get("additionalProperties") is False:
+                self.primitive("space")
+                return self.add(name, '"{" space "}" space')
+            return self.primitive("object")
+
+        self.primitive("space")
+        pairs = {}
+        for prop, prop_schema in properties.items():
+            value = self.visit(prop_schema, f"{name}-{prop}")
+            pairs[prop] = self.add(f"{name}-{prop}-kv", f'{_literal(prop)} ":" space {value}')
+        # Proprietà nell'ordine dello schema: obbligatorie, poi facoltative
+        mandatory = [pairs[p] for p in properties if p in required]
+        optional = [pairs[p] for p in properties if p not in required]
+        if mandatory:
+            body = ' "," space '.join(mandatory) + "".join(f' ( "," space {o} )?' for o in optional)
+        else:
+            body = "( " + optional[0] + "".join(f' ( "," space {o} )?' for o in optional[1:]) + " )?"
+        return self.add(name, f'"{{" space {body} "}}" space')
+
+    def _array(self, schema: Dict[str, Any], name: str) -> str:
+        item = self.visit(schema.get("items", True), f"{name}-item")
+        low = int(schema.get("minItems", 0))
+        high = schema.get("maxItems")
+        self.primitive("space")
+        if high is not None and int(high) == 0:
+            return self.add(name, '"[" space "]" space')
+        rest_high = "" if high is None else str(int(high) - 1)
+        rest = "" if rest_high == "0" else f' ( "," space {item} ){{{max(low - 1, 0)},{rest_high}}}'
+        if low == 0:
+            return self.add(name, f'"[" space ( {item}{rest} )? "]" space')
+        return self.add(name, f'"[" space {item}{rest} "]" space')
+
+    def render(self, root: str) -> str:
+        lines = [f"root ::= {root}"]
+        lines += [f"{rule} ::= {body}" for rule, body in self.rules.items()]
+        lines += [f"{rule} ::= {PRIMITIVES[rule]}" for rule in PRIMITIVES if rule in self.primitives]
+        return "\n".join(lines) + "\n"
+
+
+def schema_to_grammar(schema: Dict[str, Any]) -> Optional[str]:
+    """
+    Converte uno schema JSON in grammatica GBNF per llama-server.
+
+    Args:
+        schema: Schema JSON
+
+    Returns:
+        Grammatica, o None se lo schema usa costrutti non gestiti
+        localmente (viene allora passato a llama-server come `json_schema`)
+    """
+    builder = _GrammarBuilder()
+    try:
+        root = builder.visit(schema, "root-value")
+    except (_Unsupported, TypeError, ValueError):
+        return None
+    return builder.render(root)
+
+
+class CompiledSchema:
+    """Schema compilato: validatore e parametri per llama-server."""
+
+    __slots__ = ("hash", "schema", "validator", "grammar", "_instructions")
+
+    def __init__(self, schema_hash: str, schema: Dict[str, Any]):
+        self.hash = schema_hash
+        self.schema = schema
+        self.validator = Draft202012Validator(schema)
+        self.grammar = schema_to_grammar(schema)
+        self._instructions = (
+            "Rispondi solo con JSON conforme a questo schema: "
+            + json.dumps(schema, ensure_ascii=False, separators=(",", ":"))
+        )
+
+    def llama_params(self) -> Dict[str, Any]:
+        """Parametri del vincolo da aggiungere alla richiesta a llama-server."""
+        if self.grammar is not None:
+            return {"grammar": self.grammar}
+        return {"json_schema": self.schema}
+
+    def instructions(self) -> str:
+        """Istruzione da aggiungere al messaggio utente (i nomi dei campi aiutano il modello)."""
+        return self._instructions
+
+    def parse(self, text: str, finish_reason: Optional[str] = None) -> Any:
+        """
+        Decodifica e valida la risposta del modello.
+
+        Raises:
+            StructuredOutputError: JSON non valido o non conforme allo schema
+        """
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            reason = " (risposta troncata da max_tokens)" if finish_reason == "length" else ""
+            raise StructuredOutputError(f"JSON non valido{reason}: {e}", text, finish_reason)
+        error = next(iter(self.validator.iter_errors(data)), None)
+        if error is not None:
+            path = "/".join(str(p) for p in error.absolute_path) or "(radice)"
+            raise StructuredOutputError(
+                f"Risposta non conforme allo schema in {path}: {error.message}", text, finish_reason
+            )
+        return data
+
+
+class SchemaCompiler:
+    """Cache LRU degli schemi compilati, per hash dello schema."""
+
+    def __init__(self, max_entries: int = 128):
+        """
+        Args:
+            max_entries: Schemi compilati conservati
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._compiled: "OrderedDict[str, CompiledSchema]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0
+        self.grammar_schemas = 0
+        self.server_schemas = 0
+
+    @staticmethod
+    def schema_hash(schema: Dict[str, Any]) -> str:
+        canonical = json.dumps(schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+    def compile(self, schema: Any) -> CompiledSchema:
+        """
+        Schema compilato (dalla cache se già visto).
+
+        Raises:
+            SchemaError: Se lo schema non è un oggetto JSON Schema valido
+        """
+        if not isinstance(schema, dict):
+            raise SchemaError("'json_schema' deve essere un oggetto JSON Schema")
+        key = self.schema_hash(schema)
+        with self._lock:
+            compiled = self._compiled.get(key)
+            if compiled is not None:
+                self._compiled.move_to_end(key)
+                self.hits += 1
+                return compiled
+
+        started = time.perf_counter()
+        try:
+            Draft202012Validator.check_schema(schema)
+        except _JSONSchemaError as e:
+            raise SchemaError(f"Schema JSON non valido: {e.message}")
+        compiled = CompiledSchema(key, schema)
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self.misses += 1
+            self.compile_time += elapsed
+            if compiled.grammar is not None:
+                self.grammar_schemas += 1
+            else:
+                self.server_schemas += 1
+            self._compiled[key] = compiled
+            while len(self._compiled) > self.max_entries:
+                self._compiled.popitem(last=False)
+        return compiled
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "schemas": len(self._compiled),
+                "hits": self.hits,
+                "misses": self.misses,
+                "compile_avg_ms": round(1000 * self.compile_time / self.misses, 2) if self.misses else 0.0,
+                "grammar": self.grammar_schemas,
+                "server_json_schema": self.server_schemas,
+            }
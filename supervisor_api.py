@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Accesso diretto alla API di Home Assistant tramite Supervisor.
+Usa il pool HTTP condiviso e il token SUPERVISOR_TOKEN dell'addon.
+"""
+
+import os
+from typing import Any, Dict, Optional
+
+from http_pool import HTTPPool
+
+# Endpoint esposti dal Supervisor per il Core di Home Assistant
+SUPERVISOR_API_URL = os.environ.get("SUPERVISOR_API_URL", "http://supervisor/core/api")
+SUPERVISOR_WS_URL = os.environ.get("SUPERVISOR_WS_URL", "ws://supervisor/core/websocket")
+
+
+class SupervisorAPI:
+    """Client REST minimale per la Core API via Supervisor."""
+
+    def __init__(
+        self,
+        pool: HTTPPool,
+        base_url: str = SUPERVISOR_API_URL,
+        ws_url: str = SUPERVISOR_WS_URL,
+        token: Optional[str] = None
+    ):
+        """
+        Inizializza il client.
+
+        Args:
+            pool: Pool HTTP condiviso
+            base_url: URL base della REST API (senza slash finale)
+            ws_url: URL della WebSocket API
+            token: Token di accesso (default: variabile SUPERVISOR_TOKEN)
+        """
+        self.pool = pool
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = ws_url
+        self.token = token if token is not None else os.environ.get("SUPERVISOR_TOKEN", "")
+
+    @property
+    def available(self) -> bool:
+        """True se è disponibile un token per la Supervisor API."""
+        return bool(self.token)
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+        }
+
+    def get(self, path: str, **kwargs) -> Any:
+        """
+        Esegue una GET e restituisce il JSON decodificato.
+
+        Raises:
+            requests.exceptions.RequestException: In caso di errore HTTP
+        """
+        response = self.pool.get(
+            f"{self.base_url}{path}", endpoint="supervisor", headers=self.headers, **kwargs
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, path: str, payload: Optional[Dict[str, Any]] = None, **kwargs) -> Any:
+        """
+        Esegue una POST e restituisce il JSON decodificato.
+
+        Raises:
+            requests.exceptions.RequestException: In caso di errore HTTP
+        """
+        response = self.pool.post(
+            f"{self.base_url}{path}", endpoint="supervisor", headers=self.headers,
+            json=payload or {}, **kwargs
+        )
+        response.raise_for_status()
+        return response.json()
+
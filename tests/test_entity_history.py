@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Test della cache della storia (entity_history) contro il Supervisor finto
+dei benchmark: storia sintetica via REST e statistiche via WebSocket.
+
+Eseguire dalla radice del repository:
+    python3 tests/test_entity_history.py
+"""
+
+import math
+import os
+import sys
+import time
+import unittest
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from entity_history import HistoryCache, parse_period  # noqa: E402
+from fake_supervisor import FakeSupervisor  # noqa: E402
+from ha_state_mirror import StateMirror  # noqa: E402
+from http_pool import HTTPPool  # noqa: E402
+from recorder import RecorderClient  # noqa: E402
+from supervisor_api import SupervisorAPI  # noqa: E402
+
+HOUR = 3600
+DAY = 86400
+
+
+class TestHistoryCache(unittest.TestCase):
+    """HistoryCache con recorder e mirror reali verso il Supervisor finto."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.supervisor = FakeSupervisor(entities=80, event_rate=0).start()
+        cls.api = SupervisorAPI(
+            HTTPPool(), base_url=cls.supervisor.api_url, ws_url=cls.supervisor.ws_url, token="test"
+        )
+        cls.mirror = StateMirror(cls.api)
+        cls.mirror.start()
+        assert cls.mirror.wait_ready(10), "mirror non pronto"
+        states = cls.supervisor.states.values()
+        cls.energy = sorted(
+            s["entity_id"] for s in states if s["attributes"].get("state_class") == "total_increasing"
+        )
+        cls.temperature = next(
+            s["entity_id"] for s in states if s["attributes"].get("device_class") == "temperature"
+        )
+        cls.binary = next(s["entity_id"] for s in states if s["entity_id"].startswith("binary_sensor."))
+        # Intervalli chiusi nel passato: nessun aggiornamento live
+        cls.base = math.floor(time.time() / HOUR) * HOUR - DAY
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mirror.stop()
+        cls.supervisor.stop()
+
+    def cache(self, **kwargs) -> HistoryCache:
+        return HistoryCache(RecorderClient(self.api), self.mirror, **kwargs)
+
+    def test_incremental_fetch_reads_only_missing_ranges(self):
+        """Estendere l'intervallo legge dal recorder solo i tratti nuovi."""
+        cache = self.cache()
+        cache.aggregate(self.temperature, self.base - 2 * DAY, self.base - DAY)
+        self.assertEqual(cache.fetches, 1)
+
+        requests = self.supervisor.history_requests
+        cache.aggregate(self.temperature, self.base - 3 * DAY, self.base)
+        # Un tratto prima e uno dopo quello già in cache
+        self.assertEqual(cache.fetches, 3)
+        self.assertEqual(self.supervisor.history_requests - requests, 2)
+
+        cache.aggregate(self.temperature, self.base - 3 * DAY + HOUR, self.base - HOUR)
+        self.assertEqual(cache.fetches, 3)
+        self.assertEqual(cache.hits, 1)
+
+        fresh = self.cache().aggregate(self.temperature, self.base - 3 * DAY, self.base)
+        merged = cache.aggregate(self.temperature, self.base - 3 * DAY, self.base)
+        self.assertAlmostEqual(merged["mean"], fresh["mean"], places=4)
+        self.assertEqual(merged["min"], fresh["min"])
+        self.assertEqual(merged["max"], fresh["max"])
+
+    def test_compaction_keeps_integrals_and_counter_totals(self):
+        """Una settimana al minuto, compattata, conserva media e totali."""
+        start, end = self.base - 7 * DAY, self.base
+        for entity_id, field in ((self.temperature, "mean"), (self.energy[0], "change")):
+            full = self.cache(max_points=10 ** 6).aggregate(entity_id, start, end, buckets=7)
+            compact_cache = self.cache(max_points=2000)
+            compact = compact_cache.aggregate(entity_id, start, end, buckets=7)
+
+            self.assertGreater(compact_cache.compactions, 0)
+            self.assertLessEqual(compact_cache.get_stats()["points"], 2000)
+            self.assertAlmostEqual(compact[field], full[field], delta=abs(full[field]) * 1e-5)
+            self.assertEqual(compact["min"], full["min"])
+            self.assertEqual(compact["max"], full["max"])
+            # Un gruppo compattato a cavallo di due bucket sposta l'incremento
+            # nell'uno o nell'altro: i bucket sono vicini, la somma è esatta
+            for compacted, exact in zip(compact["buckets"], full["buckets"]):
+                self.assertAlmostEqual(compacted[field], exact[field], delta=abs(exact[field]) * 0.05)
+            self.assertAlmostEqual(
+                sum(b[field] for b in compact["buckets"]), sum(b[field] for b in full["buckets"]), places=2
+            )
+
+    def test_counter_reset_counts_the_new_value(self):
+        """Un calo di un contatore total_increasing è un azzeramento."""
+        entity_id = self.energy[-1]
+        start = self.base - DAY
+        points = [(start + i * 600, 100.0 + i) for i in range(11)]
+        points += [(start + (11 + i) * 600, float(i)) for i in range(6)]
+        self.supervisor.set_history(entity_id, points)
+        try:
+            result = self.cache().aggregate(entity_id, start, start + 20 * 600, buckets=2)
+        finally:
+            self.supervisor.set_history(entity_id, None)
+        self.assertEqual(result["kind"], "counter")
+        # +10 fino all'azzeramento, +0 al nuovo valore 0, poi +5
+        self.assertAlmostEqual(result["change"], 15.0)
+        self.assertAlmostEqual(sum(b["change"] for b in result["buckets"]), 15.0)
+
+    def test_old_ranges_use_statistics(self):
+        """Oltre la conservazione del recorder si usano le statistiche."""
+        cache = self.cache(raw_days=10)
+        requests = self.supervisor.history_requests
+        result = cache.aggregate(self.energy[0], self.base - 30 * DAY, self.base - 20 * DAY, buckets=4)
+        self.assertEqual(result["source"], "statistics")
+        self.assertGreater(result["change"], 0)
+        self.assertEqual(self.supervisor.history_requests, requests)
+
+        # Intervallo chiuso: la seconda richiesta viene dalla cache
+        cache.aggregate(self.energy[0], self.base - 30 * DAY, self.base - 20 * DAY, buckets=4)
+        self.assertEqual(cache.statistics_hits, 1)
+
+    def test_old_ranges_without_statistics_fall_back_to_history(self):
+        """Senza statistiche (nessuna state_class) si legge la storia."""
+        cache = self.cache(raw_days=10)
+        result = cache.aggregate(self.binary, self.base - 12 * DAY, self.base - 11 * DAY)
+        self.assertEqual(result["source"], "history")
+        self.assertEqual(result["kind"], "binary")
+        self.assertEqual(cache.fetches, 1)
+
+
+class TestParsePeriod(unittest.TestCase):
+    """Periodi citati nelle domande."""
+
+    NOW = datetime(2026, 10, 18, 15, 30, tzinfo=timezone.utc)
+
+    def check(self, text, start, end, label):
+        period = parse_period(text, self.NOW)
+        self.assertIsNotNone(period, text)
+        self.assertEqual((period[0].isoformat(), period[1].isoformat(), period[2]), (start, end, label))
+
+    def test_relative_periods(self):
+        self.check("temperatura ultime 6 ore", "2026-10-18T09:30:00+00:00", "2026-10-18T15:30:00+00:00", "ultime 6 ore")
+        self.check("last 3 days", "2026-10-15T15:30:00+00:00", "2026-10-18T15:30:00+00:00", "ultimi 3 giorni")
+        self.check("ultima settimana", "2026-10-11T15:30:00+00:00", "2026-10-18T15:30:00+00:00", "ultima settimana")
+
+    def test_calendar_periods(self):
+        self.check("quanta energia ieri?", "2026-10-17T00:00:00+00:00", "2026-10-18T00:00:00+00:00", "ieri")
+        self.check("oggi", "2026-10-18T00:00:00+00:00", "2026-10-18T15:30:00+00:00", "oggi")
+        # "last week" è la settimana di calendario precedente
+        self.check("last week energy", "2026-10-05T00:00:00+00:00", "2026-10-12T00:00:00+00:00", "settimana scorsa")
+        self.check("consumi del mese scorso", "2026-09-01T00:00:00+00:00", "2026-10-01T00:00:00+00:00", "mese scorso")
+        self.check("questo mese", "2026-10-01T00:00:00+00:00", "2026-10-18T15:30:00+00:00", "questo mese")
+
+    def test_no_period(self):
+        self.assertIsNone(parse_period("ciao", self.NOW))
+        self.assertIsNone(parse_period("accendi la luce", self.NOW))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)